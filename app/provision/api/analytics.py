@@ -0,0 +1,305 @@
+"""
+Provisioning analytics: fetch counters and per-device last-seen data, kept in
+aggregate tables so the ops dashboard never scans core.Provisioning.
+
+download_config calls record() once per response. record() only bumps counters in
+memory (a dict under a lock); a daemon thread writes them every
+settings.PROVISION_ANALYTICS_FLUSH_SECONDS into:
+
+- core.ProvisioningStat: fetches per (minute, vendor, model, version, status),
+  incremented with UPDATE ... SET count = count + n (INSERT for new keys);
+- core.DeviceLastSeen: last fetch per MAC (firmware from the User-Agent, status),
+  upserted with bulk_create(update_conflicts=True).
+
+Rows older than settings.PROVISION_ANALYTICS_RETENTION_DAYS are pruned while flushing.
+Raw core.Provisioning rows saved by other code feed the same counters (api.signals),
+and `manage.py rebuild_provisioning_stats` rebuilds the tables from them.
+
+dashboard() computes the ops dashboard (fetches per minute, failure rate by status,
+top failing models, devices not seen in N days, firmware distribution) from the
+aggregate tables; results are cached in the 'analytics' namespace of api.cache.
+
+Counters not flushed yet are lost if the process is killed (SIGKILL); a normal
+exit flushes them (atexit).
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from api.cache import provision_cache
+
+logger = logging.getLogger(__name__)
+
+STATUS_OK = "ok"
+STATUS_FORBIDDEN = "forbidden"
+STATUS_ERROR = "error"
+
+_lock = threading.Lock()
+_counts = defaultdict(int)  # (bucket, vendor, model, version, status) -> fetches
+_seen = {}  # mac -> (vendor, model, version, status, when)
+_flusher_pid = None
+_last_prune = 0.0
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _field(value):
+    return (value or "")[:50]
+
+
+def record(vendor="", model="", version="", status=STATUS_OK, mac_address="", when=None):
+    """Count one fetch (and the device's last contact when mac_address is known). Cheap: memory only."""
+    if not _setting("PROVISION_ANALYTICS", True):
+        return
+    when = when or timezone.now()
+    key = (when.replace(second=0, microsecond=0), _field(vendor), _field(model), _field(version), status)
+    with _lock:
+        _counts[key] += 1
+        if mac_address:
+            seen = _seen.get(mac_address)
+            if seen is None or seen[4] <= when:
+                _seen[mac_address] = key[1:] + (when,)
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+
+def _start_flusher():
+    """One flush thread per process (gunicorn workers are forked after the app is loaded)."""
+    global _flusher_pid
+    interval = _setting("PROVISION_ANALYTICS_FLUSH_SECONDS", 10)
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    atexit.register(_flush_quietly)
+    if interval > 0:
+        threading.Thread(target=_flush_loop, args=(interval,), name="provision-analytics", daemon=True).start()
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        close_old_connections()
+        _flush_quietly()
+        close_old_connections()
+
+
+def _flush_quietly():
+    try:
+        flush()
+    except Exception as exc:
+        logger.warning("Failed to flush provisioning analytics: %s", exc)
+
+
+def pending() -> dict:
+    with _lock:
+        return {"stats": len(_counts), "devices": len(_seen)}
+
+
+def flush() -> dict:
+    """
+    Write the pending counters to the aggregate tables, in one transaction. On failure
+    they are kept for the next flush. Returns the number of stat keys and devices written.
+    """
+    global _counts, _seen
+    with _lock:
+        counts, _counts = _counts, defaultdict(int)
+        seen, _seen = _seen, {}
+    if not counts and not seen:
+        return {"stats": 0, "devices": 0}
+    try:
+        with transaction.atomic():
+            write_counts(counts)
+            write_seen(seen)
+    except Exception:
+        with _lock:
+            for key, n in counts.items():
+                _counts[key] += n
+            for mac, value in seen.items():
+                if mac not in _seen:
+                    _seen[mac] = value
+        raise
+    _prune()
+    return {"stats": len(counts), "devices": len(seen)}
+
+
+def write_counts(counts):
+    """Add {(bucket, vendor, model, version, status): n} to core.ProvisioningStat."""
+    from core.models import ProvisioningStat
+
+    for (bucket, vendor, model, version, status), n in counts.items():
+        lookup = {"bucket": bucket, "vendor": vendor, "model": model, "version": version, "status": status}
+        if ProvisioningStat.objects.filter(**lookup).update(count=F("count") + n):
+            continue
+        try:
+            with transaction.atomic():
+                ProvisioningStat.objects.create(count=n, **lookup)
+        except IntegrityError:
+            # inserted by another process since our UPDATE
+            ProvisioningStat.objects.filter(**lookup).update(count=F("count") + n)
+
+
+def write_seen(seen):
+    """Upsert {mac: (vendor, model, version, status, when)} into core.DeviceLastSeen."""
+    from core.models import DeviceLastSeen
+
+    if not seen:
+        return
+    rows = [
+        DeviceLastSeen(mac_address=mac, vendor=vendor, model=model, version=version, status=status, last_seen_at=when)
+        for mac, (vendor, model, version, status, when) in seen.items()
+    ]
+    # MySQL upserts on any unique key (ON DUPLICATE KEY) and does not accept a conflict target
+    unique_fields = ["mac_address"] if connection.features.supports_update_conflicts_with_target else None
+    DeviceLastSeen.objects.bulk_create(
+        rows,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=["vendor", "model", "version", "status", "last_seen_at"],
+    )
+
+
+def _prune():
+    """Drop per-minute stats past the retention period (at most once an hour per process)."""
+    from core.models import ProvisioningStat
+
+    global _last_prune
+    days = _setting("PROVISION_ANALYTICS_RETENTION_DAYS", 30)
+    if not days or time.monotonic() - _last_prune < 3600:
+        return
+    _last_prune = time.monotonic()
+    deleted, _ = ProvisioningStat.objects.filter(bucket__lt=timezone.now() - timedelta(days=days)).delete()
+    if deleted:
+        logger.info("Pruned %s provisioning stat rows older than %s days", deleted, days)
+
+
+def rebuild(days=None) -> dict:
+    """
+    Recompute the aggregate tables from core.Provisioning rows of the last `days`
+    days (all rows when None): per-minute stats of that period are replaced and the
+    last-seen rows upserted. Scans the raw table once, streaming.
+    """
+    from core.models import Provisioning, ProvisioningStat
+
+    rows = Provisioning.objects.order_by()
+    since = None
+    if days:
+        since = (timezone.now() - timedelta(days=days)).replace(second=0, microsecond=0)
+        rows = rows.filter(created_at__gte=since)
+    counts = defaultdict(int)
+    seen = {}
+    scanned = 0
+    fields = ("vendor", "model", "version", "status", "mac_address", "created_at")
+    for vendor, model, version, status, mac_address, created_at in rows.values_list(*fields).iterator(chunk_size=2000):
+        scanned += 1
+        key = (created_at.replace(second=0, microsecond=0), _field(vendor), _field(model), _field(version), status)
+        counts[key] += 1
+        if mac_address and (mac_address not in seen or seen[mac_address][4] <= created_at):
+            seen[mac_address] = key[1:] + (created_at,)
+
+    with transaction.atomic():
+        stats = ProvisioningStat.objects.all()
+        if since is not None:
+            stats = stats.filter(bucket__gte=since)
+        stats.delete()
+        write_counts(counts)
+        write_seen(seen)
+    provision_cache.clear_namespace("analytics")
+    return {"rows": scanned, "stats": len(counts), "devices": len(seen)}
+
+
+# --- dashboard -----------------------------------------------------------------
+
+def dashboard(hours=None, stale_days=None) -> dict:
+    """Dashboard data for the last `hours` hours; devices without contact for `stale_days` days."""
+    hours = hours or _setting("PROVISION_ANALYTICS_WINDOW_HOURS", 24)
+    stale_days = stale_days or _setting("PROVISION_ANALYTICS_STALE_DAYS", 7)
+    return provision_cache.get_or_set(
+        "analytics", f"dashboard:{hours}:{stale_days}", lambda: compute_dashboard(hours, stale_days)
+    )
+
+
+def compute_dashboard(hours, stale_days, now=None) -> dict:
+    from core.models import DeviceConfig, DeviceLastSeen, ProvisioningStat
+
+    now = now or timezone.now()
+    since = now - timedelta(hours=hours)
+    stats = ProvisioningStat.objects.filter(bucket__gte=since)
+
+    by_status = dict(stats.values_list("status").annotate(n=Sum("count")).order_by())
+    total = sum(by_status.values())
+    failures = total - by_status.get(STATUS_OK, 0)
+
+    # last hour, one point per minute (minutes without fetches count as 0)
+    last_minute = now.replace(second=0, microsecond=0)
+    first_minute = last_minute - timedelta(minutes=59)
+    per_minute = dict(
+        stats.filter(bucket__gte=first_minute).values_list("bucket").annotate(n=Sum("count")).order_by()
+    )
+    series = [
+        (minute, per_minute.get(minute, 0))
+        for minute in (first_minute + timedelta(minutes=i) for i in range(60))
+    ]
+
+    failing_models = list(
+        stats.values("vendor", "model")
+        .annotate(fetches=Sum("count"), failures=Sum("count", filter=~Q(status=STATUS_OK)))
+        .filter(failures__gt=0)
+        .order_by("-failures", "vendor", "model")[:10]
+    )
+    for row in failing_models:
+        row["failure_rate"] = row["failures"] / row["fetches"]
+
+    stale_cutoff = now - timedelta(days=stale_days)
+    recent = DeviceLastSeen.objects.filter(last_seen_at__gte=stale_cutoff).values("mac_address")
+    stale = DeviceConfig.objects.exclude(mac_address__in=recent)
+
+    firmware = list(
+        DeviceLastSeen.objects.values("vendor", "model", "version")
+        .annotate(devices=Count("id"))
+        .order_by("-devices", "vendor", "model", "version")[:25]
+    )
+
+    return {
+        "generated_at": now,
+        "hours": hours,
+        "stale_days": stale_days,
+        "fetches": total,
+        "fetches_per_minute": round(total / (hours * 60), 2),
+        "per_minute": series,
+        "by_status": [
+            {"status": status, "fetches": n, "share": n / total if total else 0}
+            for status, n in sorted(by_status.items(), key=lambda item: -item[1])
+        ],
+        "failures": failures,
+        "failure_rate": failures / total if total else 0,
+        "failing_models": failing_models,
+        "devices": DeviceConfig.objects.count(),
+        "stale_devices": stale.count(),
+        "stale_sample": list(stale.order_by("identifier").values("pk", "identifier", "mac_address")[:20]),
+        "firmware": firmware,
+    }
+
+
+def distinct_values(field) -> list:
+    """Known values of vendor/model (from core.DeviceLastSeen), e.g. for admin list filters."""
+    from core.models import DeviceLastSeen
+
+    def load():
+        return list(
+            DeviceLastSeen.objects.exclude(**{field: ""}).values_list(field, flat=True).distinct().order_by(field)
+        )
+
+    return provision_cache.get_or_set("analytics", f"distinct:{field}", load)
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        # invalidação do cache de provisionamento (api.cache) ao salvar devices/profiles
+        from . import signals  # noqa: F401
+        # reconstrução da arena de templates quando um template muda (api.invalidation)
+        from . import template_arena  # noqa: F401
@@ -0,0 +1,293 @@
+"""
+Batch rendering of device configurations (whole profiles, templates or fleets).
+
+Calling download_config once per device costs an ORM fetch, a template lookup and
+a compile per device. render_batch() instead:
+
+- reads the devices as flat rows joined with their profile (one values() query,
+  streamed with iterator(), no model instances);
+- resolves each template once and ships its text to the workers, which compile it
+  once per process (cache 'compiled', keyed by the version's sha256);
+- builds the profile half of the context once per profile and only the device
+  half per device (api.render_context: RenderContext over shared value tuples);
+- renders chunks of rows in parallel in a process pool (spawn: children only need
+  Django's template engine, never the databases), keeping a bounded number of
+  chunks in flight so memory stays flat on 500k devices;
+- streams each result to a sink: a directory, a .tar/.tar.gz, a callback, or
+  nothing (validation run).
+
+Usage:
+    from api.batch_render import DirectorySink, render_batch
+    report = render_batch(profile=3, sink=DirectorySink("/tmp/out"))
+
+or `manage.py render_configs` (see core/management/commands/render_configs.py).
+Rendering here has no User-Agent: vendor/model/version come from the `ua` argument.
+"""
+import io
+import logging
+import multiprocessing
+import os
+import re
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+
+from api.render_context import DEVICE_COLUMNS, NO_PROFILE_VALUES, PROFILE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+DEVICE_FIELDS = ("id", "profile_id") + DEVICE_COLUMNS
+PROFILE_FIELDS = PROFILE_COLUMNS + ("template_ref",)
+
+
+class _Row(dict):
+    """A values() row readable with attribute access, as the context builders expect."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _output_name(row, ext):
+    base = row["mac_address"] or re.sub(r"[^A-Za-z0-9._-]", "_", row["identifier"] or str(row["id"]))
+    return f"{base}.{ext}"
+
+
+# --- sinks -------------------------------------------------------------------
+
+class DirectorySink:
+    """Write each config to <directory>/<mac>.<ext>."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, name, content, row):
+        with open(os.path.join(self.directory, name), "w", encoding="utf-8") as fh:
+            fh.write(content)
+
+    def close(self):
+        pass
+
+
+class TarSink:
+    """Stream configs into a tar archive (gzip-compressed when the name ends in .gz/.tgz)."""
+
+    def __init__(self, path):
+        mode = "w:gz" if path.endswith((".gz", ".tgz")) else "w"
+        self.tar = tarfile.open(path, mode)
+        self.mtime = time.time()
+
+    def write(self, name, content, row):
+        data = content.encode("utf-8")
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.tar.close()
+
+
+class CallbackSink:
+    """Call func(name, content, row) for each rendered config."""
+
+    def __init__(self, func):
+        self.func = func
+
+    def write(self, name, content, row):
+        self.func(name, content, row)
+
+    def close(self):
+        pass
+
+
+# --- rendering (runs in the pool processes) ----------------------------------
+
+def _init_process():
+    import django
+
+    django.setup()
+
+
+def render_chunk(rows, templates, profile_contexts, ua):
+    """
+    Render a list of device rows. templates: {key: (sha256, text, ext)};
+    profile_contexts: {profile_id: profile placeholder values}; each row carries its
+    template key in '_template'. Returns [(row, name, content or None, error or None)].
+    """
+    from api.render_context import RenderContext, device_values
+    from api.views import get_compiled_template, substitute_percent_placeholders
+    from django.template import Context
+
+    results = []
+    for row in rows:
+        sha256, text, ext = templates[row["_template"]]
+        try:
+            compiled = get_compiled_template(text, cache_key=sha256)
+            context = RenderContext(
+                ua,
+                device_values(_Row(row), row["identifier"]),
+                profile_contexts.get(row["profile_id"], NO_PROFILE_VALUES),
+            )
+            content = substitute_percent_placeholders(compiled.render(Context(context)), context)
+            results.append((row, _output_name(row, ext), content, None))
+        except Exception as exc:
+            results.append((row, None, None, f"{type(exc).__name__}: {exc}"))
+    return results
+
+
+# --- driver ------------------------------------------------------------------
+
+def _resolve(template_ref, cache):
+    """(sha256, text, ext) of a template reference, or an Exception explaining why not."""
+    from api.utils.templates import get_template_body
+    from api.views import _find_template_by_ref
+
+    if template_ref in cache:
+        return cache[template_ref]
+    try:
+        doc = _find_template_by_ref(template_ref)
+        if not doc:
+            raise LookupError(f"template '{template_ref}' not found")
+        text = get_template_body(doc)
+        if not isinstance(text, str):
+            raise ValueError(f"template '{template_ref}' has no body")
+        ext = (doc.get("extension") or doc.get("file_type") or "xml").lower()
+        # documents without a version hash are compiled once per process by their ref
+        resolved = (doc.get("sha256") or f"ref:{template_ref}", text, ext)
+    except Exception as exc:
+        resolved = exc
+    cache[template_ref] = resolved
+    return resolved
+
+
+def select_devices(devices=None, profile=None, template=None):
+    """DeviceConfig queryset for render_batch: explicit queryset, a profile, or a template's profiles."""
+    from api.propagation import affected_devices
+    from core.models import DeviceConfig
+
+    if devices is not None:
+        qs = devices
+    elif profile is not None or template is not None:
+        qs = affected_devices(
+            profile_ids=[getattr(profile, "pk", profile)] if profile is not None else (),
+            template_ids=[template] if template is not None and profile is None else (),
+        )
+    else:
+        qs = DeviceConfig.objects.all()
+    if profile is not None and devices is not None:
+        qs = qs.filter(profile_id=getattr(profile, "pk", profile))
+    return qs
+
+
+def render_batch(devices=None, profile=None, template=None, sink=None, processes=None, chunk_size=None, ua=("", "", "")) -> dict:
+    """
+    Render the selected devices (see select_devices) and stream them to sink.
+
+    template overrides the profiles' template_ref (render a new template across a
+    fleet before switching to it); without it, devices whose profile has no
+    template_ref are skipped. processes=0 renders in this process. Returns a report
+    (total, rendered, failed, skipped, bytes, errors, seconds, devices_per_second).
+    """
+    processes = _setting("PROVISION_BATCH_PROCESSES", os.cpu_count() or 1) if processes is None else processes
+    chunk_size = chunk_size or _setting("PROVISION_BATCH_CHUNK_SIZE", 1000)
+    max_errors = _setting("PROVISION_PROPAGATION_MAX_ERRORS", 500)
+    ua = tuple(ua)[:3]
+    started = time.monotonic()
+    report = {"total": 0, "rendered": 0, "failed": 0, "skipped": 0, "bytes": 0, "errors": []}
+
+    qs = select_devices(devices, profile, template)
+    fields = DEVICE_FIELDS + tuple(f"profile__{f}" for f in PROFILE_FIELDS)
+    rows = qs.order_by("pk").values(*fields).iterator(chunk_size=chunk_size)
+
+    resolved = {}
+    profile_contexts = {}
+
+    def fail(row, error):
+        report["failed"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"device": row["id"], "identifier": row["identifier"], "error": error})
+
+    def collect(results):
+        for row, name, content, error in results:
+            if error is not None:
+                fail(row, error)
+                continue
+            report["rendered"] += 1
+            report["bytes"] += len(content)
+            if sink is not None:
+                sink.write(name, content, row)
+
+    def chunks():
+        """Rows ready to render, grouped in chunks with the templates/contexts they need."""
+        from api.render_context import profile_values
+
+        batch, templates, contexts = [], {}, {}
+        for raw in rows:
+            report["total"] += 1
+            row = {f: raw[f] for f in DEVICE_FIELDS}
+            ref = template or raw["profile__template_ref"]
+            if not ref:
+                report["skipped"] += 1
+                continue
+            tpl = _resolve(ref, resolved)
+            if isinstance(tpl, Exception):
+                fail(row, f"{type(tpl).__name__}: {tpl}")
+                continue
+            row["_template"] = ref
+            templates[ref] = tpl
+            profile_id = row["profile_id"]
+            if profile_id not in profile_contexts:
+                profile = _Row({f: raw[f"profile__{f}"] for f in PROFILE_FIELDS}) if profile_id else None
+                profile_contexts[profile_id] = profile_values(profile)
+            contexts[profile_id] = profile_contexts[profile_id]
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                yield batch, templates, contexts
+                batch, templates, contexts = [], {}, {}
+        if batch:
+            yield batch, templates, contexts
+
+    try:
+        if processes <= 0:
+            for batch, templates, contexts in chunks():
+                collect(render_chunk(batch, templates, contexts, ua))
+        else:
+            pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_process,
+            )
+            try:
+                in_flight = set()
+                for batch, templates, contexts in chunks():
+                    in_flight.add(pool.submit(render_chunk, batch, templates, contexts, ua))
+                    # bounded read-ahead: rows are not loaded faster than they are rendered
+                    while len(in_flight) >= processes * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect(future.result())
+                for future in in_flight:
+                    collect(future.result())
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+    finally:
+        if sink is not None:
+            sink.close()
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    report["devices_per_second"] = round(report["rendered"] / report["seconds"], 1) if report["seconds"] else None
+    logger.info(
+        "Batch render: %s devices, %s rendered (%s bytes), %s failed, %s skipped in %.2fs",
+        report["total"], report["rendered"], report["bytes"], report["failed"], report["skipped"], report["seconds"],
+    )
+    return report
@@ -0,0 +1,230 @@
+"""
+Circuit breakers and a per-request latency budget for the backends of the download
+path ('mysql': device/profile lookups, 'mongo': template resolution and bodies).
+
+guard(dependency) wraps one backend call:
+
+- the request budget (request_budget(), set by download_config from
+  settings.PROVISION_REQUEST_BUDGET_SECONDS) must not be used up, otherwise
+  BudgetExhausted is raised before touching the backend;
+- the dependency's breaker must let the call through, otherwise CircuitOpen;
+- MongoDB calls run under pymongo.timeout() with what is left of the budget (capped
+  by the dependency's "timeout"), so a slow Atlas cannot hold a request for the
+  full driver timeout; MySQL relies on the driver timeouts (connect/read/write in
+  DATABASES OPTIONS) and is only measured;
+- the outcome and latency go into the breaker's rolling window.
+
+A breaker (CircuitBreaker) keeps per-second buckets of calls, errors and slow calls
+(slower than "slow_ms") over "window_seconds". With at least "min_calls" in the
+window and the error rate or slow rate at or above "error_rate" / "slow_rate" it
+opens: calls fail at once for "open_seconds", then one probe at a time is let
+through (half-open); a good probe closes it, a failed or slow one opens it again.
+
+The lookups catch these exceptions like any backend error, so the request falls
+back to cached data (api.last_good) or answers without waiting. Settings per
+dependency in settings.PROVISION_BREAKERS; states, counters and transitions in
+stats() (cache stats endpoint). Breakers are per process.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+import pymongo
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULTS = {
+    "window_seconds": 10,
+    "min_calls": 20,
+    "error_rate": 0.5,
+    "slow_ms": 1000,
+    "slow_rate": 0.8,
+    "open_seconds": 5,
+    "timeout": 5.0,
+}
+
+
+class CircuitOpen(Exception):
+    """The dependency's breaker is open: the call was not attempted."""
+
+    def __init__(self, dependency):
+        super().__init__(f"circuit open for {dependency}")
+        self.dependency = dependency
+
+
+class BudgetExhausted(Exception):
+    """The request's latency budget was used up before calling the dependency."""
+
+    def __init__(self, dependency):
+        super().__init__(f"request budget exhausted before {dependency}")
+        self.dependency = dependency
+
+
+class CircuitBreaker:
+    """Rolling error/latency window with closed, open and half-open states. Thread-safe."""
+
+    def __init__(self, name, window_seconds=10, min_calls=20, error_rate=0.5, slow_ms=1000, slow_rate=0.8,
+                 open_seconds=5, timeout=None):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_ms / 1000.0
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.timeout = timeout
+        self.state = CLOSED
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self._probing = False
+        self._buckets = deque()  # [second, calls, errors, slow]
+        self._lock = threading.Lock()
+
+    def _window(self, now):
+        horizon = int(now) - self.window_seconds
+        while self._buckets and self._buckets[0][0] <= horizon:
+            self._buckets.popleft()
+        calls = sum(b[1] for b in self._buckets)
+        errors = sum(b[2] for b in self._buckets)
+        slow = sum(b[3] for b in self._buckets)
+        return calls, errors, slow
+
+    def _transition(self, state, now):
+        logger.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        if state == OPEN:
+            self.opened_at = now
+            self.trips += 1
+        elif state == CLOSED:
+            self.opened_at = None
+            self._buckets.clear()
+
+    def allow(self) -> bool:
+        """Whether a call may go to the dependency now (takes the probe slot when half-open)."""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN, now)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, seconds, ok):
+        now = time.monotonic()
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += 0 if ok else 1
+            bucket[3] += 1 if slow else 0
+            if self.state == HALF_OPEN:
+                self._probing = False
+                self._transition(CLOSED if ok and not slow else OPEN, now)
+                return
+            if self.state != CLOSED:
+                return
+            calls, errors, slow_calls = self._window(now)
+            if calls >= self.min_calls and (errors / calls >= self.error_rate or slow_calls / calls >= self.slow_rate):
+                self._transition(OPEN, now)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls, errors, slow = self._window(time.monotonic())
+            return {
+                "state": self.state,
+                "calls": calls,
+                "errors": errors,
+                "slow": slow,
+                "error_rate": round(errors / calls, 4) if calls else None,
+                "trips": self.trips,
+                "rejected": self.rejected,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get(dependency) -> CircuitBreaker:
+    breaker = _breakers.get(dependency)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(dependency)
+            if breaker is None:
+                conf = dict(DEFAULTS, **getattr(settings, "PROVISION_BREAKERS", {}).get(dependency, {}))
+                breaker = _breakers[dependency] = CircuitBreaker(dependency, **conf)
+    return breaker
+
+
+def reset():
+    """Forget every breaker (configuration is read again on next use). For tests and maintenance."""
+    with _breakers_lock:
+        _breakers.clear()
+
+
+# --- request budget ----------------------------------------------------------------
+
+_deadline = ContextVar("provision_request_deadline", default=None)
+
+
+@contextmanager
+def request_budget(seconds=None):
+    """Give the backend calls made in this block (same thread) seconds in total; 0/None = no budget."""
+    if seconds is None:
+        seconds = getattr(settings, "PROVISION_REQUEST_BUDGET_SECONDS", 0)
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left in the current request budget, or None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def guard(dependency):
+    """Run the block as one call to dependency (budget, breaker, timeout, measurement)."""
+    breaker = get(dependency)
+    left = remaining()
+    if left is not None and left <= 0:
+        raise BudgetExhausted(dependency)
+    if not breaker.allow():
+        raise CircuitOpen(dependency)
+    limits = [x for x in (left, breaker.timeout) if x]
+    limit = min(limits) if limits else None
+    started = time.monotonic()
+    try:
+        with ExitStack() as stack:
+            if dependency == "mongo" and limit:
+                stack.enter_context(pymongo.timeout(limit))
+            yield
+    except BaseException:
+        breaker.record(time.monotonic() - started, ok=False)
+        raise
+    breaker.record(time.monotonic() - started, ok=True)
+
+
+def stats() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,456 @@
+"""
+Two-tier cache for the provisioning path.
+
+- L1: in-process LRU (LocalLRU) bounded by entry count and by an estimate of
+  the bytes held, so a few large templates cannot push out everything else.
+- L2: a Django cache (settings.PROVISION_CACHE["L2_ALIAS"], 'default' unless
+  configured): memcached/redis in production, so gunicorn workers and Cloud Run
+  instances share warm data; LocMem/file/DB caches work as local stand-ins.
+
+Entries live in namespaces ('device', 'profile', 'template', 'template_version',
+'rendered', ...) configured in settings.PROVISION_CACHE["NAMESPACES"] with their
+own TTLs. L1 normally keeps entries for a shorter time than L2, bounding how
+long a worker can serve a value another process has already replaced; a
+namespace can also skip L1 ("l1": False) or L2 ("l2": False) entirely.
+clear_namespace() bumps a generation number stored in L2, which invalidates the
+namespace for every process at once.
+
+delete() does not reach other processes' L1 (their copies expire with l1_ttl)
+and clear_namespace() reaches them after GENERATION_CHECK_SECONDS; the
+invalidation bus (api.invalidation) evicts them sooner through evict_local(),
+which also drops the L2 entry (or bumps the generation) when L2 is a
+LocMemCache, i.e. one per process.
+
+get_or_set() coalesces cold misses (single flight): concurrent misses for the same
+key in one process wait for a single loader call and share its result (or its
+exception). With a lease (PROVISION_CACHE["LEASE_SECONDS"], or "lease" on a
+namespace) the first process to miss also takes a short lease in L2 (cache.add)
+and the others poll L2 for its result instead of calling their own loader; when
+the lease holder fails or the lease expires, the next one takes over. This only
+helps with a shared L2 (memcached/redis). Per-namespace hit/miss/coalesced
+counters are available from stats().
+
+Usage:
+    from api.cache import provision_cache
+    profile = provision_cache.get_or_set("profile", profile_id, lambda: load(profile_id))
+"""
+import hashlib
+import logging
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+_MISS = object()
+
+# memcached limits keys to 250 printable chars without whitespace
+_SAFE_KEY_RE = re.compile(r"^[A-Za-z0-9_.:@/|-]{1,200}$")
+
+DEFAULT_NAMESPACE = {"ttl": 60, "l1_ttl": 10}
+
+# how often a process waiting on another one's lease looks for the result in L2
+LEASE_POLL_SECONDS = 0.02
+
+
+def _estimate_size(value, _depth=0) -> int:
+    """Rough size in bytes of value, used for L1 accounting (not exact)."""
+    if isinstance(value, (str, bytes, bytearray)):
+        return sys.getsizeof(value)
+    if _depth >= 3:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            _estimate_size(k, _depth + 1) + _estimate_size(v, _depth + 1) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(_estimate_size(v, _depth + 1) for v in value)
+    if hasattr(value, "__dict__"):
+        return sys.getsizeof(value) + _estimate_size(vars(value), _depth + 1)
+    return sys.getsizeof(value)
+
+
+class LocalLRU:
+    """Thread-safe LRU with per-entry expiry, bounded by entries and estimated bytes."""
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.bytes = 0
+        self._data = OrderedDict()  # key -> (expires_at | None, size, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, size, value = item
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self.bytes -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, size=None):
+        if size is None:
+            size = _estimate_size(value)
+        if size > self.max_bytes:
+            return False
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (expires_at, size, value)
+            self.bytes += size
+            while self._data and (self.bytes > self.max_bytes or len(self._data) > self.max_entries):
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                self.bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _SingleFlight:
+    """Concurrent calls for the same key run fn once; the others wait and share its outcome."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._flights = {}  # key -> _Flight
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, fn, on_join=None):
+        """Return fn()'s result; on_join() is called by callers that wait on someone else's call."""
+        with self._guard:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if on_join is not None:
+                on_join()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = fn()
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._guard:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.value
+
+
+class TieredCache:
+    """L1 (LocalLRU) in front of L2 (Django cache) with per-namespace TTLs and stats."""
+
+    def __init__(self):
+        self._l1 = None
+        self._l1_guard = threading.Lock()
+        self._flights = _SingleFlight()
+        self._generations = {}  # namespace -> (generation, checked_at)
+        self._stats = defaultdict(lambda: defaultdict(int))
+
+    # --- configuration -------------------------------------------------------
+
+    @staticmethod
+    def _config() -> dict:
+        return getattr(settings, "PROVISION_CACHE", {}) or {}
+
+    def namespace_config(self, namespace: str) -> dict:
+        configured = self._config().get("NAMESPACES", {}).get(namespace, {})
+        conf = dict(DEFAULT_NAMESPACE, **configured)
+        if "l1_ttl" not in configured and conf["ttl"] is None:
+            # immutable entries (e.g. template versions) may stay in L1 until evicted
+            conf["l1_ttl"] = None
+        return conf
+
+    @property
+    def l1(self) -> LocalLRU:
+        if self._l1 is None:
+            with self._l1_guard:
+                if self._l1 is None:
+                    conf = self._config()
+                    self._l1 = LocalLRU(
+                        max_bytes=conf.get("L1_MAX_BYTES", 32 * 1024 * 1024),
+                        max_entries=conf.get("L1_MAX_ENTRIES", 10000),
+                    )
+        return self._l1
+
+    def _l2(self):
+        return caches[self._config().get("L2_ALIAS", "default")]
+
+    def _prefix(self) -> str:
+        return self._config().get("KEY_PREFIX", "prov")
+
+    # --- keys / generations --------------------------------------------------
+
+    def _generation(self, namespace: str) -> int:
+        checked = self._generations.get(namespace)
+        now = time.monotonic()
+        if checked is not None and now - checked[1] < self._config().get("GENERATION_CHECK_SECONDS", 5):
+            return checked[0]
+        try:
+            generation = self._l2().get(f"{self._prefix()}:gen:{namespace}", 0)
+        except Exception as exc:
+            logger.debug("L2 generation lookup failed for %s: %s", namespace, exc)
+            generation = checked[0] if checked else 0
+        self._generations[namespace] = (generation, now)
+        return generation
+
+    def make_key(self, namespace: str, key) -> str:
+        key = str(key)
+        if not _SAFE_KEY_RE.match(key):
+            key = "h:" + hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return f"{self._prefix()}:{namespace}:{self._generation(namespace)}:{key}"
+
+    # --- operations ----------------------------------------------------------
+
+    def get(self, namespace: str, key, default=None):
+        conf = self.namespace_config(namespace)
+        stats = self._stats[namespace]
+        if not conf.get("enabled", True):
+            stats["misses"] += 1
+            return default
+        full_key = self.make_key(namespace, key)
+        use_l1 = conf.get("l1", True)
+        value = self.l1.get(full_key, _MISS) if use_l1 else _MISS
+        if value is not _MISS:
+            stats["l1_hits"] += 1
+            return value
+        if conf.get("l2", True):
+            try:
+                value = self._l2().get(full_key, _MISS)
+            except Exception as exc:
+                stats["l2_errors"] += 1
+                logger.debug("L2 get failed for %s: %s", full_key, exc)
+                value = _MISS
+            if value is not _MISS:
+                stats["l2_hits"] += 1
+                if use_l1:
+                    self.l1.set(full_key, value, conf.get("l1_ttl"))
+                return value
+        stats["misses"] += 1
+        return default
+
+    def set(self, namespace: str, key, value, ttl=_MISS):
+        conf = self.namespace_config(namespace)
+        if not conf.get("enabled", True):
+            return
+        full_key = self.make_key(namespace, key)
+        l2_ttl = conf.get("ttl") if ttl is _MISS else ttl
+        l1_ttl = conf.get("l1_ttl")
+        if l1_ttl is None or (l2_ttl is not None and l2_ttl < l1_ttl):
+            l1_ttl = l2_ttl
+        if conf.get("l1", True):
+            self.l1.set(full_key, value, l1_ttl)
+        if conf.get("l2", True):
+            try:
+                self._l2().set(full_key, value, l2_ttl)
+            except Exception as exc:
+                self._stats[namespace]["l2_errors"] += 1
+                logger.debug("L2 set failed for %s: %s", full_key, exc)
+
+    def delete(self, namespace: str, key):
+        full_key = self.make_key(namespace, key)
+        self.l1.delete(full_key)
+        try:
+            self._l2().delete(full_key)
+        except Exception as exc:
+            logger.debug("L2 delete failed for %s: %s", full_key, exc)
+
+    def get_or_set(self, namespace: str, key, loader, ttl=_MISS):
+        """
+        Return the cached value, or call loader() once (per process and key, even under
+        concurrent misses; per key across processes while a lease is held), cache its
+        result (None included) and return it.
+        Exceptions raised by loader are propagated to every waiting caller and nothing is cached.
+        """
+        value = self.get(namespace, key, _MISS)
+        if value is not _MISS:
+            return value
+        full_key = self.make_key(namespace, key)
+
+        def joined():
+            self._stats[namespace]["coalesced"] += 1
+
+        return self._flights.do(full_key, lambda: self._load(namespace, key, full_key, loader, ttl), joined)
+
+    def _lease_seconds(self, conf) -> float:
+        if not conf.get("enabled", True) or not conf.get("l2", True):
+            return 0
+        return conf.get("lease", self._config().get("LEASE_SECONDS", 0)) or 0
+
+    def _load(self, namespace, key, full_key, loader, ttl):
+        # a flight that finished just before ours started may have filled L1
+        value = self.l1.get(full_key, _MISS)
+        if value is not _MISS:
+            return value
+        conf = self.namespace_config(namespace)
+        stats = self._stats[namespace]
+        lease = self._lease_seconds(conf)
+        leased = False
+        if lease:
+            value, leased = self._wait_for_lease(namespace, full_key, lease, conf)
+            if value is not _MISS:
+                return value
+        try:
+            started = time.perf_counter()
+            value = loader()
+            stats["loads"] += 1
+            stats["load_ms"] += int((time.perf_counter() - started) * 1000)
+            self.set(namespace, key, value, ttl)
+            return value
+        finally:
+            if leased:
+                try:
+                    self._l2().delete(f"{full_key}:lease")
+                except Exception as exc:
+                    logger.debug("L2 lease release failed for %s: %s", full_key, exc)
+
+    def _wait_for_lease(self, namespace, full_key, lease, conf):
+        """
+        Take the L2 lease for full_key, or wait for the process holding it to store the
+        value. Returns (value or _MISS, whether we hold the lease); (_MISS, False) when
+        the wait timed out or L2 is unavailable: the caller then loads without a lease.
+        """
+        l2 = self._l2()
+        stats = self._stats[namespace]
+        lease_key = f"{full_key}:lease"
+        deadline = time.monotonic() + lease
+        waited = False
+        while True:
+            try:
+                if l2.add(lease_key, os.getpid(), math.ceil(lease)):
+                    return _MISS, True
+                if not waited:
+                    waited = True
+                    stats["lease_waits"] += 1
+                time.sleep(LEASE_POLL_SECONDS)
+                value = l2.get(full_key, _MISS)
+            except Exception as exc:
+                stats["l2_errors"] += 1
+                logger.debug("L2 lease failed for %s: %s", full_key, exc)
+                return _MISS, False
+            if value is not _MISS:
+                stats["lease_hits"] += 1
+                if conf.get("l1", True):
+                    self.l1.set(full_key, value, conf.get("l1_ttl"))
+                return value, False
+            if time.monotonic() >= deadline:
+                stats["lease_timeouts"] += 1
+                return _MISS, False
+
+    def clear_namespace(self, namespace: str):
+        """Invalidate a whole namespace in every process (bumps its generation in L2)."""
+        gen_key = f"{self._prefix()}:gen:{namespace}"
+        try:
+            l2 = self._l2()
+            if not l2.add(gen_key, 1, None):
+                l2.incr(gen_key)
+        except Exception as exc:
+            logger.warning("Failed to bump cache generation for %s: %s", namespace, exc)
+        self._generations.pop(namespace, None)
+        self.l1.delete_prefix(f"{self._prefix()}:{namespace}:")
+
+    def l2_is_local(self) -> bool:
+        """Whether the L2 backend lives in this process (LocMemCache), i.e. is not shared by the workers."""
+        try:
+            return isinstance(self._l2(), LocMemCache)
+        except Exception:
+            return False
+
+    def evict_local(self, namespace: str, keys=None):
+        """
+        Drop entries changed in another process. A shared L2 was already updated by whoever
+        changed the data, so only this process's L1 is dropped; a process-local L2
+        (LocMemCache) is dropped too. keys None drops the whole namespace: re-reads its
+        generation from a shared L2 on next use, or bumps it in a local one. Used by the
+        invalidation bus (api.invalidation).
+        """
+        local_l2 = self.l2_is_local()
+        if keys is None:
+            if local_l2:
+                self.clear_namespace(namespace)
+                return
+            self._generations.pop(namespace, None)
+            self.l1.delete_prefix(f"{self._prefix()}:{namespace}:")
+            return
+        for key in keys:
+            if local_l2:
+                self.delete(namespace, key)
+            else:
+                self.l1.delete(self.make_key(namespace, key))
+
+    def clear(self):
+        """Drop everything (L1 and the whole L2 cache). Meant for tests and maintenance."""
+        self.l1.clear()
+        self._generations.clear()
+        self._stats.clear()
+        try:
+            self._l2().clear()
+        except Exception as exc:
+            logger.warning("Failed to clear L2 cache: %s", exc)
+
+    def stats(self) -> dict:
+        """
+        Per-namespace counters (l1_hits, l2_hits, misses, loads, load_ms, coalesced,
+        lease_waits, lease_hits, lease_timeouts, hit_rate) plus L1 usage and loads in flight.
+        """
+        result = {}
+        for namespace, counters in list(self._stats.items()):
+            data = dict(counters)
+            lookups = data.get("l1_hits", 0) + data.get("l2_hits", 0) + data.get("misses", 0)
+            data["hit_rate"] = round((data.get("l1_hits", 0) + data.get("l2_hits", 0)) / lookups, 4) if lookups else None
+            result[namespace] = data
+        return {
+            "namespaces": result,
+            "l1": {"entries": len(self.l1), "bytes": self.l1.bytes, "max_bytes": self.l1.max_bytes},
+            "in_flight": len(self._flights),
+        }
+
+
+provision_cache = TieredCache()
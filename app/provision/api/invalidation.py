@@ -0,0 +1,420 @@
+"""
+Cache invalidation bus: evicts per-process cache entries (L1 of api.cache) in every
+gunicorn worker and Cloud Run instance when a device, profile or template changes.
+
+Without it, a worker keeps serving its own L1 copy of a changed row until l1_ttl
+expires (clear_namespace() reaches other processes after
+PROVISION_CACHE["GENERATION_CHECK_SECONDS"]), and with the default LocMemCache L2
+(one per process) its own L2 copy until ttl. With it, the lag is bounded by
+settings.PROVISION_INVALIDATION_POLL_SECONDS: evict_local() drops the L1 entries,
+and the L2 ones too when L2 is process-local.
+
+Events are typed: EVENT_DEVICE (keys 'mac:<mac>' / 'id:<identifier>'),
+EVENT_PROFILE (profile ids), EVENT_TEMPLATE (template names; the whole
+'template' namespace is evicted, since resolutions are cached by ref and model)
+and EVENT_OAUTH_TOKEN (token checksums, api.oauth_validators).
+They are published after the transaction commits, from api.signals,
+api.template_pointer, api.utils.templates (publish/rollback) and the template
+delete view, right after the local cache.delete()/clear_namespace().
+
+Each process runs one subscriber thread (started on first download or by
+gunicorn post_worker_init) that skips its own events and calls
+provision_cache.evict_local(). The transport is chosen by
+settings.PROVISION_INVALIDATION_TRANSPORT:
+
+- "db": rows of core.CacheInvalidation, polled by id (pruned after
+  PROVISION_INVALIDATION_RETENTION_SECONDS);
+- "mongo": a capped collection ('cache_invalidations') read with a tailable cursor;
+- "local": in-process only (tests, single-process servers); no thread;
+- "" disables the bus.
+
+Other modules react to changes with listen(kind, callback) (api.template_arena
+rebuilds its shared template store on template events).
+
+When the subscriber may have missed events (transport errors, capped collection
+overwritten, poll stalled longer than the retention) it evicts the device, profile
+and template namespaces of its L1 entirely.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict, deque, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from api.cache import provision_cache
+
+logger = logging.getLogger(__name__)
+
+EVENT_DEVICE = "device"
+EVENT_PROFILE = "profile"
+EVENT_TEMPLATE = "template"
+EVENT_OAUTH_TOKEN = "oauth_token"
+
+# event kind -> cache namespace it evicts
+NAMESPACES = {
+    EVENT_DEVICE: "device",
+    EVENT_PROFILE: "profile",
+    EVENT_TEMPLATE: "template",
+    EVENT_OAUTH_TOKEN: "oauth_token",
+}
+# kinds whose keys are not cache keys: the whole namespace goes
+WHOLE_NAMESPACE = {EVENT_TEMPLATE}
+
+Event = namedtuple("Event", "kind keys origin at")
+
+
+_listeners = defaultdict(list)
+
+
+def listen(kind, callback):
+    """
+    Call callback(keys) whenever kind changes: in the publishing process after commit,
+    in the others when the event arrives (keys [] after a gap, when they are unknown).
+    """
+    _listeners[kind].append(callback)
+
+
+def _notify(kind, keys):
+    for callback in _listeners.get(kind, ()):
+        try:
+            callback(keys)
+        except Exception:
+            logger.exception("Cache invalidation listener %r failed for %s", callback, kind)
+
+
+class InvalidationGap(Exception):
+    """The subscriber may have missed events."""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class LocalTransport:
+    """Events kept in memory; every bus of the process sharing it sees them."""
+
+    name = "local"
+    threaded = False
+
+    def __init__(self):
+        self._events = []
+        self._position = 0
+        self._lock = threading.Lock()
+
+    def publish(self, events):
+        with self._lock:
+            self._events.extend(events)
+
+    def reset(self):
+        with self._lock:
+            self._position = len(self._events)
+
+    def poll(self, timeout):
+        with self._lock:
+            events, self._position = self._events[self._position:], len(self._events)
+        return events
+
+
+class DatabaseTransport:
+    """
+    core.CacheInvalidation rows polled by id. Ids are not always committed in order,
+    so each poll re-reads the last OVERLAP ids and skips those already seen.
+    """
+
+    name = "db"
+    threaded = True
+    OVERLAP = 200
+
+    def __init__(self):
+        self._position = 0
+        self._seen = set()
+        self._seen_order = deque()
+        self._last_prune = 0.0
+
+    @staticmethod
+    def _model():
+        from core.models import CacheInvalidation
+
+        return CacheInvalidation
+
+    def publish(self, events):
+        model = self._model()
+        model.objects.bulk_create([model(kind=e.kind, keys=list(e.keys), origin=e.origin) for e in events])
+        self._prune()
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        retention = _setting("PROVISION_INVALIDATION_RETENTION_SECONDS", 3600)
+        self._model().objects.filter(created_at__lt=timezone.now() - timedelta(seconds=retention)).delete()
+
+    def reset(self):
+        self._seen.clear()
+        self._seen_order.clear()
+        # start after the current rows, including those the overlap window would re-read
+        recent = list(self._model().objects.order_by("-id").values_list("id", flat=True)[:self.OVERLAP])
+        for pk in reversed(recent):
+            self._remember(pk)
+        self._position = recent[0] if recent else 0
+
+    def _remember(self, pk):
+        self._seen.add(pk)
+        self._seen_order.append(pk)
+        while len(self._seen_order) > 4 * self.OVERLAP:
+            self._seen.discard(self._seen_order.popleft())
+
+    def poll(self, timeout):
+        rows = (
+            self._model().objects.filter(id__gt=max(self._position - self.OVERLAP, 0))
+            .order_by("id")
+            .values_list("id", "kind", "keys", "origin", "created_at")[:1000]
+        )
+        events = []
+        for pk, kind, keys, origin, created_at in rows:
+            if pk in self._seen:
+                continue
+            self._remember(pk)
+            self._position = max(self._position, pk)
+            events.append(Event(kind, keys, origin, created_at.timestamp()))
+        if not events and timeout:
+            time.sleep(timeout)
+        return events
+
+
+class MongoTransport:
+    """Capped collection read with a tailable cursor (insertion order, blocks until timeout)."""
+
+    name = "mongo"
+    threaded = True
+    COLLECTION = "cache_invalidations"
+
+    def __init__(self, db=None):
+        self._db = db
+        self._cursor = None
+        self._last = None
+        self._ready = False
+
+    def _collection(self):
+        from api.utils.mongo import get_mongo_client
+
+        db = self._db if self._db is not None else get_mongo_client()
+        coll = db[self.COLLECTION]
+        if not self._ready:
+            if self.COLLECTION not in db.list_collection_names():
+                from pymongo.errors import CollectionInvalid
+
+                try:
+                    db.create_collection(
+                        self.COLLECTION, capped=True,
+                        size=_setting("PROVISION_INVALIDATION_MONGO_BYTES", 1024 * 1024),
+                    )
+                    # a tailable cursor dies when its query matches nothing
+                    coll.insert_one({"kind": "start", "keys": [], "origin": "", "at": time.time()})
+                except CollectionInvalid:
+                    pass
+            self._ready = True
+        return coll
+
+    def publish(self, events):
+        self._collection().insert_many(
+            [{"kind": e.kind, "keys": list(e.keys), "origin": e.origin, "at": e.at} for e in events]
+        )
+
+    def reset(self):
+        last = next(iter(self._collection().find({}, projection={"_id": 1}).sort("$natural", -1).limit(1)), None)
+        self._last = last["_id"] if last else None
+        self._cursor = None
+
+    def poll(self, timeout):
+        from pymongo import CursorType
+
+        if self._cursor is None:
+            query = {"_id": {"$gte": self._last}} if self._last is not None else {}
+            self._cursor = self._collection().find(
+                query, cursor_type=CursorType.TAILABLE_AWAIT, max_await_time_ms=int(timeout * 1000) or 1
+            )
+        events = []
+        while self._cursor.alive:
+            doc = self._cursor.try_next()
+            if doc is None:
+                break
+            if doc["_id"] == self._last:
+                continue
+            self._last = doc["_id"]
+            if doc.get("kind") in NAMESPACES:
+                events.append(Event(doc["kind"], doc.get("keys") or [], doc.get("origin", ""), doc.get("at") or 0.0))
+        if not self._cursor.alive:
+            # the capped collection wrapped past our position
+            self._cursor = None
+            raise InvalidationGap("tailable cursor died")
+        return events
+
+
+TRANSPORTS = {"local": LocalTransport, "db": DatabaseTransport, "mongo": MongoTransport}
+
+
+class Bus:
+    """Publisher and subscriber of one process."""
+
+    def __init__(self, transport, origin=None, cache=provision_cache):
+        self.transport = transport
+        self.origin = origin or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.cache = cache
+        self.pid = os.getpid()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counts = {"published": 0, "received": 0, "applied": 0, "gaps": 0, "errors": 0}
+        self._lag_ms = None
+        self._max_lag_ms = 0.0
+
+    def publish(self, kind, keys):
+        event = Event(kind, [str(k) for k in keys], self.origin, time.time())
+        try:
+            self.transport.publish([event])
+        except Exception as exc:
+            # other processes keep the old entry until its l1_ttl
+            self._counts["errors"] += 1
+            logger.warning("Could not publish cache invalidation %s %s: %s", kind, event.keys, exc)
+            return
+        self._counts["published"] += 1
+
+    def apply(self, events) -> int:
+        applied = 0
+        now = time.time()
+        for event in events:
+            self._counts["received"] += 1
+            namespace = NAMESPACES.get(event.kind)
+            if event.origin == self.origin or namespace is None:
+                continue
+            if event.kind in WHOLE_NAMESPACE:
+                self.cache.evict_local(namespace)
+            else:
+                self.cache.evict_local(namespace, event.keys)
+            _notify(event.kind, event.keys)
+            applied += 1
+            if event.at:
+                self._lag_ms = max(0.0, (now - event.at) * 1000)
+                self._max_lag_ms = max(self._max_lag_ms, self._lag_ms)
+        self._counts["applied"] += applied
+        return applied
+
+    def evict_all(self):
+        self._counts["gaps"] += 1
+        for kind, namespace in NAMESPACES.items():
+            self.cache.evict_local(namespace)
+            _notify(kind, [])
+
+    def poll_once(self, timeout=0) -> int:
+        """Read and apply the pending events. InvalidationGap and transport errors propagate."""
+        return self.apply(self.transport.poll(timeout))
+
+    # --- subscriber thread -------------------------------------------------
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self.transport.threaded:
+                return
+            self._thread = threading.Thread(target=self._run, name="provision-invalidation", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        interval = _setting("PROVISION_INVALIDATION_POLL_SECONDS", 1.0)
+        retention = _setting("PROVISION_INVALIDATION_RETENTION_SECONDS", 3600)
+        synced = failed = False
+        last_ok = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                close_old_connections()
+                if not synced:
+                    self.transport.reset()
+                    if failed or time.monotonic() - last_ok > retention:
+                        self.evict_all()
+                    synced, failed = True, False
+                self.poll_once(interval)
+                last_ok = time.monotonic()
+            except InvalidationGap as exc:
+                logger.info("Cache invalidation events may have been missed (%s); evicting local cache", exc)
+                self.evict_all()
+                synced = False
+            except Exception as exc:
+                self._counts["errors"] += 1
+                logger.warning("Cache invalidation subscriber failed: %s", exc)
+                synced, failed = False, True
+                self._stop.wait(min(interval * 5, 30))
+
+    def stats(self) -> dict:
+        return dict(
+            self._counts,
+            transport=self.transport.name,
+            origin=self.origin,
+            subscribed=self._thread is not None and self._thread.is_alive(),
+            lag_ms=round(self._lag_ms, 1) if self._lag_ms is not None else None,
+            max_lag_ms=round(self._max_lag_ms, 1),
+        )
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    """The bus of this process (a new one after fork or a transport change); None when disabled."""
+    global _bus
+    name = _setting("PROVISION_INVALIDATION_TRANSPORT", "local")
+    bus = _bus
+    if bus is not None and bus.pid == os.getpid() and bus.transport.name == name:
+        return bus
+    if not name:
+        return None
+    with _bus_lock:
+        if _bus is None or _bus.pid != os.getpid() or _bus.transport.name != name:
+            if name not in TRANSPORTS:
+                raise ValueError(f"Unknown PROVISION_INVALIDATION_TRANSPORT {name!r}")
+            _bus = Bus(TRANSPORTS[name]())
+        return _bus
+
+
+def ensure_subscriber():
+    """Start this process's subscriber thread if the transport needs one. Cheap after the first call."""
+    bus = _bus
+    if bus is not None and bus.pid == os.getpid() and (bus._thread is not None or not bus.transport.threaded):
+        return
+    bus = get_bus()
+    if bus is not None:
+        bus.start()
+
+
+def publish(kind, keys=()):
+    """Tell the other processes that kind/keys changed, once the current transaction commits."""
+    bus = get_bus()
+    keys = list(keys)
+
+    def send():
+        _notify(kind, keys)
+        if bus is not None:
+            bus.publish(kind, keys)
+
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(send)
+    else:
+        send()  # Mongo-only changes (templates) run outside transactions
+
+
+def stats():
+    bus = get_bus()
+    return bus.stats() if bus is not None else None
@@ -0,0 +1,201 @@
+"""
+Last-known-good configurations, served when MySQL or MongoDB fail or are slow.
+
+The lookups of the download path (device, profile, template, template body) log
+backend errors and carry on with None, which used to end in a 403 (or in a config
+rendered without the device's data). download_config now:
+
+- stores each successful response per device (key: MAC or identifier + extension)
+  in the 'last_good' cache namespace (L2, long TTL; written only when the content
+  changes or the entry is older than REFRESH_SECONDS);
+- collects the backend errors seen while building a response (collect() around the
+  build, note_error() in the lookups). With errors, the device's last good
+  response is served instead of the fresh result;
+- while backends are degraded (an error, or a build slower than
+  PROVISION_LAST_GOOD_SLOW_SECONDS, in the last PROVISION_LAST_GOOD_DEGRADED_SECONDS),
+  builds for devices with a stored response run in a small thread pool and the
+  request waits at most PROVISION_LAST_GOOD_WAIT_SECONDS: past that the stored
+  response is served (stale-while-revalidate) and the build finishes in the
+  background, refreshing the stored response. One background build per device at
+  a time.
+
+Stale responses carry X-Provision-Stale ("error" or "slow"), Age and
+Warning: 110 headers and are counted in stats() (shown by the cache stats
+endpoint). Disabled with settings.PROVISION_LAST_GOOD = False.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+from api.cache import provision_cache
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "last_good"
+
+# an unchanged response is written again after this long (keeps the L2 entry alive)
+REFRESH_SECONDS = 3600
+
+_errors = ContextVar("provision_backend_errors", default=None)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enabled() -> bool:
+    return _setting("PROVISION_LAST_GOOD", True)
+
+
+# --- backend errors of the current build -----------------------------------------
+
+@contextmanager
+def collect():
+    """Collect the note_error() calls made in this block (same thread); yields the list."""
+    errors = []
+    token = _errors.set(errors)
+    try:
+        yield errors
+    finally:
+        _errors.reset(token)
+
+
+def note_error(source, exc=None):
+    """Record a backend failure ('device', 'profile', 'template', ...) for the running build."""
+    errors = _errors.get()
+    if errors is not None:
+        errors.append(f"{source}: {type(exc).__name__}" if exc is not None else source)
+    mark_degraded()
+
+
+# --- degraded state --------------------------------------------------------------
+
+_degraded_until = 0.0
+
+
+def mark_degraded():
+    global _degraded_until
+    _degraded_until = time.monotonic() + _setting("PROVISION_LAST_GOOD_DEGRADED_SECONDS", 30)
+
+
+def degraded() -> bool:
+    return time.monotonic() < _degraded_until
+
+
+def timed(build):
+    """Run build(); a build slower than PROVISION_LAST_GOOD_SLOW_SECONDS marks backends degraded."""
+    started = time.monotonic()
+    try:
+        return build()
+    finally:
+        if time.monotonic() - started > _setting("PROVISION_LAST_GOOD_SLOW_SECONDS", 2.0):
+            mark_degraded()
+
+
+# --- stored responses ------------------------------------------------------------
+
+def key_for(identifier, ext) -> str:
+    return f"{identifier}:{ext}"
+
+
+def get(key):
+    """{"content", "content_type", "digest", "stored_at"} or None."""
+    if not enabled():
+        return None
+    return provision_cache.get(NAMESPACE, key)
+
+
+def remember(key, content, content_type, current=None):
+    """Store a successful response unless current (the entry get() returned) is identical and recent."""
+    if not enabled():
+        return
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    now = time.time()
+    if current is not None and current["digest"] == digest and now - current["stored_at"] < REFRESH_SECONDS:
+        return
+    provision_cache.set(NAMESPACE, key, {"content": content, "content_type": content_type, "digest": digest, "stored_at": now})
+    _count("stored")
+
+
+# --- builds under a deadline -----------------------------------------------------
+
+_executor = None
+_executor_pid = None
+_in_flight = {}  # key -> Future
+_lock = threading.RLock()  # a build that already finished runs its done callback right away
+
+
+def _pool():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(
+            max_workers=_setting("PROVISION_LAST_GOOD_REFRESH_THREADS", 4), thread_name_prefix="provision-last-good"
+        )
+        _executor_pid = os.getpid()
+        _in_flight.clear()
+    return _executor
+
+
+def _run_in_thread(build):
+    try:
+        return build()
+    finally:
+        # pool threads get their own DB connection; do not leak it
+        connections.close_all()
+
+
+def _finished(key, future):
+    with _lock:
+        if _in_flight.get(key) is future:
+            del _in_flight[key]
+
+
+def run_with_deadline(key, build):
+    """
+    Run build() in the pool and wait up to PROVISION_LAST_GOOD_WAIT_SECONDS. Returns
+    (True, result) or (False, None) on timeout (build keeps running). A build already
+    running for key is joined instead of starting another one.
+    """
+    with _lock:
+        future = _in_flight.get(key)
+        if future is None:
+            future = _pool().submit(_run_in_thread, build)
+            _in_flight[key] = future
+            future.add_done_callback(lambda f: _finished(key, f))
+    try:
+        return True, future.result(_setting("PROVISION_LAST_GOOD_WAIT_SECONDS", 1.0))
+    except FutureTimeout:
+        return False, None
+
+
+# --- stats -----------------------------------------------------------------------
+
+_counters = {"stored": 0, "stale_error": 0, "stale_slow": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] = _counters.get(name, 0) + 1
+
+
+def served_stale(key, reason, errors=()):
+    _count(f"stale_{reason}")
+    logger.warning("Serving last good config for %s (%s%s)", key, reason, f": {', '.join(errors)}" if errors else "")
+
+
+def stats() -> dict:
+    with _counters_lock:
+        data = dict(_counters)
+    data["degraded"] = degraded()
+    data["refreshing"] = len(_in_flight)
+    return data
@@ -0,0 +1,344 @@
+"""
+Load generator for /api/download-xml/: simulates phones booting or polling for
+their configuration, to measure how many phones per second a node sustains.
+
+- load_fleet() builds phones from core.DeviceConfig: the MAC (written in the
+  separators/case phones really send), and a User-Agent with the firmware last
+  reported by that device (core.DeviceLastSeen) or one from UA_POOL. A share of
+  unknown MACs can be mixed in (unregistered phones).
+- Storm profiles yield (offset in seconds, phone) in time order:
+  ramp (arrival rate growing linearly up to `rate`), herd (every phone once,
+  within `spread` seconds: power restored to a site) and steady (every phone
+  polls each `interval` seconds, with jitter).
+- run_storm() replays a schedule with asyncio (raw HTTP/1.1 over asyncio streams,
+  one connection per request like a booting phone, at most `concurrency` in
+  flight) and returns a Stats report: throughput, latency percentiles and
+  histogram, outcomes by HTTP status or error, and how late requests were sent
+  compared with the schedule (client saturation shows up there, not as latency).
+- serve() runs the app in a child process with Django's threaded server, optionally
+  with an in-memory Mongo (mongomock, when installed) seeded with a template, so
+  the whole loop runs offline against SQLite/MySQL.
+
+Entry point: `manage.py loadtest_provisioning` (core/management/commands).
+Numbers from the threaded development server are a lower bound; point --url at
+gunicorn (gunicorn.conf.py) to size real instances.
+"""
+import asyncio
+import heapq
+import logging
+import math
+import random
+import ssl
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# vendor, model, firmware version: used for devices that never reported one
+UA_POOL = (
+    ("Yealink", "T46U", "108.86.0.45"),
+    ("Yealink", "T54W", "96.86.0.100"),
+    ("Grandstream", "GXP2170", "1.0.11.74"),
+    ("Polycom", "VVX450", "6.4.3.2000"),
+    ("Fanvil", "X4U", "2.12.3"),
+    ("Ale", "H2P", "2.10"),
+)
+
+DEFAULT_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<config>
+  <account>{{ account }}</account>
+  <displayname>{{ displayname }}</displayname>
+  <sip server="{{ sipserver }}" port="{{ port }}" domain="{{ domain }}"/>
+  <mac>%%macaddress%%</mac>
+</config>
+"""
+
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+# --- fleet -------------------------------------------------------------------
+
+def _format_mac(mac, rng):
+    """The same MAC the way different phones send it."""
+    style = rng.randrange(4)
+    if style == 0:
+        return mac
+    if style == 1:
+        return mac.upper()
+    pairs = [mac[i:i + 2] for i in range(0, len(mac), 2)]
+    return (":" if style == 2 else "-").join(pairs).upper()
+
+
+def load_fleet(devices=None, unknown_ratio=0.0, seed=None, ua_pool=UA_POOL) -> list:
+    """
+    [(user_agent, ...)] phones: up to `devices` DeviceConfig rows (all when None)
+    plus unknown MACs so that they are `unknown_ratio` of the fleet.
+    """
+    from core.models import DeviceConfig, DeviceLastSeen
+
+    rng = random.Random(seed)
+    qs = DeviceConfig.objects.order_by("?" if devices else "pk").values_list("mac_address", "identifier")
+    rows = list(qs[:devices] if devices else qs)
+    firmware = {}
+    macs = [mac for mac, _ in rows if mac]
+    for start in range(0, len(macs), 1000):
+        for mac, vendor, model, version in DeviceLastSeen.objects.filter(mac_address__in=macs[start:start + 1000]).values_list(
+            "mac_address", "vendor", "model", "version"
+        ):
+            if vendor and model and version:
+                firmware[mac] = (vendor, model, version)
+
+    phones = []
+    for mac, identifier in rows:
+        vendor, model, version = firmware.get(mac) or rng.choice(ua_pool)
+        phones.append(f"{vendor} {model} {version} {_format_mac(mac, rng) if mac else identifier}")
+    if 0 < unknown_ratio < 1:
+        for _ in range(round(len(rows) * unknown_ratio / (1 - unknown_ratio))):
+            vendor, model, version = rng.choice(ua_pool)
+            phones.append(f"{vendor} {model} {version} {_format_mac('%012x' % rng.getrandbits(48), rng)}")
+    rng.shuffle(phones)
+    return phones
+
+
+# --- storm profiles ----------------------------------------------------------
+
+def ramp(phones, duration, rate):
+    """Arrival rate grows linearly from 0 to `rate` requests/s over `duration` seconds."""
+    total = int(rate * duration / 2)
+    for k in range(total):
+        yield math.sqrt(2 * duration * k / rate), phones[k % len(phones)]
+
+
+def herd(phones, spread=0.0, seed=None):
+    """Every phone once, at a random moment within `spread` seconds (0 = all at once)."""
+    rng = random.Random(seed)
+    yield from sorted(((rng.uniform(0, spread) if spread else 0.0, phone) for phone in phones), key=lambda item: item[0])
+
+
+def steady(phones, duration, interval, jitter=0.1, seed=None):
+    """Every phone polls each `interval` seconds (± jitter * interval), for `duration` seconds."""
+    rng = random.Random(seed)
+    heap = [(rng.uniform(0, interval), i) for i in range(len(phones))]
+    heapq.heapify(heap)
+    while heap:
+        offset, i = heapq.heappop(heap)
+        if offset >= duration:
+            continue
+        yield offset, phones[i]
+        heapq.heappush(heap, (offset + interval * (1 + rng.uniform(-jitter, jitter)), i))
+
+
+PROFILES = ("ramp", "herd", "steady")
+
+
+def build_schedule(profile, phones, *, duration=60.0, rate=100.0, spread=0.0, interval=30.0, jitter=0.1, seed=None):
+    if profile == "ramp":
+        return ramp(phones, duration, rate)
+    if profile == "herd":
+        return herd(phones, spread, seed)
+    if profile == "steady":
+        return steady(phones, duration, interval, jitter, seed)
+    raise ValueError(f"Unknown storm profile {profile!r} (choose from {', '.join(PROFILES)})")
+
+
+# --- stats -------------------------------------------------------------------
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Stats:
+    """Outcomes, latencies (ms) and send lag (ms) of every request of a run."""
+
+    def __init__(self):
+        self.latencies = []
+        self.lags = []
+        self.outcomes = Counter()
+        self.per_second = Counter()
+        self.bytes = 0
+
+    def add(self, outcome, latency_ms, lag_ms, second, size=0):
+        self.outcomes[outcome] += 1
+        self.latencies.append(latency_ms)
+        self.lags.append(lag_ms)
+        self.per_second[second] += 1
+        self.bytes += size
+
+    def report(self, seconds) -> dict:
+        latencies = sorted(self.latencies)
+        lags = sorted(self.lags)
+        total = len(latencies)
+        histogram, start = [], 0
+        for bound in HISTOGRAM_MS + (None,):
+            end = len(latencies) if bound is None else _bisect_right(latencies, bound, start)
+            histogram.append({"le_ms": bound, "count": end - start})
+            start = end
+        ok = self.outcomes.get("200", 0)
+        return {
+            "requests": total,
+            "ok": ok,
+            "errors": total - ok,
+            "seconds": round(seconds, 3),
+            "throughput": round(total / seconds, 1) if seconds else None,
+            "ok_per_second": round(ok / seconds, 1) if seconds else None,
+            "peak_per_second": max(self.per_second.values(), default=0),
+            "bytes": self.bytes,
+            "latency_ms": {
+                "mean": round(sum(latencies) / total, 2) if total else None,
+                "p50": _round(_percentile(latencies, 0.50)),
+                "p90": _round(_percentile(latencies, 0.90)),
+                "p99": _round(_percentile(latencies, 0.99)),
+                "max": _round(latencies[-1] if latencies else None),
+            },
+            "send_lag_ms": {"p50": _round(_percentile(lags, 0.50)), "p99": _round(_percentile(lags, 0.99))},
+            "histogram": histogram,
+            "outcomes": dict(self.outcomes.most_common()),
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def _bisect_right(values, bound, lo):
+    hi = len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] <= bound:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+# --- client ------------------------------------------------------------------
+
+async def fetch(url, user_agent, headers=None, timeout=10.0):
+    """GET url as a phone would (new connection, Connection: close). Returns (status, body bytes)."""
+    parts = urlsplit(url)
+    secure = parts.scheme == "https"
+    port = parts.port or (443 if secure else 80)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    lines = [f"GET {path} HTTP/1.1", f"Host: {parts.netloc}", f"User-Agent: {user_agent}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def exchange():
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, port, ssl=ssl.create_default_context() if secure else None
+        )
+        try:
+            writer.write(request)
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    response = await asyncio.wait_for(exchange(), timeout)
+    head, _, body = response.partition(b"\r\n\r\n")
+    status_line = head.split(b"\r\n", 1)[0].split()
+    if len(status_line) < 2 or not status_line[1].isdigit():
+        raise ValueError("bad response")
+    return int(status_line[1]), body
+
+
+async def run_storm(url, schedule, concurrency=100, timeout=10.0, headers=None) -> Stats:
+    """Send the requests of schedule ((offset, user_agent) in time order) and collect their Stats."""
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    started = loop.time()
+
+    async def one(user_agent, due):
+        try:
+            sent = loop.time()
+            try:
+                status, body = await fetch(url, user_agent, headers, timeout)
+                outcome, size = str(status), len(body)
+            except asyncio.TimeoutError:
+                outcome, size = "timeout", 0
+            except Exception as exc:
+                outcome, size = type(exc).__name__, 0
+            done = loop.time()
+            stats.add(outcome, (done - sent) * 1000, (sent - due) * 1000, int(done - started), size)
+        finally:
+            slots.release()
+
+    for offset, user_agent in schedule:
+        due = started + offset
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await slots.acquire()
+        task = asyncio.create_task(one(user_agent, due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return stats
+
+
+def run(url, schedule, concurrency=100, timeout=10.0, headers=None) -> dict:
+    """Blocking wrapper around run_storm(); returns the report."""
+    started = time.monotonic()
+    stats = asyncio.run(run_storm(url, schedule, concurrency, timeout, headers))
+    return stats.report(time.monotonic() - started)
+
+
+# --- local server --------------------------------------------------------------
+
+def seed_templates(db, text, models=()):
+    """Publish `text` under every profile's template_ref and under each model name (lower-case)."""
+    from api.utils.templates import build_template_doc, publish_template
+    from core.models import DeviceProfile
+
+    names = set(DeviceProfile.objects.exclude(template_ref="").values_list("template_ref", flat=True))
+    names.update(model.lower() for model in models)
+    for name in sorted(names):
+        publish_template(db, build_template_doc(name, text, file_type="xml", uploaded_by="loadtest"))
+    return sorted(names)
+
+
+def serve(port, memory_mongo=False, template_text=None, ready=None):
+    """Child process: Django's threaded server on 127.0.0.1:port (see start_server)."""
+    import django
+
+    django.setup()
+    from django.conf import settings
+    from django.core.servers.basehttp import run as run_server
+    from django.core.wsgi import get_wsgi_application
+
+    application = get_wsgi_application()
+    logging.getLogger("django.server").setLevel(logging.WARNING)  # no line per request
+    if memory_mongo:
+        import mongomock
+
+        from api.utils.mongo import use_mongo_database
+
+        db = mongomock.MongoClient()[settings.MONGODB.get("DB_NAME") or "provision_mongo"]
+        use_mongo_database(db)
+        seed_templates(db, template_text or DEFAULT_TEMPLATE, [model for _, model, _ in UA_POOL])
+    run_server("127.0.0.1", port, application, threading=True, on_bind=lambda _: ready and ready.set())
+
+
+def start_server(port, memory_mongo=False, template_text=None, timeout=60):
+    """Start serve() in a spawned process and wait until it accepts connections. Returns the process."""
+    import multiprocessing
+
+    if memory_mongo:
+        try:
+            import mongomock  # noqa: F401
+        except ImportError as exc:
+            raise RuntimeError("The in-memory Mongo needs the 'mongomock' package (pip install mongomock)") from exc
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Event()
+    process = ctx.Process(target=serve, args=(port, memory_mongo, template_text, ready), daemon=True)
+    process.start()
+    if not ready.wait(timeout):
+        process.terminate()
+        raise RuntimeError(f"Local server did not start on port {port} within {timeout}s")
+    return process
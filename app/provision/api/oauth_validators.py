@@ -0,0 +1,92 @@
+"""
+OAuth2 validator with a cache for access-token lookups.
+
+django-oauth-toolkit loads the AccessToken row (with application and user) from
+MySQL on every authenticated request. CachedOAuth2Validator keeps the plain fields
+of the loaded token (scope, expiry, ids) and of its user and application in the
+'oauth_token' namespace of api.cache, keyed by the sha256 of the bearer token (the
+same checksum DOT stores in AccessToken.token_checksum), so the token itself never
+becomes a cache key; hits rebuild the instances from those fields (Model.from_db,
+other columns deferred). Scope and expiry checks still run on every request
+(AccessToken.is_valid); the entry TTL is capped at the token's remaining lifetime
+and unknown tokens are not cached.
+
+Revocation (/o/revoke_token/, refresh rotation, cleartokens) deletes the AccessToken
+row; api.signals drops the cache entry on post_delete, and the entries of every
+token of a user or application when it is saved or deleted (deactivation, new
+redirect URIs...). The drop is published on the invalidation bus (api.invalidation,
+EVENT_OAUTH_TOKEN), so the other workers evict their copy too, including a
+process-local L2 (LocMemCache).
+
+Enabled through OAUTH2_PROVIDER["OAUTH2_VALIDATOR_CLASS"].
+"""
+import hashlib
+
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model, get_application_model
+from oauth2_provider.oauth2_validators import OAuth2Validator
+
+from api.cache import provision_cache
+
+NAMESPACE = "oauth_token"
+
+TOKEN_FIELDS = ("id", "user_id", "application_id", "expires", "scope")
+APPLICATION_FIELDS = ("id", "user_id", "client_id", "name", "client_type", "authorization_grant_type")
+
+
+def token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _user_fields():
+    User = get_user_model()
+    return tuple(dict.fromkeys(("id", User.USERNAME_FIELD, User.get_email_field_name(), "is_active", "is_staff", "is_superuser")))
+
+
+def _values(instance, fields):
+    return None if instance is None else {field: getattr(instance, field, None) for field in fields}
+
+
+def _from_values(model, values, db):
+    # from_db() takes the values in concrete field order
+    names = [f.attname for f in model._meta.concrete_fields if f.attname in values]
+    return model.from_db(db, names, [values[name] for name in names])
+
+
+def token_entry(access_token) -> dict:
+    """Plain fields of access_token, its user and its application (the cached value)."""
+    return {
+        "db": access_token._state.db,
+        "token": _values(access_token, TOKEN_FIELDS),
+        "user": _values(access_token.user, _user_fields()),
+        "application": _values(access_token.application, APPLICATION_FIELDS),
+    }
+
+
+def token_from_entry(entry, token: str):
+    """AccessToken rebuilt from token_entry(); user and application attached, other columns deferred."""
+    db = entry["db"]
+    access_token = _from_values(get_access_token_model(), entry["token"], db)
+    access_token.token = token
+    access_token.user = _from_values(get_user_model(), entry["user"], db) if entry["user"] else None
+    if entry["application"]:
+        access_token.application = _from_values(get_application_model(), entry["application"], db)
+    return access_token
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    def _load_access_token(self, token):
+        key = token_cache_key(token)
+        entry = provision_cache.get(NAMESPACE, key)
+        if entry is not None:
+            return token_from_entry(entry, token)
+
+        access_token = super()._load_access_token(token)
+        if access_token is not None and access_token.expires:
+            remaining = int((access_token.expires - timezone.now()).total_seconds())
+            ttl = provision_cache.namespace_config(NAMESPACE)["ttl"]
+            ttl = remaining if ttl is None else min(ttl, remaining)
+            if ttl > 0:
+                provision_cache.set(NAMESPACE, key, token_entry(access_token), ttl=ttl)
+        return access_token
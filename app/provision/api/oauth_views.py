@@ -3,12 +3,15 @@ from django.views.decorators.http import require_GET
 from oauth2_provider.decorators import protected_resource
 from django.utils import timezone
 import logging
+import os
+
+from api.oauth_validators import CachedOAuth2Validator
 
 logger = logging.getLogger(__name__)
 
 
 @require_GET
-@protected_resource(scopes=["read"])
+@protected_resource(scopes=["read"], validator_cls=CachedOAuth2Validator)
 def whoami(request, *args, **kwargs):
     """
     Example protected endpoint that returns basic info about the authenticated user/token.
@@ -17,7 +20,8 @@ def whoami(request, *args, **kwargs):
       - Use an OAuth2 access token as Bearer token in Authorization header.
       - The endpoint requires the 'read' scope (see OAUTH2_PROVIDER['SCOPES']).
     """
-    user = getattr(request, "user", None)
+    # protected_resource exposes the token owner as request.resource_owner
+    user = getattr(request, "resource_owner", None) or getattr(request, "user", None)
     token = getattr(request, "oauth2_provider_token", None) or getattr(request, "auth", None)
     data = {
         "username": getattr(user, "username", None),
@@ -27,4 +31,34 @@ def whoami(request, *args, **kwargs):
         "timestamp": timezone.now().isoformat(),
     }
     logger.debug("whoami called: %s", data)
-    return JsonResponse(data)
\ No newline at end of file
+    return JsonResponse(data)
+
+
+@require_GET
+@protected_resource(scopes=["admin"], validator_cls=CachedOAuth2Validator)
+def cache_stats(request, *args, **kwargs):
+    """
+    Hit/miss counters of the provisioning cache (api.cache) for the worker serving the request.
+
+    "invalidation" has the counters and last lag of the worker's invalidation bus
+    subscriber (api.invalidation); "template_arena" the shared template store it has
+    mapped (api.template_arena); "render_overruns" the renders aborted per template
+    (api.sandbox); "last_good" the last-known-good configs stored and served stale
+    (api.last_good); "breakers" the state and rolling window of the MySQL/MongoDB
+    circuit breakers (api.breaker).
+
+    Counters are per process: with several gunicorn workers each call may hit a different one.
+    Requires the 'admin' scope.
+    """
+    from api import breaker, invalidation, last_good, sandbox, template_arena
+    from api.cache import provision_cache
+
+    data = provision_cache.stats()
+    data["invalidation"] = invalidation.stats()
+    data["template_arena"] = template_arena.stats()
+    data["render_overruns"] = sandbox.overruns()
+    data["last_good"] = last_good.stats()
+    data["breakers"] = breaker.stats()
+    data["pid"] = os.getpid()
+    data["timestamp"] = timezone.now().isoformat()
+    return JsonResponse(data)
@@ -0,0 +1,348 @@
+"""
+Background re-render of the devices affected by a DeviceProfile or template change.
+
+Saving a profile (api.signals) or importing, rolling back or deleting a template
+(core.views) calls schedule_propagation(). It records a core.models.PropagationRun
+and, after the surrounding transaction commits, hands it to a background thread, so
+the admin request returns immediately. The run:
+
+1. finds the affected devices with one set-based query: the profile's devices, or
+   the devices whose profile.template_ref names the template (case-insensitively,
+   like api.views._find_template_by_ref);
+2. resolves and compiles the template once per profile (template_ref) or, for
+   profiles without template_ref, once per profile and phone model, like
+   download_config does (api.views.get_template_from_mongo, both extensions),
+   refreshing the 'profile', 'template' and 'compiled' entries of api.cache along
+   the way;
+3. renders the devices in chunks on a thread pool (settings.PROVISION_PROPAGATION_WORKERS
+   threads, PROVISION_PROPAGATION_CHUNK_SIZE devices per chunk) and stores each
+   output in the 'rendered' namespace under the key download_config computes
+   (api.views._rendered_cache_key), so the next download is a cache hit;
+4. stores counts and per-device errors (e.g. TemplateSyntaxError, missing template)
+   on the run, visible in the admin.
+
+There is no User-Agent here: vendor/model/version come from the phone's last download
+(core.models.DeviceLastSeen). Devices that never downloaded are rendered with them
+empty when their profile has a template_ref (the output is only stored when the
+template does not read them) and skipped otherwise, since their model is unknown.
+A template change reaches the devices whose profile names it in template_ref;
+devices resolved by model pick the new version up at their next download.
+
+With settings.PROVISION_PROPAGATION_RUNNER = "jobs" the run is queued as a job
+(api.tasks.propagation_task) for `manage.py runjobs` instead of a thread in the web
+worker. Runs interrupted by a restart stay pending/running; `manage.py
+propagate_changes --pending` picks them up.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.cache import provision_cache
+from api.render_context import UA_PLACEHOLDERS, build_render_context, profile_row
+from api.utils.templates import get_template_body
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def affected_devices(profile_ids=(), template_ids=()):
+    """QuerySet (a single query) of the devices rendered with these profiles or templates."""
+    from core.models import DeviceConfig
+
+    condition = Q()
+    if profile_ids:
+        condition |= Q(profile_id__in=list(profile_ids))
+    for template_id in template_ids:
+        condition |= Q(profile__template_ref__iexact=template_id)
+    if not condition:
+        return DeviceConfig.objects.none()
+    return DeviceConfig.objects.filter(condition)
+
+
+def _extension(doc):
+    return doc.get("extension") or doc.get("file_type") or "xml"
+
+
+def _compile(doc, name):
+    """(template_doc, text, ext), or raise with the reason it cannot render."""
+    from api.views import get_compiled_template
+
+    text = get_template_body(doc)
+    if not isinstance(text, str):
+        raise ValueError(f"template '{name}' has no body")
+    # compile errors (TemplateSyntaxError) surface here, once per template
+    get_compiled_template(text, cache_key=doc.get("sha256"))
+    return doc, text, _extension(doc)
+
+
+def _resolve_template(profile, model=None):
+    """
+    [(template_doc, text, ext)] the devices of profile download: its template_ref, or
+    without one the templates resolved for model (xml and cfg, like download_config).
+    Raises with the reason they cannot render.
+    """
+    from api.views import _find_template_by_ref, get_template_from_mongo
+
+    if profile is not None and profile.template_ref:
+        doc = _find_template_by_ref(profile.template_ref)
+        if not doc:
+            raise LookupError(f"template '{profile.template_ref}' not found")
+        return [_compile(doc, profile.template_ref)]
+    resolved = {}
+    for ext in ("xml", "cfg"):
+        doc = get_template_from_mongo(model, ext)
+        if doc:
+            doc, text, _ = _compile(doc, doc.get("_id"))
+            resolved[doc.get("_id"), ext] = (doc, text, ext)
+    if not resolved:
+        raise LookupError(f"no template for model '{model}'")
+    return list(resolved.values())
+
+
+def render_device(device, profile, template_doc, text, ua_data=None, ext=None):
+    """
+    Render one device exactly as api.views.download_config would (ua_data: vendor, model,
+    version of its last download, empty when unknown) and store the output in the
+    'rendered' cache when download_config would look it up under the same key.
+    """
+    from api.views import render_template, substitute_percent_placeholders
+
+    ua_data = ua_data or ("", "", "", device.identifier)
+    context = build_render_context(device, profile, ua_data)
+    output = render_template(text, context, cache_key=template_doc.get("sha256"), template=template_doc.get("_id"))
+    output = substitute_percent_placeholders(output, context)
+    _store_rendered(template_doc, context, device, profile, ua_data, ext or _extension(template_doc), output)
+    return output
+
+
+def _store_rendered(template_doc, context, device, profile, ua_data, ext, output):
+    from api.views import _rendered_cache_key, template_variables
+
+    # only keys built from the values the template reads: the fallback key includes the
+    # User-Agent identifier exactly as the phone sends it, which is not known here
+    variables = template_variables(template_doc) if template_doc.get("sha256") else None
+    if variables is None:
+        return
+    if not any(ua_data[:3]) and set(variables) & set(UA_PLACEHOLDERS):
+        return
+    key = _rendered_cache_key(template_doc, context, device, profile, ua_data, ext)
+    if key:
+        provision_cache.set("rendered", key, output)
+
+
+def _error(device_id, identifier, exc):
+    return {"device": device_id, "identifier": identifier, "error": f"{type(exc).__name__}: {exc}"}
+
+
+def _render_chunk(device_ids, profiles, templates, plans):
+    """Render one chunk of devices (plans: device id -> (User-Agent data, templates key)). Returns (rendered, bytes, errors)."""
+    from core.models import DeviceConfig
+
+    rendered, size, errors = 0, 0, []
+    for device in DeviceConfig.objects.filter(pk__in=device_ids).order_by("pk"):
+        profile = profiles.get(device.profile_id)
+        ua_data, template_key = plans[device.pk]
+        try:
+            for doc, text, ext in templates[template_key]:
+                size += len(render_device(device, profile, doc, text, ua_data, ext))
+            rendered += 1
+        except Exception as exc:
+            errors.append(_error(device.pk, device.identifier, exc))
+    return rendered, size, errors
+
+
+def _last_seen(macs):
+    """mac -> (vendor, model, version) of the last download (core.models.DeviceLastSeen)."""
+    from core.models import DeviceLastSeen
+
+    macs = [mac for mac in macs if mac]
+    if not macs:
+        return {}
+    rows = DeviceLastSeen.objects.filter(mac_address__in=macs).values_list("mac_address", "vendor", "model", "version")
+    return {mac: (vendor, model, version) for mac, vendor, model, version in rows}
+
+
+def _render_chunk_in_thread(device_ids, profiles, templates, plans):
+    try:
+        return _render_chunk(device_ids, profiles, templates, plans)
+    finally:
+        # pool threads get their own DB connection; do not leak it
+        connections.close_all()
+
+
+def propagate(profile_ids=(), template_ids=(), run=None, workers=None, chunk_size=None, progress=None) -> dict:
+    """
+    Re-render every device affected by the given profiles/templates. Returns a report
+    (total, rendered, failed, skipped, bytes, errors, seconds); with run, the counts are
+    saved on it as each chunk finishes, and progress(done, total) is called likewise.
+    """
+    from core.models import DeviceProfile
+
+    workers = workers or _setting("PROVISION_PROPAGATION_WORKERS", 4)
+    chunk_size = chunk_size or _setting("PROVISION_PROPAGATION_CHUNK_SIZE", 500)
+    max_errors = _setting("PROVISION_PROPAGATION_MAX_ERRORS", 500)
+    started = time.monotonic()
+
+    rows = list(
+        affected_devices(profile_ids, template_ids).order_by("pk").values_list("pk", "identifier", "profile_id", "mac_address")
+    )
+    report = {"total": len(rows), "rendered": 0, "failed": 0, "skipped": 0, "bytes": 0, "errors": []}
+
+    def add_errors(errors):
+        report["failed"] += len(errors)
+        room = max_errors - len(report["errors"])
+        if room > 0:
+            report["errors"].extend(errors[:room])
+
+    def save_progress():
+        if progress is not None:
+            progress(report["rendered"] + report["failed"] + report["skipped"], report["total"])
+        if run is not None:
+            for field in ("total", "rendered", "failed", "skipped", "errors"):
+                setattr(run, field, report[field])
+            run.save(update_fields=["total", "rendered", "failed", "skipped", "errors"])
+
+    save_progress()
+
+    profiles = DeviceProfile.objects.in_bulk({row[2] for row in rows if row[2]})
+    for profile_id, profile in profiles.items():
+        provision_cache.set("profile", profile_id, profile_row(profile))
+    seen = _last_seen(row[3] for row in rows)
+    templates = {}  # (profile id, model or None) -> [(doc, text, ext)] or the exception
+    plans = {}
+    renderable = []
+    for device_id, identifier, profile_id, mac_address in rows:
+        profile = profiles.get(profile_id)
+        vendor, model, version = seen.get(mac_address, ("", "", ""))
+        if profile is not None and profile.template_ref:
+            template_key = (profile_id, None)
+        elif model:
+            template_key = (profile_id, model.strip().lower())
+        else:
+            # never downloaded: the template depends on a model we do not know
+            report["skipped"] += 1
+            continue
+        if template_key not in templates:
+            try:
+                templates[template_key] = _resolve_template(profile, template_key[1])
+            except Exception as exc:
+                templates[template_key] = exc
+        resolved = templates[template_key]
+        if isinstance(resolved, Exception):
+            add_errors([_error(device_id, identifier, resolved)])
+        else:
+            plans[device_id] = ((vendor, model, version, mac_address or identifier), template_key)
+            renderable.append(device_id)
+
+    chunks = [renderable[i:i + chunk_size] for i in range(0, len(renderable), chunk_size)]
+
+    def collect(result):
+        rendered, size, errors = result
+        report["rendered"] += rendered
+        report["bytes"] += size
+        add_errors(errors)
+        save_progress()
+
+    if len(chunks) == 1 or workers <= 1:
+        for chunk in chunks:
+            collect(_render_chunk(chunk, profiles, templates, plans))
+    elif chunks:
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks)), thread_name_prefix="propagate") as pool:
+            futures = [pool.submit(_render_chunk_in_thread, chunk, profiles, templates, plans) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    result = future.result()
+                except Exception as exc:
+                    logger.exception("Propagation chunk failed: %s", exc)
+                    result = (0, 0, [_error(device_id, None, exc) for device_id in chunk])
+                collect(result)
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    return report
+
+
+def run_propagation(run_id, progress=None):
+    """Execute a PropagationRun (background thread, job worker or propagate_changes)."""
+    from core.models import PropagationRun
+
+    run = PropagationRun.objects.filter(pk=run_id).first()
+    if run is None:
+        return None
+    run.status = PropagationRun.STATUS_RUNNING
+    run.started_at = timezone.now()
+    run.save(update_fields=["status", "started_at"])
+    if run.trigger == PropagationRun.TRIGGER_PROFILE:
+        kwargs = {"profile_ids": [int(run.target)]}
+    else:
+        kwargs = {"template_ids": [run.target]}
+    try:
+        report = propagate(run=run, progress=progress, **kwargs)
+    except Exception as exc:
+        logger.exception("Propagation %s failed: %s", run, exc)
+        run.status = PropagationRun.STATUS_FAILED
+        run.errors = list(run.errors or []) + [_error(None, None, exc)]
+    else:
+        run.status = PropagationRun.STATUS_DONE
+        logger.info(
+            "Propagation %s: %s devices, %s rendered, %s failed, %s skipped in %.2fs",
+            run, report["total"], report["rendered"], report["failed"], report["skipped"], report["seconds"],
+        )
+    run.finished_at = timezone.now()
+    run.save(update_fields=["status", "errors", "finished_at"])
+    return run
+
+
+def _run_in_background(run_id):
+    close_old_connections()
+    try:
+        run_propagation(run_id)
+    except Exception:
+        logger.exception("Propagation run %s crashed", run_id)
+    finally:
+        connections.close_all()
+
+
+def _submit(run_id):
+    global _executor
+    if _setting("PROVISION_PROPAGATION_RUNNER", "thread") == "jobs":
+        from jobs.queue import enqueue
+
+        enqueue("api.tasks.propagation_task", {"run_id": run_id}, max_attempts=1)
+        return
+    with _executor_lock:
+        if _executor is None:
+            # one run at a time per process; each run fans out to its own render pool
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="propagation")
+    _executor.submit(_run_in_background, run_id)
+
+
+def schedule_propagation(trigger, target):
+    """
+    Record a PropagationRun for a changed profile (trigger 'profile', target = id) or
+    template ('template', target = _id) and start it after commit. A run still pending
+    for the same target is reused, so repeated saves do not queue duplicate work.
+    Returns the run, or None when settings.PROVISION_PROPAGATION is off.
+    """
+    from core.models import PropagationRun
+
+    if not _setting("PROVISION_PROPAGATION", False):
+        return None
+    target = str(target)
+    run = PropagationRun.objects.filter(trigger=trigger, target=target, status=PropagationRun.STATUS_PENDING).first()
+    if run is not None:
+        return run
+    run = PropagationRun.objects.create(trigger=trigger, target=target)
+    transaction.on_commit(lambda: _submit(run.pk))
+    return run
@@ -0,0 +1,275 @@
+"""
+Placeholder context used to render device configurations.
+
+The placeholders a template can use are declared once, here: UA_PLACEHOLDERS
+(from the User-Agent), DEVICE_PLACEHOLDERS (DeviceConfig columns) and
+PROFILE_PLACEHOLDERS (DeviceProfile columns). Everything else is derived from them:
+
+- ROW_COLUMNS: exactly those columns for a device joined with its profile, read by
+  load_device_row() in one values_list() query (no model instances);
+- DeviceRow / ProfileRow: the flat values of one device / one profile, cached by
+  download_config under 'device' ('mac:<mac>', 'id:<identifier>') and 'profile'
+  (profile id) in api.cache. The ProfileRow is shared by every device of the profile;
+- RenderContext: a read-only mapping over the (User-Agent, device, profile) value
+  tuples. Building it allocates one small object per request instead of a
+  26-key dict; Django's Context and substitute_percent_placeholders read it like
+  a dict.
+
+build_render_context() builds the same context from model instances or values()
+rows (background re-render in api.propagation, batch rendering in api.batch_render).
+"""
+from collections.abc import Mapping
+
+UA_PLACEHOLDERS = ("vendor", "model", "version")
+
+# placeholder, DeviceConfig column; empty/NULL columns render as ""
+DEVICE_PLACEHOLDERS = (
+    ("identifier", "identifier"),
+    ("account", "identifier"),
+    ("displayname", "display_name"),
+    ("user", "user_register"),
+    ("passwd", "passwd_register"),
+    ("macaddress", "mac_address"),  # without a MAC: the identifier from the User-Agent, normalized
+    ("ip_address", "ip_address"),
+    ("public_ip", "public_ip"),
+    ("private_ip", "private_ip"),
+)
+
+# placeholder, DeviceProfile column, value for devices without a profile
+PROFILE_PLACEHOLDERS = (
+    ("sipserver", "sip_server", ""),
+    ("port", "port_server", ""),
+    ("backsipserver", "backup_server", ""),
+    ("backsipport", "backup_port", ""),
+    ("proxy", "proxy", ""),
+    ("domain", "domain_server", ""),
+    ("registerttl", "register_ttl", ""),
+    ("codecs", "voice_codecs", ""),
+    ("ntpserver", "ntp_server", ""),
+    ("provisionserver", "provision_server", ""),
+    ("provisionfile", "provision_file", ""),
+    ("vlanactive", "vlan_active", False),
+    ("vlanid", "vlan_id", ""),
+)
+
+DEVICE_COLUMNS = tuple(dict.fromkeys(column for _, column in DEVICE_PLACEHOLDERS))
+PROFILE_COLUMNS = tuple(dict.fromkeys(column for _, column, _ in PROFILE_PLACEHOLDERS))
+
+# one joined row: device metadata, device columns, profile metadata, profile columns
+_DEVICE_META = ("pk", "updated_at", "profile_id")
+# template_ref and the template pinned from it (api.template_pointer)
+PROFILE_TEMPLATE_FIELDS = ("template_ref", "template_id", "template_sha256", "template_extension")
+_PROFILE_META = ("profile__updated_at",) + tuple(f"profile__{f}" for f in PROFILE_TEMPLATE_FIELDS)
+ROW_COLUMNS = _DEVICE_META + DEVICE_COLUMNS + _PROFILE_META + tuple(f"profile__{c}" for c in PROFILE_COLUMNS)
+_PROFILE_OFFSET = len(_DEVICE_META) + len(DEVICE_COLUMNS)
+
+_DEVICE_POS = tuple(DEVICE_COLUMNS.index(column) for _, column in DEVICE_PLACEHOLDERS)
+_PROFILE_POS = tuple(PROFILE_COLUMNS.index(column) for _, column, _ in PROFILE_PLACEHOLDERS)
+_IDENTIFIER = 0
+_MACADDRESS = [name for name, _ in DEVICE_PLACEHOLDERS].index("macaddress")
+
+NO_PROFILE_VALUES = tuple(default for _, _, default in PROFILE_PLACEHOLDERS)
+
+KEYS = (
+    UA_PLACEHOLDERS
+    + tuple(name for name, _ in DEVICE_PLACEHOLDERS)
+    + tuple(name for name, _, _ in PROFILE_PLACEHOLDERS)
+)
+# key -> (part, position): 0 = User-Agent, 1 = device, 2 = profile
+_SLOTS = {}
+_SLOTS.update({name: (0, i) for i, name in enumerate(UA_PLACEHOLDERS)})
+_SLOTS.update({name: (1, i) for i, (name, _) in enumerate(DEVICE_PLACEHOLDERS)})
+_SLOTS.update({name: (2, i) for i, (name, _, _) in enumerate(PROFILE_PLACEHOLDERS)})
+
+
+class DeviceRow:
+    """Placeholder values of one device (DEVICE_PLACEHOLDERS order) and what the view needs around them."""
+
+    __slots__ = ("pk", "updated_at", "profile_id", "values")
+
+    def __init__(self, pk, updated_at, profile_id, values):
+        self.pk = pk
+        self.updated_at = updated_at
+        self.profile_id = profile_id
+        self.values = values
+
+    @property
+    def identifier(self):
+        return self.values[_IDENTIFIER]
+
+    @property
+    def mac_address(self):
+        return self.values[_MACADDRESS]
+
+    def __repr__(self):
+        return f"<DeviceRow {self.pk} {self.identifier}>"
+
+
+class ProfileRow:
+    """Placeholder values of one profile (PROFILE_PLACEHOLDERS order), shared by all its devices."""
+
+    __slots__ = ("pk", "updated_at", "template_ref", "template_id", "template_sha256", "template_extension", "values")
+
+    def __init__(self, pk, updated_at, template_ref, values, template_id="", template_sha256="", template_extension=""):
+        self.pk = pk
+        self.updated_at = updated_at
+        self.template_ref = template_ref
+        self.template_id = template_id or ""
+        self.template_sha256 = template_sha256 or ""
+        self.template_extension = template_extension or ""
+        self.values = values
+
+    def __repr__(self):
+        return f"<ProfileRow {self.pk}>"
+
+
+def _normalized(identifier):
+    from api.views import _normalize_mac
+
+    return _normalize_mac(identifier) or (identifier or "").strip()
+
+
+def _no_device_values(identifier):
+    values = [""] * len(DEVICE_PLACEHOLDERS)
+    values[_IDENTIFIER] = values[1] = identifier or ""
+    values[_MACADDRESS] = _normalized(identifier)
+    return tuple(values)
+
+
+def _with_mac(values, identifier):
+    if values[_MACADDRESS]:
+        return values
+    return values[:_MACADDRESS] + (_normalized(identifier),) + values[_MACADDRESS + 1:]
+
+
+def device_values(device, identifier):
+    """
+    Device placeholder values of a DeviceConfig (or values() row with attribute
+    access); identifier is the one from the User-Agent, used when device is None.
+    """
+    if device is None:
+        return _no_device_values(identifier)
+    return _with_mac(tuple(getattr(device, column) or "" for _, column in DEVICE_PLACEHOLDERS), identifier)
+
+
+def profile_values(profile):
+    """Profile placeholder values of a DeviceProfile (or values() row with attribute access), or of no profile."""
+    if profile is None:
+        return NO_PROFILE_VALUES
+    return tuple(getattr(profile, column) for _, column, _ in PROFILE_PLACEHOLDERS)
+
+
+def _profile_row(pk, updated_at, template_fields, columns):
+    template_ref, template_id, template_sha256, template_extension = template_fields
+    values = tuple(columns[i] for i in _PROFILE_POS)
+    return ProfileRow(pk, updated_at, template_ref, values, template_id, template_sha256, template_extension)
+
+
+def profile_row(profile):
+    return ProfileRow(
+        profile.pk, profile.updated_at, profile.template_ref, profile_values(profile),
+        profile.template_id, profile.template_sha256, profile.template_extension,
+    )
+
+
+def load_device_row(**lookup):
+    """
+    (DeviceRow, ProfileRow) of the device matching lookup (mac_address=... or
+    identifier=...), read in one joined query. (None, None) when there is no such
+    device; the ProfileRow is None for devices without a profile.
+    """
+    from core.models import DeviceConfig
+
+    rows = list(DeviceConfig.objects.filter(**lookup).values_list(*ROW_COLUMNS)[:2])
+    if len(rows) != 1:
+        return None, None
+    return split_row(rows[0])
+
+
+def split_row(row):
+    """(DeviceRow, ProfileRow or None) of a ROW_COLUMNS tuple."""
+    pk, updated_at, profile_id = row[:3]
+    columns = row[3:_PROFILE_OFFSET]
+    device = DeviceRow(pk, updated_at, profile_id, tuple(columns[i] or "" for i in _DEVICE_POS))
+    if not profile_id:
+        return device, None
+    meta = row[_PROFILE_OFFSET:_PROFILE_OFFSET + len(_PROFILE_META)]
+    return device, _profile_row(profile_id, meta[0], meta[1:], row[_PROFILE_OFFSET + len(_PROFILE_META):])
+
+
+def load_profile_row(profile_id):
+    """ProfileRow of a profile id, or None."""
+    from core.models import DeviceProfile
+
+    row = (
+        DeviceProfile.objects.filter(pk=profile_id)
+        .values_list("updated_at", *PROFILE_TEMPLATE_FIELDS, *PROFILE_COLUMNS)
+        .first()
+    )
+    if row is None:
+        return None
+    meta = len(PROFILE_TEMPLATE_FIELDS) + 1
+    return _profile_row(profile_id, row[0], row[1:meta], row[meta:])
+
+
+class RenderContext(Mapping):
+    """
+    Template context over three value tuples: the User-Agent (vendor, model,
+    version, ...), the device half (DEVICE_PLACEHOLDERS order) and the profile half
+    (PROFILE_PLACEHOLDERS order). Keys are lower-case. Template tags that assign
+    variables ({% cycle ... as x %}) store them in a small dict created on demand.
+    """
+
+    __slots__ = ("_ua", "_device", "_profile", "_extra")
+
+    lowercase_keys = True
+
+    def __init__(self, ua, device, profile=NO_PROFILE_VALUES):
+        self._ua = ua
+        self._device = device
+        self._profile = profile
+        self._extra = None
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        part, index = _SLOTS[key]
+        if part == 1:
+            return self._device[index]
+        if part == 2:
+            return self._profile[index]
+        return self._ua[index]
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return key in _SLOTS or (self._extra is not None and key in self._extra)
+
+    def __iter__(self):
+        yield from KEYS
+        if self._extra:
+            yield from (key for key in self._extra if key not in _SLOTS)
+
+    def __len__(self):
+        return len(KEYS) + (len([key for key in self._extra if key not in _SLOTS]) if self._extra else 0)
+
+    def __repr__(self):
+        return f"<RenderContext {dict(self)!r}>"
+
+
+def row_render_context(device, profile, ua_data):
+    """RenderContext of a cached DeviceRow and ProfileRow (either may be None); no copies of their values."""
+    identifier = ua_data[3]
+    values = _with_mac(device.values, identifier) if device is not None else _no_device_values(identifier)
+    return RenderContext(ua_data, values, profile.values if profile is not None else NO_PROFILE_VALUES)
+
+
+def build_render_context(device, profile, ua_data):
+    """
+    Context of the template placeholders from the User-Agent data (vendor, model,
+    version, identifier), a DeviceConfig and a DeviceProfile (either may be None).
+    """
+    return RenderContext(ua_data, device_values(device, ua_data[3]), profile_values(profile))
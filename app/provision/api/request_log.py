@@ -0,0 +1,172 @@
+"""
+Per-request timing log for the download path, and the non-blocking log handler.
+
+QueueStreamHandler (used by settings.LOGGING) only puts records on a bounded
+in-memory queue; a QueueListener thread writes them to the stream. Request threads
+never wait on stdout/stderr: when the queue is full the record is dropped and
+counted (handler.dropped). The listener is started lazily in each process (threads
+do not survive gunicorn's fork) and stopped, flushing the queue, at exit.
+
+download_config opens a RequestLog (begin()) and times its stages with stage()
+('device', 'profile', 'template', 'render'); finish() emits one JSON line on the
+'provision.requests' logger:
+
+  {"severity", "event": "provision_request", "ms", "status", "outcome", "device",
+   "template", "vendor", "model", "version", "ext", "stages": {name: ms}, "errors"}
+
+Only a sample of the requests is logged (settings.PROVISION_REQUEST_LOG_SAMPLE, 0..1);
+failures (status other than 200/304), stale responses (api.last_good) and requests slower
+than PROVISION_REQUEST_LOG_SLOW_MS are always logged. "severity" follows the Cloud
+Logging convention, so each line is indexed as a structured entry.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+logger = logging.getLogger("provision.requests")
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full at exit: wait for room instead of losing the stop signal
+        self.queue.put(self._sentinel, timeout=5)
+
+
+class QueueStreamHandler(QueueHandler):
+    """StreamHandler whose writes happen on a listener thread; emit() never blocks."""
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.stream = stream
+        self.maxsize = maxsize
+        self.listener = None
+        self.dropped = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # a queue inherited through fork may hold a locked mutex: start over
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = _Listener(self.queue, logging.StreamHandler(self.stream))
+            self.listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._stop, self.listener)
+
+    @staticmethod
+    def _stop(listener):
+        try:
+            listener.stop()
+        except Exception:
+            pass
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None and self._pid == os.getpid():
+            self._stop(self.listener)
+            self._pid = None
+        super().close()
+
+
+# --- per-request record -------------------------------------------------------------
+
+_current = ContextVar("provision_request_log", default=None)
+
+
+class RequestLog:
+    __slots__ = ("started", "stages", "fields")
+
+    def __init__(self, **fields):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fields = fields
+
+
+def begin(**fields) -> RequestLog:
+    """Start the record of the current request (this thread)."""
+    entry = RequestLog(**fields)
+    _current.set(entry)
+    return entry
+
+
+def current():
+    """The current request's RequestLog, or None."""
+    return _current.get()
+
+
+@contextmanager
+def bound(entry):
+    """Make entry the current record in another thread (e.g. api.last_good's pool)."""
+    token = _current.set(entry)
+    try:
+        yield entry
+    finally:
+        _current.reset(token)
+
+
+def annotate(**fields):
+    entry = _current.get()
+    if entry is not None:
+        entry.fields.update(fields)
+
+
+@contextmanager
+def stage(name):
+    """Add the block's duration (ms) to stage name of the current record, if any."""
+    entry = _current.get()
+    if entry is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - started) * 1000
+        entry.stages[name] = round(entry.stages.get(name, 0) + ms, 2)
+
+
+def _keep(ms, status, outcome) -> bool:
+    if status not in (200, 304) or outcome.startswith("stale"):
+        return True
+    if ms >= getattr(settings, "PROVISION_REQUEST_LOG_SLOW_MS", 500):
+        return True
+    sample = getattr(settings, "PROVISION_REQUEST_LOG_SAMPLE", 0.01)
+    return sample >= 1 or random.random() < sample
+
+
+def finish(entry, status):
+    """Emit entry as one JSON line if it is sampled (or failed, stale or slow)."""
+    _current.set(None)
+    outcome = entry.fields.pop("outcome", "ok")
+    ms = round((time.perf_counter() - entry.started) * 1000, 2)
+    if not logger.isEnabledFor(logging.INFO) or not _keep(ms, status, outcome):
+        return
+    record = {
+        "severity": "INFO" if status in (200, 304) and outcome in ("ok", "not_modified") else "WARNING",
+        "event": "provision_request",
+        "ms": ms,
+        "status": status,
+        "outcome": outcome,
+    }
+    record.update(entry.fields)
+    record["stages"] = entry.stages
+    logger.info(json.dumps(record, default=str, separators=(",", ":")))
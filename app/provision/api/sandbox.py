@@ -0,0 +1,367 @@
+"""
+Render budget for staff-uploaded templates.
+
+Templates are rendered with the full Django template engine; a template with deep
+{% for %} nesting over long values, or a huge body, could keep a worker busy for
+seconds. render() runs a compiled template under a budget:
+
+- steps: every context lookup and loop assignment counts one step (BudgetContext);
+  more than settings.PROVISION_RENDER_MAX_STEPS aborts the render;
+- CPU time: checked every few steps against settings.PROVISION_RENDER_CPU_SECONDS
+  (time.thread_time, so waiting on other threads does not count);
+- output: more than settings.PROVISION_RENDER_MAX_OUTPUT_CHARS characters is not served.
+
+With settings.PROVISION_RENDER_POOL > 0 renders run in that many spawned processes
+(multiprocessing.Pool): the CPU budget is then also enforced by a CPU timer signal,
+an optional address-space limit (PROVISION_RENDER_POOL_MEMORY_MB) bounds memory, and
+a render that does not answer in time gets the pool terminated and replaced. The
+request thread only waits.
+
+Overruns raise RenderBudgetExceeded, are logged and counted per template
+(overruns(); shown by the cache stats endpoint). download_config answers them like
+any render error and api.propagation reports them per device.
+
+check_template() runs at import (core.views.import_template): it compiles the
+template, measures it (nodes, loops, loop nesting, text inside loops) and renders it
+once with an empty context under the same budget, rejecting outliers before they
+are published. The metrics are kept on the version document ('complexity').
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing import TimeoutError as PoolTimeout
+
+from django.conf import settings
+from django.template import Context
+
+from api.cache import provision_cache
+
+logger = logging.getLogger(__name__)
+
+# CPU time is read every CHECK_EVERY steps (thread_time costs ~1 us)
+CHECK_EVERY = 64
+
+
+class RenderBudgetExceeded(Exception):
+    """A render used more steps, CPU time or output than allowed."""
+
+    def __init__(self, reason, template=None):
+        super().__init__(f"render budget exceeded: {reason}")
+        self.reason = reason
+        self.template = template
+
+
+class TemplateRejected(ValueError):
+    """A template failed check_template() at import."""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def limits() -> dict:
+    return {
+        "steps": _setting("PROVISION_RENDER_MAX_STEPS", 100000),
+        "cpu_seconds": _setting("PROVISION_RENDER_CPU_SECONDS", 0.5),
+        "output_chars": _setting("PROVISION_RENDER_MAX_OUTPUT_CHARS", 4 * 1024 * 1024),
+    }
+
+
+class BudgetContext(Context):
+    """Django Context that counts lookups/assignments and stops the render when over budget."""
+
+    def __init__(self, dict_=None, max_steps=None, cpu_seconds=None):
+        super().__init__(dict_)
+        self.steps = 0
+        self._max_steps = max_steps
+        self._cpu_deadline = time.thread_time() + cpu_seconds if cpu_seconds else None
+
+    def _step(self):
+        self.steps += 1
+        if self._max_steps and self.steps > self._max_steps:
+            raise RenderBudgetExceeded(f"more than {self._max_steps} steps")
+        if self._cpu_deadline is not None and not self.steps % CHECK_EVERY and time.thread_time() > self._cpu_deadline:
+            raise RenderBudgetExceeded("CPU time")
+
+    def __getitem__(self, key):
+        self._step()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._step()
+        super().__setitem__(key, value)
+
+
+def compile_template(template_str, cache_key=None):
+    """Compiled Django template; with cache_key (a version sha256) kept in the L1-only 'compiled' cache."""
+    from django.template import Template
+
+    if not cache_key:
+        return Template(template_str)
+    return provision_cache.get_or_set("compiled", cache_key, lambda: Template(template_str))
+
+
+def _render_inline(template_str, context, cache_key, budget):
+    template = compile_template(template_str, cache_key)
+    output = template.render(BudgetContext(context, budget["steps"], budget["cpu_seconds"]))
+    if budget["output_chars"] and len(output) > budget["output_chars"]:
+        raise RenderBudgetExceeded(f"output over {budget['output_chars']} characters")
+    return output
+
+
+# --- process pool --------------------------------------------------------------
+
+def _init_child(memory_mb):
+    # kept light: spawn children import this module, then set up Django for the template engine
+    import django
+
+    django.setup()
+    if memory_mb:
+        import resource
+
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _ping():
+    return os.getpid()
+
+
+def _cpu_timer_expired(signum, frame):
+    raise RenderBudgetExceeded("CPU time")
+
+
+def _render_in_child(template_str, context, cache_key, budget):
+    """Pool task: returns (output, None) or (None, (kind, message)); exceptions are not pickled."""
+    previous = signal.signal(signal.SIGVTALRM, _cpu_timer_expired)
+    if budget["cpu_seconds"]:
+        # hard stop even inside code that never touches the context
+        signal.setitimer(signal.ITIMER_VIRTUAL, budget["cpu_seconds"] * 1.5)
+    try:
+        return _render_inline(template_str, context, cache_key, budget), None
+    except RenderBudgetExceeded as exc:
+        return None, ("budget", exc.reason)
+    except MemoryError:
+        return None, ("budget", "memory")
+    except Exception as exc:
+        return None, ("error", f"{type(exc).__name__}: {exc}")
+    finally:
+        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+        signal.signal(signal.SIGVTALRM, previous)
+
+
+class RenderPool:
+    """multiprocessing.Pool of spawned renderers, replaced when a render has to be abandoned."""
+
+    def __init__(self, processes, memory_mb=None):
+        self.processes = processes
+        self.memory_mb = memory_mb
+        self.pid = os.getpid()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._pool is None:
+                ctx = multiprocessing.get_context("spawn")
+                pool = ctx.Pool(self.processes, initializer=_init_child, initargs=(self.memory_mb,))
+                # children import Django first: do not count their start-up against a render
+                pool.apply(_ping)
+                self._pool = pool
+            return self._pool
+
+    def _discard(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.terminate()
+
+    def render(self, template_str, context, cache_key, budget):
+        pool = self._get()
+        wait = (budget["cpu_seconds"] or 1.0) * 2 + 1.0
+        try:
+            output, error = pool.apply_async(_render_in_child, (template_str, dict(context), cache_key, budget)).get(wait)
+        except PoolTimeout:
+            # a stuck renderer cannot be interrupted from here: drop the whole pool
+            threading.Thread(target=self._discard, args=(pool,), daemon=True).start()
+            raise RenderBudgetExceeded("no answer from the render pool")
+        if error is None:
+            return output
+        kind, message = error
+        if kind == "budget":
+            raise RenderBudgetExceeded(message)
+        raise RuntimeError(message)
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _render_pool():
+    global _pool
+    processes = _setting("PROVISION_RENDER_POOL", 0)
+    if processes <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid() or _pool.processes != processes:
+            _pool = RenderPool(processes, _setting("PROVISION_RENDER_POOL_MEMORY_MB", 0))
+        return _pool
+
+
+# --- overrun report ------------------------------------------------------------
+
+_overruns = {}
+_overruns_lock = threading.Lock()
+
+
+def _record_overrun(template, reason):
+    with _overruns_lock:
+        entry = _overruns.setdefault(template or "?", {"count": 0, "reason": "", "at": 0.0})
+        entry["count"] += 1
+        entry["reason"] = reason
+        entry["at"] = time.time()
+
+
+def overruns() -> dict:
+    """{template: {count, reason (last), at (last, epoch seconds)}} for this process."""
+    with _overruns_lock:
+        return {name: dict(entry) for name, entry in _overruns.items()}
+
+
+def render(template_str, context, cache_key=None, template=None) -> str:
+    """
+    Render template_str with context (a mapping) under the budget. cache_key is the
+    version sha256 (compiled once per process); template names it in the overrun report.
+    Raises RenderBudgetExceeded on overrun; template errors propagate.
+    """
+    budget = limits()
+    pool = _render_pool()
+    try:
+        if pool is not None:
+            return pool.render(template_str, context, cache_key, budget)
+        return _render_inline(template_str, context, cache_key, budget)
+    except RenderBudgetExceeded as exc:
+        exc.template = template or cache_key
+        _record_overrun(exc.template, exc.reason)
+        logger.warning("Template %s aborted: %s", exc.template, exc.reason)
+        raise
+
+
+# --- import checks -------------------------------------------------------------
+
+def complexity(template) -> dict:
+    """Size metrics of a compiled template: nodes, for loops, deepest loop nesting, text bytes inside loops."""
+    from django.template.defaulttags import ForNode
+    from django.template.base import TextNode
+
+    metrics = {"nodes": 0, "loops": 0, "max_loop_depth": 0, "loop_text_bytes": 0}
+
+    def walk(nodelist, depth):
+        for node in nodelist:
+            metrics["nodes"] += 1
+            inner = depth
+            if isinstance(node, ForNode):
+                inner += 1
+                metrics["loops"] += 1
+                metrics["max_loop_depth"] = max(metrics["max_loop_depth"], inner)
+            elif isinstance(node, TextNode) and depth:
+                metrics["loop_text_bytes"] += len(node.s)
+            for attr in node.child_nodelists:
+                child = getattr(node, attr, None)
+                if child:
+                    walk(child, inner)
+
+    walk(template.nodelist, 0)
+    return metrics
+
+
+def _filter_expressions(value):
+    """FilterExpressions held by a node attribute (directly, in containers or in {% if %} conditions)."""
+    from django.template.base import FilterExpression, Node, NodeList
+
+    if isinstance(value, FilterExpression):
+        yield value
+    elif isinstance(value, (Node, NodeList, str)):
+        return
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _filter_expressions(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _filter_expressions(item)
+    else:
+        # smartif operators (first/second) and literals (value)
+        for attr in ("first", "second", "value"):
+            if hasattr(value, attr):
+                yield from _filter_expressions(getattr(value, attr))
+
+
+def is_deterministic(template) -> bool:
+    """
+    Whether a compiled template's output depends only on its context: False when it uses
+    {% now %}, the random filter or {% lorem ... random %}, whose output must not be cached.
+    """
+    from django.template import defaultfilters
+    from django.template.base import Node
+    from django.template.defaulttags import LoremNode, NowNode
+
+    for node in template.nodelist.get_nodes_by_type(Node):
+        if isinstance(node, NowNode) or (isinstance(node, LoremNode) and not node.common):
+            return False
+        for value in vars(node).values():
+            for expression in _filter_expressions(value):
+                if any(func is defaultfilters.random for func, _ in expression.filters):
+                    return False
+    return True
+
+
+def check_template_size(size):
+    """TemplateRejected when size (bytes) is over settings.PROVISION_TEMPLATE_MAX_BYTES; call before reading the body."""
+    max_bytes = _setting("PROVISION_TEMPLATE_MAX_BYTES", 8 * 1024 * 1024)
+    if max_bytes and size is not None and size > max_bytes:
+        raise TemplateRejected(f"{size} bytes (limit {max_bytes})")
+
+
+def check_template(text, size=None) -> dict:
+    """
+    Metrics of an uploaded template, or TemplateRejected when it does not compile, is
+    over settings.PROVISION_TEMPLATE_MAX_BYTES / _MAX_NODES / _MAX_LOOP_DEPTH, or does
+    not render with an empty context within the render budget.
+    """
+    from django.template import Template, TemplateSyntaxError
+
+    size = len(text.encode("utf-8")) if size is None else size
+    check_template_size(size)
+    try:
+        template = Template(text)
+    except TemplateSyntaxError as exc:
+        raise TemplateRejected(f"syntax error: {exc}") from exc
+    metrics = complexity(template)
+    metrics["bytes"] = size
+    max_nodes = _setting("PROVISION_TEMPLATE_MAX_NODES", 20000)
+    if max_nodes and metrics["nodes"] > max_nodes:
+        raise TemplateRejected(f"{metrics['nodes']} template nodes (limit {max_nodes})")
+    max_depth = _setting("PROVISION_TEMPLATE_MAX_LOOP_DEPTH", 3)
+    if max_depth and metrics["max_loop_depth"] > max_depth:
+        raise TemplateRejected(f"{{% for %}} nested {metrics['max_loop_depth']} deep (limit {max_depth})")
+
+    budget = limits()
+    started = time.thread_time()
+    try:
+        output = _render_inline(text, {}, None, budget)
+    except RenderBudgetExceeded as exc:
+        raise TemplateRejected(f"trial render: {exc.reason}") from exc
+    except Exception as exc:
+        raise TemplateRejected(f"trial render failed: {type(exc).__name__}: {exc}") from exc
+    metrics["trial_ms"] = round((time.thread_time() - started) * 1000, 2)
+    metrics["trial_output_chars"] = len(output)
+    return metrics
@@ -0,0 +1,89 @@
+"""
+DRF serializers for the device/profile REST API (api.viewsets).
+
+FieldsMixin implements `?fields=a,b` projection: only the requested fields are
+serialized (unknown names are ignored). MAC addresses are normalized (hex only,
+lower case) before the uniqueness validator runs, the same way DeviceConfig.save()
+stores them.
+"""
+from rest_framework import serializers
+
+from core.models import DeviceConfig, DeviceProfile, _normalize_mac
+
+
+class FieldsMixin:
+    """Drop the fields not listed in context['fields'] (set by the view from ?fields=)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = self.context.get("fields")
+        if requested:
+            for name in set(self.fields) - set(requested):
+                self.fields.pop(name)
+
+
+class MacAddressField(serializers.CharField):
+    def to_internal_value(self, data):
+        return _normalize_mac(super().to_internal_value(data))
+
+
+class DeviceProfileSerializer(FieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = DeviceProfile
+        fields = [
+            "id",
+            "name",
+            "sip_server",
+            "port_server",
+            "protocol_type",
+            "backup_server",
+            "backup_port",
+            "proxy",
+            "domain_server",
+            "time_zone",
+            "register_ttl",
+            "ntp_server",
+            "voice_codecs",
+            "provision_server",
+            "provision_file",
+            "vlan_active",
+            "vlan_id",
+            "srtp_enable",
+            "template_ref",
+            "metadata",
+            "created_at",
+            "updated_at",
+        ]
+        read_only_fields = ["id", "created_at", "updated_at"]
+
+
+class DeviceConfigSerializer(FieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = DeviceConfig
+        fields = [
+            "id",
+            "profile",
+            "identifier",
+            "mac_address",
+            "display_name",
+            "user_register",
+            "passwd_register",
+            "ip_address",
+            "public_ip",
+            "private_ip",
+            "provisioned_at",
+            "attempts_provisioning",
+            "exported_to_rps",
+            "metadata",
+            "created_at",
+            "updated_at",
+        ]
+        read_only_fields = ["id", "provisioned_at", "attempts_provisioning", "created_at", "updated_at"]
+        # senhas de registro podem ser gravadas pela API, mas não são devolvidas
+        extra_kwargs = {"passwd_register": {"write_only": True}}
+
+    def build_standard_field(self, field_name, model_field):
+        field_class, field_kwargs = super().build_standard_field(field_name, model_field)
+        if field_name == "mac_address":
+            field_class = MacAddressField
+        return field_class, field_kwargs
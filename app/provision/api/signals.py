@@ -0,0 +1,184 @@
+"""
+Invalidation of the provisioning cache (api.cache) when devices or profiles change.
+
+Device lookups are cached under 'mac:<mac>' and 'id:<identifier>' (see
+api.views.get_device_row), so both keys are dropped on save/delete, for the old
+and the new values when a device is renamed. Profiles are cached by id. Rendered
+output does not need invalidation: its key includes the template version and the
+values the template reads (or updated_at of device and profile).
+
+Saving a profile pins the template its template_ref resolves to (api.template_pointer).
+Saving an existing profile also schedules a background re-render of its devices
+(api.propagation), which validates them against the new values, unless none of
+the changed fields is read by the profile's pinned template.
+
+Provisioning rows saved by other code are counted in the ops dashboard aggregates
+(api.analytics), like the fetches download_config records itself.
+
+Every eviction is also published on the invalidation bus (api.invalidation), so
+other gunicorn workers and instances drop their local copies within
+PROVISION_INVALIDATION_POLL_SECONDS instead of the namespace l1_ttl.
+
+Deleted (revoked) OAuth2 access tokens are dropped from the 'oauth_token'
+namespace (api.oauth_validators), and so are all the tokens of a user or
+application that is saved or deleted (the cached entries hold their fields).
+
+QuerySet.update() does not send signals; entries changed that way expire with the
+namespace TTL.
+"""
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from oauth2_provider.models import get_access_token_model, get_application_model
+
+from api.cache import provision_cache
+from api.oauth_validators import NAMESPACE as OAUTH_TOKEN_NAMESPACE
+from api.propagation import schedule_propagation
+from api.render_context import PROFILE_PLACEHOLDERS
+from api.utils.templates import templates_using
+from api import analytics, invalidation, template_pointer
+from core.models import DeviceConfig, DeviceProfile, Provisioning
+
+logger = logging.getLogger(__name__)
+
+
+def _device_keys(mac_address, identifier):
+    keys = []
+    if mac_address:
+        keys.append(f"mac:{mac_address}")
+    if identifier:
+        keys.append(f"id:{identifier}")
+    return keys
+
+
+def _delete_now_and_on_commit(namespace, keys):
+    """
+    Drop the keys now and again after commit: a request running while the
+    transaction is open may re-cache the old row in between. Other processes
+    evict their copies when the bus event arrives (api.invalidation).
+    """
+    def delete():
+        for key in keys:
+            provision_cache.delete(namespace, key)
+
+    delete()
+    transaction.on_commit(delete)
+    invalidation.publish(namespace, keys)
+
+
+@receiver(pre_save, sender=DeviceConfig)
+def remember_device_keys(sender, instance, **kwargs):
+    instance._cache_keys_before = []
+    if instance.pk:
+        old = sender.objects.filter(pk=instance.pk).values_list("mac_address", "identifier").first()
+        if old:
+            instance._cache_keys_before = _device_keys(*old)
+
+
+@receiver(post_save, sender=DeviceConfig)
+@receiver(post_delete, sender=DeviceConfig)
+def invalidate_device(sender, instance, **kwargs):
+    keys = set(_device_keys(instance.mac_address, instance.identifier))
+    keys.update(getattr(instance, "_cache_keys_before", []))
+    _delete_now_and_on_commit("device", keys)
+
+
+@receiver(pre_save, sender=DeviceProfile)
+def pin_profile_template(sender, instance, raw=False, update_fields=None, **kwargs):
+    # resolve template_ref once here instead of on every download (api.template_pointer)
+    if raw or (update_fields is not None and "template_ref" not in update_fields):
+        return
+    template_pointer.pin(instance)
+
+
+# profile columns whose change can alter rendered output, as render context keys
+_PROFILE_KEYS = {column: name for name, column, _ in PROFILE_PLACEHOLDERS}
+_PROFILE_TEMPLATE = ("template_ref", "template_id", "template_sha256")
+
+
+@receiver(pre_save, sender=DeviceProfile)
+def remember_profile_changes(sender, instance, raw=False, **kwargs):
+    # after pin_profile_template: a new pin counts as a template change
+    instance._changed_keys = None
+    if raw or not instance.pk:
+        return
+    columns = tuple(_PROFILE_KEYS) + _PROFILE_TEMPLATE
+    old = sender.objects.filter(pk=instance.pk).values_list(*columns).first()
+    if old is None:
+        return
+    changed = {column for column, value in zip(columns, old) if getattr(instance, column) != value}
+    if changed.intersection(_PROFILE_TEMPLATE):
+        return  # another template: everything may change
+    instance._changed_keys = sorted({_PROFILE_KEYS[column] for column in changed})
+
+
+def _profile_change_renders(instance):
+    """
+    Whether saving the profile can change its devices' output: some changed field is
+    read by the pinned template (templates_using, over the 'variables' stored at import).
+    Unknown changes, unpinned profiles and Mongo errors count as yes.
+    """
+    keys = getattr(instance, "_changed_keys", None)
+    if keys is None:
+        return True
+    if not keys:
+        return False
+    if not instance.template_id:
+        return True
+    try:
+        return instance.template_id in templates_using(keys)
+    except Exception as exc:
+        logger.warning("Could not check the templates using %s: %s", ", ".join(keys), exc)
+        return True
+
+
+@receiver(post_save, sender=DeviceProfile)
+@receiver(post_delete, sender=DeviceProfile)
+def invalidate_profile(sender, instance, **kwargs):
+    _delete_now_and_on_commit("profile", [instance.pk])
+
+
+@receiver(post_save, sender=DeviceProfile)
+def propagate_profile(sender, instance, created=False, raw=False, **kwargs):
+    # a new profile has no devices yet; fixtures (raw) are not rendered; changes to
+    # fields the template does not read leave the output as it was
+    if not created and not raw and _profile_change_renders(instance):
+        schedule_propagation("profile", instance.pk)
+
+
+@receiver(post_save, sender=Provisioning)
+def count_provisioning(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        analytics.record(
+            instance.vendor, instance.model, instance.version, instance.status, instance.mac_address, instance.created_at
+        )
+
+
+@receiver(post_save, sender=get_access_token_model())
+@receiver(post_delete, sender=get_access_token_model())
+def invalidate_access_token(sender, instance, **kwargs):
+    if instance.token_checksum:
+        _delete_now_and_on_commit(OAUTH_TOKEN_NAMESPACE, [instance.token_checksum])
+
+
+def _invalidate_tokens(**lookup):
+    checksums = list(get_access_token_model().objects.filter(**lookup).values_list("token_checksum", flat=True))
+    if checksums:
+        _delete_now_and_on_commit(OAUTH_TOKEN_NAMESPACE, [c for c in checksums if c])
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(pre_delete, sender=get_user_model())
+def invalidate_user_tokens(sender, instance, **kwargs):
+    # deactivation, new password, staff flags: cached tokens hold the user's fields
+    _invalidate_tokens(user_id=instance.pk)
+
+
+@receiver(post_save, sender=get_application_model())
+@receiver(pre_delete, sender=get_application_model())
+def invalidate_application_tokens(sender, instance, **kwargs):
+    _invalidate_tokens(application_id=instance.pk)
@@ -0,0 +1,16 @@
+"""
+Background job tasks (jobs.queue) of the api app. Only imported by the job worker
+and when enqueuing, so the provisioning role does not need the jobs app.
+"""
+from jobs.queue import task
+
+from api.propagation import run_propagation
+
+
+@task
+def propagation_task(ctx, run_id):
+    """Run a PropagationRun in the job worker (settings.PROVISION_PROPAGATION_RUNNER = "jobs")."""
+    run = run_propagation(run_id, progress=ctx.progress)
+    if run is None:
+        return None
+    return {"status": run.status, "total": run.total, "rendered": run.rendered, "failed": run.failed, "skipped": run.skipped}
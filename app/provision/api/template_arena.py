@@ -0,0 +1,312 @@
+"""
+Template store shared by every gunicorn worker of a container.
+
+Each worker caching every template body in its own L1 multiplies memory by the
+number of workers. The arena is one file holding the current template catalog,
+written by build() (the gunicorn master before forking, or whichever process saw a
+template change) in settings.PROVISION_TEMPLATE_ARENA_DIR (/dev/shm by default, so
+it lives in RAM) and mapped read-only (mmap) by every process: the bodies are
+shared pages and per-worker memory no longer grows with the catalog, only with the
+small index.
+
+File layout: header (MAGIC, generation, index length), JSON index (template
+pointers by _id, body offsets by sha256), UTF-8 bodies. Each build writes
+arena-<generation>.bin and then replaces the 'current' file (os.replace, atomic);
+processes look at 'current' at most every PROVISION_TEMPLATE_ARENA_CHECK_SECONDS
+and switch to the new mapping when the generation changes. Builds are serialized
+with a file lock.
+
+- get_version_text() (api.utils.templates) reads bodies from the arena before
+  Mongo and does not copy them into L1. Bodies are immutable (keyed by hash),
+  so the arena is always right for them.
+- get_template_from_mongo() (api.views) resolves templates from the arena index
+  (same preference order as the Mongo pipeline) while it is fresh. Any template
+  change (publish, rollback, delete, here or in another process through
+  api.invalidation) makes the index stale until a build started after the change
+  is mapped; meanwhile resolution goes to Mongo. The change also schedules that
+  build when an arena exists.
+- find_common_template() (api.views) finds common templates (pointers with
+  'common_file') by file name in the same index; they are left out of resolve().
+
+Only format 3 templates (pointer + version) are served; resolutions that pick an
+older-format document fall back to Mongo. Compiled Django templates cannot be
+shared between processes and stay in each worker's 'compiled' cache.
+Disabled with settings.PROVISION_TEMPLATE_ARENA = False.
+"""
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from api import invalidation
+from api.utils.mongo import get_mongo_client
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"PTARENA1"
+HEADER = struct.Struct("<8sQI")  # magic, generation, index length
+POINTER = "current"
+
+# resolution picked a document the arena does not hold (older format)
+UNAVAILABLE = object()
+
+# pointer fields kept in the index (those of TEMPLATE_BODY_PROJECTION a format 3 pointer has)
+META_FIELDS = ("format", "sha256", "extension", "file_type", "variables", "common_file")
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enabled() -> bool:
+    return _setting("PROVISION_TEMPLATE_ARENA", True)
+
+
+def arena_dir() -> str:
+    directory = _setting("PROVISION_TEMPLATE_ARENA_DIR", "")
+    if directory:
+        return directory
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "provision-templates")
+
+
+class Arena:
+    """A mapped arena file: index in memory, bodies read from the mapping."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, index_len = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a template arena")
+        index = json.loads(self._mm[HEADER.size:HEADER.size + index_len])
+        self.path = path
+        self.started_at = index["started_at"]
+        self.size = len(self._mm)
+        self._base = HEADER.size + index_len
+        self.versions = {sha: tuple(span) for sha, span in index["versions"].items()}
+        self.templates = {}
+        self._inline = set()
+        by_model, by_extension, common = {}, {}, {}
+        for doc in sorted(index["templates"], key=lambda d: str(d["_id"])):
+            name = doc.pop("_id")
+            model = (doc.pop("model", None) or "").lower()
+            if doc.pop("inline", False):
+                self._inline.add(name)
+            if doc.get("common_file"):
+                common.setdefault(doc["common_file"], (name, doc))
+                continue
+            self.templates[name] = doc
+            ext = doc.get("extension")
+            if model:
+                by_model.setdefault((model, ext), name)
+            by_extension.setdefault(ext, name)
+        self._by_model = by_model
+        self._by_extension = by_extension
+        self._common = common
+
+    def text(self, sha256):
+        span = self.versions.get(sha256)
+        if span is None:
+            return None
+        start = self._base + span[0]
+        return self._mm[start:start + span[1]].decode("utf-8")
+
+    def _doc(self, name, doc=None):
+        if name in self._inline:
+            return UNAVAILABLE
+        return dict(doc if doc is not None else self.templates[name], _id=name)
+
+    def common(self, common_file):
+        """Common template served as common_file (lowest _id), None or UNAVAILABLE."""
+        found = self._common.get(common_file)
+        return self._doc(*found) if found is not None else None
+
+    def resolve(self, template_ref, model_q: str, ext: str):
+        """
+        Same preference as api.views.template_resolution_pipeline(): template_ref (exact,
+        then lower case), model + extension, _id == model, any template with the
+        extension; ties by lowest _id. Returns the pointer, None or UNAVAILABLE.
+        """
+        if template_ref:
+            for name in (template_ref, str(template_ref).strip().lower()):
+                if name in self.templates:
+                    return self._doc(name)
+        if model_q:
+            name = self._by_model.get((model_q, ext))
+            if name is None and model_q in self.templates:
+                name = model_q
+            if name is not None:
+                return self._doc(name)
+        name = self._by_extension.get(ext)
+        return self._doc(name) if name is not None else None
+
+
+_arena = None
+_checked_at = 0.0
+_changed_at = 0.0  # last template change seen by this process (time.time())
+_state_lock = threading.Lock()
+
+
+def _read_pointer(directory):
+    try:
+        with open(os.path.join(directory, POINTER)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def current():
+    """The mapped arena (switching to a newer generation if there is one), or None."""
+    global _arena, _checked_at
+    if not enabled():
+        return None
+    now = time.monotonic()
+    if now - _checked_at < _setting("PROVISION_TEMPLATE_ARENA_CHECK_SECONDS", 1.0):
+        return _arena
+    with _state_lock:
+        _checked_at = now
+        directory = arena_dir()
+        pointer = _read_pointer(directory)
+        if pointer is not None and (_arena is None or _arena.generation != pointer["generation"]):
+            try:
+                # the previous mapping stays valid for requests still reading it
+                _arena = Arena(os.path.join(directory, pointer["file"]))
+            except (OSError, ValueError, KeyError) as exc:
+                logger.warning("Could not map template arena %s: %s", pointer.get("file"), exc)
+        elif pointer is None:
+            _arena = None
+    return _arena
+
+
+def is_fresh(arena) -> bool:
+    """Whether the arena index was built after the last template change this process knows of."""
+    return arena.started_at > _changed_at
+
+
+@contextmanager
+def _locked(directory):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _catalog(db):
+    from api.utils.templates import decode_body_bytes, get_templates_collection, get_versions_collection, iter_template_body_bytes
+
+    projection = dict.fromkeys(META_FIELDS + ("model", "gridfs_id", "encoding"), 1)
+    docs = list(get_templates_collection(db).find({}, projection=projection))
+    shas = list({doc["sha256"] for doc in docs if (doc.get("format") or 0) >= 3 and doc.get("sha256")})
+    texts = {}
+    for version in get_versions_collection(db).find({"_id": {"$in": shas}}):
+        texts[version["_id"]] = decode_body_bytes(b"".join(iter_template_body_bytes(version, db)))
+    return docs, texts
+
+
+def build(db=None, directory=None, since=None) -> dict:
+    """
+    Write a new arena from device_templates and the versions they point to, and make it
+    current. With since (a time.time() value), skip the build when the current arena
+    was started after it. Returns a report. Mongo errors propagate.
+    """
+    directory = directory or arena_dir()
+    with _locked(directory):
+        pointer = _read_pointer(directory) or {"generation": 0}
+        if since is not None and pointer.get("started_at", 0) > since:
+            return {"skipped": True, "generation": pointer["generation"]}
+        started_at = time.time()
+        docs, texts = _catalog(db if db is not None else get_mongo_client())
+
+        bodies, versions, offset = [], {}, 0
+        for sha, text in texts.items():
+            data = text.encode("utf-8")
+            versions[sha] = (offset, len(data))
+            bodies.append(data)
+            offset += len(data)
+        templates = []
+        for doc in docs:
+            meta = {field: doc[field] for field in META_FIELDS if doc.get(field) is not None}
+            meta["_id"], meta["model"] = doc["_id"], doc.get("model") or ""
+            if doc.get("sha256") not in versions:
+                meta["inline"] = True
+            templates.append(meta)
+
+        generation = pointer["generation"] + 1
+        index = json.dumps({"started_at": started_at, "templates": templates, "versions": versions}).encode("utf-8")
+        name = f"arena-{generation}.bin"
+        tmp = os.path.join(directory, name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, generation, len(index)))
+            f.write(index)
+            for data in bodies:
+                f.write(data)
+        os.replace(tmp, os.path.join(directory, name))
+        with open(os.path.join(directory, POINTER + ".tmp"), "w") as f:
+            json.dump({"generation": generation, "file": name, "started_at": started_at}, f)
+        os.replace(os.path.join(directory, POINTER + ".tmp"), os.path.join(directory, POINTER))
+        # mapped files stay readable after unlink
+        for old in os.listdir(directory):
+            if old.startswith("arena-") and old != name:
+                try:
+                    os.remove(os.path.join(directory, old))
+                except OSError:
+                    pass
+    return {
+        "skipped": False,
+        "generation": generation,
+        "templates": len(templates),
+        "versions": len(versions),
+        "bytes": HEADER.size + len(index) + offset,
+        "seconds": round(time.time() - started_at, 3),
+    }
+
+
+def _rebuild_quietly(since):
+    try:
+        report = build(since=since)
+        logger.info("Template arena rebuilt: %s", report)
+    except Exception as exc:
+        logger.warning("Could not rebuild the template arena: %s", exc)
+
+
+def _schedule_rebuild(since):
+    threading.Thread(target=_rebuild_quietly, args=(since,), name="provision-template-arena", daemon=True).start()
+
+
+def template_changed(keys=()):
+    """Stop resolving from the mapped index and rebuild the arena (if there is one)."""
+    global _changed_at, _checked_at
+    with _state_lock:
+        _changed_at = time.time()
+        _checked_at = 0.0
+    if enabled() and _read_pointer(arena_dir()) is not None:
+        _schedule_rebuild(_changed_at)
+
+
+invalidation.listen(invalidation.EVENT_TEMPLATE, template_changed)
+
+
+def stats():
+    arena = current()
+    if arena is None:
+        return None
+    return {
+        "generation": arena.generation,
+        "templates": len(arena.templates),
+        "common": len(arena._common),
+        "versions": len(arena.versions),
+        "bytes": arena.size,
+        "fresh": is_fresh(arena),
+    }
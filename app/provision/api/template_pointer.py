@@ -0,0 +1,179 @@
+"""
+Template pinned on DeviceProfile.
+
+template_ref is free text: a device_templates _id as written, matched exactly or
+in lower case. It is resolved once and stored on the profile (template_id,
+template_sha256, template_extension), so download_config builds the template
+pointer from the profile row and reads the body by hash
+(api.utils.templates.get_version_text, cached without expiry) instead of
+querying device_templates on every fetch.
+
+- pin(profile): resolve template_ref and set the fields; run on every profile save
+  (pre_save in api.signals). pin_all(profiles) does the same for the REST bulk
+  create, which bypasses pre_save. DeviceProfileForm uses check_template_ref() so an
+  unknown reference is reported when the profile is saved, not as a 403 to the phone.
+- repin_template(name): refresh the profiles of template name after it is
+  published, rolled back (api.utils.templates) or deleted (core.views).
+- reconcile(): recompute every pointer from device_templates and fix those that
+  drifted (documents changed outside the app, saves while Mongo was down);
+  `manage.py reconcile_template_pointers`.
+
+A sha256 is pinned only when its immutable version exists (older document formats
+pin just the _id). Profiles whose reference does not resolve keep empty fields and
+download_config falls back to get_template_from_mongo().
+Disabled with settings.PROVISION_TEMPLATE_PINNING = False.
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api import invalidation
+from api.cache import provision_cache
+from api.utils.mongo import get_mongo_client
+from api.utils.templates import get_templates_collection, get_versions_collection
+
+logger = logging.getLogger(__name__)
+
+POINTER_FIELDS = ("template_id", "template_sha256", "template_extension")
+UNRESOLVED = ("", "", "")
+
+
+def enabled() -> bool:
+    return getattr(settings, "PROVISION_TEMPLATE_PINNING", True)
+
+
+def _candidates(template_ref):
+    ids = [template_ref]
+    lower = str(template_ref).strip().lower()
+    if lower and lower != template_ref:
+        ids.append(lower)
+    return ids
+
+
+def resolve_refs(refs, db=None) -> dict:
+    """
+    {template_ref: (template_id, template_sha256, template_extension)} for the given
+    references, UNRESOLVED for those without a template. Two queries whatever the
+    number of references. Mongo errors propagate.
+    """
+    refs = [ref for ref in dict.fromkeys(refs) if ref]
+    if not refs:
+        return {}
+    db = db if db is not None else get_mongo_client()
+    ids = list(dict.fromkeys(i for ref in refs for i in _candidates(ref)))
+    docs = {
+        doc["_id"]: doc
+        for doc in get_templates_collection(db).find({"_id": {"$in": ids}}, projection={"sha256": 1, "extension": 1})
+    }
+    hashes = list({doc["sha256"] for doc in docs.values() if doc.get("sha256")})
+    versions = {doc["_id"] for doc in get_versions_collection(db).find({"_id": {"$in": hashes}}, projection={"_id": 1})}
+
+    resolved = {}
+    for ref in refs:
+        doc = next((docs[i] for i in _candidates(ref) if i in docs), None)
+        if doc is None:
+            resolved[ref] = UNRESOLVED
+            continue
+        sha256 = doc.get("sha256") if doc.get("sha256") in versions else ""
+        resolved[ref] = (str(doc["_id"]), sha256 or "", doc.get("extension") or "")
+    return resolved
+
+
+def check_template_ref(template_ref):
+    """True/False whether template_ref names a template; None when Mongo cannot be reached."""
+    try:
+        return resolve_refs([template_ref])[template_ref] != UNRESOLVED
+    except Exception as exc:
+        logger.warning("Could not check template reference %r: %s", template_ref, exc)
+        return None
+
+
+def pin_all(profiles):
+    """
+    pin() for profiles that are saved without pre_save (bulk_create), with one
+    resolve_refs() call for all of them. Returns {template_ref: pointer}, or None when
+    Mongo could not be reached (the profiles are left unresolved, like pin()).
+    """
+    if not enabled():
+        return {}
+    try:
+        pointers = resolve_refs(profile.template_ref for profile in profiles)
+    except Exception as exc:
+        logger.warning("Could not resolve the templates of %s profiles: %s", len(profiles), exc)
+        pointers = None
+    now = timezone.now()
+    for profile in profiles:
+        pointer = (pointers or {}).get(profile.template_ref, UNRESOLVED)
+        for field, value in zip(POINTER_FIELDS, pointer):
+            setattr(profile, field, value)
+        profile.template_resolved_at = now if pointer != UNRESOLVED else None
+    return pointers
+
+
+def pin(profile):
+    """Set the profile's pinned template from its template_ref (not saved). Unresolved on Mongo errors."""
+    if not enabled():
+        return None
+    pointer = UNRESOLVED
+    if profile.template_ref:
+        try:
+            pointer = resolve_refs([profile.template_ref])[profile.template_ref]
+        except Exception as exc:
+            logger.warning("Could not resolve template %r of profile %s: %s", profile.template_ref, profile.pk, exc)
+    for field, value in zip(POINTER_FIELDS, pointer):
+        setattr(profile, field, value)
+    profile.template_resolved_at = timezone.now() if pointer != UNRESOLVED else None
+    return pointer
+
+
+def _repin(profiles, dry_run=False, db=None) -> dict:
+    """Recompute the pointers of a DeviceProfile queryset; update (one UPDATE per changed profile) those that differ."""
+    from core.models import DeviceProfile
+
+    rows = list(profiles.values_list("pk", "template_ref", *POINTER_FIELDS))
+    pointers = resolve_refs((ref for _, ref, *_ in rows), db)
+    changed = []
+    now = timezone.now()
+    for pk, template_ref, *current in rows:
+        pointer = pointers.get(template_ref, UNRESOLVED)
+        if tuple(current) == pointer:
+            continue
+        changed.append(pk)
+        if not dry_run:
+            DeviceProfile.objects.filter(pk=pk).update(
+                template_resolved_at=now if pointer != UNRESOLVED else None, **dict(zip(POINTER_FIELDS, pointer))
+            )
+    if changed and not dry_run:
+        # QuerySet.update() sends no signals: drop the cached profile rows here
+        def invalidate():
+            for pk in changed:
+                provision_cache.delete("profile", pk)
+
+        invalidate()
+        transaction.on_commit(invalidate)
+        invalidation.publish(invalidation.EVENT_PROFILE, changed)
+    return {
+        "profiles": len(rows),
+        "repaired": len(changed),
+        "unresolved": sorted({ref for _, ref, *_ in rows if ref and pointers.get(ref, UNRESOLVED) == UNRESOLVED}),
+    }
+
+
+def repin_template(name, db=None) -> dict:
+    """Refresh the profiles pinned to template name or referencing it (any case)."""
+    from core.models import DeviceProfile
+
+    if not enabled():
+        return {"profiles": 0, "repaired": 0, "unresolved": []}
+    return _repin(DeviceProfile.objects.filter(Q(template_id=name) | Q(template_ref__iexact=name)), db=db)
+
+
+def reconcile(dry_run=False, db=None) -> dict:
+    """Recompute the pinned template of every profile with a template_ref (or a stale pin)."""
+    from core.models import DeviceProfile
+
+    profiles = DeviceProfile.objects.exclude(template_ref="", template_id="")
+    return _repin(profiles, dry_run=dry_run, db=db)
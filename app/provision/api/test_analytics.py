@@ -0,0 +1,97 @@
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import api.views as views
+from api import analytics
+
+
+@pytest.fixture
+def counters(monkeypatch, settings):
+    settings.PROVISION_ANALYTICS = True
+    monkeypatch.setattr(analytics, "_counts", defaultdict(int))
+    monkeypatch.setattr(analytics, "_seen", {})
+    monkeypatch.setattr(analytics, "_flusher_pid", os.getpid())  # no flush thread: tests flush explicitly
+
+
+@pytest.mark.django_db
+def test_flush_increments_aggregates(counters):
+    from core.models import DeviceLastSeen, ProvisioningStat
+
+    now = timezone.now()
+    analytics.record("Yealink", "T46", "66.1", analytics.STATUS_OK, "aabbcc000001", when=now)
+    analytics.record("Yealink", "T46", "66.1", analytics.STATUS_OK, "aabbcc000001", when=now)
+    analytics.record("Yealink", "T46", "66.2", analytics.STATUS_ERROR, "aabbcc000001", when=now + timedelta(seconds=1))
+    assert analytics.flush() == {"stats": 2, "devices": 1}
+
+    analytics.record("Yealink", "T46", "66.1", analytics.STATUS_OK, when=now)
+    analytics.flush()
+
+    counts = dict(ProvisioningStat.objects.values_list("version", "count"))
+    assert counts == {"66.1": 3, "66.2": 1}
+    seen = DeviceLastSeen.objects.get(mac_address="aabbcc000001")
+    assert (seen.version, seen.status) == ("66.2", analytics.STATUS_ERROR)
+    assert analytics.pending() == {"stats": 0, "devices": 0}
+
+
+@pytest.mark.django_db
+def test_download_config_is_counted(client, counters, monkeypatch):
+    from core.models import DeviceConfig, DeviceLastSeen, ProvisioningStat
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: {"template": "cfg {{ account }}"})
+    DeviceConfig.objects.create(identifier="an-1", mac_address="aabbcc0000a1")
+
+    assert client.get("/api/download-xml/", HTTP_USER_AGENT="Grandstream GXP2170 1.0.11 aabbcc0000a1").status_code == 200
+    assert client.get("/api/download-xml/", HTTP_USER_AGENT="broken").status_code == 403
+    analytics.flush()
+
+    assert dict(ProvisioningStat.objects.values_list("status", "count")) == {"ok": 1, "forbidden": 1}
+    assert DeviceLastSeen.objects.get(mac_address="aabbcc0000a1").model == "GXP2170"
+
+
+@pytest.mark.django_db
+def test_dashboard_reads_only_aggregates(client, counters, django_user_model):
+    from core.models import DeviceConfig
+
+    now = timezone.now()
+    DeviceConfig.objects.create(identifier="seen", mac_address="aabbcc0000b1")
+    DeviceConfig.objects.create(identifier="silent", mac_address="aabbcc0000b2")
+    for _ in range(3):
+        analytics.record("Yealink", "T46", "66.1", analytics.STATUS_OK, "aabbcc0000b1", when=now)
+    analytics.record("Polycom", "VVX400", "6.0", analytics.STATUS_ERROR, when=now)
+    analytics.flush()
+
+    data = analytics.compute_dashboard(hours=1, stale_days=7, now=now)
+    assert (data["fetches"], data["failures"]) == (4, 1)
+    assert data["per_minute"][-1] == (now.replace(second=0, microsecond=0), 4)
+    assert data["failing_models"] == [{"vendor": "Polycom", "model": "VVX400", "fetches": 1, "failures": 1, "failure_rate": 1.0}]
+    assert (data["stale_devices"], [d["identifier"] for d in data["stale_sample"]]) == (1, ["silent"])
+    assert data["firmware"] == [{"vendor": "Yealink", "model": "T46", "version": "66.1", "devices": 1}]
+
+    staff = django_user_model.objects.create_user("ops", password="x", is_staff=True)
+    client.force_login(staff)
+    with CaptureQueriesContext(connection) as queries:
+        resp = client.get("/analytics/?hours=1")
+    assert resp.status_code == 200
+    assert b"VVX400" in resp.content
+    assert not [q for q in queries.captured_queries if "core_provisioning\"" in q["sql"] or "core_provisioning`" in q["sql"]]
+
+
+@pytest.mark.django_db
+def test_rebuild_from_provisioning_rows(counters):
+    from core.models import DeviceLastSeen, Provisioning, ProvisioningStat
+
+    Provisioning.objects.create(mac_address="aabbcc0000c1", vendor="Yealink", model="T46", version="1", status="ok")
+    Provisioning.objects.create(mac_address="aabbcc0000c1", vendor="Yealink", model="T46", version="2", status="ok")
+    analytics.flush()  # the post_save counters
+    ProvisioningStat.objects.update(count=99)
+
+    assert analytics.rebuild(days=1) == {"rows": 2, "stats": 2, "devices": 1}
+    assert sorted(ProvisioningStat.objects.values_list("count", flat=True)) == [1, 1]
+    assert DeviceLastSeen.objects.get().version == "2"
@@ -0,0 +1,63 @@
+import tarfile
+
+import pytest
+
+from api import batch_render, views
+from api.render_context import profile_values
+
+
+TEMPLATES = {
+    "t4x": {"_id": "t4x", "body": "<cfg>{{ account }} {{ macaddress }} %%sipserver%% {{ vendor }}</cfg>", "sha256": "3" * 64, "extension": "xml"},
+    "broken": {"_id": "broken", "body": "{% for %}", "sha256": "4" * 64, "extension": "cfg"},
+}
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "_find_template_by_ref", lambda ref: TEMPLATES.get(str(ref).lower()))
+    good = DeviceProfile.objects.create(name="T4X", sip_server="sip.example", template_ref="T4X")
+    broken = DeviceProfile.objects.create(name="Broken", template_ref="broken")
+    DeviceConfig.objects.bulk_create(
+        [DeviceConfig(profile=good, identifier=f"acc{i}", mac_address=f"0000000000{i:02x}") for i in range(12)]
+        + [DeviceConfig(profile=broken, identifier="bad", mac_address="0000000001ff")]
+        + [DeviceConfig(identifier="orphan", mac_address="0000000002ff")]
+    )
+    return good, broken
+
+
+@pytest.mark.django_db
+def test_render_batch_streams_rows_to_callback_in_one_query(fleet, django_assert_num_queries):
+    out = {}
+    with django_assert_num_queries(1):
+        report = batch_render.render_batch(
+            sink=batch_render.CallbackSink(lambda name, content, row: out.__setitem__(name, content)),
+            processes=0, chunk_size=5, ua=("Yealink", "T46", "1.0"),
+        )
+    assert (report["total"], report["rendered"], report["failed"], report["skipped"]) == (14, 12, 1, 1)
+    assert report["errors"][0]["identifier"] == "bad"
+    assert out["000000000003.xml"] == "<cfg>acc3 000000000003 sip.example Yealink</cfg>"
+
+
+@pytest.mark.django_db
+def test_render_batch_template_override_to_tarball(fleet, tmp_path):
+    good, _ = fleet
+    path = str(tmp_path / "out.tar.gz")
+    report = batch_render.render_batch(profile=good.pk, template="t4x", sink=batch_render.TarSink(path), processes=0)
+    assert report["rendered"] == 12
+    with tarfile.open(path) as tar:
+        names = tar.getnames()
+        assert len(names) == 12
+        assert tar.extractfile("00000000000b.xml").read() == b"<cfg>acc11 00000000000b sip.example </cfg>"
+
+
+def test_render_chunk_matches_download_config_context():
+    row = {"id": 1, "identifier": "acc", "mac_address": "aabb", "display_name": "Ana", "user_register": "u",
+           "passwd_register": "p", "ip_address": None, "public_ip": None, "private_ip": None, "profile_id": 7,
+           "_template": "k"}
+    templates = {"k": ("5" * 64, "{{ displayname }}/%%user%%/%%port%%", "cfg")}
+    profile = batch_render._Row({f: "" for f in batch_render.PROFILE_FIELDS}, port_server=5061)
+    contexts = {7: profile_values(profile)}
+    [(_, name, content, error)] = batch_render.render_chunk([row], templates, contexts, ("", "", ""))
+    assert (name, content, error) == ("aabb.cfg", "Ana/u/5061", None)
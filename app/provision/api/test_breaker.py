@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+import api.views as views
+from api import breaker
+from api.cache import provision_cache
+
+
+def test_breaker_opens_on_errors_and_closes_after_a_good_probe():
+    cb = breaker.CircuitBreaker("mongo", min_calls=4, error_rate=0.5, open_seconds=0.05)
+    for ok in (True, False, True, False):
+        assert cb.allow()
+        cb.record(0.001, ok)
+    assert cb.state == breaker.OPEN and not cb.allow()
+
+    time.sleep(0.06)
+    assert cb.allow() and cb.state == breaker.HALF_OPEN
+    assert not cb.allow()  # one probe at a time
+    cb.record(0.001, ok=True)
+    assert cb.state == breaker.CLOSED
+    assert cb.snapshot()["trips"] == 1 and cb.snapshot()["rejected"] == 2
+
+
+def test_slow_calls_open_the_breaker_and_a_slow_probe_reopens_it():
+    cb = breaker.CircuitBreaker("mysql", min_calls=3, slow_ms=10, slow_rate=0.6, open_seconds=0)
+    for _ in range(3):
+        cb.record(0.05, ok=True)
+    assert cb.state == breaker.OPEN
+    assert cb.allow()  # open_seconds elapsed: half-open probe
+    cb.record(0.05, ok=True)
+    assert cb.state == breaker.OPEN and cb.trips == 2
+
+
+def test_guard_fails_fast_when_the_budget_is_spent_or_the_circuit_is_open(settings):
+    settings.PROVISION_BREAKERS = {"mysql": {"min_calls": 1, "open_seconds": 60}}
+    with breaker.request_budget(0.01):
+        time.sleep(0.02)
+        with pytest.raises(breaker.BudgetExhausted):
+            with breaker.guard("mysql"):
+                pytest.fail("called after the budget")
+
+    with pytest.raises(ConnectionError):
+        with breaker.guard("mysql"):
+            raise ConnectionError("mysql gone")
+    with pytest.raises(breaker.CircuitOpen):
+        with breaker.guard("mysql"):
+            pytest.fail("called with the circuit open")
+    assert breaker.stats()["mysql"]["state"] == breaker.OPEN
+
+
+@pytest.mark.django_db
+def test_open_mongo_circuit_serves_the_last_good_config(client, settings, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    settings.PROVISION_BREAKERS = {"mongo": {"min_calls": 1, "open_seconds": 60}}
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    profile = DeviceProfile.objects.create(name="HQ", sip_server="sip.hq")
+    DeviceConfig.objects.create(profile=profile, identifier="br-1", mac_address="aabbcc000301")
+    doc = {"_id": "hq", "body": "<cfg>{{ sipserver }}</cfg>", "sha256": "6" * 64}
+    monkeypatch.setattr(views, "_templates_collection", lambda: type("C", (), {"aggregate": lambda self, p: iter([doc])})())
+    ua = "Yealink T46 1.0 aabbcc000301"
+    assert client.get("/api/download-xml/", HTTP_USER_AGENT=ua).content == b"<cfg>sip.hq</cfg>"
+
+    breaker.get("mongo").record(0.001, ok=False)
+    monkeypatch.setattr(views, "_templates_collection", lambda: pytest.fail("Mongo called with the circuit open"))
+    provision_cache.clear_namespace("template")
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT=ua)
+    assert resp.content == b"<cfg>sip.hq</cfg>" and resp["X-Provision-Stale"] == "error"
+    assert breaker.stats()["mongo"]["rejected"] == 1
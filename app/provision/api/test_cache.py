@@ -0,0 +1,157 @@
+import threading
+import time
+
+import pytest
+
+from api.cache import LocalLRU, TieredCache
+
+
+def test_local_lru_evicts_by_bytes_and_expires():
+    lru = LocalLRU(max_bytes=100, max_entries=10)
+    lru.set("a", "x", size=60)
+    lru.set("b", "y", size=30)
+    assert lru.get("a") == "x"  # 'a' becomes most recently used
+    lru.set("c", "z", size=40)  # over budget -> evicts 'b'
+    assert lru.get("b") is None
+    assert lru.get("a") == "x" and lru.get("c") == "z"
+    assert lru.bytes == 100
+    assert lru.set("huge", "w", size=500) is False
+
+    lru.set("short", "v", ttl=0.01, size=1)
+    time.sleep(0.02)
+    assert lru.get("short", "missing") == "missing"
+
+
+def test_get_or_set_loads_once_under_concurrency():
+    cache = TieredCache()
+    calls = []
+    started = threading.Barrier(8)
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        return {"value": 42}
+
+    results = []
+
+    def worker():
+        started.wait()
+        results.append(cache.get_or_set("device", "mac:aabbcc", loader))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{"value": 42}] * 8
+    stats = cache.stats()["namespaces"]["device"]
+    assert stats["loads"] == 1 and stats["misses"] >= 1
+
+
+def test_none_is_cached_and_exceptions_are_not():
+    cache = TieredCache()
+    assert cache.get_or_set("device", "id:x", lambda: None) is None
+    assert cache.get_or_set("device", "id:x", lambda: pytest.fail("should be cached")) is None
+
+    def boom():
+        raise RuntimeError("mongo down")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_set("template", "model:h2p:xml", boom)
+    assert cache.get_or_set("template", "model:h2p:xml", lambda: {"_id": "h2p"}) == {"_id": "h2p"}
+
+
+def test_concurrent_misses_share_the_loader_exception():
+    cache = TieredCache()
+    calls, errors = [], []
+    started = threading.Barrier(4)
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.05)
+        raise RuntimeError("mongo down")
+
+    def worker():
+        started.wait()
+        try:
+            cache.get_or_set("template", "model:t46:cfg", loader)
+        except RuntimeError as exc:
+            errors.append(str(exc))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1 and errors == ["mongo down"] * 4
+    assert cache.stats()["namespaces"]["template"]["coalesced"] == 3
+
+
+def test_lease_makes_other_processes_wait_for_one_load(settings):
+    settings.PROVISION_CACHE = {"LEASE_SECONDS": 2}
+    leader, follower = TieredCache(), TieredCache()  # two workers sharing the same L2
+    loading = threading.Event()
+    calls = []
+
+    def slow_loader():
+        calls.append("leader")
+        loading.set()
+        time.sleep(0.1)
+        return "<cfg/>"
+
+    thread = threading.Thread(target=leader.get_or_set, args=("rendered", "k", slow_loader))
+    thread.start()
+    loading.wait()
+    assert follower.get_or_set("rendered", "k", lambda: calls.append("follower")) == "<cfg/>"
+    thread.join()
+    assert calls == ["leader"]
+    assert follower.stats()["namespaces"]["rendered"]["lease_hits"] == 1
+
+    # a failed lease holder releases the lease: the next process loads
+    def failing():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        leader.get_or_set("rendered", "k2", failing)
+    assert follower.get_or_set("rendered", "k2", lambda: "ok") == "ok"
+
+
+def test_l2_serves_other_processes_and_clear_namespace_invalidates():
+    writer, reader = TieredCache(), TieredCache()  # two workers sharing the same L2
+    writer.set("template", "ref:t1", {"sha256": "1"})
+    assert reader.get("template", "ref:t1") == {"sha256": "1"}
+    assert reader.stats()["namespaces"]["template"]["l2_hits"] == 1
+
+    writer.clear_namespace("template")
+    reader._generations.clear()  # skip the generation re-check interval
+    assert reader.get("template", "ref:t1") is None
+
+
+def test_namespace_ttl_and_disable(settings):
+    settings.PROVISION_CACHE = {"NAMESPACES": {"rendered": {"enabled": False}, "template_version": {"ttl": None}}}
+    cache = TieredCache()
+    cache.set("rendered", "k", "body")
+    assert cache.get("rendered", "k") is None
+    assert cache.namespace_config("template_version")["l1_ttl"] is None
+
+
+@pytest.mark.django_db
+def test_device_save_invalidates_cached_lookup():
+    from api.render_context import row_render_context
+    from api.views import get_device_row
+    from core.models import DeviceConfig
+
+    device = DeviceConfig.objects.create(identifier="cache-1", mac_address="00:11:22:33:44:55")
+    ua = ("V", "M", "1", "001122334455")
+    assert row_render_context(get_device_row("001122334455"), None, ua)["displayname"] == ""
+
+    device.display_name = "Recepção"
+    device.save()
+    assert row_render_context(get_device_row("001122334455"), None, ua)["displayname"] == "Recepção"
+
+    device.mac_address = "001122334466"
+    device.save()
+    assert get_device_row("00:11:22:33:44:55") is None  # old MAC no longer served from the cache
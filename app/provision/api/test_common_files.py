@@ -0,0 +1,90 @@
+import pytest
+
+import api.views as views
+from api import template_arena
+from api.cache import provision_cache
+from api.utils.mongo import reset_mongo_client, use_mongo_database
+from api.utils.templates import build_template_doc, normalize_common_file, publish_template
+
+mongomock = pytest.importorskip("mongomock")
+
+COMMON = "/api/download-xml/y000000000028.cfg/"
+
+
+@pytest.fixture
+def mongo(db, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    mdb = mongomock.MongoClient().db
+    use_mongo_database(mdb)
+    common = build_template_doc("t46-common", "sip={{ sipserver }} mac={{ macaddress }} fw={{ version }}", file_type="cfg")
+    common["common_file"] = "y000000000028.cfg"
+    publish_template(mdb, common)
+    publish_template(mdb, build_template_doc("t46", "account={{ account }}", file_type="cfg"))
+    profile = DeviceProfile.objects.create(name="Floor", sip_server="sip.floor")
+    for n in (1, 2):
+        DeviceConfig.objects.create(profile=profile, identifier=f"cf-{n}", mac_address=f"aabbcc00060{n}")
+    yield mdb
+    reset_mongo_client()
+
+
+def test_normalize_common_file():
+    assert normalize_common_file(" Y000000000028.CFG ") == "y000000000028.cfg"
+    assert normalize_common_file("") is None
+    for name in ("../etc/passwd.cfg", "common.txt", "a/b.xml"):
+        with pytest.raises(ValueError):
+            normalize_common_file(name)
+
+
+def test_common_file_is_rendered_once_without_device_data_and_revalidated(client, mongo, monkeypatch):
+    renders = []
+    render_config = views._render_config
+    monkeypatch.setattr(views, "_render_config", lambda *a: renders.append(a) or render_config(*a))
+
+    first = client.get(COMMON, HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000601")
+    assert first.status_code == 200 and first.content == b"sip=sip.floor mac= fw=84.0"
+    assert first["Cache-Control"] == "public, max-age=86400" and first["ETag"].startswith('"')
+
+    second = client.get(COMMON, HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000602")
+    assert second.content == first.content and second["ETag"] == first["ETag"]
+    assert len(renders) == 1  # shared by every phone of the profile
+
+    resp = client.get(COMMON, HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000602", HTTP_IF_NONE_MATCH=first["ETag"])
+    assert resp.status_code == 304 and resp["ETag"] == first["ETag"] and len(renders) == 1
+
+    # the per-MAC file still resolves to the device template, never to the common one
+    own = client.get("/api/download-xml/aabbcc000601.cfg/", HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000601")
+    assert own.content == b"account=cf-1" and "ETag" not in own
+
+
+def test_common_templates_are_found_by_file_name_in_the_arena(client, mongo, settings, tmp_path, monkeypatch):
+    settings.PROVISION_TEMPLATE_ARENA = True
+    settings.PROVISION_TEMPLATE_ARENA_DIR = str(tmp_path)
+    settings.PROVISION_TEMPLATE_ARENA_CHECK_SECONDS = 0
+    monkeypatch.setattr(template_arena, "_arena", None)
+    template_arena.build()
+
+    monkeypatch.setattr(views, "_templates_collection", lambda: pytest.fail("resolved in Mongo"))
+    assert views.find_common_template("y000000000028.cfg")["_id"] == "t46-common"
+    assert views.find_common_template("aabbcc000601.cfg") is None
+    assert views.get_template_from_mongo("t46", "cfg")["_id"] == "t46"  # not the common template
+    assert template_arena.stats()["common"] == 1
+
+    provision_cache.clear_namespace("rendered")
+    assert client.get(COMMON, HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000601").status_code == 200
+
+
+def test_lookup_failure_answers_503_only_for_known_common_files(client, mongo, monkeypatch):
+    ua = "Yealink T46 84.0 aabbcc000601"
+    assert client.get(COMMON, HTTP_USER_AGENT=ua).status_code == 200
+    assert client.get("/api/download-xml/config.cfg/", HTTP_USER_AGENT=ua).content == b"account=cf-1"
+
+    def down():
+        raise ConnectionError("atlas unreachable")
+
+    monkeypatch.setattr(views, "_templates_collection", down)
+    provision_cache.clear_namespace("template")
+    assert client.get(COMMON, HTTP_USER_AGENT=ua).status_code == 503
+    resp = client.get("/api/download-xml/config.cfg/", HTTP_USER_AGENT=ua)
+    assert resp.status_code == 200 and resp["X-Provision-Stale"] == "error"
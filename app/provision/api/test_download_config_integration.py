@@ -18,7 +18,7 @@ def test_download_config_success(monkeypatch, settings):
     device = DeviceConfig.objects.create(profile=profile, identifier="dev-123", mac_address="aabbcc112233")
 
     # mock get_template_from_mongo to return a simple template
-    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext: {"template": "cfg for {{ identifier }}", "model": model, "extension": ext})
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: {"template": "cfg for {{ identifier }}", "model": model, "extension": ext})
 
     # set API key and perform request with matching header
     monkeypatch.setenv("PROVISION_API_KEY", "secret-key")
@@ -0,0 +1,81 @@
+import pytest
+
+from api import invalidation
+from api.cache import TieredCache
+
+
+def _worker(transport, name):
+    cache = TieredCache()
+    return cache, invalidation.Bus(transport, origin=name, cache=cache)
+
+
+def test_other_workers_evict_their_local_copy():
+    transport = invalidation.LocalTransport()
+    cache_a, bus_a = _worker(transport, "a")
+    cache_b, bus_b = _worker(transport, "b")
+    bus_b.transport.reset()
+
+    for cache in (cache_a, cache_b):
+        cache.set("device", "mac:aabbcc000001", {"v": 1})
+        cache.set("device", "mac:aabbcc000002", {"v": 1})
+        cache.set("template", "resolve:office:t46:xml", {"_id": "office"})
+
+    cache_a.delete("device", "mac:aabbcc000001")
+    bus_a.publish(invalidation.EVENT_DEVICE, ["mac:aabbcc000001"])
+    bus_a.publish(invalidation.EVENT_TEMPLATE, ["office"])
+    assert cache_b.get("device", "mac:aabbcc000001") == {"v": 1}  # stale L1 until the event is read
+
+    assert bus_b.poll_once() == 2
+    assert cache_b.get("device", "mac:aabbcc000001") is None
+    assert cache_b.get("device", "mac:aabbcc000002") == {"v": 1}
+    assert cache_b.l1.get(cache_b.make_key("template", "resolve:office:t46:xml")) is None
+    # a worker ignores its own events (it already evicted)
+    assert bus_a.poll_once() == 0
+    assert bus_b.stats()["applied"] == 2 and bus_b.stats()["lag_ms"] is not None
+
+
+def test_gap_evicts_the_bus_namespaces():
+    cache, bus = _worker(invalidation.LocalTransport(), "a")
+    cache.set("profile", 1, {"v": 1})
+    cache.set("rendered", "x", "<cfg/>")
+    bus.evict_all()
+    assert cache.l1.get(cache.make_key("profile", 1)) is None
+    assert cache.l1.get(cache.make_key("rendered", "x")) == "<cfg/>"
+
+
+@pytest.mark.django_db
+def test_database_transport_delivers_each_row_once():
+    publisher, subscriber = invalidation.DatabaseTransport(), invalidation.DatabaseTransport()
+    publisher.publish([invalidation.Event("profile", ["1"], "a", 0.0)])
+    subscriber.reset()  # history before the subscriber started is skipped
+
+    publisher.publish([invalidation.Event("profile", ["2"], "a", 0.0), invalidation.Event("device", ["id:x"], "a", 0.0)])
+    assert [(e.kind, e.keys) for e in subscriber.poll(0)] == [("profile", ["2"]), ("device", ["id:x"])]
+    assert subscriber.poll(0) == []  # overlap window re-read, nothing repeated
+
+
+@pytest.mark.django_db
+def test_device_save_publishes_after_commit(django_capture_on_commit_callbacks):
+    from core.models import DeviceConfig
+
+    bus = invalidation.get_bus()
+    bus.transport.reset()
+    with django_capture_on_commit_callbacks(execute=True):
+        DeviceConfig.objects.create(identifier="bus-1", mac_address="aabbcc0000b1")
+    events = bus.transport.poll(0)
+    assert [(e.kind, sorted(e.keys)) for e in events] == [("device", ["id:bus-1", "mac:aabbcc0000b1"])]
+    assert events[0].origin == bus.origin
+
+
+def test_process_local_l2_is_evicted_too():
+    # LocMemCache is one per process: the subscriber drops its L2 copy and bumps the generation
+    cache, bus = _worker(invalidation.LocalTransport(), "b")
+    assert cache.l2_is_local()
+    cache.set("profile", 7, {"v": 1})
+    cache.set("template", "resolve:office:t46:xml", {"_id": "office"})
+    bus.apply([
+        invalidation.Event(invalidation.EVENT_PROFILE, ["7"], "a", 0.0),
+        invalidation.Event(invalidation.EVENT_TEMPLATE, ["office"], "a", 0.0),
+    ])
+    assert cache._l2().get(cache.make_key("profile", 7)) is None
+    assert cache.get("template", "resolve:office:t46:xml") is None
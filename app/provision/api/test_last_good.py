@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import api.views as views
+from api import analytics, last_good
+from api.cache import provision_cache
+
+UA = "Yealink T46 1.0 aabbcc000201"
+
+
+@pytest.fixture
+def device(db, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    profile = DeviceProfile.objects.create(name="Branch", sip_server="sip.example")
+    return DeviceConfig.objects.create(profile=profile, identifier="lg-1", mac_address="aabbcc000201")
+
+
+def test_mongo_outage_serves_the_last_good_config(client, device, monkeypatch):
+    doc = {"_id": "branch", "body": "<cfg>{{ sipserver }}</cfg>", "sha256": "5" * 64}
+    monkeypatch.setattr(views, "_query_template", lambda *a: doc)
+    assert client.get("/api/download-xml/", HTTP_USER_AGENT=UA).content == b"<cfg>sip.example</cfg>"
+
+    def down(*a):
+        raise ConnectionError("atlas unreachable")
+
+    monkeypatch.setattr(views, "_query_template", down)
+    provision_cache.clear_namespace("template")
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT=UA)
+    assert resp.status_code == 200 and resp.content == b"<cfg>sip.example</cfg>"
+    assert resp["X-Provision-Stale"] == "error" and "Age" in resp
+    assert last_good.stats()["stale_error"] >= 1 and last_good.degraded()
+
+    # nothing stored for this device: still refused
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aabbcc0002ff")
+    assert resp.status_code == 403
+
+
+def test_slow_backend_serves_stale_and_refreshes_in_background(client, device, settings, monkeypatch):
+    settings.PROVISION_LAST_GOOD_WAIT_SECONDS = 0.05
+    key = last_good.key_for("aabbcc000201", "xml")
+    last_good.remember(key, "<cfg>old</cfg>", "application/xml; charset=utf-8")
+    last_good.mark_degraded()
+
+    def slow_build(ua_data, ext):
+        time.sleep(0.3)
+        return views.ConfigResult(analytics.STATUS_OK, "<cfg>new</cfg>", object(), ())
+
+    monkeypatch.setattr(views, "_build_config", slow_build)
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT=UA)
+    assert resp.content == b"<cfg>old</cfg>" and resp["X-Provision-Stale"] == "slow"
+
+    deadline = time.monotonic() + 5
+    while last_good.get(key)["content"] != "<cfg>new</cfg>":
+        assert time.monotonic() < deadline, "background build did not refresh the stored config"
+        time.sleep(0.02)
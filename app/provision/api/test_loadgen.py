@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+from django.utils import timezone
+
+from api import loadgen
+
+
+def test_schedules_follow_their_profile():
+    phones = [f"Yealink T46U 1 {i:012x}" for i in range(10)]
+
+    ramp = list(loadgen.ramp(phones, duration=10, rate=20))
+    assert len(ramp) == 100  # rate * duration / 2
+    offsets = [offset for offset, _ in ramp]
+    assert offsets == sorted(offsets) and offsets[-1] < 10
+    assert sum(1 for o in offsets if o >= 5) > 2 * sum(1 for o in offsets if o < 5)  # rate grows
+
+    herd = list(loadgen.herd(phones, spread=2, seed=1))
+    assert sorted(phone for _, phone in herd) == phones
+    assert all(0 <= offset <= 2 for offset, _ in herd)
+
+    steady = list(loadgen.steady(phones, duration=30, interval=10, jitter=0, seed=1))
+    assert len(steady) == 30 and [offset for offset, _ in steady] == sorted(offset for offset, _ in steady)
+
+
+def test_stats_report():
+    stats = loadgen.Stats()
+    for ms in range(1, 101):
+        stats.add("200" if ms <= 98 else "503", float(ms), 0.0, ms // 50, size=10)
+    report = stats.report(2.0)
+    assert (report["requests"], report["ok"], report["errors"], report["throughput"]) == (100, 98, 2, 50.0)
+    assert (report["latency_ms"]["p50"], report["latency_ms"]["p99"], report["latency_ms"]["max"]) == (51.0, 100.0, 100.0)
+    assert report["outcomes"] == {"200": 98, "503": 2}
+    assert sum(row["count"] for row in report["histogram"]) == 100
+
+
+def test_run_storm_against_a_stub_server():
+    seen = []
+
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        agent = [line for line in head.decode().split("\r\n") if line.startswith("User-Agent:")][0]
+        seen.append(agent)
+        status = b"403 Forbidden" if agent.endswith("bad") else b"200 OK"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 5\r\nConnection: close\r\n\r\n<cfg>")
+        await writer.drain()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            schedule = loadgen.herd(["Yealink T46U 1 aabbcc000001"] * 5 + ["x bad"], spread=0.05, seed=2)
+            return await loadgen.run_storm(f"http://127.0.0.1:{port}/api/download-xml/", schedule, concurrency=2,
+                                           headers={"X-API-KEY": "k"})
+
+    report = asyncio.run(main()).report(1.0)
+    assert report["outcomes"] == {"200": 5, "403": 1}
+    assert report["bytes"] == 30 and len(seen) == 6
+
+
+@pytest.mark.django_db
+def test_fleet_uses_last_seen_firmware():
+    from core.models import DeviceConfig, DeviceLastSeen
+
+    DeviceConfig.objects.create(identifier="lg-1", mac_address="aabbcc0000d1")
+    DeviceConfig.objects.create(identifier="lg-2", mac_address="aabbcc0000d2")
+    DeviceLastSeen.objects.create(mac_address="aabbcc0000d1", vendor="Fanvil", model="X4U", version="9.9", last_seen_at=timezone.now())
+
+    phones = loadgen.load_fleet(unknown_ratio=0.5, seed=3)
+    assert len(phones) == 4
+    fanvil = [p for p in phones if p.startswith("Fanvil X4U 9.9 ")]
+    assert len(fanvil) == 1 and fanvil[0].split()[-1].replace(":", "").replace("-", "").lower() == "aabbcc0000d1"
@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory
+from django.utils import timezone
+from oauth2_provider.models import get_access_token_model, get_application_model
+
+from api.cache import provision_cache
+from api.oauth_validators import NAMESPACE, CachedOAuth2Validator, token_cache_key
+
+
+@pytest.fixture
+def access_token(db):
+    user = get_user_model().objects.create_user("m2m", password="pw-12345678")
+    app = get_application_model().objects.create(
+        name="sync", user=user, client_type="confidential", authorization_grant_type="client-credentials"
+    )
+    return get_access_token_model().objects.create(
+        user=user, application=app, token="tok-123", scope="read provision", expires=timezone.now() + timedelta(hours=1)
+    )
+
+
+def _validate(token, scopes):
+    request = RequestFactory().get("/api/whoami/")
+    return CachedOAuth2Validator().validate_bearer_token(token, scopes, request), request
+
+
+def test_token_lookup_is_cached(access_token, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        assert _validate("tok-123", ["read"])[0]
+    with django_assert_num_queries(0):
+        ok, request = _validate("tok-123", ["read"])
+    assert ok and request.user.username == "m2m"
+    # scopes are still checked against the cached token
+    with django_assert_num_queries(0):
+        assert not _validate("tok-123", ["admin"])[0]
+
+
+def test_entry_holds_plain_fields_and_follows_user_changes(access_token, django_assert_num_queries):
+    assert _validate("tok-123", ["read"])[0]
+    entry = provision_cache.get(NAMESPACE, token_cache_key("tok-123"))
+    assert entry["token"]["scope"] == "read provision" and entry["user"]["username"] == "m2m"
+    assert entry["application"]["client_id"] == access_token.application.client_id
+
+    user = access_token.user
+    user.is_active = False
+    user.save()
+    with django_assert_num_queries(1):  # dropped with the user change
+        ok, request = _validate("tok-123", ["read"])
+    assert ok and not request.user.is_active
+
+
+def test_revoked_token_is_rejected_immediately(access_token):
+    assert _validate("tok-123", ["read"])[0]
+    access_token.revoke()
+    assert not _validate("tok-123", ["read"])[0]
+
+
+def test_unknown_and_expired_tokens_are_not_cached(access_token, django_assert_num_queries):
+    assert not _validate("nope", ["read"])[0]
+    with django_assert_num_queries(1):
+        assert not _validate("nope", ["read"])[0]
+
+    access_token.expires = timezone.now() - timedelta(seconds=1)
+    access_token.save()
+    assert not _validate("tok-123", ["read"])[0]
+    with django_assert_num_queries(1):
+        assert not _validate("tok-123", ["read"])[0]
+
+
+def test_whoami_uses_the_cached_validator(access_token, client, django_assert_num_queries):
+    assert client.get("/api/whoami/", HTTP_AUTHORIZATION="Bearer tok-123").status_code == 200
+    with django_assert_num_queries(0):
+        resp = client.get("/api/whoami/", HTTP_AUTHORIZATION="Bearer tok-123")
+    assert resp.json()["username"] == "m2m"
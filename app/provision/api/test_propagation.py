@@ -0,0 +1,122 @@
+import pytest
+
+from api import propagation, views
+
+
+TEMPLATES = {
+    "good": {"_id": "good", "body": "<cfg>{{ account }} %%sipserver%%</cfg>", "sha256": "1" * 64},
+    "broken": {"_id": "broken", "body": "<cfg>{% if %}</cfg>", "sha256": "2" * 64},
+}
+
+
+@pytest.fixture
+def fake_templates(monkeypatch):
+    monkeypatch.setattr(views, "_find_template_by_ref", lambda ref: TEMPLATES.get(str(ref).lower()))
+
+
+@pytest.mark.django_db
+def test_propagate_renders_devices_and_reports_failures(fake_templates):
+    from core.models import DeviceConfig, DeviceProfile
+
+    good = DeviceProfile.objects.create(name="Good", sip_server="sip.example", template_ref="GOOD")
+    broken = DeviceProfile.objects.create(name="Broken", template_ref="broken")
+    no_ref = DeviceProfile.objects.create(name="ByModel")
+    for i in range(5):
+        DeviceConfig.objects.create(profile=good, identifier=f"g{i}", mac_address=f"00:00:00:00:00:0{i}")
+    DeviceConfig.objects.create(profile=broken, identifier="b0", mac_address="00:00:00:00:01:00")
+    DeviceConfig.objects.create(profile=no_ref, identifier="n0", mac_address="00:00:00:00:02:00")
+
+    report = propagation.propagate(profile_ids=[good.pk, broken.pk, no_ref.pk], chunk_size=2, workers=1)
+
+    assert report["total"] == 7
+    assert report["rendered"] == 5
+    assert report["skipped"] == 1
+    assert report["failed"] == 1
+    (error,) = report["errors"]
+    assert error["identifier"] == "b0" and error["error"].startswith("TemplateSyntaxError")
+    assert report["bytes"] == sum(len(f"<cfg>g{i} sip.example</cfg>") for i in range(5))
+
+
+@pytest.mark.django_db
+def test_affected_devices_by_template_ref_is_one_query(django_assert_num_queries):
+    from core.models import DeviceConfig, DeviceProfile
+
+    p1 = DeviceProfile.objects.create(name="A", template_ref="Yealink_T4X")
+    p2 = DeviceProfile.objects.create(name="B", template_ref="other")
+    DeviceConfig.objects.create(profile=p1, identifier="a0", mac_address="00:00:00:00:00:0a")
+    DeviceConfig.objects.create(profile=p2, identifier="b0", mac_address="00:00:00:00:00:0b")
+
+    with django_assert_num_queries(1):
+        identifiers = list(propagation.affected_devices(template_ids=["yealink_t4x"]).values_list("identifier", flat=True))
+    assert identifiers == ["a0"]
+
+
+@pytest.mark.django_db
+def test_profile_save_schedules_background_run(fake_templates, monkeypatch, settings, django_capture_on_commit_callbacks):
+    from core.models import DeviceConfig, DeviceProfile, PropagationRun
+
+    settings.PROVISION_PROPAGATION = True
+    submitted = []
+    monkeypatch.setattr(propagation, "_submit", submitted.append)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        profile = DeviceProfile.objects.create(name="P", template_ref="good")
+    assert not PropagationRun.objects.exists()  # new profile: no devices to render
+    DeviceConfig.objects.create(profile=profile, identifier="d0", mac_address="00:00:00:00:00:d0")
+
+    with django_capture_on_commit_callbacks(execute=True):
+        profile.sip_server = "sip2.example"
+        profile.save()
+        profile.save()  # still pending: same run
+
+    run = PropagationRun.objects.get()
+    assert (run.trigger, run.target, run.status) == ("profile", str(profile.pk), "pending")
+    assert submitted == [run.pk]
+
+    run = propagation.run_propagation(run.pk)
+    assert (run.status, run.total, run.rendered, run.failed) == ("done", 1, 1, 0)
+    assert run.started_at and run.finished_at
+
+
+@pytest.mark.django_db
+def test_profile_changes_the_template_does_not_read_are_not_propagated(monkeypatch):
+    from api import signals
+    from core.models import DeviceProfile
+
+    scheduled = []
+    monkeypatch.setattr(signals, "schedule_propagation", lambda trigger, target: scheduled.append(target))
+    monkeypatch.setattr(signals, "templates_using", lambda keys: ["good"] if "sipserver" in keys else [])
+    profile = DeviceProfile.objects.create(name="Pin", template_ref="good")
+    DeviceProfile.objects.filter(pk=profile.pk).update(template_id="good")
+    profile.refresh_from_db()
+
+    profile.proxy = "proxy.example"
+    profile.save()
+    profile.save()
+    assert scheduled == []
+    profile.sip_server = "sip2.example"
+    profile.save()
+    assert scheduled == [profile.pk]
+
+
+@pytest.mark.django_db
+def test_propagate_resolves_by_model_and_fills_the_download_cache(client, monkeypatch):
+    from django.utils import timezone
+
+    from core.models import DeviceConfig, DeviceLastSeen, DeviceProfile
+
+    doc = {"_id": "t46", "body": "<cfg>{{ account }} {{ model }} {{ sipserver }}</cfg>", "sha256": "3" * 64, "extension": "xml"}
+    monkeypatch.setattr(views, "_query_template", lambda ref, model, ext: doc if model == "t46" and ext == "xml" else None)
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    profile = DeviceProfile.objects.create(name="ByModel", sip_server="sip.example")
+    DeviceConfig.objects.create(profile=profile, identifier="m0", mac_address="aabbcc000701")
+    DeviceConfig.objects.create(profile=profile, identifier="m1", mac_address="aabbcc000702")  # never downloaded
+    DeviceLastSeen.objects.create(mac_address="aabbcc000701", vendor="Yealink", model="T46", version="84.0",
+                                  status="ok", last_seen_at=timezone.now())
+
+    report = propagation.propagate(profile_ids=[profile.pk], workers=1)
+    assert (report["rendered"], report["skipped"], report["failed"]) == (1, 1, 0)
+
+    monkeypatch.setattr(views, "_render_config", lambda *a: pytest.fail("rendered again on download"))
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 84.0 aabbcc000701")
+    assert resp.content == b"<cfg>m0 T46 sip.example</cfg>"
@@ -0,0 +1,31 @@
+import pytest
+from django.test import Client
+
+import api.views as views
+from core.models import DeviceConfig, DeviceProfile
+from provision import settings_provisioning
+
+
+def test_provisioning_role_is_lean():
+    assert "django.contrib.sessions" not in settings_provisioning.INSTALLED_APPS
+    assert "drf_spectacular" not in settings_provisioning.INSTALLED_APPS
+    assert not any("Session" in m or "Csrf" in m or "Message" in m for m in settings_provisioning.MIDDLEWARE)
+    assert {"core", "api"} <= set(settings_provisioning.INSTALLED_APPS)
+
+
+@pytest.mark.django_db
+def test_provisioning_urlconf_serves_only_the_api(monkeypatch, settings):
+    settings.ROOT_URLCONF = settings_provisioning.ROOT_URLCONF
+    settings.MIDDLEWARE = settings_provisioning.MIDDLEWARE
+    client = Client()
+
+    profile = DeviceProfile.objects.create(name="LEAN")
+    DeviceConfig.objects.create(profile=profile, identifier="lean-1", mac_address="aabbcc0000aa")
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: {"template": "lean {{ identifier }}"})
+
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Vendor Model 1.0 aabbcc0000aa")
+    assert resp.status_code == 200
+    assert resp.content == b"lean lean-1"
+    assert "sessionid" not in resp.cookies
+    assert client.get("/admin/").status_code == 404
+    assert client.get("/templates/").status_code == 404
@@ -0,0 +1,98 @@
+import pytest
+from django.template import Context, Template
+
+import api.views as views
+from api.render_context import KEYS, build_render_context, row_render_context
+
+TEMPLATE = {
+    "_id": "rc",
+    "body": "<cfg>{{ account }} {{ macaddress }} {{ sipserver }}:{{ port }} %%vlanactive%% {{ model }}</cfg>",
+    "sha256": "6" * 64,
+}
+
+
+@pytest.mark.django_db
+def test_download_config_reads_device_and_profile_in_one_query(client, monkeypatch, django_assert_num_queries):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: TEMPLATE)
+    profile = DeviceProfile.objects.create(name="RC", sip_server="sip.example", vlan_active=True, template_ref="rc")
+    DeviceConfig.objects.create(profile=profile, identifier="rc-1", mac_address="aa:bb:cc:00:00:0a")
+    DeviceConfig.objects.create(profile=profile, identifier="rc-2", mac_address="aa:bb:cc:00:00:0b")
+
+    with django_assert_num_queries(1):
+        resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aabbcc00000a")
+    assert resp.content == b"<cfg>rc-1 aabbcc00000a sip.example:5060 1 T46</cfg>"
+
+    # the second device of the profile reuses the cached profile row
+    with django_assert_num_queries(1):
+        resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aa:bb:cc:00:00:0b")
+    assert resp.content == b"<cfg>rc-2 aabbcc00000b sip.example:5060 1 T46</cfg>"
+    assert views.get_profile_row(views.get_device_row("aabbcc00000a")) is views.get_profile_row(views.get_device_row("aabbcc00000b"))
+
+
+@pytest.mark.django_db
+def test_row_context_matches_instance_context():
+    from core.models import DeviceConfig, DeviceProfile
+
+    profile = DeviceProfile.objects.create(name="RC2", proxy="px", vlan_id=12)
+    device = DeviceConfig.objects.create(profile=profile, identifier="rc-3", mac_address="aabbcc00000c", public_ip="8.8.8.8")
+    ua = ("V", "M", "2", "aabbcc00000c")
+
+    from_rows = row_render_context(views.get_device_row("aabbcc00000c"), views.get_profile_row(device), ua)
+    assert dict(from_rows) == dict(build_render_context(device, profile, ua))
+    assert list(from_rows) == list(KEYS)
+    assert from_rows["private_ip"] == "" and from_rows["vlanid"] == 12
+
+    unknown = row_render_context(None, None, ("V", "M", "2", "AA-BB-CC-00-00-FF"))
+    assert (unknown["account"], unknown["macaddress"], unknown["sipserver"], unknown["vlanactive"]) == (
+        "AA-BB-CC-00-00-FF", "aabbcc0000ff", "", False
+    )
+
+
+def test_render_context_accepts_template_assignments():
+    context = build_render_context(None, None, ("V", "M", "2", "acc"))
+    text = Template("{% cycle 'a' 'b' as x silent %}{{ x }}/{{ account }}").render(Context(context))
+    assert text == "a/acc"
+    assert "x" in context and "vendor" in context and "nope" not in context
+
+
+@pytest.mark.django_db
+def test_devices_share_output_of_a_template_reading_only_profile_fields(client, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    doc = {"_id": "shared", "body": "<cfg>{{ sipserver }} %%vlanactive%%</cfg>", "sha256": "7" * 64}
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: doc)
+    renders = []
+    render_template = views.render_template
+    monkeypatch.setattr(views, "render_template", lambda *a, **k: renders.append(1) or render_template(*a, **k))
+    profile = DeviceProfile.objects.create(name="Shared", sip_server="sip.example")
+    for i in range(3):
+        DeviceConfig.objects.create(profile=profile, identifier=f"sh-{i}", mac_address=f"aabbcc0001{i:02x}")
+
+    for i in range(3):
+        resp = client.get("/api/download-xml/", HTTP_USER_AGENT=f"Yealink T46 1.0 aabbcc0001{i:02x}")
+        assert resp.content == b"<cfg>sip.example 0</cfg>"
+    assert len(renders) == 1
+
+
+@pytest.mark.django_db
+def test_templates_with_time_or_random_output_skip_the_rendered_cache(client, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    doc = {"_id": "clock", "body": '<cfg>{{ sipserver }} {% now "U" %}</cfg>', "sha256": "8" * 64}
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: doc)
+    renders = []
+    render_template = views.render_template
+    monkeypatch.setattr(views, "render_template", lambda *a, **k: renders.append(1) or render_template(*a, **k))
+    profile = DeviceProfile.objects.create(name="Clock", sip_server="sip.example")
+    DeviceConfig.objects.create(profile=profile, identifier="ck-1", mac_address="aabbcc000201")
+
+    for _ in range(2):
+        resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aabbcc000201")
+        assert resp.status_code == 200 and resp.content.startswith(b"<cfg>sip.example ")
+    assert len(renders) == 2
+    assert views._rendered_cache_key(doc, {}, None, None, ("", "", "", ""), "xml") is None
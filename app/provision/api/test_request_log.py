@@ -0,0 +1,71 @@
+import io
+import json
+import logging
+import os
+import queue
+
+import pytest
+
+import api.views as views
+from api import request_log
+
+
+class _Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def records():
+    handler = _Records()
+    request_log.logger.addHandler(handler)
+    yield handler.lines
+    request_log.logger.removeHandler(handler)
+
+
+def test_queue_handler_writes_on_the_listener_and_drops_instead_of_blocking():
+    stream = io.StringIO()
+    handler = request_log.QueueStreamHandler(stream=stream, maxsize=1)
+    handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    log = logging.getLogger("test.request_log.queue")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        log.warning("hello %s", "world")
+        handler.close()  # stops the listener after draining the queue
+        assert stream.getvalue() == "WARNING hello world\n"
+
+        handler._pid, handler.queue = os.getpid(), queue.Queue(1)
+        log.warning("fills the queue")
+        log.warning("dropped")
+        assert handler.dropped == 1
+    finally:
+        log.removeHandler(handler)
+
+
+@pytest.mark.django_db
+def test_download_emits_one_sampled_record_with_stage_timings(client, settings, monkeypatch, records):
+    from core.models import DeviceConfig, DeviceProfile
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    doc = {"_id": "lobby", "body": "<cfg>{{ sipserver }}</cfg>", "sha256": "8" * 64}
+    monkeypatch.setattr(views, "_query_template", lambda *a: doc)
+    profile = DeviceProfile.objects.create(name="Lobby", sip_server="sip.lobby")
+    DeviceConfig.objects.create(profile=profile, identifier="rl-1", mac_address="aabbcc000401")
+
+    settings.PROVISION_REQUEST_LOG_SAMPLE = 1
+    assert client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aabbcc000401").status_code == 200
+    (line,) = records
+    assert (line["status"], line["outcome"], line["device"], line["template"]) == (200, "ok", "aabbcc000401", "lobby")
+    assert set(line["stages"]) == {"device", "profile", "template", "render"}
+    assert line["severity"] == "INFO" and line["errors"] == []
+
+    settings.PROVISION_REQUEST_LOG_SAMPLE = 0
+    client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46 1.0 aabbcc000401")
+    assert len(records) == 1  # not sampled
+    client.get("/api/download-xml/", HTTP_USER_AGENT="bad")
+    assert records[-1]["status"] == 403 and records[-1]["severity"] == "WARNING"
@@ -0,0 +1,129 @@
+import pytest
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+
+from core.models import DeviceConfig, DeviceProfile
+
+
+@pytest.fixture
+def api(db):
+    staff = get_user_model().objects.create_user("ops", password="pw-12345678", is_staff=True)
+    client = APIClient()
+    client.force_authenticate(staff)
+    return client
+
+
+def test_requires_staff_or_token(db):
+    assert APIClient().get("/api/devices/").status_code in (401, 403)
+
+
+def test_bulk_create_update_delete(api):
+    profile = DeviceProfile.objects.create(name="BULK")
+    resp = api.post("/api/devices/bulk/", {
+        "create": [
+            {"identifier": f"bulk-{i}", "mac_address": f"AA:BB:CC:00:00:0{i}", "profile": profile.pk} for i in range(3)
+        ],
+    }, format="json")
+    assert resp.status_code == 200, resp.content
+    ids = resp.json()["created"]
+    assert len(ids) == 3 and all(ids)
+    assert DeviceConfig.objects.get(pk=ids[0]).mac_address == "aabbcc000000"
+
+    resp = api.post("/api/devices/bulk/", {
+        "update": [{"id": ids[0], "display_name": "Sala 1"}],
+        "delete": [ids[2]],
+    }, format="json")
+    assert resp.json() == {"created": [], "updated": 1, "deleted": 1}
+    assert DeviceConfig.objects.get(pk=ids[0]).display_name == "Sala 1"
+    assert not DeviceConfig.objects.filter(pk=ids[2]).exists()
+
+
+def test_bulk_is_all_or_nothing(api):
+    DeviceConfig.objects.create(identifier="taken", mac_address="001122334455")
+    resp = api.post("/api/devices/bulk/", {
+        "create": [
+            {"identifier": "new-1", "mac_address": "00:00:00:00:00:01"},
+            {"identifier": "new-2", "mac_address": "00-11-22-33-44-55"},  # duplicate MAC after normalization
+        ],
+    }, format="json")
+    assert resp.status_code == 400
+    assert "1" in {str(k) for k in resp.json()["errors"]["create"]}
+    assert not DeviceConfig.objects.filter(identifier="new-1").exists()
+
+
+def test_bulk_limit(api, settings):
+    settings.PROVISION_API_BULK_MAX = 2
+    resp = api.post("/api/devices/bulk/", {"delete": [1, 2, 3]}, format="json")
+    assert resp.status_code == 400
+
+
+def test_cursor_pagination_and_field_projection(api):
+    for i in range(5):
+        DeviceConfig.objects.create(identifier=f"page-{i}", mac_address=f"0000000000a{i}")
+    resp = api.get("/api/devices/?page_size=2&fields=id,identifier")
+    body = resp.json()
+    assert [set(row) for row in body["results"]] == [{"id", "identifier"}] * 2
+    seen = [row["identifier"] for row in body["results"]]
+    while body["next"]:
+        body = api.get(body["next"]).json()
+        seen += [row["identifier"] for row in body["results"]]
+    assert seen == [f"page-{i}" for i in range(5)]
+
+
+def test_passwords_are_write_only(api):
+    device = DeviceConfig.objects.create(identifier="pw", mac_address="0000000000ff", passwd_register="s3cret")
+    assert "passwd_register" not in api.get(f"/api/devices/{device.pk}/").json()
+
+
+def test_conditional_get_and_partial_update(api):
+    device = DeviceConfig.objects.create(identifier="etag-1", mac_address="0000000000b1")
+    first = api.get(f"/api/devices/{device.pk}/")
+    etag = first["ETag"]
+    assert api.get(f"/api/devices/{device.pk}/", HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+    listing = api.get("/api/devices/")
+    assert api.get("/api/devices/", HTTP_IF_NONE_MATCH=listing["ETag"]).status_code == 304
+
+    assert api.patch(f"/api/devices/{device.pk}/", {"display_name": "Novo"}, format="json").status_code == 200
+    assert api.get(f"/api/devices/{device.pk}/", HTTP_IF_NONE_MATCH=etag).status_code == 200
+    assert api.get("/api/devices/", HTTP_IF_NONE_MATCH=listing["ETag"]).status_code == 200
+
+
+def test_bulk_created_profiles_are_pinned(api, settings, monkeypatch):
+    from api import template_pointer
+
+    settings.PROVISION_TEMPLATE_PINNING = True
+    pointers = {"Office": ("office", "a" * 64, "xml"), "nope": template_pointer.UNRESOLVED}
+    monkeypatch.setattr(template_pointer, "resolve_refs", lambda refs, db=None: {ref: pointers[ref] for ref in refs if ref})
+
+    resp = api.post("/api/profiles/bulk/", {"create": [{"name": "HQ", "template_ref": "Office"}, {"name": "Free"}]}, format="json")
+    assert resp.status_code == 200, resp.json()
+    hq = DeviceProfile.objects.get(name="HQ")
+    assert (hq.template_id, hq.template_sha256, hq.template_extension) == pointers["Office"]
+    assert hq.template_resolved_at is not None
+
+    resp = api.post("/api/profiles/bulk/", {"create": [{"name": "X", "template_ref": "nope"}]}, format="json")
+    assert resp.status_code == 400 and "template_ref" in resp.json()["errors"]["create"]["0"]
+    assert not DeviceProfile.objects.filter(name="X").exists()
+
+
+def test_bulk_delete_validates_ids(api):
+    profile = DeviceProfile.objects.create(name="Del")
+    resp = api.post("/api/profiles/bulk/", {"delete": [{"id": 1}, "abc", [2]]}, format="json")
+    assert resp.status_code == 400 and set(resp.json()["errors"]["delete"]) == {"0", "1", "2"}
+
+    resp = api.post("/api/profiles/bulk/", {"delete": [str(profile.pk), profile.pk]}, format="json")
+    assert resp.json() == {"created": [], "updated": 0, "deleted": 1}
+    assert not DeviceProfile.objects.filter(pk=profile.pk).exists()
+
+
+def test_bulk_update_validates_ids(api):
+    profile = DeviceProfile.objects.create(name="Upd")
+    resp = api.post("/api/profiles/bulk/", {"update": [{"id": "abc"}, {"id": {"x": 1}}, {"id": [1]}, {"name": "no id"}]},
+                    format="json")
+    assert resp.status_code == 400
+    assert resp.json()["errors"]["update"] == {str(i): {"id": ["A valid integer id is required."]} for i in range(4)}
+
+    resp = api.post("/api/profiles/bulk/", {"update": [{"id": str(profile.pk), "name": "Renamed"}]}, format="json")
+    assert resp.json() == {"created": [], "updated": 1, "deleted": 0}
+    assert DeviceProfile.objects.get(pk=profile.pk).name == "Renamed"
@@ -0,0 +1,64 @@
+import pytest
+
+from api import sandbox
+
+NESTED = "{% for a in s %}{% for b in s %}{{ a }}{% endfor %}{% endfor %}"
+
+
+def test_render_stops_at_the_step_budget_and_reports_the_template(settings):
+    settings.PROVISION_RENDER_MAX_STEPS = 1000
+    assert sandbox.render("<cfg>{{ account }}</cfg>", {"account": "1001"}) == "<cfg>1001</cfg>"
+
+    with pytest.raises(sandbox.RenderBudgetExceeded) as exc:
+        sandbox.render(NESTED, {"s": "x" * 100}, template="Office")
+    assert exc.value.reason == "more than 1000 steps"
+    assert sandbox.overruns()["Office"]["count"] >= 1
+
+
+def test_cpu_and_output_budgets(settings):
+    settings.PROVISION_RENDER_MAX_STEPS = 0
+    settings.PROVISION_RENDER_CPU_SECONDS = 0.02
+    with pytest.raises(sandbox.RenderBudgetExceeded, match="CPU time"):
+        sandbox.render(NESTED, {"s": "x" * 3000})
+
+    settings.PROVISION_RENDER_CPU_SECONDS = 5
+    settings.PROVISION_RENDER_MAX_OUTPUT_CHARS = 1000
+    with pytest.raises(sandbox.RenderBudgetExceeded, match="output"):
+        sandbox.render("{% for a in s %}0123456789{% endfor %}", {"s": "x" * 200})
+
+
+def test_check_template_measures_and_rejects_outliers(settings):
+    metrics = sandbox.check_template("{% for a in s %}<line>{{ a }}</line>{% endfor %}")
+    assert (metrics["loops"], metrics["max_loop_depth"], metrics["loop_text_bytes"]) == (1, 1, 13)
+
+    settings.PROVISION_TEMPLATE_MAX_LOOP_DEPTH = 1
+    with pytest.raises(sandbox.TemplateRejected, match="nested 2 deep"):
+        sandbox.check_template(NESTED)
+    with pytest.raises(sandbox.TemplateRejected, match="syntax error"):
+        sandbox.check_template("{% for a in s %}")
+
+    settings.PROVISION_RENDER_MAX_STEPS = 500
+    with pytest.raises(sandbox.TemplateRejected, match="trial render"):
+        sandbox.check_template('{% for a in "' + "x" * 1000 + '" %}{{ a }}{% endfor %}')
+
+
+def test_pool_abandons_a_stuck_render(settings):
+    settings.PROVISION_RENDER_POOL = 1
+    settings.PROVISION_RENDER_MAX_STEPS = 0
+    settings.PROVISION_RENDER_CPU_SECONDS = 0.2
+    try:
+        assert sandbox.render("{{ a }}", {"a": "ok"}) == "ok"
+        with pytest.raises(sandbox.RenderBudgetExceeded, match="CPU time"):
+            sandbox.render(NESTED, {"s": "x" * 5000})
+        assert sandbox.render("{{ a }}", {"a": "still ok"}) == "still ok"
+    finally:
+        sandbox._render_pool().close()
+
+
+def test_is_deterministic_finds_time_and_random_output():
+    from django.template import Template
+
+    for text in ('{% now "U" %}', "{{ lines|random }}", "{% if a %}{% for x in s|random %}{% endfor %}{% endif %}",
+                 "{% if not s|random %}x{% endif %}", "{% with x=s|random %}{{ x }}{% endwith %}", "{% lorem 2 w random %}"):
+        assert not sandbox.is_deterministic(Template(text)), text
+    assert sandbox.is_deterministic(Template("{% if a and s|length %}{{ s|first|upper }}{% endif %}{% lorem 2 w %}"))
@@ -0,0 +1,61 @@
+import pytest
+
+import api.views as views
+from api import template_arena
+from api.utils.mongo import reset_mongo_client, use_mongo_database
+from api.utils.templates import build_template_doc, get_version_text, publish_template
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def arena(settings, tmp_path, monkeypatch):
+    settings.PROVISION_TEMPLATE_ARENA = True
+    settings.PROVISION_TEMPLATE_ARENA_DIR = str(tmp_path)
+    settings.PROVISION_TEMPLATE_ARENA_CHECK_SECONDS = 0
+    db = mongomock.MongoClient().db
+    use_mongo_database(db)
+    rebuilds = []
+    monkeypatch.setattr(template_arena, "_schedule_rebuild", rebuilds.append)
+    monkeypatch.setattr(template_arena, "_arena", None)
+    yield db, rebuilds
+    reset_mongo_client()
+
+
+def test_bodies_and_resolution_come_from_the_mapped_file(arena, monkeypatch, tmp_path):
+    db, _ = arena
+    office = publish_template(db, build_template_doc("Office", "<cfg>{{ account }}</cfg>", file_type="xml"))
+    publish_template(db, build_template_doc("t46", "t46 body", file_type="xml"))
+    db.device_templates.update_one({"_id": "t46"}, {"$set": {"model": "T46"}})
+    db.device_templates.insert_one({"_id": "legacy", "extension": "cfg", "template": "old"})
+
+    report = template_arena.build()
+    assert (report["generation"], report["templates"], report["versions"]) == (1, 3, 2)
+
+    monkeypatch.setattr(views, "_query_template", lambda *a: pytest.fail("resolved in Mongo"))
+    assert views.get_template_from_mongo("x", "cfg", template_ref="Office")["_id"] == "Office"
+    assert views.get_template_from_mongo("T46", "xml")["_id"] == "t46"
+    assert views.get_template_from_mongo("unknown", "txt") is None
+    assert template_arena.current().resolve(None, "", "cfg") is template_arena.UNAVAILABLE  # older format
+
+    db.device_template_versions.delete_many({})
+    assert get_version_text(office["sha256"]) == "<cfg>{{ account }}</cfg>"
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith("arena-")) == ["arena-1.bin"]
+
+
+def test_template_change_goes_to_mongo_until_the_next_generation(arena, monkeypatch):
+    db, rebuilds = arena
+    publish_template(db, build_template_doc("lobby", "v1", file_type="cfg"))
+    template_arena.build()
+    assert views.get_template_from_mongo("x", "cfg", template_ref="lobby")["_id"] == "lobby"
+
+    publish_template(db, build_template_doc("annex", "v1", file_type="cfg"))  # notifies api.invalidation listeners
+    assert len(rebuilds) == 1
+    assert not template_arena.is_fresh(template_arena.current())
+    assert views.get_template_from_mongo("x", "cfg", template_ref="annex")["_id"] == "annex"  # from Mongo
+
+    assert template_arena.build(since=rebuilds[0])["generation"] == 2
+    assert template_arena.build(since=rebuilds[0])["skipped"]  # another worker already rebuilt
+    arena_now = template_arena.current()
+    assert arena_now.generation == 2 and template_arena.is_fresh(arena_now)
+    assert arena_now.resolve("annex", "", "cfg")["_id"] == "annex"
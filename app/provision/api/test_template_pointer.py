@@ -0,0 +1,63 @@
+import pytest
+
+import api.views as views
+from api import template_pointer
+from api.utils.mongo import reset_mongo_client, use_mongo_database
+from api.utils.templates import build_template_doc, publish_template
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def db(settings):
+    settings.PROVISION_TEMPLATE_PINNING = True
+    db = mongomock.MongoClient().db
+    use_mongo_database(db)
+    yield db
+    reset_mongo_client()
+
+
+@pytest.mark.django_db
+def test_download_reads_the_pinned_version_without_querying_templates(client, db, monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    publish_template(db, build_template_doc("Office", "<cfg>{{ account }}</cfg>", file_type="xml"))
+    profile = DeviceProfile.objects.create(name="Pinned", template_ref="Office")
+    assert (profile.template_id, profile.template_extension, len(profile.template_sha256)) == ("Office", "xml", 64)
+    DeviceConfig.objects.create(profile=profile, identifier="pin-1", mac_address="aabbcc0000e1")
+
+    monkeypatch.setattr(views, "OAuth2Authentication", None)
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda *a, **k: pytest.fail("template resolved from Mongo"))
+    resp = client.get("/api/download-xml/", HTTP_USER_AGENT="Yealink T46U 1 aabbcc0000e1")
+    assert resp.content == b"<cfg>pin-1</cfg>"
+
+
+@pytest.mark.django_db
+def test_publish_delete_and_reconcile_keep_pins_current(db):
+    from core.models import DeviceProfile
+
+    first = publish_template(db, build_template_doc("lobby", "v1", file_type="cfg"))
+    profile = DeviceProfile.objects.create(name="Lobby", template_ref="Lobby")
+    assert profile.template_sha256 == first["sha256"]
+
+    second = publish_template(db, build_template_doc("lobby", "v2", file_type="cfg"))
+    profile.refresh_from_db()
+    assert profile.template_sha256 == second["sha256"]
+
+    db.device_templates.delete_one({"_id": "lobby"})
+    assert template_pointer.reconcile(dry_run=True) == {"profiles": 1, "repaired": 1, "unresolved": ["Lobby"]}
+    assert template_pointer.reconcile()["repaired"] == 1
+    profile.refresh_from_db()
+    assert (profile.template_id, profile.template_sha256, profile.template_resolved_at) == ("", "", None)
+    assert template_pointer.reconcile()["repaired"] == 0
+
+
+@pytest.mark.django_db
+def test_profile_form_rejects_unknown_template(db):
+    from core.forms import DeviceProfileForm
+
+    publish_template(db, build_template_doc("known", "x", file_type="xml"))
+    data = {"name": "F", "port_server": 5060, "protocol_type": "UDP", "backup_port": 5060, "register_ttl": 3600, "metadata": "{}"}
+    assert DeviceProfileForm(data=dict(data, template_ref="KNOWN")).is_valid()
+    form = DeviceProfileForm(data=dict(data, template_ref="missing"))
+    assert not form.is_valid() and "template_ref" in form.errors
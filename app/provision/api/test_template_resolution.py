@@ -0,0 +1,61 @@
+import pytest
+
+import api.views as views
+from api.cache import provision_cache
+
+mongomock = pytest.importorskip("mongomock")
+
+DOCS = [
+    {"_id": "Office", "extension": "xml", "body": "exact ref"},
+    {"_id": "office", "extension": "xml", "body": "lower ref"},
+    {"_id": "lobby", "extension": "xml", "body": "lower ref only"},
+    {"_id": "t46-xml", "model": "T46", "extension": "xml", "body": "by model"},
+    {"_id": "t46-cfg", "model": "T46", "extension": "cfg", "body": "by model cfg"},
+    {"_id": "vvx", "extension": "cfg", "body": "by id"},
+    {"_id": "A-default", "extension": "xml", "body": "by extension"},
+]
+
+
+@pytest.fixture
+def templates(monkeypatch):
+    db = mongomock.MongoClient().db
+    db.device_templates.insert_many([dict(doc) for doc in DOCS])
+    calls = []
+    aggregate = db.device_templates.aggregate
+    monkeypatch.setattr(db.device_templates, "aggregate", lambda pipeline: calls.append(pipeline) or aggregate(pipeline))
+    monkeypatch.setattr(views, "get_mongo_client", lambda: db)
+    provision_cache.clear_namespace("template")
+    yield calls
+    provision_cache.clear_namespace("template")
+
+
+@pytest.mark.parametrize(
+    "template_ref,model,ext,body",
+    [
+        ("Office", "T46", "xml", "exact ref"),
+        ("Lobby", "T46", "xml", "lower ref only"),
+        ("missing", "t46", "xml", "by model"),
+        (None, "T46", "cfg", "by model cfg"),
+        (None, "VVX", "cfg", "by id"),
+        (None, "unknown", "xml", "by extension"),  # ties: lowest _id
+        (None, "", "xml", "by extension"),
+    ],
+)
+def test_one_query_picks_the_preferred_candidate(templates, template_ref, model, ext, body):
+    assert views.get_template_from_mongo(model, ext, template_ref=template_ref)["body"] == body
+    assert len(templates) == 1
+
+
+def test_resolution_is_memoized_per_ref_model_and_ext(templates):
+    views.get_template_from_mongo("T46", "xml", template_ref="missing")
+    views.get_template_from_mongo("t46", "xml", template_ref="missing")
+    assert len(templates) == 1
+    views.get_template_from_mongo("T46", "cfg", template_ref="missing")
+    assert len(templates) == 2
+    assert views.get_template_from_mongo("nope", "txt") is None
+
+
+def test_find_by_ref_prefers_the_exact_id(templates):
+    assert views._find_template_by_ref("Office")["body"] == "exact ref"
+    assert views._find_template_by_ref("LOBBY")["body"] == "lower ref only"
+    assert views._find_template_by_ref("nope") is None
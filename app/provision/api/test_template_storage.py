@@ -0,0 +1,182 @@
+import hashlib
+import zlib
+
+import pytest
+
+from api.utils import templates as tpl
+
+
+def test_build_template_doc_small_body_is_plain():
+    doc = tpl.build_template_doc("t1", "<a>%%Account%% %%sipserver%% %%account%%</a>", file_type="XML", compress_min_bytes=1024)
+    assert doc["_id"] == "t1"
+    assert doc["encoding"] == tpl.ENCODING_PLAIN
+    assert doc["body"] == "<a>%%Account%% %%sipserver%% %%account%%</a>"
+    assert doc["extension"] == "xml"
+    assert doc["placeholders"] == ["account", "sipserver"]
+    assert doc["sha256"] == hashlib.sha256(doc["body"].encode("utf-8")).hexdigest()
+    assert doc["size"] == len(doc["body"])
+    assert "template" not in doc and "content" not in doc
+
+
+def test_build_template_doc_large_body_is_compressed():
+    content = "line %%macaddress%%\n" * 500
+    doc = tpl.build_template_doc("big", content, file_type="cfg", compress_min_bytes=1024)
+    assert doc["encoding"] == tpl.ENCODING_ZLIB
+    assert isinstance(doc["body"], bytes)
+    assert len(doc["body"]) < doc["size"]
+    assert zlib.decompress(doc["body"]).decode("utf-8") == content
+    assert tpl.get_template_body(doc) == content
+
+
+def test_get_template_body_reads_legacy_documents():
+    assert tpl.get_template_body({"template": "T", "content": "C"}) == "T"
+    assert tpl.get_template_body({"content": "C"}) == "C"
+    assert tpl.get_template_body({}) is None
+    assert tpl.get_template_body(None) is None
+
+
+def test_compact_template_doc_keeps_metadata():
+    legacy = {"_id": "old", "filename": "old.xml", "file_type": "xml", "template": "<x/>", "content": "<x/>", "uploaded_by": "admin"}
+    new_doc = tpl.compact_template_doc(legacy, compress_min_bytes=-1)
+    assert new_doc["_id"] == "old"
+    assert new_doc["body"] == "<x/>"
+    assert new_doc["filename"] == "old.xml"
+    assert new_doc["uploaded_by"] == "admin"
+    assert new_doc["extension"] == "xml"
+    # already compact -> nothing to do
+    assert tpl.compact_template_doc(new_doc) is None
+
+
+class FakeGridIn:
+    def __init__(self):
+        self._id = "grid-1"
+        self.data = b""
+        self.closed = self.aborted = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeBucket:
+    def __init__(self):
+        self.grid_in = FakeGridIn()
+
+    def open_upload_stream(self, filename, metadata=None):
+        return self.grid_in
+
+
+def test_stream_validator_finds_placeholders_across_chunks():
+    validator = tpl.TemplateStreamValidator("cfg")
+    for chunk in (b"a=%%sip", b"server%%\nb=%", b"%Account%%\n"):
+        validator.feed(chunk)
+    validator.close()
+    assert validator.placeholders == ["account", "sipserver"]
+    assert validator.size == len(b"a=%%sipserver%%\nb=%%Account%%\n")
+
+
+def test_extract_variables_reads_placeholders_and_template_tags():
+    text = (
+        "{{ Account|default:displayname }} {% if vlanactive and vlanid %}{{ vlanid.real }}{% endif %}"
+        " {% cycle 'sipserver' proxy as x silent %} %%PORT%% {# {{ user }} #}"
+    )
+    assert tpl.extract_variables(text) == ["account", "displayname", "port", "proxy", "user", "vlanactive", "vlanid", "x"]
+    assert tpl.extract_variables("{% include 'other.xml' %}") is None
+    assert tpl.build_template_doc("t", "<a>{{ sipserver }}</a>", file_type="xml")["variables"] == ["sipserver"]
+
+    validator = tpl.TemplateStreamValidator("cfg")
+    for chunk in (b"{{ acc", b"ount }} {% if vlan", b"active %}x{% endif %}"):
+        validator.feed(chunk)
+    assert validator.variables == ["account", "vlanactive"]
+    validator.feed(b"{{ " + b" " * 300 + b"sipserver }}")
+    assert validator.variables is None  # tag too long for the streaming scan
+
+
+def test_ingest_rejects_malformed_xml():
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    uploaded = SimpleUploadedFile("bad.xml", b"<root><a></root>")
+    with pytest.raises(tpl.TemplateValidationError):
+        tpl.ingest_template_upload(None, "bad", uploaded, file_type="xml", chunk_size=4)
+
+
+def test_ingest_small_latin1_xml_is_inline(settings):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    settings.TEMPLATE_GRIDFS_MIN_BYTES = 1024
+    raw = "<root>Olá %%displayname%%</root>".encode("latin-1")
+    doc = tpl.ingest_template_upload(None, "small", SimpleUploadedFile("s.xml", raw), file_type="xml", chunk_size=5)
+    assert doc["sha256"] == hashlib.sha256(raw).hexdigest()
+    assert doc["placeholders"] == ["displayname"]
+    assert "gridfs_id" not in doc
+    assert tpl.get_template_body(doc) == "<root>Olá %%displayname%%</root>"
+
+
+def test_ingest_large_body_streams_to_gridfs(monkeypatch, settings):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    settings.TEMPLATE_GRIDFS_MIN_BYTES = 64
+    settings.TEMPLATE_COMPRESS_MIN_BYTES = 0
+    bucket = FakeBucket()
+    monkeypatch.setattr(tpl, "_gridfs_bucket", lambda db: bucket)
+    raw = b"<root>" + b"<line>%%account%%</line>" * 50 + b"</root>"
+    doc = tpl.ingest_template_upload(object(), "big", SimpleUploadedFile("b.xml", raw), file_type="xml", chunk_size=16)
+    assert doc["gridfs_id"] == "grid-1"
+    assert "body" not in doc
+    assert doc["size"] == len(raw)
+    assert doc["encoding"] == tpl.ENCODING_ZLIB
+    assert bucket.grid_in.closed
+    assert zlib.decompress(bucket.grid_in.data) == raw
+
+
+class RecordingCollection:
+    def __init__(self, upserted_id="new"):
+        self.calls = []
+        self.upserted_id = upserted_id
+
+    def update_one(self, flt, update, upsert=False):
+        self.calls.append((flt, update, upsert))
+        return type("Result", (), {"upserted_id": self.upserted_id})()
+
+
+class FakeDB:
+    def __init__(self):
+        self.device_templates = RecordingCollection()
+        self.device_template_versions = RecordingCollection()
+
+    def get_collection(self, name):
+        return getattr(self, name)
+
+
+def test_publish_template_stores_version_and_pointer():
+    db = FakeDB()
+    doc = tpl.build_template_doc("t1", "<a>%%account%%</a>", file_type="xml", uploaded_by="admin", compress_min_bytes=-1)
+    pointer = tpl.publish_template(db, doc, history_limit=5)
+
+    (vflt, vupdate, vupsert), = db.device_template_versions.calls
+    assert vflt == {"_id": doc["sha256"]} and vupsert
+    assert vupdate["$setOnInsert"]["body"] == "<a>%%account%%</a>"
+
+    (pflt, pupdate, _), = db.device_templates.calls
+    assert pflt == {"_id": "t1"}
+    assert pupdate["$set"]["sha256"] == doc["sha256"]
+    assert "body" not in pupdate["$set"] and "body" in pupdate["$unset"]
+    assert pupdate["$push"]["history"]["$slice"] == -5
+    assert pointer["format"] == tpl.FORMAT_VERSION
+
+
+def test_get_template_body_resolves_pointer_by_hash(monkeypatch):
+    loads = []
+
+    def fake_load(sha256, db=None):
+        loads.append(sha256)
+        return {"_id": sha256, "body": "BODY", "encoding": tpl.ENCODING_PLAIN}
+
+    monkeypatch.setattr(tpl, "load_template_version", fake_load)
+    pointer = {"_id": "t1", "format": tpl.FORMAT_VERSION, "sha256": "f" * 64}
+    assert tpl.is_versioned_doc(pointer)
+    assert tpl.get_template_body(pointer) == "BODY"
+    assert tpl.get_template_body(pointer) == "BODY"
+    assert loads == ["f" * 64]  # immutable: second read served from the cache
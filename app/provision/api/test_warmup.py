@@ -0,0 +1,58 @@
+import pytest
+
+from api import warmup
+from api.cache import provision_cache
+
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, flt=None, projection=None):
+        return iter(self.docs)
+
+
+class FakeDB:
+    def __init__(self, docs):
+        self.device_templates = FakeCollection(docs)
+
+    def get_collection(self, name):
+        return getattr(self, name)
+
+
+@pytest.mark.django_db
+def test_warmup_loads_profiles_templates_and_devices(monkeypatch):
+    from core.models import DeviceConfig, DeviceProfile
+
+    profile = DeviceProfile.objects.create(name="WP", template_ref="H2P")
+    DeviceConfig.objects.create(profile=profile, identifier="warm-1", mac_address="aa:bb:cc:00:00:01")
+    pointer = {"_id": "h2p", "format": 3, "sha256": "a" * 64}
+    monkeypatch.setattr(warmup, "get_mongo_client", lambda: FakeDB([pointer, {"_id": "legacy", "template": "x"}]))
+    monkeypatch.setattr(warmup, "get_version_text", lambda sha: "<cfg>{{ account }}</cfg>")
+
+    report = warmup.warm_provisioning_cache(devices=10)
+
+    assert report["profiles"] == 1
+    assert report["templates"] == 1 and report["templates_skipped"] == 1
+    assert report["devices"] == 1
+    assert report["errors"] == []
+    assert provision_cache.get("profile", profile.pk).template_ref == "H2P"
+    assert provision_cache.get("template", "ref:H2P") == pointer  # profile's template_ref, resolved lower-case
+    assert provision_cache.get("device", "mac:aabbcc000001").identifier == "warm-1"
+    assert provision_cache.get("compiled", "a" * 64) is not None
+    assert warmup.get_warmup_state()["status"] == warmup.STATUS_READY
+
+
+@pytest.mark.django_db
+def test_ready_endpoint_waits_for_warmup(client, monkeypatch, settings):
+    settings.PROVISION_WARMUP = True
+    monkeypatch.setattr(warmup, "_state", {"status": warmup.STATUS_PENDING, "report": None})
+    resp = client.get("/api/ready/")
+    assert resp.status_code == 503
+    assert resp.json()["warmup"] == "pending"
+
+    monkeypatch.setattr(warmup, "get_mongo_client", lambda: FakeDB([]))
+    warmup.warm_provisioning_cache()
+    resp = client.get("/api/ready/")
+    assert resp.status_code == 200
+    assert resp.json()["report"]["profiles"] == 0
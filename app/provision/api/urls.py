@@ -1,10 +1,23 @@
-from django.urls import path, re_path
-from .views import download_config
+from django.conf import settings
+from django.urls import include, path, re_path
+from .views import download_config, ready
 from . import oauth_views
 
 app_name = "api"
 
 urlpatterns = [
     re_path(r'^download-xml(?:/(?P<filename>[^/]+))?/$', download_config, name='download-xml'),
+    path('ready/', ready, name='ready'),
     path('whoami/', oauth_views.whoami, name='whoami'),
-]
\ No newline at end of file
+    path('cache/stats/', oauth_views.cache_stats, name='cache-stats'),
+]
+
+# API REST de devices/profiles (DRF); fora do papel de provisionamento, que não instala o DRF
+if "rest_framework" in settings.INSTALLED_APPS:
+    from rest_framework.routers import SimpleRouter
+    from .viewsets import DeviceConfigViewSet, DeviceProfileViewSet
+
+    router = SimpleRouter()
+    router.register('devices', DeviceConfigViewSet, basename='device')
+    router.register('profiles', DeviceProfileViewSet, basename='profile')
+    urlpatterns += [path('', include(router.urls))]
@@ -9,6 +9,19 @@ logger = logging.getLogger(__name__)
 _client_lock = threading.Lock()
 _db_instance = None
 
+def _client_options():
+    """
+    Driver timeouts (ms) from settings.MONGODB. Without them pymongo waits 30s for a
+    server and indefinitely for a socket read; requests also have their own budget
+    (api.breaker).
+    """
+    return {
+        "serverSelectionTimeoutMS": settings.MONGODB.get("SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": settings.MONGODB.get("CONNECT_TIMEOUT_MS", 3000),
+        "socketTimeoutMS": settings.MONGODB.get("SOCKET_TIMEOUT_MS", 10000),
+    }
+
+
 def get_mongo_client():
     """
     Return a cached/persistent pymongo database handle.
@@ -32,13 +45,39 @@ def get_mongo_client():
             if user and password:
                 # Use a connection string with user/pass when provided
                 uri = f"mongodb://{user}:{password}@{host}:{port}/{db_name}"
-                client = MongoClient(uri)
+                client = MongoClient(uri, **_client_options())
             else:
-                client = MongoClient(host, port)
+                client = MongoClient(host, port, **_client_options())
 
             _db_instance = client[db_name]
             logger.info("Connected to MongoDB database '%s' at %s:%s", db_name, host, port)
             return _db_instance
     except Exception as exc:
         logger.exception("Failed to create MongoDB client: %s", exc)
-        raise
\ No newline at end of file
+        raise
+
+
+def reset_mongo_client(close: bool = False):
+    """
+    Forget the cached DB handle so the next get_mongo_client() connects again.
+    pymongo clients are not fork-safe: the gunicorn master closes its client after
+    warm-up (close=True) and each worker starts with a fresh one.
+    """
+    global _db_instance
+    with _client_lock:
+        db, _db_instance = _db_instance, None
+    if close and db is not None:
+        try:
+            db.client.close()
+        except Exception as exc:
+            logger.debug("Failed to close MongoDB client: %s", exc)
+
+
+def use_mongo_database(db):
+    """
+    Make get_mongo_client() return db (e.g. an in-memory mongomock database for a
+    local load test) instead of connecting to settings.MONGODB.
+    """
+    global _db_instance
+    with _client_lock:
+        _db_instance = db
@@ -0,0 +1,666 @@
+"""
+Helpers for the storage format of the MongoDB collections 'device_templates'
+and 'device_template_versions'.
+
+Template bodies are immutable versions keyed by content hash: each document in
+'device_template_versions' has _id == sha256 of the body. A document in
+'device_templates' (_id == template name) is only a pointer to the current
+version ('sha256') plus listing metadata and a 'history' of published versions,
+so publishing or rolling back is a pointer flip (publish_template() /
+rollback_template()). Anything derived from a body can be cached by its hash
+with no expiry; only the small name -> hash pointer needs revalidation.
+
+A version keeps a single copy of the template body under 'body'. Bodies
+larger than settings.TEMPLATE_COMPRESS_MIN_BYTES are stored zlib-compressed
+(encoding 'zlib'); smaller ones are stored as plain strings (encoding 'plain').
+Alongside the body the document records its sha256, size (bytes, uncompressed)
+and the %%placeholders%% it references, so callers can inspect a template
+without downloading it. 'variables' lists the names the body may read from the
+render context, through %%name%%, {{ var }} or template tags (extract_variables):
+download_config keys rendered output on the values of those that are context
+keys only, and templates_using() finds the templates a changed field affects. It
+is None when the body includes other templates, loads tag libraries or dumps the
+context ({% include %}, {% load %}, {% debug %}): the whole context is assumed then.
+
+Bodies at or above settings.TEMPLATE_GRIDFS_MIN_BYTES do not fit comfortably in
+a document; they are streamed to the GridFS bucket 'device_templates_fs' and the
+version stores 'gridfs_id' instead of 'body'. Uploads go through
+ingest_template_upload(), which reads the file in chunks, validating XML with an
+incremental expat parser while hashing, so peak memory does not grow with the
+file size.
+
+Older documents in 'device_templates' still hold the body themselves: format 2
+('body'/'gridfs_id') and legacy ones, with the body twice under 'template' and
+'content'. get_template_body() reads all of them, and the 'compact_templates'
+command converts them to versions.
+"""
+import codecs
+import hashlib
+import logging
+import re
+import zlib
+from xml.parsers import expat
+
+from django.conf import settings
+
+from api import breaker, invalidation, template_arena
+from api.cache import provision_cache
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_COLLECTION = "device_templates"
+VERSIONS_COLLECTION = "device_template_versions"
+GRIDFS_BUCKET = "device_templates_fs"
+
+# 3: device_templates holds a pointer ('sha256') to device_template_versions
+FORMAT_VERSION = 3
+
+ENCODING_PLAIN = "plain"
+ENCODING_ZLIB = "zlib"
+
+# Fields needed to render a template (pointer + inline bodies of older formats).
+TEMPLATE_BODY_PROJECTION = {
+    "format": 1,
+    "body": 1,
+    "gridfs_id": 1,
+    "encoding": 1,
+    "sha256": 1,
+    "extension": 1,
+    "file_type": 1,
+    "template": 1,
+    "content": 1,
+    "variables": 1,
+}
+
+# Everything except the body, for listings and metadata pages.
+TEMPLATE_META_PROJECTION = {"body": 0, "template": 0, "content": 0, "history": 0}
+
+# Where a body lives in a version (or in a format 2 document).
+_BODY_FIELDS = ("body", "gridfs_id", "encoding")
+_LEGACY_FIELDS = ("template", "content")
+
+# metadata preserved when a legacy document is compacted
+_META_FIELDS = ("filename", "file_type", "extension", "model", "common_file", "uploaded_by", "uploaded_at")
+
+# name a phone requests for a model/profile-wide file (y000000000028.cfg, 000000000000.cfg, ...)
+COMMON_FILE_RE = re.compile(r"^[a-z0-9][a-z0-9._-]{0,99}\.(cfg|xml)$")
+
+PLACEHOLDER_RE = re.compile(r"%%([A-Za-z0-9_]+)%%")
+
+# streaming scan: placeholders and template tags longer than this are not expected in real templates
+_MAX_PLACEHOLDER_BYTES = 256
+_PLACEHOLDER_BYTES_RE = re.compile(rb"%%([A-Za-z0-9_]+)%%|\{\{(.{0,250}?)\}\}|\{%(.{0,250}?)%\}", re.S)
+_TAG_OPENER_BYTES_RE = re.compile(rb"\{\{|\{%")
+
+# Django {{ var }} / {% tag %}: identifiers outside quoted strings, filter names and
+# attribute lookups are the variables a tag may read
+_TAG_RE = re.compile(r"\{\{(.*?)\}\}|\{%(.*?)%\}", re.S)
+_NOT_VARIABLE_RE = re.compile(r"\"[^\"]*\"|'[^']*'|[|.]\s*[A-Za-z0-9_]+")
+_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_TAG_KEYWORDS = {"and", "or", "not", "in", "is", "as", "with", "by", "silent", "reversed", "only", "none", "true", "false"}
+# tags whose output depends on more than the variables written in the template
+_OPAQUE_TAGS = {"include", "extends", "debug", "ssi", "load"}
+
+
+class TemplateValidationError(ValueError):
+    """Raised when an uploaded template is rejected (e.g. malformed XML)."""
+
+    def __init__(self, message, is_utf8=True):
+        super().__init__(message)
+        self.is_utf8 = is_utf8
+
+
+def get_templates_collection(db):
+    """Return the device_templates collection from a pymongo database handle."""
+    return getattr(db, TEMPLATES_COLLECTION, db.get_collection(TEMPLATES_COLLECTION))
+
+
+def get_versions_collection(db):
+    """Return the device_template_versions collection from a pymongo database handle."""
+    return getattr(db, VERSIONS_COLLECTION, db.get_collection(VERSIONS_COLLECTION))
+
+
+def _default_db(db):
+    if db is None:
+        from api.utils.mongo import get_mongo_client
+        db = get_mongo_client()
+    return db
+
+
+def extract_placeholders(text: str) -> list:
+    """Return the sorted, lower-cased set of %%name%% placeholders used in text."""
+    if not text:
+        return []
+    return sorted({m.lower() for m in PLACEHOLDER_RE.findall(text)})
+
+
+def _tag_names(content: str, names: set, is_tag: bool) -> bool:
+    """Add the variable names of a {{ }} / {% %} content to names; False for tags that read the whole context."""
+    found = _NAME_RE.findall(_NOT_VARIABLE_RE.sub(" ", content))
+    if is_tag and found:
+        if found[0] in _OPAQUE_TAGS:
+            return False
+        found = found[1:]  # the tag name
+    names.update(name.lower() for name in found if name.lower() not in _TAG_KEYWORDS)
+    return True
+
+
+def extract_variables(text: str):
+    """
+    Return the sorted, lower-cased names a template may read from its context
+    (%%name%% placeholders, {{ var }} and variables in tags), or None when that cannot
+    be known from the text alone. Over-approximates; callers intersect the names with
+    the context keys they provide (api.render_context.KEYS).
+    """
+    if not text:
+        return []
+    names = {m.lower() for m in PLACEHOLDER_RE.findall(text)}
+    for var, tag in _TAG_RE.findall(text):
+        if not _tag_names(tag or var, names, is_tag=bool(tag)):
+            return None
+    return sorted(names)
+
+
+def templates_using(names, db=None) -> list:
+    """
+    Names of the templates whose current version may read any of the given context
+    keys (api.render_context.KEYS), including those whose variables are unknown.
+    """
+    query = {"$or": [{"variables": {"$in": [name.lower() for name in names]}}, {"variables": None}]}
+    return sorted(doc["_id"] for doc in get_templates_collection(_default_db(db)).find(query, projection={"_id": 1}))
+
+
+def decode_body_bytes(raw: bytes) -> str:
+    """Decode a stored body as UTF-8, falling back to latin-1 (same rule as the upload)."""
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("latin-1", errors="replace")
+
+
+def encode_body(raw: bytes, compress_min_bytes: int = None):
+    """
+    Return (stored_value, encoding) for a body given as bytes.
+    Bodies at or above compress_min_bytes are zlib-compressed; compression is
+    skipped when it would not make the body smaller.
+    """
+    if compress_min_bytes is None:
+        compress_min_bytes = getattr(settings, "TEMPLATE_COMPRESS_MIN_BYTES", 1024)
+    if compress_min_bytes >= 0 and len(raw) >= compress_min_bytes:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            return packed, ENCODING_ZLIB
+    return decode_body_bytes(raw), ENCODING_PLAIN
+
+
+def _template_doc_meta(name, *, sha256, size, placeholders, variables, filename, file_type, uploaded_by, uploaded_at) -> dict:
+    file_type = (file_type or "").lower() or None
+    return {
+        "_id": name,
+        "format": FORMAT_VERSION,
+        "filename": filename,
+        "file_type": file_type,
+        # 'extension' is the field used by the API lookups (api.views)
+        "extension": file_type,
+        "sha256": sha256,
+        "size": size,
+        "placeholders": placeholders,
+        "variables": variables,
+        "uploaded_by": uploaded_by,
+        "uploaded_at": uploaded_at,
+    }
+
+
+def build_template_doc(name: str, content, *, filename=None, file_type=None, uploaded_by=None, uploaded_at=None,
+                       compress_min_bytes: int = None) -> dict:
+    """
+    Build a device_templates document in the compact format, with the body inline.
+    content may be str or bytes; the sha256/size are computed over the body bytes
+    (UTF-8 for str).
+    """
+    raw = content.encode("utf-8") if isinstance(content, str) else bytes(content or b"")
+    text = content if isinstance(content, str) else decode_body_bytes(raw)
+    body, encoding = encode_body(raw, compress_min_bytes)
+    doc = _template_doc_meta(
+        name,
+        sha256=hashlib.sha256(raw).hexdigest(),
+        size=len(raw),
+        placeholders=extract_placeholders(text),
+        variables=extract_variables(text),
+        filename=filename,
+        file_type=file_type,
+        uploaded_by=uploaded_by,
+        uploaded_at=uploaded_at,
+    )
+    doc["body"] = body
+    doc["encoding"] = encoding
+    return doc
+
+
+class TemplateStreamValidator:
+    """
+    Consumes a template chunk by chunk keeping O(chunk) state: sha256, size,
+    %%placeholder%% names, context variables (see extract_variables) and, for XML,
+    an incremental expat parse (no DOM is built).
+    """
+
+    def __init__(self, file_type: str, xml_encoding: str = None):
+        self.size = 0
+        self.is_utf8 = True
+        self._sha = hashlib.sha256()
+        self._placeholders = set()
+        self._names = set()
+        self._opaque = False
+        self._carry = b""
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._parser = expat.ParserCreate(xml_encoding) if file_type == "xml" else None
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    @property
+    def placeholders(self) -> list:
+        return sorted(self._placeholders)
+
+    @property
+    def variables(self):
+        return None if self._opaque else sorted(self._names | self._placeholders)
+
+    def feed(self, chunk: bytes) -> None:
+        self._sha.update(chunk)
+        self.size += len(chunk)
+        self._check_utf8(chunk, final=False)
+        self._scan_placeholders(chunk)
+        self._parse(chunk, final=False)
+
+    def close(self) -> None:
+        self._check_utf8(b"", final=True)
+        self._parse(b"", final=True)
+
+    def _check_utf8(self, chunk, final):
+        if self.is_utf8:
+            try:
+                self._utf8.decode(chunk, final)
+            except UnicodeDecodeError:
+                self.is_utf8 = False
+
+    def _scan_placeholders(self, chunk):
+        data = self._carry + chunk
+        last_end = 0
+        for m in _PLACEHOLDER_BYTES_RE.finditer(data):
+            if _TAG_OPENER_BYTES_RE.search(data, last_end, m.start()):
+                self._opaque = True  # a tag too long to scan: its variables are unknown
+            if m.group(1):
+                self._placeholders.add(m.group(1).decode("ascii").lower())
+            elif not _tag_names((m.group(2) or m.group(3)).decode("utf-8", "replace"), self._names, m.group(3) is not None):
+                self._opaque = True
+            last_end = m.end()
+        # a placeholder or tag split across chunks starts inside the kept tail
+        keep = max(last_end, len(data) - _MAX_PLACEHOLDER_BYTES)
+        if _TAG_OPENER_BYTES_RE.search(data, last_end, keep):
+            self._opaque = True
+        self._carry = data[keep:]
+
+    def _parse(self, chunk, final):
+        if self._parser is None:
+            return
+        try:
+            self._parser.Parse(chunk, final)
+        except expat.ExpatError as exc:
+            raise TemplateValidationError(str(exc), is_utf8=self.is_utf8) from exc
+
+
+def _gridfs_bucket(db):
+    import gridfs
+    return gridfs.GridFSBucket(db, bucket_name=GRIDFS_BUCKET)
+
+
+def _ingest(db, name, uploaded, *, file_type, filename, uploaded_by, uploaded_at, chunk_size, xml_encoding):
+    validator = TemplateStreamValidator(file_type, xml_encoding)
+    gridfs_min = getattr(settings, "TEMPLATE_GRIDFS_MIN_BYTES", 1024 * 1024)
+    compress_min = getattr(settings, "TEMPLATE_COMPRESS_MIN_BYTES", 1024)
+    buffered = []
+    grid_in = compressor = None
+    try:
+        for chunk in uploaded.chunks(chunk_size):
+            validator.feed(chunk)
+            if grid_in is None:
+                buffered.append(chunk)
+                if validator.size < gridfs_min:
+                    continue
+                # body too big for an inline document: switch to GridFS and stop buffering
+                grid_in = _gridfs_bucket(db).open_upload_stream(filename or name, metadata={"template": name})
+                compressor = zlib.compressobj(6) if compress_min >= 0 else None
+                pending, buffered = buffered, None
+            else:
+                pending = (chunk,)
+            for part in pending:
+                grid_in.write(compressor.compress(part) if compressor else part)
+        validator.close()
+        if grid_in is not None:
+            if compressor:
+                grid_in.write(compressor.flush())
+            grid_in.close()
+    except BaseException:
+        if grid_in is not None:
+            grid_in.abort()
+        raise
+
+    if grid_in is None:
+        return build_template_doc(
+            name, b"".join(buffered), filename=filename, file_type=file_type,
+            uploaded_by=uploaded_by, uploaded_at=uploaded_at,
+        )
+
+    doc = _template_doc_meta(
+        name,
+        sha256=validator.sha256,
+        size=validator.size,
+        placeholders=validator.placeholders,
+        variables=validator.variables,
+        filename=filename,
+        file_type=file_type,
+        uploaded_by=uploaded_by,
+        uploaded_at=uploaded_at,
+    )
+    doc["gridfs_id"] = grid_in._id
+    doc["encoding"] = ENCODING_ZLIB if compressor else ENCODING_PLAIN
+    return doc
+
+
+def ingest_template_upload(db, name: str, uploaded, *, file_type: str, filename: str = None, uploaded_by=None,
+                           uploaded_at=None, chunk_size: int = None) -> dict:
+    """
+    Read an uploaded file (django UploadedFile) in chunks and build its device_templates
+    document. Small bodies are kept inline; bodies of TEMPLATE_GRIDFS_MIN_BYTES or more
+    are streamed to GridFS. The document is returned, not saved.
+
+    XML is validated incrementally. Files that are not UTF-8 and have no encoding
+    declaration are re-validated as latin-1 (same fallback as the decoder).
+    Raises TemplateValidationError when the template is rejected.
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, "TEMPLATE_UPLOAD_CHUNK_BYTES", 64 * 1024)
+    kwargs = dict(file_type=file_type, filename=filename, uploaded_by=uploaded_by, uploaded_at=uploaded_at,
+                  chunk_size=chunk_size)
+    try:
+        return _ingest(db, name, uploaded, xml_encoding=None, **kwargs)
+    except TemplateValidationError as exc:
+        if file_type != "xml" or exc.is_utf8:
+            raise
+    return _ingest(db, name, uploaded, xml_encoding="ISO-8859-1", **kwargs)
+
+
+def delete_template_body(db, doc) -> None:
+    """Remove the GridFS file holding doc's body, if any (inline bodies need nothing)."""
+    gridfs_id = (doc or {}).get("gridfs_id")
+    if gridfs_id is None:
+        return
+    import gridfs
+    try:
+        _gridfs_bucket(db).delete(gridfs_id)
+    except gridfs.errors.NoFile:
+        pass
+
+
+def normalize_common_file(name):
+    """
+    Lower-case file name of a common template (served to every phone that requests it,
+    rendered without device data; see api.views.find_common_template), or None for an
+    empty name. Raises ValueError for names that are not a plain .cfg/.xml file name.
+    """
+    name = (name or "").strip().lower()
+    if not name:
+        return None
+    if not COMMON_FILE_RE.match(name):
+        raise ValueError(f"invalid common file name {name!r}")
+    return name
+
+
+def is_legacy_doc(doc) -> bool:
+    """True for documents stored before the compact format (body under 'template'/'content')."""
+    return bool(doc) and "body" not in doc and "gridfs_id" not in doc and ("template" in doc or "content" in doc)
+
+
+def is_versioned_doc(doc) -> bool:
+    """True for device_templates pointers (body stored in device_template_versions)."""
+    return bool(doc) and (doc.get("format") or 0) >= 3 and "body" not in doc and "gridfs_id" not in doc
+
+
+def _iter_stored_body(doc, db):
+    if doc.get("gridfs_id") is not None:
+        decompressor = zlib.decompressobj() if doc.get("encoding") == ENCODING_ZLIB else None
+        for chunk in _gridfs_bucket(_default_db(db)).open_download_stream(doc["gridfs_id"]):
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            if data:
+                yield data
+        if decompressor:
+            tail = decompressor.flush()
+            if tail:
+                yield tail
+        return
+    body = doc.get("body")
+    if doc.get("encoding") == ENCODING_ZLIB:
+        yield zlib.decompress(body)
+    elif isinstance(body, (bytes, bytearray)):
+        yield bytes(body)
+    elif body:
+        yield body.encode("utf-8")
+
+
+def load_template_version(sha256: str, db=None):
+    """Fetch a version document (with its body fields) from device_template_versions, or None."""
+    if not sha256:
+        return None
+    return get_versions_collection(_default_db(db)).find_one({"_id": sha256})
+
+
+def get_version_text(sha256: str, db=None):
+    """
+    Return the decoded body of version sha256, or None. Versions are immutable: the
+    text is read from the shared template arena (api.template_arena) when it holds it,
+    otherwise cached by hash in the 'template_version' namespace of api.cache (no expiry).
+    The Mongo reads go through the 'mongo' circuit breaker (api.breaker).
+    """
+    arena = template_arena.current()
+    if arena is not None:
+        text = arena.text(sha256)
+        if text is not None:
+            return text
+    text = provision_cache.get("template_version", sha256)
+    if text is not None:
+        return text
+    with breaker.guard("mongo"):
+        version = load_template_version(sha256, db)
+        if not version:
+            return None
+        data = b"".join(_iter_stored_body(version, db))
+    text = decode_body_bytes(data)
+    provision_cache.set("template_version", sha256, text)
+    return text
+
+
+def iter_template_body_bytes(doc, db=None, version=None):
+    """
+    Yield the (uncompressed) body of a template as byte chunks. doc may be a pointer
+    (its version is loaded unless given), a version, or an older-format document.
+    GridFS bodies are streamed; db defaults to api.utils.mongo.get_mongo_client().
+    """
+    if not doc:
+        return
+    if is_versioned_doc(doc):
+        version = version or load_template_version(doc.get("sha256"), db)
+        if version:
+            yield from _iter_stored_body(version, db)
+        return
+    if "body" in doc or doc.get("gridfs_id") is not None:
+        yield from _iter_stored_body(doc, db)
+        return
+    body = doc.get("template") or doc.get("content")
+    if isinstance(body, str) and body:
+        yield body.encode("utf-8")
+
+
+def get_template_body(doc, db=None):
+    """
+    Return the template text of a device_templates document, or None.
+    Reads pointers (body from the version, cached by hash), format 2 documents
+    ('body' or 'gridfs_id', plus 'encoding') and legacy documents ('template' with
+    fallback to 'content').
+    """
+    if not doc:
+        return None
+    if is_versioned_doc(doc):
+        return get_version_text(doc.get("sha256"), db)
+    if "body" in doc and doc.get("encoding") != ENCODING_ZLIB and isinstance(doc.get("body"), str):
+        return doc["body"]
+    if "body" in doc or doc.get("gridfs_id") is not None:
+        return decode_body_bytes(b"".join(_iter_stored_body(doc, db)))
+    body = doc.get("template") or doc.get("content")
+    return body if isinstance(body, str) else None
+
+
+def _history_entry(doc, **extra) -> dict:
+    entry = {
+        "sha256": doc.get("sha256"),
+        "filename": doc.get("filename"),
+        "uploaded_by": doc.get("uploaded_by"),
+        "uploaded_at": doc.get("uploaded_at"),
+    }
+    entry.update(extra)
+    return entry
+
+
+def publish_template(db, doc, history_limit: int = None) -> dict:
+    """
+    Store doc's body as an immutable version (deduplicated by sha256) and point the
+    template doc["_id"] at it, appending to the pointer's history. doc is a document
+    built by build_template_doc()/ingest_template_upload() (or a format 2 document).
+    Returns the pointer fields that were set.
+    """
+    if history_limit is None:
+        history_limit = getattr(settings, "TEMPLATE_HISTORY_LIMIT", 20)
+    sha256 = doc["sha256"]
+    version = {field: doc[field] for field in _BODY_FIELDS if field in doc}
+    version.update({
+        "size": doc.get("size"),
+        "placeholders": doc.get("placeholders") or [],
+        "variables": doc.get("variables"),
+        "complexity": doc.get("complexity"),
+        "file_type": doc.get("file_type"),
+        "extension": doc.get("extension"),
+        "created_by": doc.get("uploaded_by"),
+        "created_at": doc.get("uploaded_at"),
+    })
+    try:
+        result = get_versions_collection(db).update_one({"_id": sha256}, {"$setOnInsert": version}, upsert=True)
+    except Exception:
+        delete_template_body(db, doc)
+        raise
+    # from here on a failure leaves at most an unreferenced version (see compact_templates --prune-versions)
+    if result.upserted_id is None and doc.get("gridfs_id") is not None:
+        # same content was already stored: the GridFS copy just written is not needed
+        delete_template_body(db, doc)
+
+    pointer = {
+        "format": FORMAT_VERSION,
+        "sha256": sha256,
+        "size": doc.get("size"),
+        "placeholders": doc.get("placeholders") or [],
+        "variables": doc.get("variables"),
+        "filename": doc.get("filename"),
+        "file_type": doc.get("file_type"),
+        "extension": doc.get("extension"),
+        "uploaded_by": doc.get("uploaded_by"),
+        "uploaded_at": doc.get("uploaded_at"),
+    }
+    for field in _META_FIELDS:
+        if field not in pointer and doc.get(field) is not None:
+            pointer[field] = doc[field]
+    unset = {field: "" for field in _BODY_FIELDS + _LEGACY_FIELDS}
+    if "common_file" not in pointer:
+        # imported again without a common file name: back to a per-device template
+        unset["common_file"] = ""
+    get_templates_collection(db).update_one(
+        {"_id": doc["_id"]},
+        {
+            "$set": pointer,
+            "$unset": unset,
+            "$push": {"history": {"$each": [_history_entry(doc)], "$slice": -history_limit}},
+        },
+        upsert=True,
+    )
+    # template lookups cached by api.views now point at a stale version
+    provision_cache.clear_namespace("template")
+    invalidation.publish(invalidation.EVENT_TEMPLATE, [doc["_id"]])
+    _repin_profiles(db, doc["_id"])
+    return dict(pointer, _id=doc["_id"])
+
+
+def _repin_profiles(db, name):
+    """Profiles pin the version of their template (api.template_pointer): follow the new one."""
+    from api.template_pointer import repin_template
+
+    try:
+        repin_template(name, db=db)
+    except Exception as exc:
+        logger.warning("Failed to update the profiles pinned to template %s: %s", name, exc)
+
+
+def rollback_template(db, name: str, sha256: str, *, rolled_back_by=None, rolled_back_at=None, history_limit: int = None):
+    """
+    Point template name back at version sha256, which must be in its history.
+    Returns the updated pointer fields, or None when the version is unknown.
+    """
+    if history_limit is None:
+        history_limit = getattr(settings, "TEMPLATE_HISTORY_LIMIT", 20)
+    coll = get_templates_collection(db)
+    current = coll.find_one({"_id": name}, projection={"history": 1})
+    previous = next((h for h in (current or {}).get("history") or [] if h.get("sha256") == sha256), None)
+    if previous is None:
+        return None
+    version = get_versions_collection(db).find_one({"_id": sha256}, projection={"body": 0})
+    if not version:
+        return None
+    pointer = {
+        "sha256": sha256,
+        "size": version.get("size"),
+        "placeholders": version.get("placeholders") or [],
+        "variables": version.get("variables"),
+        "file_type": version.get("file_type"),
+        "extension": version.get("extension"),
+        "filename": previous.get("filename"),
+        "uploaded_by": rolled_back_by,
+        "uploaded_at": rolled_back_at,
+    }
+    coll.update_one(
+        {"_id": name},
+        {
+            "$set": pointer,
+            "$push": {"history": {"$each": [_history_entry(pointer, rollback=True)], "$slice": -history_limit}},
+        },
+    )
+    provision_cache.clear_namespace("template")
+    invalidation.publish(invalidation.EVENT_TEMPLATE, [name])
+    _repin_profiles(db, name)
+    return dict(pointer, _id=name)
+
+
+def compact_template_doc(doc, compress_min_bytes: int = None):
+    """
+    Convert a legacy document to a compact document (single inline body), ready for
+    publish_template(). Returns None when doc is not legacy or has no usable body.
+    """
+    if not is_legacy_doc(doc):
+        return None
+    text = get_template_body(doc)
+    if text is None:
+        return None
+    new_doc = build_template_doc(doc["_id"], text, compress_min_bytes=compress_min_bytes)
+    for field in _META_FIELDS:
+        if doc.get(field) is not None:
+            new_doc[field] = doc[field]
+    if not new_doc.get("extension"):
+        new_doc["extension"] = new_doc.get("file_type")
+    return new_doc
@@ -1,21 +1,43 @@
-from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, Http404
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotModified, JsonResponse, Http404
 from django.views.decorators.http import require_GET
+import hashlib
 import logging
 import os
 import re
 import ipaddress
-from drf_spectacular.utils import extend_schema
+import time
+from collections import namedtuple
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
-from django.utils import timezone
 from django.db import transaction
 from django.db.models import F
+from api import analytics, breaker, invalidation, last_good, request_log, sandbox, template_arena, template_pointer
+from api.cache import provision_cache
+from api.render_context import KEYS as RENDER_KEYS, load_device_row, load_profile_row, row_render_context
 from api.utils.mongo import get_mongo_client
+from api.utils.templates import (
+    FORMAT_VERSION as TEMPLATE_FORMAT_VERSION,
+    TEMPLATE_BODY_PROJECTION,
+    extract_variables,
+    get_template_body,
+    normalize_common_file,
+)
+
+# drf_spectacular / DRF só são importados quando instalados: o papel de provisionamento
+# (provision.settings_provisioning) não os carrega, para iniciar mais rápido
+if "drf_spectacular" in settings.INSTALLED_APPS:
+    from drf_spectacular.utils import extend_schema
+else:
+    def extend_schema(*args, **kwargs):
+        return lambda view: view
 
 # OAuth2 auth helper (django-oauth-toolkit)
-try:
-    from oauth2_provider.contrib.rest_framework import OAuth2Authentication
-except Exception:
-    OAuth2Authentication = None
+OAuth2Authentication = None
+if "rest_framework" in settings.INSTALLED_APPS:
+    try:
+        from oauth2_provider.contrib.rest_framework import OAuth2Authentication
+    except Exception:
+        OAuth2Authentication = None
 
 logger = logging.getLogger(__name__)
 
@@ -120,68 +142,255 @@ def _extract_private_ip(request):
     return None
 
 
+def _fetch_device(DeviceConfig, **lookup):
+    try:
+        return DeviceConfig.objects.get(**lookup)
+    except DeviceConfig.DoesNotExist:
+        return None
+
+
 def get_device_config(identifier):
+    """
+    Busca o DeviceConfig (instância do model) por MAC normalizado e, se não achar, por
+    identifier. Não passa pelo cache: o download usa get_device_row, que lê só as
+    colunas dos placeholders.
+    """
     DeviceConfig, Provisioning, DeviceProfile = _get_models()
     if not DeviceConfig:
         return None
     norm_mac = _normalize_mac(identifier)
     if norm_mac:
         try:
-            return DeviceConfig.objects.get(mac_address=norm_mac)
-        except DeviceConfig.DoesNotExist:
-            pass
+            device = _fetch_device(DeviceConfig, mac_address=norm_mac)
         except Exception as exc:
             logger.exception("Error fetching DeviceConfig by mac_address=%s: %s", norm_mac, exc)
             return None
+        if device is not None:
+            return device
     try:
-        return DeviceConfig.objects.get(identifier=identifier)
-    except DeviceConfig.DoesNotExist:
-        return None
+        return _fetch_device(DeviceConfig, identifier=identifier)
     except Exception as exc:
         logger.exception("Error fetching DeviceConfig by identifier=%s: %s", identifier, exc)
         return None
 
 
-def get_template_from_mongo(model: str, ext: str):
+def _load_device_row(**lookup):
+    with breaker.guard("mysql"):
+        device, profile = load_device_row(**lookup)
+    if profile is not None:
+        # o profile veio na mesma consulta (join): já fica no cache para os outros devices dele
+        provision_cache.set("profile", profile.pk, profile)
+    return device
+
+
+def get_device_row(identifier):
     """
-    Busca template no MongoDB a partir do campo 'model' (case-insensitive) e 'extension'.
-    Tentativas (em ordem):
-      1) buscar por documento com campo 'model' case-insensitive igual a model e extension == ext
-      2) buscar por _id igual a model.lower() (compatibilidade com chaves salvas em lower-case)
-      3) fallback: buscar qualquer template com extension == ext
-    Retorna o documento (dict) ou None.
+    Valores dos placeholders do device (api.render_context.DeviceRow), buscando por MAC
+    normalizado e depois por identifier, numa consulta com join no profile.
+    Cada busca passa pelo cache 'device' (api.cache), incluindo resultados negativos;
+    api.signals invalida as chaves 'mac:<mac>' e 'id:<identifier>' quando o device muda.
     """
+    norm_mac = _normalize_mac(identifier)
+    if norm_mac:
+        try:
+            device = provision_cache.get_or_set("device", f"mac:{norm_mac}", lambda: _load_device_row(mac_address=norm_mac))
+        except Exception as exc:
+            logger.exception("Error fetching DeviceConfig by mac_address=%s: %s", norm_mac, exc)
+            last_good.note_error("device", exc)
+            return None
+        if device is not None:
+            return device
     try:
-        db = get_mongo_client()
+        return provision_cache.get_or_set("device", f"id:{identifier}", lambda: _load_device_row(identifier=identifier))
     except Exception as exc:
-        logger.exception("Failed to get mongo DB handle: %s", exc)
+        logger.exception("Error fetching DeviceConfig by identifier=%s: %s", identifier, exc)
+        last_good.note_error("device", exc)
         return None
 
+
+def _load_profile_row(profile_id):
+    with breaker.guard("mysql"):
+        return load_profile_row(profile_id)
+
+
+def get_profile_row(device):
+    """Valores dos placeholders do profile do device (api.render_context.ProfileRow) via cache 'profile', ou None."""
+    profile_id = device.profile_id if device else None
+    if not profile_id:
+        return None
     try:
-        coll = getattr(db, "device_templates", db.get_collection("device_templates"))
-        model_q = (model or "").strip().lower()
-        # 1) buscar por campo 'model' case-insensitive
-        if model_q:
-            # escapamos para evitar metacaracteres regex
-            regex = f"^{re.escape(model_q)}$"
-            doc = coll.find_one({"model": {"$regex": regex, "$options": "i"}, "extension": ext})
-            if doc:
-                return doc
-
-            # 2) buscar por _id igual ao model em lower-case
-            doc = coll.find_one({"_id": model_q})
-            if doc:
-                return doc
-
-        # 3) fallback por extensão
-        doc = coll.find_one({"extension": ext})
-        if doc:
-            return doc
+        return provision_cache.get_or_set("profile", profile_id, lambda: _load_profile_row(profile_id))
+    except Exception as exc:
+        logger.exception("Error fetching DeviceProfile id=%s: %s", profile_id, exc)
+        last_good.note_error("profile", exc)
+        return None
+
+
+def _templates_collection():
+    db = get_mongo_client()
+    return getattr(db, "device_templates", db.get_collection("device_templates"))
+
+
+def _find_template_by_ref(tref):
+    """
+    Busca o template pelo template_ref do profile (valor exato, senão lower-case) numa
+    única consulta, via cache 'template'. Erros do Mongo são propagados (e não ficam no cache).
+    """
+    def load():
+        ids = [tref]
+        t_lower = str(tref).strip().lower()
+        if t_lower and t_lower != tref:
+            ids.append(t_lower)
+        with breaker.guard("mongo"):
+            docs = {doc["_id"]: doc for doc in _templates_collection().find({"_id": {"$in": ids}}, projection=TEMPLATE_BODY_PROJECTION)}
+        return next((docs[i] for i in ids if i in docs), None)
+
+    return provision_cache.get_or_set("template", f"ref:{tref}", load)
 
+
+def pinned_template(profile):
+    """
+    Template fixado no profile (api.template_pointer), ou None. Com a versão fixada o
+    ponteiro é montado da própria linha do profile e o corpo vem de get_version_text()
+    (cache por sha256, sem expiração); documentos de formatos antigos são buscados pelo
+    _id canônico (_find_template_by_ref, em cache).
+    """
+    if profile is None or not profile.template_id or not template_pointer.enabled():
+        return None
+    if profile.template_sha256:
+        return {
+            "_id": profile.template_id,
+            "format": TEMPLATE_FORMAT_VERSION,
+            "sha256": profile.template_sha256,
+            "extension": profile.template_extension,
+        }
+    try:
+        return _find_template_by_ref(profile.template_id)
+    except Exception as exc:
+        logger.exception("Mongo lookup failed for pinned template %s", profile.template_id)
+        last_good.note_error("template", exc)
         return None
+
+
+def get_template_from_mongo(model: str, ext: str, template_ref=None):
+    """
+    Resolve o template de um download numa única consulta ao Mongo. Ordem de preferência:
+      1) _id igual ao template_ref do profile (valor exato, depois lower-case)
+      2) documento com campo 'model' case-insensitive igual a model e extension == ext
+      3) _id igual a model.lower() (compatibilidade com chaves salvas em lower-case)
+      4) fallback: qualquer template com extension == ext
+    Retorna o documento (dict) ou None. Com a arena de templates (api.template_arena)
+    atualizada, resolve no índice compartilhado, sem ida ao Mongo. Senão o resultado fica
+    no cache 'template' (api.cache) por (template_ref, model, ext), invalidado quando
+    templates são importados, removidos ou restaurados.
+    """
+    model_q = (model or "").strip().lower()
+    arena = template_arena.current()
+    if arena is not None and template_arena.is_fresh(arena):
+        doc = arena.resolve(template_ref, model_q, ext)
+        if doc is not template_arena.UNAVAILABLE:
+            return doc
+    key = f"resolve:{template_ref or ''}:{model_q}:{ext}"
+    try:
+        return provision_cache.get_or_set("template", key, lambda: _query_template(template_ref, model_q, ext))
     except Exception as exc:
-        logger.exception("MongoDB query failed for model=%s ext=%s: %s", model, ext, exc)
+        logger.exception("MongoDB query failed for template_ref=%s model=%s ext=%s: %s", template_ref, model, ext, exc)
+        last_good.note_error("template", exc)
+        return None
+
+
+def find_common_template(filename):
+    """
+    Template comum (api.utils.templates.normalize_common_file) pedido pelo telefone como
+    filename (ex.: y000000000028.cfg), ou None. Renderizado sem dados do device e igual
+    para todos os telefones do modelo/profile. Resolve na arena quando atualizada; senão
+    uma consulta por nome de arquivo no cache 'template' (None incluído, para os nomes
+    por MAC). Erros do Mongo são propagados. Nomes encontrados ficam registrados
+    (is_known_common_file) no namespace 'last_good', de vida longa.
+    """
+    try:
+        name = normalize_common_file(filename)
+    except ValueError:
+        return None
+    if not name:
         return None
+    arena = template_arena.current()
+    if arena is not None and template_arena.is_fresh(arena):
+        doc = arena.common(name)
+        if doc is not template_arena.UNAVAILABLE:
+            return doc
+
+    def load():
+        with breaker.guard("mongo"):
+            cursor = _templates_collection().find({"common_file": name}, projection=TEMPLATE_BODY_PROJECTION)
+            doc = next(iter(cursor.sort("_id", 1).limit(1)), None)
+        if doc is not None:
+            provision_cache.set(last_good.NAMESPACE, f"common_file:{name}", True)
+        return doc
+
+    return provision_cache.get_or_set("template", f"common:{name}", load)
+
+
+def is_known_common_file(filename) -> bool:
+    """
+    Se filename já foi visto como arquivo comum (arena mapeada, mesmo desatualizada, ou
+    registro de find_common_template), sem consultar o Mongo: decide, com o Mongo fora,
+    entre 503 (arquivo comum) e o caminho por device (que cai na última configuração boa).
+    """
+    try:
+        name = normalize_common_file(filename)
+    except ValueError:
+        return False
+    if not name:
+        return False
+    arena = template_arena.current()
+    if arena is not None and arena.common(name) is not None:
+        return True
+    return bool(provision_cache.get(last_good.NAMESPACE, f"common_file:{name}"))
+
+
+def template_resolution_pipeline(template_ref, model_q: str, ext: str) -> list:
+    """
+    Pipeline de agregação que casa todos os candidatos da ordem de preferência de
+    get_template_from_mongo() ($or), calcula a prioridade de cada um ($switch) e fica
+    com o melhor ($sort + $limit): uma ida ao servidor em vez de até cinco find_one.
+    Empates (ex.: vários templates com a mesma extensão) são decididos pelo _id.
+    Templates comuns (campo 'common_file') ficam de fora: só são servidos pelo nome do arquivo.
+    """
+    candidates, branches = [], []
+
+    def prefer(match, case):
+        candidates.append(match)
+        branches.append({"case": case, "then": len(branches)})
+
+    if template_ref:
+        prefer({"_id": template_ref}, {"$eq": ["$_id", template_ref]})
+        t_lower = str(template_ref).strip().lower()
+        if t_lower and t_lower != template_ref:
+            prefer({"_id": t_lower}, {"$eq": ["$_id", t_lower]})
+    if model_q:
+        # regex ancorada e escapada no $match (usa o índice de 'model'); a prioridade compara em lower-case
+        prefer(
+            {"model": {"$regex": f"^{re.escape(model_q)}$", "$options": "i"}, "extension": ext},
+            {"$and": [{"$eq": [{"$toLower": "$model"}, model_q]}, {"$eq": ["$extension", ext]}]},
+        )
+        prefer({"_id": model_q}, {"$eq": ["$_id", model_q]})
+    candidates.append({"extension": ext})
+
+    priority = {"$switch": {"branches": branches, "default": len(branches)}} if branches else {"$literal": 0}
+    return [
+        {"$match": {"$or": candidates, "common_file": None}},
+        {"$addFields": {"_priority": priority}},
+        {"$sort": {"_priority": 1, "_id": 1}},
+        {"$limit": 1},
+        {"$project": TEMPLATE_BODY_PROJECTION},
+    ]
+
+
+def _query_template(template_ref, model_q: str, ext: str):
+    pipeline = template_resolution_pipeline(template_ref, model_q, ext)
+    with breaker.guard("mongo"):
+        return next(iter(_templates_collection().aggregate(pipeline)), None)
 
 def substitute_percent_placeholders(template_text: str, context: dict) -> str:
     """
@@ -194,7 +403,11 @@ def substitute_percent_placeholders(template_text: str, context: dict) -> str:
         return template_text
 
     # preparar um dicionário com chaves lower-case para lookup rápido
-    ctx = {str(k).lower(): v for k, v in (context or {}).items()}
+    # (RenderContext já tem chaves lower-case e é usado direto)
+    if getattr(context, "lowercase_keys", False):
+        ctx = context
+    else:
+        ctx = {str(k).lower(): v for k, v in (context or {}).items()}
 
     def repl(match: re.Match) -> str:
         key = (match.group(1) or "").strip().lower()
@@ -218,11 +431,22 @@ def substitute_percent_placeholders(template_text: str, context: dict) -> str:
     pattern = re.compile(r"%%([A-Za-z0-9_]+)%%")
     return pattern.sub(repl, template_text)
 
-def render_template(template_str, context):
-    from django.template import Template, Context, TemplateSyntaxError
+def get_compiled_template(template_str, cache_key=None):
+    """
+    Compila o template Django. Com cache_key (ex.: sha256 da versão) o objeto compilado
+    fica no cache 'compiled' (somente L1, por processo; pré-carregado por api.warmup).
+    """
+    return sandbox.compile_template(template_str, cache_key)
+
+
+def render_template(template_str, context, cache_key=None, template=None):
+    """
+    Renderiza dentro do orçamento de passos, CPU e tamanho de saída (api.sandbox;
+    opcionalmente num pool de processos). Estouro levanta RenderBudgetExceeded.
+    """
+    from django.template import TemplateSyntaxError
     try:
-        django_template = Template(template_str)
-        return django_template.render(Context(context))
+        return sandbox.render(template_str, context, cache_key=cache_key, template=template)
     except TemplateSyntaxError as exc:
         logger.exception("Template syntax error while rendering: %s", exc)
         raise
@@ -240,6 +464,273 @@ def _sanitize_filename(name):
     return safe
 
 
+def _content_type(ext):
+    return "application/xml; charset=utf-8" if ext == "xml" else "text/plain; charset=utf-8"
+
+
+def template_variables(template_doc):
+    """
+    Chaves do contexto (api.render_context.KEYS) que o template lê, ou None quando não se
+    sabe. Os nomes vêm do documento (api.utils.templates.extract_variables, no import);
+    ponteiros montados do profile e documentos antigos não os trazem: são extraídos do
+    corpo. Uma vez por versão e processo (cache 'compiled', como o template compilado).
+    """
+    def analyze():
+        if "variables" in template_doc:
+            names = template_doc["variables"]
+        else:
+            text = get_template_body(template_doc)
+            names = extract_variables(text) if isinstance(text, str) else None
+        if names is None:
+            return None
+        names = set(names)
+        return tuple(key for key in RENDER_KEYS if key in names)
+
+    return provision_cache.get_or_set("compiled", f"variables:{template_doc['sha256']}", analyze)
+
+
+def template_is_deterministic(template_doc):
+    """
+    Se a saída do template depende só do contexto (api.sandbox.is_deterministic): falso
+    com {% now %}, o filtro random etc., cuja saída não pode ir para o cache 'rendered'.
+    Verificado no template compilado, uma vez por versão e processo (cache 'compiled').
+    """
+    def analyze():
+        text = get_template_body(template_doc)
+        if not isinstance(text, str):
+            return True  # sem corpo não há renderização (InvalidTemplate)
+        return sandbox.is_deterministic(get_compiled_template(text, template_doc["sha256"]))
+
+    return provision_cache.get_or_set("compiled", f"deterministic:{template_doc['sha256']}", analyze)
+
+
+def _rendered_cache_key(template_doc, context, device, profile, ua_data, ext):
+    """
+    Chave do cache 'rendered': versão do template (sha256) + valores das chaves do contexto
+    que o template lê. Devices que diferem só em campos que o template não usa (ou um
+    template que só lê o profile) compartilham a saída. Sem a lista de variáveis, usa
+    device/profile (id e updated_at) + dados do User-Agent. Documentos antigos sem sha256 e
+    templates com saída variável ({% now %}, |random) não são cacheados (retorna None).
+    """
+    sha = template_doc.get("sha256") if isinstance(template_doc, dict) else None
+    if not sha:
+        return None
+    try:
+        if not template_is_deterministic(template_doc):
+            return None
+    except Exception:
+        # erro de sintaxe: a renderização falha e não entra no cache
+        logger.exception("Failed to compile template %s", template_doc.get("_id"))
+        return None
+    try:
+        variables = template_variables(template_doc)
+    except Exception:
+        logger.exception("Failed to analyze template %s", template_doc.get("_id"))
+        variables = None
+    if variables is not None:
+        parts = (sha, ext, tuple(context[key] for key in variables))
+    else:
+        parts = (
+            sha,
+            ext,
+            tuple(ua_data),
+            (device.pk, device.updated_at.isoformat() if device.updated_at else None) if device else None,
+            (profile.pk, profile.updated_at.isoformat() if profile.updated_at else None) if profile else None,
+        )
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _track(ua_data, device, status):
+    """Conta o download no painel de operação (api.analytics; só memória, gravado em lote)."""
+    vendor, model, version, _ = ua_data
+    analytics.record(vendor, model, version, status, device.mac_address if device else "")
+
+
+class InvalidTemplate(Exception):
+    """Documento de template sem corpo utilizável ('body'/'template')."""
+
+
+def _render_config(template_doc, context, device):
+    """
+    Corpo do template renderizado com o contexto e com os placeholders %%nome%% substituídos.
+    InvalidTemplate quando o documento não tem corpo; erros de renderização (inclusive
+    sandbox.RenderBudgetExceeded) propagam.
+    """
+    # 'body' no formato compacto; 'template' -> 'content' em documentos antigos
+    try:
+        template_str = get_template_body(template_doc)
+    except Exception as exc:
+        logger.exception("Failed to decode template body for template %s", template_doc.get("_id"))
+        last_good.note_error("template body", exc)
+        template_str = None
+    if not isinstance(template_str, str):
+        raise InvalidTemplate(template_doc.get("_id"))
+
+    # levanta TemplateSyntaxError em template inválido
+    config_content = render_template(
+        template_str, context, cache_key=template_doc.get("sha256"), template=template_doc.get("_id")
+    )
+
+    # aplicar substituição para placeholders do tipo %%nome%% usando os dados do context
+    try:
+        return substitute_percent_placeholders(config_content, context)
+    except Exception:
+        logger.exception("Failed to substitute %%...%% placeholders for device %s", getattr(device, "identifier", None))
+        return config_content
+
+
+ConfigResult = namedtuple("ConfigResult", "status content device errors")
+
+
+def _build_config(ua_data, ext):
+    """
+    Busca device, profile e template e renderiza a configuração. Retorna ConfigResult:
+    status do api.analytics, conteúdo (ou a mensagem do 403), device (DeviceRow ou None) e
+    as falhas de MySQL/Mongo vistas no caminho (api.last_good; as buscas seguem com None).
+    """
+    vendor, model, version, identifier = ua_data
+    model_for_query = (model or "").strip().lower()
+
+    with last_good.collect() as errors:
+        # localizar device (tenta MAC normalizado primeiro, depois identifier)
+        with request_log.stage("device"):
+            device = get_device_row(identifier)
+        with request_log.stage("profile"):
+            profile = get_profile_row(device)
+
+        # template fixado no profile (sem consulta); senão template_ref, model do UA ou extensão numa consulta (em cache)
+        with request_log.stage("template"):
+            template_doc = pinned_template(profile)
+            if template_doc is None:
+                template_doc = get_template_from_mongo(model_for_query, ext, template_ref=profile.template_ref if profile else None)
+
+        # se não encontrou -> reprovar
+        if not template_doc:
+            logger.warning("Configuration template not found for model=%s ext=%s", model_for_query, ext)
+            return ConfigResult(
+                analytics.STATUS_FORBIDDEN, "Configuration template not found for this model and extension", device, tuple(errors)
+            )
+
+        # montar contexto para renderização (placeholders declarados em api.render_context;
+        # a parte do profile é a tupla compartilhada do cache; nenhum valor é copiado)
+        context = row_render_context(device, profile, ua_data)
+
+        # saída renderizada em cache: a chave muda com a versão do template e com os valores
+        # que ele lê, então não precisa de invalidação explícita. Misses simultâneos da mesma
+        # chave (ex.: um lote de telefones do mesmo modelo) esperam uma única renderização.
+        rendered_key = _rendered_cache_key(template_doc, context, device, profile, ua_data, ext)
+
+        def render():
+            return _render_config(template_doc, context, device)
+
+        request_log.annotate(template=template_doc.get("_id"))
+        try:
+            with request_log.stage("render"):
+                if rendered_key:
+                    content = provision_cache.get_or_set("rendered", rendered_key, render)
+                else:
+                    content = render()
+        except InvalidTemplate:
+            logger.error("Invalid template document structure for model=%s ext=%s: %s", model_for_query, ext, template_doc)
+            return ConfigResult(analytics.STATUS_ERROR, "Configuration template invalid", device, tuple(errors))
+        except sandbox.RenderBudgetExceeded:
+            # já registrado por template em api.sandbox; não derruba o worker
+            return ConfigResult(analytics.STATUS_ERROR, "Forbidden: error rendering template", device, tuple(errors))
+        except Exception:
+            logger.exception("Error rendering template for device %s", getattr(device, "identifier", None))
+            return ConfigResult(analytics.STATUS_ERROR, "Forbidden: error rendering template", device, tuple(errors))
+        return ConfigResult(analytics.STATUS_OK, content, device, tuple(errors))
+
+
+def _stale_response(stored, ua_data, mac_address, key, reason, errors=()):
+    """Resposta com a última configuração boa (api.last_good), marcada como desatualizada."""
+    vendor, model, version, _ = ua_data
+    last_good.served_stale(key, reason, errors)
+    request_log.annotate(outcome=f"stale_{reason}", errors=list(errors))
+    analytics.record(vendor, model, version, analytics.STATUS_OK, mac_address or "")
+    response = HttpResponse(stored["content"], content_type=stored["content_type"])
+    response["X-Provision-Stale"] = reason
+    response["Age"] = str(max(0, int(time.time() - stored["stored_at"])))
+    response["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+def _unavailable():
+    """503 de arquivo comum com backend fora: melhor o telefone tentar de novo que guardar um arquivo errado."""
+    response = HttpResponse("Service unavailable", status=503, content_type="text/plain; charset=utf-8")
+    response["Retry-After"] = "30"
+    return response
+
+
+def _common_cache_control():
+    max_age = getattr(settings, "PROVISION_COMMON_MAX_AGE", 86400)
+    return f"public, max-age={max_age}"
+
+
+def _etag_matches(request, etag):
+    header = request.META.get("HTTP_IF_NONE_MATCH", "")
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _serve_common(request, template_doc, ua_data, ext):
+    """
+    Arquivo comum (find_common_template): renderizado só com o profile do device e os dados
+    do User-Agent, sem o identifier. A saída fica no cache 'rendered' uma vez por versão do
+    template e valores que ele lê, e vai com ETag (a própria chave) e Cache-Control público
+    de PROVISION_COMMON_MAX_AGE: telefones, proxies e CDN reaproveitam o mesmo arquivo, e um
+    If-None-Match igual recebe 304 sem renderizar.
+    """
+    vendor, model, version, identifier = ua_data
+    request_log.annotate(template=template_doc.get("_id"), common=True)
+
+    # o profile vem do device do User-Agent; sem MySQL a saída seria a de "sem profile": 503
+    with last_good.collect() as errors, breaker.request_budget():
+        with request_log.stage("device"):
+            device = get_device_row(identifier)
+        with request_log.stage("profile"):
+            profile = get_profile_row(device)
+    if errors:
+        request_log.annotate(outcome=analytics.STATUS_ERROR, errors=list(errors))
+        return _unavailable()
+
+    common_ua = (vendor, model, version, "")
+    context = row_render_context(None, profile, common_ua)
+    rendered_key = _rendered_cache_key(template_doc, context, None, profile, common_ua, ext)
+    etag = f'"{rendered_key}"' if rendered_key else None
+    if etag and _etag_matches(request, etag):
+        _track(ua_data, device, analytics.STATUS_OK)
+        request_log.annotate(outcome="not_modified")
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        response["Cache-Control"] = _common_cache_control()
+        return response
+
+    def render():
+        return _render_config(template_doc, context, None)
+
+    try:
+        with request_log.stage("render"):
+            content = provision_cache.get_or_set("rendered", rendered_key, render) if rendered_key else render()
+    except sandbox.RenderBudgetExceeded:
+        content = None
+    except Exception:
+        logger.exception("Error rendering common template %s", template_doc.get("_id"))
+        content = None
+    if content is None:
+        _track(ua_data, device, analytics.STATUS_ERROR)
+        request_log.annotate(outcome=analytics.STATUS_ERROR)
+        return HttpResponseForbidden("Forbidden: error rendering template")
+
+    _track(ua_data, device, analytics.STATUS_OK)
+    request_log.annotate(outcome=analytics.STATUS_OK)
+    response = HttpResponse(content, content_type=_content_type(ext))
+    if etag:
+        response["ETag"] = etag
+        response["Cache-Control"] = _common_cache_control()
+    return response
+
+
 @extend_schema(
     methods=['GET'],
     description=(
@@ -256,134 +747,107 @@ def download_config(request, filename: str = None):
     - Extrai vendor, model, version, identifier (MAC ou account) do User-Agent via parse_user_agent().
       Exemplo de UA: "Ale H2P 2.10 3c28a60357a0" -> vendor='Ale', model='H2P', version='2.10', identifier='3c28a60357a0'
     - Normaliza model para lower() e usa get_template_from_mongo(model_lower, ext).
-    - Normaliza mac (identifier) com _normalize_mac e busca DeviceConfig via get_device_config(identifier).
-    - Prefere profile.template_ref quando presente (tentando versão original e lower-case).
-    - Renderiza o template (campo 'template' do documento Mongo) com contexto combinado (device + profile + UA).
+    - Normaliza mac (identifier) com _normalize_mac e busca os valores do device e do profile
+      via get_device_row(identifier) / get_profile_row(device) (api.render_context).
+    - Usa o template fixado no profile (api.template_pointer); sem ele, resolve numa consulta:
+      profile.template_ref (original e lower-case), depois model, depois extensão.
+    - Renderiza o template (campo 'body' do documento Mongo, ou 'template' em documentos antigos) com contexto combinado (device + profile + UA).
     - Retorna o conteúdo renderizado como application/xml (ext == 'xml') ou text/plain (cfg).
+    - Se MySQL/Mongo falharem (ou estiverem lentos) devolve a última configuração boa do
+      device (api.last_good) com o cabeçalho X-Provision-Stale, em vez de 403.
+    - Registra o tempo de cada etapa numa linha JSON por requisição (api.request_log).
+    - filename de um template comum (ex.: y000000000028.cfg) devolve o arquivo comum do
+      modelo/profile, sem dados do device e com cache HTTP longo (_serve_common).
     """
+    # uma linha JSON por requisição (amostrada; falhas e lentas sempre) com o tempo de cada etapa
+    entry = request_log.begin()
+    try:
+        response = _serve_download(request, filename)
+    except Exception:
+        request_log.annotate(outcome=analytics.STATUS_ERROR)
+        request_log.finish(entry, 500)
+        raise
+    request_log.finish(entry, response.status_code)
+    return response
+
+
+def _serve_download(request, filename):
+    # remoção de entradas alteradas em outros processos (api.invalidation)
+    invalidation.ensure_subscriber()
+
     # parse User-Agent
     ua_data = parse_user_agent(request)
     if not ua_data:
         logger.warning("Invalid User-Agent format for request from %s", request.META.get("REMOTE_ADDR"))
+        analytics.record(status=analytics.STATUS_FORBIDDEN)
+        request_log.annotate(outcome=analytics.STATUS_FORBIDDEN, errors=["invalid user-agent"])
         return HttpResponseForbidden("Forbidden: Invalid User-Agent format")
 
     vendor, model, version, identifier = ua_data
-    model_for_query = (model or "").strip().lower()
-    # identifier normalmente é mac ou account; normalizar para busca
-    norm_identifier = _normalize_mac(identifier) or (identifier or "").strip()
-
-    # localizar device (tenta MAC normalizado primeiro, depois identifier)
-    device = None
-    try:
-        device = get_device_config(identifier)
-    except Exception:
-        logger.exception("Error fetching device for identifier=%s", identifier)
-        device = None
 
     # inferir extensão (xml por padrão; se filename terminar com .cfg então cfg)
     ext = "xml"
     if filename and filename.lower().endswith(".cfg"):
         ext = "cfg"
-    else:
-        # também tentar inspecionar request.path ou outros parâmetros se necessário
-        pass
-
-    template_doc = None
+    norm_mac = _normalize_mac(identifier)
+    request_log.annotate(device=norm_mac or identifier, vendor=vendor, model=model, version=version, ext=ext)
 
-    # 1) preferir profile.template_ref se device.profile estiver presente
-    if device and device.profile and device.profile.template_ref:
+    # arquivo comum do modelo/profile (o arquivo do próprio MAC não é procurado)
+    if filename and _normalize_mac(os.path.splitext(filename)[0]) != norm_mac:
         try:
-            db = get_mongo_client()
-            coll = getattr(db, "device_templates", db.get_collection("device_templates"))
-            # tenta pelo template_ref exato
-            tref = device.profile.template_ref
-            template_doc = coll.find_one({"_id": tref})
-            if not template_doc:
-                # tenta versão lower-case (compatibilidade)
-                t_lower = str(tref).strip().lower()
-                if t_lower:
-                    template_doc = coll.find_one({"_id": t_lower})
-        except Exception:
-            logger.exception("Mongo lookup by template_ref failed for %s", device.profile.template_ref)
-            template_doc = None
-
-    # 2) se não encontrou via template_ref, buscar por model extraído do UA
-    if not template_doc:
-        template_doc = get_template_from_mongo(model_for_query, ext)
-
-    # 3) se ainda não encontrou -> reprovar
-    if not template_doc:
-        logger.warning("Configuration template not found for model=%s ext=%s", model_for_query, ext)
-        return HttpResponseForbidden("Configuration template not found for this model and extension")
-
-    # obter string do template com fallback (template -> content)
-    template_str = template_doc.get("template") or template_doc.get("content")
-    if not isinstance(template_str, str):
-        logger.error("Invalid template document structure for model=%s ext=%s: %s", model_for_query, ext, template_doc)
-        return HttpResponseForbidden("Configuration template invalid")
-
-    # montar contexto para renderização (mapear placeholders)
-    profile = device.profile if device else None
-
-    context = {
-        # UA / device-level
-        "vendor": vendor,
-        "model": model,
-        "version": version,
-        "identifier": device.identifier if device else (identifier or ""),
-        "account": device.identifier if device else (identifier or ""),
-        "displayname": device.display_name if device else "",
-        "user": device.user_register if device else "",
-        "passwd": device.passwd_register if device else "",
-        "macaddress": device.mac_address if device and device.mac_address else norm_identifier,
-
-        # IPs
-        "ip_address": device.ip_address if device and device.ip_address else "",
-        "public_ip": device.public_ip if device and device.public_ip else "",
-        "private_ip": device.private_ip if device and device.private_ip else "",
-
-        # profile-level placeholders
-        "sipserver": profile.sip_server if profile else "",
-        "port": profile.port_server if profile else "",
-        "backsipserver": getattr(profile, "backup_server", "") if profile else "",
-        "backsipport": getattr(profile, "backup_port", "") if profile else "",
-        "proxy": getattr(profile, "proxy", "") if profile else "",
-        "domain": profile.domain_server if profile else "",
-        "registerttl": getattr(profile, "register_ttl", "") if profile else "",
-        "codecs": getattr(profile, "voice_codecs", "") if profile else "",
-        "ntpserver": getattr(profile, "ntp_server", "") if profile else "",
-        "provisionserver": getattr(profile, "provision_server", "") if profile else "",
-        "provisionfile": getattr(profile, "provision_file", "") if profile else "",
-        "vlanactive": getattr(profile, "vlan_active", False) if profile else False,
-        "vlanid": getattr(profile, "vlan_id", "") if profile else "",
-    }
-
-    # render template using existing helper (raises TemplateSyntaxError on bad template)
-    try:
-        config_content = render_template(template_str, context)
-    except Exception:
-        logger.exception("Error rendering template for device %s", getattr(device, "identifier", None))
-        return HttpResponseForbidden("Forbidden: error rendering template")
+            common_doc = find_common_template(filename)
+        except Exception as exc:
+            logger.warning("Common template lookup failed for %s: %s", filename, exc)
+            last_good.note_error("template", exc)
+            if is_known_common_file(filename):
+                request_log.annotate(outcome=analytics.STATUS_ERROR, errors=[f"template: {type(exc).__name__}"])
+                return _unavailable()
+            # nome comum do download (config.cfg, config.xml...): segue o caminho por device,
+            # que usa a última configuração boa se o Mongo continuar fora
+            common_doc = None
+        if common_doc is not None:
+            return _serve_common(request, common_doc, ua_data, ext)
+
+    # última configuração boa do device (api.last_good): servida se MySQL/Mongo falharem
+    # ou, com os backends degradados, se a resposta nova demorar demais
+    good_key = last_good.key_for(norm_mac or identifier, ext)
+    stored = last_good.get(good_key)
+
+    entry = request_log.current()
+
+    def build():
+        # orçamento de latência da requisição (api.breaker): esgotado, as buscas falham na hora
+        with breaker.request_budget(), request_log.bound(entry):
+            result = last_good.timed(lambda: _build_config(ua_data, ext))
+        if result.status == analytics.STATUS_OK and result.device is not None and not result.errors:
+            last_good.remember(good_key, result.content, _content_type(ext), stored)
+        return result
+
+    if stored is not None and last_good.degraded():
+        done, result = last_good.run_with_deadline(good_key, build)
+        if not done:
+            return _stale_response(stored, ua_data, norm_mac, good_key, "slow")
+    else:
+        result = build()
+    if result.errors and stored is not None:
+        return _stale_response(stored, ua_data, norm_mac, good_key, "error", result.errors)
 
-    # aplicar substituição para placeholders do tipo %%nome%% usando os dados do context
-    try:
-        final_content = substitute_percent_placeholders(config_content, context)
-    except Exception:
-        logger.exception("Failed to substitute %%...%% placeholders for device %s", getattr(device, "identifier", None))
-        final_content = config_content
+    _track(ua_data, result.device, result.status)
+    request_log.annotate(outcome=result.status, errors=list(result.errors))
+    if result.status != analytics.STATUS_OK:
+        return HttpResponseForbidden(result.content)
+    return HttpResponse(result.content, content_type=_content_type(ext))
 
-    # devolver final_content em vez de config_content
-    content_type = "application/xml; charset=utf-8" if ext == "xml" else "text/plain; charset=utf-8"
-    return HttpResponse(final_content, content_type=content_type)
 
-    # mark device provisioned (best-effort; preserve existing provisioning workflow)
-    try:
-        if device:
-            device.provisioned_at = timezone.now()
-            device.save(update_fields=["provisioned_at"])
-    except Exception:
-        logger.exception("Failed to update device provisioned_at for %s", getattr(device, "identifier", None))
+@extend_schema(
+    methods=['GET'],
+    description="Readiness: 200 quando o aquecimento do cache (api.warmup) terminou; 503 enquanto não terminou.",
+    responses={200: None, 503: None},
+)
+@require_GET
+def ready(request):
+    from api.warmup import get_warmup_state, is_ready
 
-    # return rendered configuration
-    content_type = "application/xml; charset=utf-8" if ext == "xml" else "text/plain; charset=utf-8"
-    return HttpResponse(config_content, content_type=content_type)
\ No newline at end of file
+    state = get_warmup_state()
+    data = {"ready": is_ready(), "warmup": state["status"], "report": state["report"]}
+    return JsonResponse(data, status=200 if data["ready"] else 503)
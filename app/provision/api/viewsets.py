@@ -0,0 +1,282 @@
+"""
+REST API (DRF) for devices and profiles, meant for OSS/BSS synchronization.
+
+  /api/devices/   /api/devices/<id>/   POST /api/devices/bulk/
+  /api/profiles/  /api/profiles/<id>/  POST /api/profiles/bulk/
+
+- Authentication: OAuth2 Bearer token ('read' scope for GET, 'write' for changes)
+  or a staff session.
+- Cursor (keyset) pagination ordered by id: ?page_size=N (max 1000) and the
+  'next'/'previous' links, stable while rows are inserted or deleted.
+- ?fields=id,mac_address limits the serialized fields (and the columns loaded).
+- Filters: ?updated_since=<ISO datetime>; devices also ?profile=, ?mac_address=,
+  ?identifier=.
+- Conditional GET: responses carry an ETag; a matching If-None-Match gets 304.
+  For lists the ETag derives from count and max(updated_at) of the filtered
+  rows, so it is checked with one aggregate query before any page is loaded.
+- Bulk: {"create": [...], "update": [{"id": 1, ...partial}], "delete": [ids]}
+  with at most PROVISION_API_BULK_MAX items, applied in one transaction: any
+  invalid item rolls everything back and the errors are returned by index.
+"""
+import hashlib
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max
+from django.utils.dateparse import parse_datetime
+from oauth2_provider.contrib.rest_framework import TokenHasReadWriteScope
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from api import template_pointer
+from api.serializers import DeviceConfigSerializer, DeviceProfileSerializer
+from api.signals import invalidate_device
+from core.models import DeviceConfig, DeviceProfile, _normalize_mac
+
+
+INVALID_ID = "A valid integer id is required."
+
+
+def _parse_id(value):
+    """Primary key of a bulk item as int ("1" included), or None when it is not one."""
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class ProvisionCursorPagination(CursorPagination):
+    ordering = "id"
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, "PROVISION_API_PAGE_SIZE", 100)
+        return super().get_page_size(request)
+
+
+class ConditionalGetMixin:
+    """ETag / If-None-Match for list and retrieve."""
+
+    def _etag(self, request, *parts):
+        fmt = getattr(getattr(request, "accepted_renderer", None), "format", "")
+        raw = repr((request.get_full_path(), fmt) + parts)
+        return '"%s"' % hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _matches(request, etag):
+        header = request.headers.get("If-None-Match")
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+    def _not_modified(self, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    def list(self, request, *args, **kwargs):
+        summary = self.filter_queryset(self.get_queryset()).aggregate(n=Count("id"), last=Max("updated_at"))
+        etag = self._etag(request, summary["n"], summary["last"])
+        if self._matches(request, etag):
+            return self._not_modified(etag)
+        response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        etag = self._etag(request, instance.pk, instance.updated_at)
+        if self._matches(request, etag):
+            return self._not_modified(etag)
+        response = Response(self.get_serializer(instance).data)
+        response["ETag"] = etag
+        return response
+
+
+class BulkMixin:
+    """POST <prefix>/bulk/: create/update/delete many rows in one transaction."""
+
+    # unique field used to find the ids of rows created with bulk_create
+    # (MySQL does not return primary keys from multi-row inserts)
+    bulk_lookup_field = None
+
+    def _before_bulk_create(self, objs, errors):
+        pass
+
+    def _after_bulk_create(self, objs):
+        pass
+
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk(self, request):
+        data = request.data if isinstance(request.data, dict) else {}
+        creates = data.get("create") or []
+        updates = data.get("update") or []
+        deletes = data.get("delete") or []
+        if not all(isinstance(part, list) for part in (creates, updates, deletes)):
+            raise ValidationError({"detail": "'create', 'update' and 'delete' must be lists."})
+        total = len(creates) + len(updates) + len(deletes)
+        limit = getattr(settings, "PROVISION_API_BULK_MAX", 1000)
+        if not total:
+            raise ValidationError({"detail": "Nothing to do: send 'create', 'update' and/or 'delete'."})
+        if total > limit:
+            raise ValidationError({"detail": f"At most {limit} items per request ({total} sent)."})
+
+        errors = {}
+        try:
+            with transaction.atomic():
+                created = self._bulk_create(creates, errors)
+                updated = self._bulk_update(updates, errors)
+                deleted = self._bulk_delete(deletes, errors)
+                if errors:
+                    transaction.set_rollback(True)
+        except IntegrityError as exc:
+            errors.setdefault("create", {})["integrity"] = str(exc)
+        if errors:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"created": created, "updated": updated, "deleted": deleted})
+
+    def _bulk_create(self, items, errors):
+        if not items:
+            return []
+        serializer = self.get_serializer(data=items, many=True)
+        if not serializer.is_valid():
+            errors["create"] = {i: e for i, e in enumerate(serializer.errors) if e}
+            return []
+        model = self.get_queryset().model
+        objs = [model(**attrs) for attrs in serializer.validated_data]
+        # bulk_create sends no pre_save: what the signals would do per row goes here
+        self._before_bulk_create(objs, errors)
+        if errors:
+            return []
+        objs = model.objects.bulk_create(objs)
+        if any(obj.pk is None for obj in objs) and self.bulk_lookup_field:
+            values = [getattr(obj, self.bulk_lookup_field) for obj in objs]
+            ids = dict(model.objects.filter(**{f"{self.bulk_lookup_field}__in": values}).values_list(self.bulk_lookup_field, "pk"))
+            for obj in objs:
+                obj.pk = ids.get(getattr(obj, self.bulk_lookup_field))
+        self._after_bulk_create(objs)
+        return [obj.pk for obj in objs]
+
+    def _bulk_update(self, items, errors):
+        if not items:
+            return 0
+        ids, item_errors = [], {}
+        for index, item in enumerate(items):
+            pk = _parse_id(item.get("id") if isinstance(item, dict) else None)
+            if pk is None:
+                item_errors[index] = {"id": [INVALID_ID]}
+            ids.append(pk)
+        instances = self.get_queryset().model.objects.in_bulk([pk for pk in ids if pk is not None])
+        for index, (pk, item) in enumerate(zip(ids, items)):
+            if pk is None:
+                continue
+            instance = instances.get(pk)
+            if instance is None:
+                item_errors[index] = {"id": ["Not found."]}
+                continue
+            serializer = self.get_serializer(instance, data=item, partial=True)
+            if serializer.is_valid():
+                serializer.save()  # save() per row: normalization, updated_at and cache invalidation
+            else:
+                item_errors[index] = serializer.errors
+        if item_errors:
+            errors["update"] = item_errors
+        return len(items) - len(item_errors)
+
+    def _bulk_delete(self, ids, errors):
+        if not ids:
+            return 0
+        pks, invalid = set(), {}
+        for index, value in enumerate(ids):
+            pk = _parse_id(value)
+            if pk is None:
+                invalid[index] = [INVALID_ID]
+            else:
+                pks.add(pk)
+        if invalid:
+            errors["delete"] = invalid
+            return 0
+        queryset = self.get_queryset().model.objects.filter(pk__in=pks)
+        missing = pks - set(queryset.values_list("pk", flat=True))
+        if missing:
+            errors["delete"] = {"not_found": sorted(missing)}
+            return 0
+        queryset.delete()
+        return len(pks)
+
+
+class ProvisionModelViewSet(ConditionalGetMixin, BulkMixin, viewsets.ModelViewSet):
+    permission_classes = [IsAdminUser | TokenHasReadWriteScope]
+    pagination_class = ProvisionCursorPagination
+
+    def _requested_fields(self):
+        raw = self.request.query_params.get("fields") if self.request else None
+        return [f.strip() for f in raw.split(",") if f.strip()] if raw else None
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request and self.request.method == "GET":
+            context["fields"] = self._requested_fields()
+        return context
+
+    def get_queryset(self):
+        queryset = self.queryset.all()
+        fields = self._requested_fields() if self.request and self.request.method == "GET" else None
+        if fields:
+            concrete = {f.name for f in queryset.model._meta.concrete_fields}
+            queryset = queryset.only("id", "updated_at", *[f for f in fields if f in concrete])
+        updated_since = self.request.query_params.get("updated_since") if self.request else None
+        if updated_since:
+            parsed = parse_datetime(updated_since)
+            if parsed is None:
+                raise ValidationError({"updated_since": "Use an ISO 8601 datetime."})
+            queryset = queryset.filter(updated_at__gte=parsed)
+        return queryset
+
+
+class DeviceProfileViewSet(ProvisionModelViewSet):
+    queryset = DeviceProfile.objects.all()
+    serializer_class = DeviceProfileSerializer
+    bulk_lookup_field = "name"
+
+    def _before_bulk_create(self, objs, errors):
+        # pin the templates (api.signals.pin_profile_template) and refuse unknown
+        # references, like DeviceProfileForm does with check_template_ref()
+        pointers = template_pointer.pin_all(objs)
+        if not pointers:
+            return
+        unknown = {
+            index: {"template_ref": [f"Template '{obj.template_ref}' not found."]}
+            for index, obj in enumerate(objs)
+            if obj.template_ref and pointers.get(obj.template_ref) == template_pointer.UNRESOLVED
+        }
+        if unknown:
+            errors["create"] = unknown
+
+
+class DeviceConfigViewSet(ProvisionModelViewSet):
+    queryset = DeviceConfig.objects.all()
+    serializer_class = DeviceConfigSerializer
+    bulk_lookup_field = "identifier"
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params if self.request else {}
+        if params.get("profile"):
+            queryset = queryset.filter(profile_id=params["profile"])
+        if params.get("mac_address"):
+            queryset = queryset.filter(mac_address=_normalize_mac(params["mac_address"]))
+        if params.get("identifier"):
+            queryset = queryset.filter(identifier=params["identifier"])
+        return queryset
+
+    def _after_bulk_create(self, objs):
+        # bulk_create does not send post_save: drop cached "unknown device" lookups
+        for obj in objs:
+            invalidate_device(DeviceConfig, obj)
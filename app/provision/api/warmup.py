@@ -0,0 +1,155 @@
+"""
+Cache warm-up for the provisioning path.
+
+warm_provisioning_cache() loads every DeviceProfile, every template (pointer,
+version body and the compiled Django template) and, optionally, the most
+recently provisioned/updated devices into api.cache. It runs:
+
+- in the gunicorn master with preload_app (gunicorn.conf.py, when_ready hook),
+  before workers are forked, so the warmed L1 pages are shared copy-on-write;
+- in each worker when the app is not preloaded (post_worker_init hook);
+- on demand with `manage.py warm_provisioning_cache`, which fills the shared L2
+  (redis/memcached) after a deploy.
+
+The outcome is kept in a module-level state used by the readiness endpoint
+(/api/ready/): with settings.PROVISION_WARMUP enabled it answers 503 until a
+warm-up has finished.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import F
+
+from api.cache import provision_cache
+from api.render_context import PROFILE_COLUMNS, PROFILE_TEMPLATE_FIELDS, ROW_COLUMNS, profile_row, split_row
+from api.utils.mongo import get_mongo_client
+from api.utils.templates import TEMPLATE_BODY_PROJECTION, get_templates_collection, get_version_text
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_READY = "ready"
+
+_state_lock = threading.Lock()
+_state = {"status": STATUS_PENDING, "report": None}
+
+
+def get_warmup_state() -> dict:
+    with _state_lock:
+        return dict(_state)
+
+
+def _set_state(**values):
+    with _state_lock:
+        _state.update(values)
+
+
+def is_ready() -> bool:
+    """True when warm-up finished, or when warm-up is not required (settings.PROVISION_WARMUP off)."""
+    if not getattr(settings, "PROVISION_WARMUP", False):
+        return True
+    return get_warmup_state()["status"] == STATUS_READY
+
+
+def _warm_profiles(report):
+    from core.models import DeviceProfile
+
+    for profile in DeviceProfile.objects.only("pk", "updated_at", *PROFILE_TEMPLATE_FIELDS, *PROFILE_COLUMNS).iterator():
+        provision_cache.set("profile", profile.pk, profile_row(profile))
+        report["profiles"] += 1
+
+
+def _warm_templates(report):
+    from api.views import get_compiled_template
+    from core.models import DeviceProfile
+
+    coll = get_templates_collection(get_mongo_client())
+    docs = {doc.get("_id"): doc for doc in coll.find({}, projection=TEMPLATE_BODY_PROJECTION)}
+
+    # same keys as api.views._find_template_by_ref: the profile's template_ref as
+    # written, resolved exactly or in lower case
+    refs = set(DeviceProfile.objects.exclude(template_ref="").values_list("template_ref", flat=True))
+    for tref in refs | set(docs):
+        doc = docs.get(tref) or docs.get(str(tref).strip().lower())
+        if doc is not None:
+            provision_cache.set("template", f"ref:{tref}", doc)
+
+    for name, doc in docs.items():
+        sha256 = doc.get("sha256")
+        if not sha256:
+            report["templates_skipped"] += 1
+            continue
+        try:
+            text = get_version_text(sha256)
+            if text is None:
+                report["templates_skipped"] += 1
+                continue
+            get_compiled_template(text, cache_key=sha256)
+        except Exception as exc:
+            report["errors"].append(f"template {name}: {exc}")
+            continue
+        report["templates"] += 1
+        report["template_bytes"] += len(text)
+
+
+def _warm_devices(report, limit):
+    from core.models import DeviceConfig
+
+    qs = DeviceConfig.objects.order_by(F("provisioned_at").desc(nulls_last=True), "-updated_at")[:limit]
+    for row in qs.values_list(*ROW_COLUMNS).iterator():
+        device, _ = split_row(row)
+        # same keys as api.views.get_device_row
+        if device.mac_address:
+            provision_cache.set("device", f"mac:{device.mac_address}", device)
+        if device.identifier:
+            provision_cache.set("device", f"id:{device.identifier}", device)
+        report["devices"] += 1
+
+
+def warm_provisioning_cache(devices: int = None, templates: bool = True) -> dict:
+    """
+    Fill api.cache with profiles, templates and (if devices > 0) the `devices` most
+    recently provisioned devices. Returns a report (counts, bytes held in L1, seconds,
+    errors) and updates the readiness state. Failures of one part do not stop the others.
+    """
+    if devices is None:
+        devices = getattr(settings, "PROVISION_WARMUP_DEVICES", 0)
+    _set_state(status=STATUS_RUNNING, report=None)
+    started = time.monotonic()
+    report = {
+        "profiles": 0,
+        "templates": 0,
+        "templates_skipped": 0,
+        "template_bytes": 0,
+        "devices": 0,
+        "errors": [],
+    }
+    steps = [("profiles", _warm_profiles)]
+    if templates:
+        steps.append(("templates", _warm_templates))
+    if devices:
+        steps.append(("devices", lambda r: _warm_devices(r, devices)))
+
+    for step, func in steps:
+        try:
+            func(report)
+        except Exception as exc:
+            logger.exception("Cache warm-up step '%s' failed: %s", step, exc)
+            report["errors"].append(f"{step}: {exc}")
+
+    l1 = provision_cache.stats()["l1"]
+    report["l1_entries"] = l1["entries"]
+    report["l1_bytes"] = l1["bytes"]
+    report["seconds"] = round(time.monotonic() - started, 3)
+    # a failed step leaves the cache cold for that part, but requests still work
+    # (they fall back to MySQL/Mongo), so the process is reported ready anyway
+    _set_state(status=STATUS_READY, report=report)
+    logger.info(
+        "Provisioning cache warmed in %.2fs: %s profiles, %s templates (%s bytes), %s devices, %s errors",
+        report["seconds"], report["profiles"], report["templates"], report["template_bytes"],
+        report["devices"], len(report["errors"]),
+    )
+    return report
@@ -0,0 +1,59 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _clear_provision_cache():
+    """Devices, profiles and templates cached by api.cache must not leak between tests."""
+    from api.cache import provision_cache
+
+    provision_cache.clear()
+    yield
+    provision_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def _no_background_propagation(settings):
+    """Profile/template saves would start re-render threads (api.propagation); tests opt in."""
+    settings.PROVISION_PROPAGATION = False
+
+
+@pytest.fixture(autouse=True)
+def _no_analytics(settings):
+    """Fetch counters (api.analytics) start a flush thread; tests opt in and flush explicitly."""
+    settings.PROVISION_ANALYTICS = False
+
+
+@pytest.fixture(autouse=True)
+def _no_template_pinning(settings):
+    """Profile saves would resolve template_ref in MongoDB (api.template_pointer); tests opt in."""
+    settings.PROVISION_TEMPLATE_PINNING = False
+
+
+@pytest.fixture(autouse=True)
+def _local_invalidation_bus(settings):
+    """Cache invalidations (api.invalidation) stay in the process: no table writes, no subscriber thread."""
+    settings.PROVISION_INVALIDATION_TRANSPORT = "local"
+
+
+@pytest.fixture(autouse=True)
+def _no_template_arena(settings):
+    """The shared template store (api.template_arena) lives in /dev/shm; tests opt in with a tmp dir."""
+    settings.PROVISION_TEMPLATE_ARENA = False
+
+
+@pytest.fixture(autouse=True)
+def _backends_not_degraded(monkeypatch):
+    """A backend error noted by an earlier test would send downloads through api.last_good's thread pool."""
+    from api import last_good
+
+    monkeypatch.setattr(last_good, "_degraded_until", 0.0)
+
+
+@pytest.fixture(autouse=True)
+def _closed_breakers():
+    """Backend failures of one test must not leave a circuit breaker (api.breaker) open for the next."""
+    from api import breaker
+
+    breaker.reset()
+    yield
+    breaker.reset()
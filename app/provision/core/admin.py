@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import DeviceProfile, DeviceConfig, Provisioning
+from .models import DeviceLastSeen, DeviceProfile, DeviceConfig, PropagationRun, ProvisioningStat, Provisioning
+from .forms import DeviceProfileForm
 
 
 class DeviceInline(admin.TabularInline):
@@ -12,10 +13,11 @@ class DeviceInline(admin.TabularInline):
 
 @admin.register(DeviceProfile)
 class DeviceProfileAdmin(admin.ModelAdmin):
-    list_display = ("name", "sip_server", "port_server", "protocol_type", "srtp_enable", "created_at")
+    form = DeviceProfileForm
+    list_display = ("name", "sip_server", "port_server", "protocol_type", "srtp_enable", "template_id", "created_at")
     search_fields = ("name", "sip_server", "template_ref")
     inlines = [DeviceInline]
-    readonly_fields = ("created_at", "updated_at")
+    readonly_fields = ("created_at", "updated_at", "template_id", "template_sha256", "template_extension", "template_resolved_at")
     list_filter = ("protocol_type", "srtp_enable")
 
 
@@ -32,9 +34,66 @@ class DeviceConfigAdmin(admin.ModelAdmin):
     )
 
 
+class _KnownValuesFilter(admin.SimpleListFilter):
+    """Opções vindas das tabelas agregadas (api.analytics), sem DISTINCT na tabela Provisioning."""
+
+    def lookups(self, request, model_admin):
+        from api.analytics import distinct_values
+
+        return [(value, value) for value in distinct_values(self.parameter_name)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**{self.parameter_name: self.value()})
+        return queryset
+
+
+class VendorFilter(_KnownValuesFilter):
+    title = "vendor"
+    parameter_name = "vendor"
+
+
+class ModelFilter(_KnownValuesFilter):
+    title = "model"
+    parameter_name = "model"
+
+
 @admin.register(Provisioning)
 class ProvisioningAdmin(admin.ModelAdmin):
     list_display = ("mac_address", "identifier", "status", "vendor", "model", "version", "created_at")
     search_fields = ("mac_address", "identifier", "vendor", "model", "notes")
-    list_filter = ("status", "vendor", "model")
-    readonly_fields = ("device", "mac_address", "identifier", "vendor", "model", "version", "public_ip", "private_ip", "filename", "template_ref", "user_agent", "notes", "created_at", "updated_at")
\ No newline at end of file
+    list_filter = ("status", VendorFilter, ModelFilter)
+    readonly_fields = ("device", "mac_address", "identifier", "vendor", "model", "version", "public_ip", "private_ip", "filename", "template_ref", "user_agent", "notes", "created_at", "updated_at")
+
+
+@admin.register(PropagationRun)
+class PropagationRunAdmin(admin.ModelAdmin):
+    list_display = ("trigger", "target", "status", "total", "rendered", "failed", "skipped", "created_at", "finished_at")
+    list_filter = ("status", "trigger")
+    search_fields = ("target",)
+    readonly_fields = ("trigger", "target", "status", "total", "rendered", "failed", "skipped", "errors", "created_at", "started_at", "finished_at")
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ProvisioningStat)
+class ProvisioningStatAdmin(admin.ModelAdmin):
+    list_display = ("bucket", "vendor", "model", "version", "status", "count")
+    list_filter = ("status",)
+    date_hierarchy = "bucket"
+    readonly_fields = ("bucket", "vendor", "model", "version", "status", "count")
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DeviceLastSeen)
+class DeviceLastSeenAdmin(admin.ModelAdmin):
+    list_display = ("mac_address", "vendor", "model", "version", "status", "last_seen_at")
+    list_filter = ("status", VendorFilter, ModelFilter)
+    search_fields = ("mac_address",)
+    readonly_fields = ("mac_address", "vendor", "model", "version", "status", "last_seen_at")
+
+    def has_add_permission(self, request):
+        return False
@@ -55,6 +55,20 @@ class DeviceProfileForm(forms.ModelForm):
         }
 
 
+    def clean_template_ref(self):
+        """
+        Referência inexistente no MongoDB é recusada aqui (o phone receberia 403).
+        Se o MongoDB não responder, o profile é salvo e o template resolvido depois
+        (reconcile_template_pointers).
+        """
+        from api.template_pointer import check_template_ref, enabled
+
+        template_ref = self.cleaned_data.get("template_ref")
+        if template_ref and enabled() and check_template_ref(template_ref) is False:
+            raise forms.ValidationError(f"Template '{template_ref}' não encontrado no MongoDB.")
+        return template_ref
+
+
 class DeviceConfigForm(forms.ModelForm):
     """
     Form para DeviceConfig. Campos mapeados para placeholders:
@@ -0,0 +1,38 @@
+"""
+Management command to rebuild the shared template arena (api.template_arena).
+
+gunicorn.conf.py builds it at startup and template changes rebuild it; this command
+is for repairs (templates edited directly in MongoDB) and for checking its size.
+Running workers switch to the new generation within
+PROVISION_TEMPLATE_ARENA_CHECK_SECONDS.
+
+Usage:
+  python app/provision/manage.py build_template_arena [--dir /dev/shm/provision-templates] [--json]
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import template_arena
+
+
+class Command(BaseCommand):
+    help = "Write a new generation of the shared template arena from MongoDB."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default=None, help="Arena directory (default: PROVISION_TEMPLATE_ARENA_DIR)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        try:
+            report = template_arena.build(directory=options["dir"])
+        except Exception as exc:
+            raise CommandError(f"Could not build the template arena: {exc}")
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"Generation {report['generation']}: {report['templates']} templates, "
+            f"{report['versions']} bodies, {report['bytes']} bytes in {report['seconds']}s"
+        )
@@ -0,0 +1,92 @@
+"""
+Management command to convert device_templates documents to the versioned storage format.
+
+Legacy documents keep the template body twice ('template' and 'content'); format 2
+documents keep a single 'body' (or 'gridfs_id') in the template document itself. This
+command moves every body into device_template_versions (keyed by sha256, zlib-compressed
+above TEMPLATE_COMPRESS_MIN_BYTES) and turns the template document into a pointer to
+that version. Documents already in the current format are left untouched, so the
+command can be run repeatedly.
+
+With --prune-versions, versions no longer referenced by any template (current version
+or history) are deleted, together with their GridFS bodies.
+
+Usage:
+  python app/provision/manage.py compact_templates [--dry-run] [--batch-size 100] [--prune-versions]
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.utils.mongo import get_mongo_client
+from api.utils.templates import (
+    FORMAT_VERSION,
+    compact_template_doc,
+    delete_template_body,
+    get_templates_collection,
+    get_versions_collection,
+    is_legacy_doc,
+    publish_template,
+)
+
+
+class Command(BaseCommand):
+    help = "Convert device_templates documents (legacy template/content or inline body) to versioned pointers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be converted")
+        parser.add_argument("--batch-size", type=int, default=100, help="Mongo cursor batch size")
+        parser.add_argument("--prune-versions", action="store_true", help="Delete versions no template references")
+
+    def handle(self, *args, **options):
+        try:
+            db = get_mongo_client()
+            coll = get_templates_collection(db)
+        except Exception as exc:
+            raise CommandError(f"Failed to connect to MongoDB: {exc}")
+
+        dry_run = options["dry_run"]
+        converted = skipped = 0
+        bytes_before = bytes_after = 0
+
+        for doc in coll.find({"format": {"$ne": FORMAT_VERSION}}, batch_size=options["batch_size"]):
+            if is_legacy_doc(doc):
+                new_doc = compact_template_doc(doc)
+                if new_doc is None:
+                    skipped += 1
+                    self.stdout.write(self.style.WARNING(f"Skipping '{doc.get('_id')}': no template body found."))
+                    continue
+                bytes_before += len((doc.get("template") or "").encode("utf-8")) + len((doc.get("content") or "").encode("utf-8"))
+                body = new_doc["body"]
+                bytes_after += len(body) if isinstance(body, bytes) else len(body.encode("utf-8"))
+            elif doc.get("sha256") and ("body" in doc or doc.get("gridfs_id") is not None):
+                new_doc = doc
+            else:
+                skipped += 1
+                self.stdout.write(self.style.WARNING(f"Skipping '{doc.get('_id')}': unknown document layout."))
+                continue
+
+            if not dry_run:
+                publish_template(db, new_doc)
+            converted += 1
+
+        verb = "Would convert" if dry_run else "Converted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {converted} template(s); skipped {skipped}."))
+        self.stdout.write(f"Legacy body bytes: {bytes_before} -> {bytes_after}")
+
+        if options["prune_versions"]:
+            self._prune_versions(db, coll, dry_run)
+
+    def _prune_versions(self, db, coll, dry_run):
+        referenced = set()
+        for doc in coll.find({}, projection={"sha256": 1, "history.sha256": 1}):
+            referenced.add(doc.get("sha256"))
+            referenced.update(entry.get("sha256") for entry in doc.get("history") or [])
+
+        versions = get_versions_collection(db)
+        pruned = 0
+        for version in versions.find({"_id": {"$nin": [sha for sha in referenced if sha]}}, projection={"gridfs_id": 1}):
+            if not dry_run:
+                versions.delete_one({"_id": version["_id"]})
+                delete_template_body(db, version)
+            pruned += 1
+        verb = "Would prune" if dry_run else "Pruned"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {pruned} unreferenced version(s)."))
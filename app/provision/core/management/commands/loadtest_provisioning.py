@@ -0,0 +1,119 @@
+"""
+Management command that simulates a fleet of phones fetching their configuration
+(api.loadgen) and reports throughput, latency percentiles and errors.
+
+Phones come from the registered devices (DeviceConfig); --unknown-ratio mixes in
+unregistered MACs. Storm profiles:
+  ramp    arrival rate grows linearly up to --rate requests/s over --duration seconds
+  herd    every phone once within --spread seconds (power restored to a site)
+  steady  every phone polls each --interval seconds (± --jitter) for --duration seconds
+
+Usage:
+  python app/provision/manage.py loadtest_provisioning --profile herd --spread 10 --concurrency 200
+  python app/provision/manage.py loadtest_provisioning --url https://provision.example/api/download-xml/ \\
+      --profile ramp --rate 500 --duration 120 --api-key ...
+  # local stack: threaded server in a child process, in-memory Mongo (needs mongomock)
+  python app/provision/manage.py loadtest_provisioning --serve 8765 --memory-mongo --profile herd
+"""
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import loadgen
+
+
+class Command(BaseCommand):
+    help = "Simulate phones booting/polling against /api/download-xml/ and report throughput and latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000/api/download-xml/", help="Download URL")
+        parser.add_argument("--profile", choices=loadgen.PROFILES, default="herd", help="Storm profile (default: herd)")
+        parser.add_argument("--devices", type=int, default=None, help="Sample N registered devices (default: all)")
+        parser.add_argument("--unknown-ratio", type=float, default=0.0, help="Share of unregistered MACs (0-1)")
+        parser.add_argument("--duration", type=float, default=60.0, help="ramp/steady: seconds (default: 60)")
+        parser.add_argument("--rate", type=float, default=100.0, help="ramp: final requests/s (default: 100)")
+        parser.add_argument("--spread", type=float, default=0.0, help="herd: boot window in seconds (default: 0)")
+        parser.add_argument("--interval", type=float, default=30.0, help="steady: poll interval in seconds")
+        parser.add_argument("--jitter", type=float, default=0.1, help="steady: interval jitter (share, default: 0.1)")
+        parser.add_argument("--concurrency", type=int, default=100, help="Requests in flight at most (default: 100)")
+        parser.add_argument("--timeout", type=float, default=10.0, help="Per-request timeout in seconds")
+        parser.add_argument("--api-key", default=None, help="X-API-KEY header (default: $PROVISION_API_KEY)")
+        parser.add_argument("--token", default=None, help="OAuth2 bearer token")
+        parser.add_argument("--serve", type=int, metavar="PORT", default=None,
+                            help="Start a local threaded server on PORT and target it")
+        parser.add_argument("--memory-mongo", action="store_true", help="--serve: use an in-memory Mongo (mongomock)")
+        parser.add_argument("--seed-template", default=None, help="--memory-mongo: template file to seed")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed (fleet and schedule)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if not 0 <= options["unknown_ratio"] < 1:
+            raise CommandError("--unknown-ratio must be between 0 and 1.")
+        phones = loadgen.load_fleet(options["devices"], options["unknown_ratio"], options["seed"])
+        if not phones:
+            raise CommandError("No registered devices to simulate.")
+
+        headers = {}
+        api_key = options["api_key"] or os.environ.get("PROVISION_API_KEY")
+        if api_key:
+            headers["X-API-KEY"] = api_key
+        if options["token"]:
+            headers["Authorization"] = f"Bearer {options['token']}"
+
+        url = options["url"]
+        server = None
+        if options["serve"]:
+            template_text = None
+            if options["seed_template"]:
+                with open(options["seed_template"], encoding="utf-8") as fh:
+                    template_text = fh.read()
+            try:
+                server = loadgen.start_server(options["serve"], options["memory_mongo"], template_text)
+            except RuntimeError as exc:
+                raise CommandError(str(exc))
+            url = f"http://127.0.0.1:{options['serve']}/api/download-xml/"
+
+        schedule = loadgen.build_schedule(
+            options["profile"], phones,
+            duration=options["duration"], rate=options["rate"], spread=options["spread"],
+            interval=options["interval"], jitter=options["jitter"], seed=options["seed"],
+        )
+        try:
+            report = loadgen.run(url, schedule, options["concurrency"], options["timeout"], headers)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join(5)
+
+        report.update(profile=options["profile"], phones=len(phones), url=url)
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        self._print(report)
+
+    def _print(self, report):
+        latency = report["latency_ms"]
+        self.stdout.write(f"{report['profile']}: {report['phones']} phones -> {report['url']}")
+        self.stdout.write(
+            f"{report['requests']} requests in {report['seconds']}s: {report['throughput']} req/s "
+            f"({report['ok_per_second']} ok/s), peak {report['peak_per_second']} in one second"
+        )
+        self.stdout.write(
+            f"latency ms: mean {latency['mean']}  p50 {latency['p50']}  p90 {latency['p90']}  "
+            f"p99 {latency['p99']}  max {latency['max']}"
+        )
+        lag = report["send_lag_ms"]
+        if lag["p99"] and lag["p99"] > 100:
+            self.stdout.write(self.style.WARNING(
+                f"requests left up to {lag['p99']} ms behind schedule (p99): raise --concurrency "
+                f"or the server is saturated"
+            ))
+        peak = max((row["count"] for row in report["histogram"]), default=0)
+        for row in report["histogram"]:
+            if row["count"]:
+                label = f"<= {row['le_ms']} ms" if row["le_ms"] is not None else "> 10000 ms"
+                self.stdout.write(f"  {label:>12} {row['count']:>8} {'#' * max(1, 40 * row['count'] // peak)}")
+        outcomes = ", ".join(f"{outcome}: {n}" for outcome, n in report["outcomes"].items())
+        style = self.style.SUCCESS if not report["errors"] else self.style.WARNING
+        self.stdout.write(style(f"outcomes: {outcomes or 'none'}"))
@@ -0,0 +1,103 @@
+"""
+Management command to compare cold-start cost of the settings profiles (roles).
+
+For each settings module a fresh interpreter runs `python -X importtime`, calls
+django.setup() and loads the URLconf (and, unless --no-wsgi, the WSGI handler with its
+middleware). Reported per role: wall time, time spent importing, number of modules,
+peak RSS and the slowest top-level imports.
+
+Usage:
+  python app/provision/manage.py measure_startup
+  python app/provision/manage.py measure_startup --settings-modules provision.settings_provisioning --top 20
+"""
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_MODULES = ["provision.settings", "provision.settings_provisioning"]
+
+_PROBE = """
+import json, os, resource, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+if {wsgi!r}:
+    from django.core.wsgi import get_wsgi_application
+    get_wsgi_application()
+from django.conf import settings
+print(json.dumps({{
+    "seconds": time.perf_counter() - started,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "apps": len(settings.INSTALLED_APPS),
+    "middleware": len(settings.MIDDLEWARE),
+}}))
+"""
+
+
+def parse_importtime(stderr: str):
+    """Return [(module, self_us, cumulative_us, depth)] from `-X importtime` output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+            rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+        except ValueError:
+            continue
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Measure import time, module count and memory at startup for each settings profile."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--settings-modules", nargs="+", default=DEFAULT_MODULES, help="Settings modules to compare")
+        parser.add_argument("--top", type=int, default=10, help="Show the N slowest top-level imports per role")
+        parser.add_argument("--no-wsgi", action="store_true", help="Do not build the WSGI handler (middleware)")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+
+    def handle(self, *args, **options):
+        results = [self._measure(module, not options["no_wsgi"], options["top"]) for module in options["settings_modules"]]
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(self.style.MIGRATE_HEADING(result["settings"]))
+            self.stdout.write(
+                f"  wall {result['seconds'] * 1000:.0f} ms | imports {result['import_ms']:.0f} ms "
+                f"({result['modules']} modules) | peak RSS {result['max_rss_kb'] // 1024} MiB | "
+                f"{result['apps']} apps, {result['middleware']} middleware"
+            )
+            for name, ms in result["slowest"]:
+                self.stdout.write(f"    {ms:8.1f} ms  {name}")
+
+    def _measure(self, module, wsgi, top):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=module)
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", _PROBE.format(wsgi=wsgi)],
+            cwd=str(settings.BASE_DIR),
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            tail = "\n".join(line for line in proc.stderr.splitlines() if not line.startswith("import time:"))[-2000:]
+            raise CommandError(f"Startup of {module} failed:\n{tail}")
+        data = json.loads(proc.stdout.strip().splitlines()[-1])
+        rows = parse_importtime(proc.stderr)
+        top_level = [row for row in rows if row[3] == 0]
+        data.update(
+            settings=module,
+            modules=len(rows),
+            import_ms=sum(row[2] for row in top_level) / 1000,
+            slowest=[(name, cumulative / 1000) for name, _, cumulative, _ in sorted(top_level, key=lambda r: -r[2])[:top]],
+        )
+        return data
@@ -0,0 +1,56 @@
+"""
+Management command to re-render (validate) the devices affected by a profile or template.
+
+Runs api.propagation synchronously: the same work the admin schedules in the
+background after a save, useful after bulk imports, when PROVISION_PROPAGATION is
+off, or to finish runs interrupted by a restart (--pending).
+
+Usage:
+  python app/provision/manage.py propagate_changes --profile 3 [--profile 4] [--template yealink_t4x] [--json]
+  python app/provision/manage.py propagate_changes --pending
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.propagation import propagate, run_propagation
+from core.models import PropagationRun
+
+
+class Command(BaseCommand):
+    help = "Re-render the devices affected by profiles/templates and report per-device failures."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profile", type=int, action="append", default=[], help="DeviceProfile id (repeatable)")
+        parser.add_argument("--template", action="append", default=[], help="Template _id (repeatable)")
+        parser.add_argument("--pending", action="store_true", help="Run the pending/interrupted PropagationRuns")
+        parser.add_argument("--workers", type=int, default=None, help="Render threads (default: PROVISION_PROPAGATION_WORKERS)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options["pending"]:
+            runs = PropagationRun.objects.filter(
+                status__in=[PropagationRun.STATUS_PENDING, PropagationRun.STATUS_RUNNING]
+            ).order_by("created_at")
+            for run_id in list(runs.values_list("pk", flat=True)):
+                run = run_propagation(run_id)
+                self.stdout.write(f"{run}: {run.rendered}/{run.total} rendered, {run.failed} failed, {run.skipped} skipped")
+            return
+
+        if not options["profile"] and not options["template"]:
+            raise CommandError("Use --profile, --template or --pending.")
+
+        report = propagate(profile_ids=options["profile"], template_ids=options["template"], workers=options["workers"])
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, default=str))
+            return
+
+        self.stdout.write(
+            f"Devices: {report['total']}  Rendered: {report['rendered']} ({report['bytes']} bytes)  "
+            f"Failed: {report['failed']}  Skipped: {report['skipped']}  Time: {report['seconds']}s"
+        )
+        for error in report["errors"]:
+            self.stdout.write(self.style.WARNING(f"device {error['device']} ({error['identifier']}): {error['error']}"))
+        style = self.style.WARNING if report["failed"] else self.style.SUCCESS
+        self.stdout.write(style("Propagation finished."))
@@ -0,0 +1,32 @@
+"""
+Management command that rebuilds the ops dashboard aggregates (core.ProvisioningStat,
+core.DeviceLastSeen) from the raw core.Provisioning rows.
+
+The aggregates are normally maintained incrementally (api.analytics); use this after
+importing Provisioning rows with bulk_create/loaddata, or to backfill history.
+
+Usage:
+  python app/provision/manage.py rebuild_provisioning_stats [--days 30] [--json]
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.analytics import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the provisioning dashboard aggregates from the Provisioning table."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Only the last N days (default: all rows)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        report = rebuild(days=options["days"])
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['rows']} provisioning rows: {report['stats']} per-minute stats, {report['devices']} devices."
+        ))
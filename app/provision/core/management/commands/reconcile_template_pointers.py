@@ -0,0 +1,36 @@
+"""
+Management command that repairs the template pinned on each DeviceProfile
+(template_id / template_sha256 / template_extension, see api.template_pointer).
+
+Pins are refreshed when profiles are saved and templates are imported, rolled back
+or deleted through the app; run this after changing device_templates directly, or
+after profile saves made while MongoDB was unreachable.
+
+Usage:
+  python app/provision/manage.py reconcile_template_pointers [--dry-run] [--json]
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.template_pointer import reconcile
+
+
+class Command(BaseCommand):
+    help = "Re-resolve the template pinned on each device profile and fix stale pointers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the stale pointers")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        report = reconcile(dry_run=options["dry_run"])
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        verb = "stale" if options["dry_run"] else "repaired"
+        self.stdout.write(self.style.SUCCESS(f"{report['profiles']} profiles checked, {report['repaired']} {verb}."))
+        if report["unresolved"]:
+            self.stdout.write(self.style.WARNING(
+                f"{len(report['unresolved'])} template references not found: {', '.join(report['unresolved'])}"
+            ))
@@ -0,0 +1,69 @@
+"""
+Management command to render device configurations in bulk (api.batch_render).
+
+Validation runs and migrations: render a profile, a template's devices or the whole
+fleet in parallel processes, writing the files to a directory or a tarball, or
+just checking that every device renders.
+
+Usage:
+  python app/provision/manage.py render_configs --profile 3 --out /tmp/configs
+  python app/provision/manage.py render_configs --template yealink_t4x --tar /tmp/t4x.tar.gz
+  python app/provision/manage.py render_configs --all --processes 8 --json      # validação apenas
+  python app/provision/manage.py render_configs --profile 3 --template new_t4x  # template novo nos devices do profile
+"""
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.batch_render import DirectorySink, TarSink, render_batch
+
+
+class Command(BaseCommand):
+    help = "Render device configs in bulk (profile, template or fleet) to a directory/tarball, or validate them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profile", type=int, default=None, help="DeviceProfile id")
+        parser.add_argument("--template", default=None, help="Template _id: its devices, or with --profile the template to use")
+        parser.add_argument("--all", action="store_true", help="Every device")
+        parser.add_argument("--out", default=None, help="Write one file per device into this directory")
+        parser.add_argument("--tar", default=None, help="Write a .tar (or .tar.gz) archive")
+        parser.add_argument("--processes", type=int, default=None, help="Render processes (default: PROVISION_BATCH_PROCESSES; 0 = inline)")
+        parser.add_argument("--chunk-size", type=int, default=None, help="Devices per chunk (default: PROVISION_BATCH_CHUNK_SIZE)")
+        parser.add_argument("--ua", default="", help='User-Agent data for the context: "vendor model version"')
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if not (options["profile"] or options["template"] or options["all"]):
+            raise CommandError("Use --profile, --template or --all.")
+        if options["out"] and options["tar"]:
+            raise CommandError("Use either --out or --tar.")
+
+        sink = None
+        if options["out"]:
+            sink = DirectorySink(options["out"])
+        elif options["tar"]:
+            sink = TarSink(options["tar"])
+        ua = (options["ua"].split() + ["", "", ""])[:3]
+
+        report = render_batch(
+            profile=options["profile"],
+            template=options["template"],
+            sink=sink,
+            processes=options["processes"],
+            chunk_size=options["chunk_size"],
+            ua=ua,
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2, default=str))
+            return
+
+        self.stdout.write(
+            f"Devices: {report['total']}  Rendered: {report['rendered']} ({report['bytes']} bytes)  "
+            f"Failed: {report['failed']}  Skipped: {report['skipped']}  "
+            f"Time: {report['seconds']}s ({report['devices_per_second']} devices/s)"
+        )
+        for error in report["errors"]:
+            self.stdout.write(self.style.WARNING(f"device {error['device']} ({error['identifier']}): {error['error']}"))
+        style = self.style.WARNING if report["failed"] else self.style.SUCCESS
+        self.stdout.write(style("Batch render finished."))
@@ -0,0 +1,42 @@
+"""
+Management command to warm the provisioning cache (api.cache) after a deploy.
+
+Loads every DeviceProfile, every template (version body + compiled template) and,
+with --devices N, the N most recently provisioned devices. Run from a release job
+it fills the shared L2 cache (redis/memcached); the in-process L1 of the gunicorn
+workers is warmed by gunicorn.conf.py at startup.
+
+Usage:
+  python app/provision/manage.py warm_provisioning_cache [--devices 5000] [--no-templates] [--json]
+"""
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.warmup import warm_provisioning_cache
+
+
+class Command(BaseCommand):
+    help = "Load profiles, templates and (optionally) hot devices into the provisioning cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=None, help="Warm the N most recently provisioned devices (default: PROVISION_WARMUP_DEVICES)")
+        parser.add_argument("--no-templates", action="store_true", help="Skip templates (Mongo)")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        report = warm_provisioning_cache(devices=options["devices"], templates=not options["no_templates"])
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(
+            f"Profiles: {report['profiles']}  Templates: {report['templates']} "
+            f"({report['template_bytes']} bytes, {report['templates_skipped']} skipped)  Devices: {report['devices']}"
+        )
+        self.stdout.write(f"L1: {report['l1_entries']} entries, {report['l1_bytes']} bytes  Time: {report['seconds']}s")
+        for error in report["errors"]:
+            self.stdout.write(self.style.WARNING(error))
+        style = self.style.WARNING if report["errors"] else self.style.SUCCESS
+        self.stdout.write(style("Warm-up finished."))
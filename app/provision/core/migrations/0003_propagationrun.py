@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-19 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_alter_deviceconfig_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PropagationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger', models.CharField(choices=[('profile', 'Profile'), ('template', 'Template')], max_length=20, verbose_name='trigger')),
+                ('target', models.CharField(help_text='Profile id or template _id', max_length=255, verbose_name='target')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20, verbose_name='status')),
+                ('total', models.IntegerField(default=0, verbose_name='devices')),
+                ('rendered', models.IntegerField(default=0, verbose_name='rendered')),
+                ('failed', models.IntegerField(default=0, verbose_name='failed')),
+                ('skipped', models.IntegerField(default=0, help_text='Devices whose template depends on the User-Agent', verbose_name='skipped')),
+                ('errors', models.JSONField(blank=True, default=list, verbose_name='errors')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='started at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='finished at')),
+            ],
+            options={
+                'verbose_name': 'Propagation run',
+                'verbose_name_plural': 'Propagation runs',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
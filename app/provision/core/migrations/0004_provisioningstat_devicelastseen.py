@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-19 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_propagationrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceLastSeen',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mac_address', models.CharField(max_length=32, unique=True, verbose_name='mac address')),
+                ('vendor', models.CharField(blank=True, max_length=50, verbose_name='vendor')),
+                ('model', models.CharField(blank=True, max_length=50, verbose_name='model')),
+                ('version', models.CharField(blank=True, max_length=50, verbose_name='version')),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('forbidden', 'Forbidden'), ('error', 'Error')], max_length=20, verbose_name='status')),
+                ('last_seen_at', models.DateTimeField(db_index=True, verbose_name='last seen at')),
+            ],
+            options={
+                'verbose_name': 'Device last seen',
+                'verbose_name_plural': 'Devices last seen',
+                'ordering': ['-last_seen_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProvisioningStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(db_index=True, verbose_name='minute')),
+                ('vendor', models.CharField(blank=True, max_length=50, verbose_name='vendor')),
+                ('model', models.CharField(blank=True, max_length=50, verbose_name='model')),
+                ('version', models.CharField(blank=True, max_length=50, verbose_name='version')),
+                ('status', models.CharField(choices=[('ok', 'OK'), ('forbidden', 'Forbidden'), ('error', 'Error')], max_length=20, verbose_name='status')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='count')),
+            ],
+            options={
+                'verbose_name': 'Provisioning stat',
+                'verbose_name_plural': 'Provisioning stats',
+                'ordering': ['-bucket'],
+                'constraints': [models.UniqueConstraint(fields=('bucket', 'vendor', 'model', 'version', 'status'), name='provisioningstat_unique_key')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-19 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_provisioningstat_devicelastseen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deviceprofile',
+            name='template_extension',
+            field=models.CharField(blank=True, editable=False, max_length=10, verbose_name='resolved template extension'),
+        ),
+        migrations.AddField(
+            model_name='deviceprofile',
+            name='template_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='resolved template _id'),
+        ),
+        migrations.AddField(
+            model_name='deviceprofile',
+            name='template_resolved_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='template resolved at'),
+        ),
+        migrations.AddField(
+            model_name='deviceprofile',
+            name='template_sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='resolved template version'),
+        ),
+    ]
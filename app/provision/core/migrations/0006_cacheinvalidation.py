@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 15:34
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_deviceprofile_template_pointer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheInvalidation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, verbose_name='kind')),
+                ('keys', models.JSONField(blank=True, default=list, verbose_name='keys')),
+                ('origin', models.CharField(help_text='Process that published the event', max_length=100, verbose_name='origin')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='created at')),
+            ],
+            options={
+                'verbose_name': 'Cache invalidation',
+                'verbose_name_plural': 'Cache invalidations',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -68,6 +68,12 @@ class DeviceProfile(models.Model):
     time_zone = models.CharField("time zone", max_length=50, blank=True)
     srtp_enable = models.BooleanField("SRTP enabled", default=False)
     template_ref = models.CharField("Mongo template reference", max_length=255, blank=True, help_text="Mongo template _id or identifier")
+    # template resolvido a partir do template_ref (api.template_pointer): preenchido ao salvar o
+    # profile e ao importar/restaurar/remover templates; reparado por reconcile_template_pointers
+    template_id = models.CharField("resolved template _id", max_length=255, blank=True, editable=False)
+    template_sha256 = models.CharField("resolved template version", max_length=64, blank=True, editable=False)
+    template_extension = models.CharField("resolved template extension", max_length=10, blank=True, editable=False)
+    template_resolved_at = models.DateTimeField("template resolved at", null=True, blank=True, editable=False)
     metadata = models.JSONField("metadata", default=dict, blank=True)
 
     created_at = models.DateTimeField("created at", auto_now_add=True)
@@ -232,4 +238,117 @@ class Provisioning(models.Model):
 
     def __str__(self):
         when = self.created_at.isoformat() if self.created_at else "unknown"
-        return f"{self.mac_address or self.identifier} @ {when}"
\ No newline at end of file
+        return f"{self.mac_address or self.identifier} @ {when}"
+
+class PropagationRun(models.Model):
+    """
+    Re-renderização em segundo plano dos devices afetados pela alteração de um
+    DeviceProfile ou de um template (ver api.propagation). Guarda o progresso e as
+    falhas por device (ex.: TemplateSyntaxError) para consulta no admin.
+    """
+    TRIGGER_PROFILE = "profile"
+    TRIGGER_TEMPLATE = "template"
+    TRIGGER_CHOICES = [
+        (TRIGGER_PROFILE, "Profile"),
+        (TRIGGER_TEMPLATE, "Template"),
+    ]
+
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    trigger = models.CharField("trigger", max_length=20, choices=TRIGGER_CHOICES)
+    target = models.CharField("target", max_length=255, help_text="Profile id or template _id")
+    status = models.CharField("status", max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+
+    total = models.IntegerField("devices", default=0)
+    rendered = models.IntegerField("rendered", default=0)
+    failed = models.IntegerField("failed", default=0)
+    skipped = models.IntegerField("skipped", default=0, help_text="Devices whose template depends on the User-Agent")
+    errors = models.JSONField("errors", default=list, blank=True)
+
+    created_at = models.DateTimeField("created at", auto_now_add=True)
+    started_at = models.DateTimeField("started at", null=True, blank=True)
+    finished_at = models.DateTimeField("finished at", null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        verbose_name = "Propagation run"
+        verbose_name_plural = "Propagation runs"
+
+    def __str__(self):
+        return f"{self.trigger} {self.target} ({self.status})"
+
+
+class ProvisioningStat(models.Model):
+    """
+    Contagem de downloads de configuração por minuto, vendor/model/versão (do
+    User-Agent) e status. Mantida incrementalmente por api.analytics (contadores em
+    memória gravados a cada poucos segundos); o painel de operação lê só esta tabela
+    e DeviceLastSeen, nunca a tabela Provisioning.
+    """
+    bucket = models.DateTimeField("minute", db_index=True)
+    vendor = models.CharField("vendor", max_length=50, blank=True)
+    model = models.CharField("model", max_length=50, blank=True)
+    version = models.CharField("version", max_length=50, blank=True)
+    status = models.CharField("status", max_length=20, choices=Provisioning.STATUS_CHOICES)
+    count = models.PositiveIntegerField("count", default=0)
+
+    class Meta:
+        ordering = ["-bucket"]
+        verbose_name = "Provisioning stat"
+        verbose_name_plural = "Provisioning stats"
+        constraints = [
+            models.UniqueConstraint(fields=["bucket", "vendor", "model", "version", "status"], name="provisioningstat_unique_key"),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H:%M} {self.vendor} {self.model} {self.version} {self.status}: {self.count}"
+
+
+class DeviceLastSeen(models.Model):
+    """
+    Último download de cada device (por MAC): firmware informado no User-Agent e
+    status. Base da distribuição de firmware e dos devices sem contato há N dias.
+    """
+    mac_address = models.CharField("mac address", max_length=32, unique=True)
+    vendor = models.CharField("vendor", max_length=50, blank=True)
+    model = models.CharField("model", max_length=50, blank=True)
+    version = models.CharField("version", max_length=50, blank=True)
+    status = models.CharField("status", max_length=20, choices=Provisioning.STATUS_CHOICES)
+    last_seen_at = models.DateTimeField("last seen at", db_index=True)
+
+    class Meta:
+        ordering = ["-last_seen_at"]
+        verbose_name = "Device last seen"
+        verbose_name_plural = "Devices last seen"
+
+    def __str__(self):
+        return f"{self.mac_address} @ {self.last_seen_at.isoformat()}"
+
+
+class CacheInvalidation(models.Model):
+    """
+    Evento do barramento de invalidação (api.invalidation, transporte "db"): um device,
+    profile ou template alterado. Cada worker lê os eventos novos a cada poucos
+    segundos e remove as chaves do seu cache local. Linhas antigas são apagadas.
+    """
+    kind = models.CharField("kind", max_length=20)
+    keys = models.JSONField("keys", default=list, blank=True)
+    origin = models.CharField("origin", max_length=100, help_text="Process that published the event")
+    created_at = models.DateTimeField("created at", default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ["id"]
+        verbose_name = "Cache invalidation"
+        verbose_name_plural = "Cache invalidations"
+
+    def __str__(self):
+        return f"{self.kind} {', '.join(map(str, self.keys))}"
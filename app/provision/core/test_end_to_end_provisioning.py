@@ -15,7 +15,7 @@ def test_full_provision_flow(monkeypatch):
     DeviceConfig.objects.create(profile=profile, identifier="accept-1", mac_address="aa:bb:cc:01:02:03")
 
     # stub mongo template
-    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext: {"template": "ACCEPT {{ identifier }}", "model": model, "extension": ext})
+    monkeypatch.setattr(views, "get_template_from_mongo", lambda model, ext, template_ref=None: {"template": "ACCEPT {{ identifier }}", "model": model, "extension": ext})
 
     ua = "Acme Model 1.2 accept-1"
     resp = client.get("/api/download-xml/config.cfg", HTTP_USER_AGENT=ua, HTTP_X_API_KEY="accept-key")
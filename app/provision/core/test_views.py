@@ -33,4 +33,28 @@ def test_profile_create_or_update_post_creates_profile(client, django_user_model
     resp = client.post(reverse("core:profile_create"), data={"name": "NewProfile", "port_server": 5060, "protocol_type": "UDP"})
     # should redirect to detail on success
     assert resp.status_code in (302, 301)
-    assert DeviceProfile.objects.filter(name="NewProfile").exists()
\ No newline at end of file
+    assert DeviceProfile.objects.filter(name="NewProfile").exists()
+
+@pytest.mark.django_db
+def test_import_template_rejects_oversized_upload_without_reading_it(client, django_user_model, settings, monkeypatch):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    import core.views as core_views
+
+    mongomock = pytest.importorskip("mongomock")
+    monkeypatch.setattr(core_views, "get_mongo_client", lambda: mongomock.MongoClient().db)
+    django_user_model.objects.create_user("u4", password="pw")
+    client.login(username="u4", password="pw")
+    settings.PROVISION_TEMPLATE_MAX_BYTES = 100
+
+    monkeypatch.setattr(core_views, "ingest_template_upload", lambda *a, **k: pytest.fail("upload was read"))
+    upload = SimpleUploadedFile("big.cfg", b"x" * 200)
+    resp = client.post(reverse("core:import_template"), {"name": "big", "file": upload})
+    assert "Template recusado" in resp.content.decode()
+
+    # size known only after ingest (e.g. compressed upload): checked before loading the body
+    monkeypatch.setattr(core_views, "ingest_template_upload", lambda *a, **k: {"_id": "big", "size": 10 ** 9})
+    monkeypatch.setattr(core_views, "get_template_body", lambda *a: pytest.fail("body loaded"))
+    monkeypatch.setattr(core_views, "delete_template_body", lambda *a: None)
+    resp = client.post(reverse("core:import_template"), {"name": "big", "file": SimpleUploadedFile("big.cfg", b"x")})
+    assert "Template recusado" in resp.content.decode()
@@ -24,4 +24,8 @@ urlpatterns = [
     path("templates/<str:name>/", views.template_detail, name="template_detail"),
     path("templates/<str:name>/download/", views.template_download, name="template_download"),
     path("templates/<str:name>/delete/", views.template_delete, name="template_delete"),
+    path("templates/<str:name>/rollback/", views.template_rollback, name="template_rollback"),
+
+    # Painel de operação (staff)
+    path("analytics/", views.analytics_dashboard, name="analytics_dashboard"),
 ]
\ No newline at end of file
@@ -7,18 +7,36 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required, user_passes_test
 from .models import DeviceConfig, DeviceProfile
 from .forms import DeviceProfileForm, DeviceFormSet
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
 from datetime import datetime
 from django.core.paginator import Paginator
-import xml.etree.ElementTree as ET
 import logging
 import os
 import re
 
 # Use the shared mongo util
+from api import invalidation
+from api.cache import provision_cache
+from api.propagation import schedule_propagation
+from api.sandbox import TemplateRejected, check_template, check_template_size
+from api.template_pointer import repin_template
 from api.utils.mongo import get_mongo_client
+from api.utils.templates import (
+    TEMPLATE_META_PROJECTION,
+    TemplateValidationError,
+    decode_body_bytes,
+    delete_template_body,
+    get_template_body,
+    ingest_template_upload,
+    is_versioned_doc,
+    iter_template_body_bytes,
+    load_template_version,
+    normalize_common_file,
+    publish_template,
+    rollback_template,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -39,7 +57,7 @@ def _sanitize_filename(name: str) -> str:
     return safe
 
 # View to list templates imported
-# -- template_download: ler 'template' com fallback para 'content' --
+# -- template_download: ler 'body' (formato compacto) com fallback para 'template'/'content' --
 @require_http_methods(["GET"])
 @login_required
 def template_download(request, name: str):
@@ -59,12 +77,18 @@ def template_download(request, name: str):
     if not doc:
         raise Http404("Template não encontrado.")
 
-    # prefer 'template' com fallback para 'content'
-    content = doc.get("template") or doc.get("content") or ""
-    if isinstance(content, str):
-        body = content.encode("utf-8")
-    else:
-        body = content
+    # ?version=<sha256> baixa uma versão do histórico; sem parâmetro, a versão atual
+    version = None
+    version_sha = (request.GET.get("version") or "").strip()
+    if version_sha and not any(h.get("sha256") == version_sha for h in doc.get("history") or []):
+        raise Http404("Versão não encontrada.")
+    if is_versioned_doc(doc):
+        try:
+            version = load_template_version(version_sha or doc.get("sha256"), db)
+        except Exception as exc:
+            logger.exception("Erro ao consultar versão do template %s: %s", name, exc)
+        if not version:
+            raise Http404("Template não encontrado.")
 
     file_type = (doc.get("file_type") or "").lower()
     filename = doc.get("filename") or f"{name}.{file_type or 'txt'}"
@@ -75,7 +99,8 @@ def template_download(request, name: str):
     else:
         content_type = "text/plain; charset=utf-8"
 
-    resp = HttpResponse(body, content_type=content_type)
+    # corpo em blocos (GridFS é lido em streaming)
+    resp = StreamingHttpResponse(iter_template_body_bytes(doc, db, version=version), content_type=content_type)
     resp["Content-Disposition"] = f'attachment; filename="{filename}"'
     return resp
 
@@ -85,7 +110,8 @@ def template_download(request, name: str):
 def template_delete(request, name: str):
     """
     Remove documento do MongoDB (collection device_templates) com _id == name.
-    Requer POST (form com CSRF token).
+    Requer POST (form com CSRF token). As versões em device_template_versions são
+    mantidas (podem ser compartilhadas); use compact_templates --prune-versions.
     """
     try:
         db = get_mongo_client()
@@ -98,20 +124,66 @@ def template_delete(request, name: str):
         return redirect("core:template_list")
 
     try:
-        result = coll.delete_one({"_id": name})
+        deleted = coll.find_one_and_delete({"_id": name}, projection={"_id": 1, "gridfs_id": 1})
     except Exception as exc:
         logger.exception("Erro ao deletar template %s: %s", name, exc)
         from django.contrib import messages
         messages.error(request, "Erro ao remover o template. Verifique os logs.")
         return redirect("core:template_list")
 
+    try:
+        delete_template_body(db, deleted)
+    except Exception:
+        logger.exception("Falha ao remover corpo do template %s do GridFS", name)
+    if deleted:
+        # buscas de template em cache (api.cache) ainda apontariam para o documento removido
+        provision_cache.clear_namespace("template")
+        invalidation.publish(invalidation.EVENT_TEMPLATE, [name])
+        # profiles fixados no template removido voltam a resolver pelo model do User-Agent
+        try:
+            repin_template(name, db=db)
+        except Exception:
+            logger.exception("Falha ao atualizar os profiles que usavam o template %s", name)
+        # devices dos profiles que usavam o template passam a falhar: registrar no relatório
+        schedule_propagation("template", name)
+
     from django.contrib import messages
-    if result.deleted_count:
+    if deleted:
         messages.success(request, f"Template '{name}' removido com sucesso.")
     else:
         messages.warning(request, f"Template '{name}' não encontrado.")
     return redirect("core:template_list")
     
+# --- view de rollback: aponta o template para uma versão do histórico ---
+@require_http_methods(["POST"])
+@login_required
+def template_rollback(request, name: str):
+    """
+    Republica uma versão anterior (sha256 presente no histórico) como versão atual.
+    As versões são imutáveis: o rollback apenas troca o ponteiro em device_templates.
+    """
+    sha256 = (request.POST.get("sha256") or "").strip()
+    try:
+        db = get_mongo_client()
+        pointer = rollback_template(
+            db,
+            name,
+            sha256,
+            rolled_back_by=request.user.username if request.user.is_authenticated else None,
+            rolled_back_at=datetime.utcnow(),
+        )
+    except Exception as exc:
+        logger.exception("Erro ao restaurar versão %s do template %s: %s", sha256, name, exc)
+        messages.error(request, "Erro ao restaurar a versão do template. Verifique os logs.")
+        return redirect("core:template_detail", name=name)
+
+    if pointer:
+        schedule_propagation("template", name)
+        messages.success(request, f"Template '{name}' restaurado para a versão {sha256[:12]}.")
+    else:
+        messages.warning(request, "Versão não encontrada no histórico do template.")
+    return redirect("core:template_detail", name=name)
+
 # -- template_list: converte _id para id e mantém compatibilidade de campo template/content --
 @login_required
 def template_list(request):
@@ -131,8 +203,8 @@ def template_list(request):
         query = {"_id": {"$regex": q, "$options": "i"}}
 
     try:
-        # não traz o campo template para agilizar a listagem
-        cursor = coll.find(query, projection={"template": 0, "content": 0}).sort("uploaded_at", -1)
+        # não traz o corpo do template para agilizar a listagem
+        cursor = coll.find(query, projection=TEMPLATE_META_PROJECTION).sort("uploaded_at", -1)
         docs = []
         for d in cursor:
             d["id"] = str(d.get("_id"))
@@ -151,7 +223,7 @@ def template_list(request):
     context = {"page_obj": page_obj, "q": q}
     return render(request, "core/template_list.html", context)
 
-# -- template_detail: usar 'template' com fallback em 'content' --
+# -- template_detail: usar 'body' com fallback em 'template'/'content' --
 @login_required
 def template_detail(request, name: str):
     try:
@@ -173,10 +245,36 @@ def template_detail(request, name: str):
     # adicionar id para o template acessar sem underscore
     doc["id"] = str(doc.get("_id"))
 
-    # prefer 'template' (schema API) e cair em 'content' como fallback
-    content = doc.get("template") or doc.get("content") or ""
+    # ponteiro (formato versionado): o corpo fica em device_template_versions
+    version = None
+    if is_versioned_doc(doc):
+        try:
+            version = load_template_version(doc.get("sha256"), db)
+        except Exception as exc:
+            logger.exception("Erro ao consultar versão %s do template %s: %s", doc.get("sha256"), name, exc)
+
+    if (version or doc).get("gridfs_id") is not None:
+        # corpos grandes (GridFS): mostrar apenas o início do arquivo
+        preview, limit = [], getattr(settings, "TEMPLATE_PREVIEW_MAX_BYTES", 256 * 1024)
+        try:
+            for chunk in iter_template_body_bytes(doc, db, version=version):
+                preview.append(chunk)
+                limit -= len(chunk)
+                if limit <= 0:
+                    break
+        except Exception as exc:
+            logger.exception("Erro ao ler corpo do template %s no GridFS: %s", name, exc)
+        content = decode_body_bytes(b"".join(preview))
+        doc["truncated"] = limit <= 0
+    elif version is not None:
+        content = decode_body_bytes(b"".join(iter_template_body_bytes(doc, db, version=version)))
+    else:
+        content = get_template_body(doc) or ""
+
+    # histórico de versões publicadas (mais recente primeiro)
+    history = list(reversed(doc.get("history") or []))
 
-    context = {"doc": doc, "content": content}
+    context = {"doc": doc, "content": content, "history": history}
     return render(request, "core/template_detail.html", context)
 
 # Device CRUD views (simplified; reuse existing patterns)
@@ -325,20 +423,29 @@ def profile_create_or_update(request, pk=None):
 
     return render(request, "core/profile_form.html", {"form": form, "formset": formset, "profile": profile})
 
-# -- import_template: salvar 'template' (compatível com api.views) --
+# -- import_template: salvar no formato compacto (ver api.utils.templates) --
 @require_http_methods(["GET", "POST"])
 @login_required
 def import_template(request):
     """
     Upload de arquivo .xml ou .cfg e salvamento no MongoDB.
     Usa api.utils.mongo.get_mongo_client() para obter o DB e grava em collection device_templates.
-    O campo 'name' é usado como chave (_id).
+    O campo 'name' é usado como chave (_id). 'common_file' (opcional) marca o template como
+    arquivo comum do modelo/profile, pedido pelos telefones com esse nome.
     """
     if request.method == "POST":
         name = (request.POST.get("name") or "").strip()
         uploaded = request.FILES.get("file")
         overwrite = request.POST.get("overwrite") in ("on", "true", "1")
 
+        # arquivo comum (ex.: y000000000028.cfg): servido a todos os telefones que o pedirem,
+        # renderizado sem dados do device (api.views.find_common_template)
+        try:
+            common_file = normalize_common_file(request.POST.get("common_file"))
+        except ValueError:
+            messages.error(request, "Nome de arquivo comum inválido: use apenas o nome do arquivo .cfg ou .xml.")
+            return render(request, "core/import_template.html", {"name": name})
+
         if not name:
             messages.error(request, "Informe um nome para o template.")
             return render(request, "core/import_template.html", {"name": name})
@@ -352,22 +459,8 @@ def import_template(request):
             messages.error(request, "Extensão inválida. Apenas .xml e .cfg são permitidos.")
             return render(request, "core/import_template.html", {"name": name})
 
-        raw = uploaded.read()
-        try:
-            content = raw.decode("utf-8")
-        except Exception:
-            content = raw.decode("latin-1", errors="replace")
-
         file_type = "xml" if ext == ".xml" else "cfg"
 
-        # validação adicional para XML
-        if file_type == "xml":
-            try:
-                ET.fromstring(content)
-            except ET.ParseError as exc:
-                messages.error(request, f"XML inválido: {exc}")
-                return render(request, "core/import_template.html", {"name": name})
-
         # obtém DB via utilitário centralizado
         try:
             db = get_mongo_client()
@@ -376,29 +469,91 @@ def import_template(request):
             messages.error(request, "Falha ao conectar ao MongoDB. Verifique logs.")
             return render(request, "core/import_template.html", {"name": name})
 
-        existing = coll.find_one({"_id": name})
+        existing = coll.find_one({"_id": name}, projection={"_id": 1, "gridfs_id": 1})
         if existing and not overwrite:
             messages.error(request, "Já existe um template com esse nome. Marque 'Sobrescrever' para atualizar.")
             return render(request, "core/import_template.html", {"name": name})
 
-        # Usar chave 'template' para compatibilidade com app/provision/api/views.py
-        doc = {
-            "_id": name,
-            "filename": uploaded.name,
-            "file_type": file_type,
-            "template": content,      # chave esperada pela API
-            "content": content,       # manter como fallback/compatibilidade (opcional)
-            "uploaded_by": request.user.username if request.user.is_authenticated else None,
-            "uploaded_at": datetime.utcnow(),
-        }
+        # acima de PROVISION_TEMPLATE_MAX_BYTES é recusado antes de ler o arquivo
+        try:
+            check_template_size(uploaded.size)
+        except TemplateRejected as exc:
+            messages.error(request, f"Template recusado: {exc}")
+            return render(request, "core/import_template.html", {"name": name})
+
+        # leitura em blocos: valida XML incrementalmente e calcula sha256 sem carregar o arquivo inteiro;
+        # corpos grandes vão para o GridFS (TEMPLATE_GRIDFS_MIN_BYTES)
+        try:
+            doc = ingest_template_upload(
+                db,
+                name,
+                uploaded,
+                file_type=file_type,
+                filename=uploaded.name,
+                uploaded_by=request.user.username if request.user.is_authenticated else None,
+                uploaded_at=datetime.utcnow(),
+            )
+        except TemplateValidationError as exc:
+            messages.error(request, f"XML inválido: {exc}")
+            return render(request, "core/import_template.html", {"name": name})
+        except Exception:
+            logger.exception("Falha ao processar upload do template %s", name)
+            messages.error(request, "Falha ao salvar o template no MongoDB. Verifique logs.")
+            return render(request, "core/import_template.html", {"name": name})
+
+        if common_file:
+            doc["common_file"] = common_file
 
+        # compila, mede (nós, laços aninhados) e renderiza uma vez com contexto vazio dentro
+        # do orçamento de renderização (api.sandbox): templates fora dos limites são recusados.
+        # O tamanho (do texto, após descompressão) é conferido antes de carregar o corpo.
         try:
-            coll.replace_one({"_id": name}, doc, upsert=True)
+            check_template_size(doc.get("size"))
+            doc["complexity"] = check_template(get_template_body(doc, db) or "", doc.get("size"))
+        except TemplateRejected as exc:
+            delete_template_body(db, doc)
+            messages.error(request, f"Template recusado: {exc}")
+            return render(request, "core/import_template.html", {"name": name})
         except Exception:
+            delete_template_body(db, doc)
+            logger.exception("Falha ao analisar o template %s", name)
+            messages.error(request, "Falha ao analisar o template. Verifique logs.")
+            return render(request, "core/import_template.html", {"name": name})
+
+        # grava a versão imutável (chave = sha256) e aponta o nome para ela
+        try:
+            publish_template(db, doc)
+        except Exception:
+            logger.exception("Falha ao gravar template %s", name)
             messages.error(request, "Falha ao salvar o template no MongoDB. Verifique logs.")
             return render(request, "core/import_template.html", {"name": name})
 
+        # documento antigo (formato 2) com corpo no GridFS ficou órfão após a publicação
+        if existing and existing.get("gridfs_id") is not None and existing.get("gridfs_id") != doc.get("gridfs_id"):
+            try:
+                delete_template_body(db, existing)
+            except Exception:
+                logger.exception("Falha ao remover corpo antigo do template %s do GridFS", name)
+
+        # re-renderiza em segundo plano os devices dos profiles que usam o template
+        schedule_propagation("template", name)
+
         messages.success(request, f"Template '{name}' salvo com sucesso.")
         return redirect("core:template_list")
     else:
-        return render(request, "core/import_template.html", {})
\ No newline at end of file
+        return render(request, "core/import_template.html", {})
+
+# -- painel de operação: lido só das tabelas agregadas (api.analytics) --
+@staff_required
+def analytics_dashboard(request):
+    from api.analytics import dashboard
+
+    def positive_int(name):
+        try:
+            return max(1, int(request.GET.get(name, "")))
+        except ValueError:
+            return None
+
+    data = dashboard(hours=positive_int("hours"), stale_days=positive_int("stale_days"))
+    peak = max((n for _, n in data["per_minute"]), default=0)
+    return render(request, "core/analytics_dashboard.html", {"data": data, "peak": peak})
@@ -0,0 +1,78 @@
+"""
+Configuração do gunicorn (Dockerfile: gunicorn -c gunicorn.conf.py provision.wsgi:application).
+
+Com preload_app o master importa o Django e aquece o cache de provisionamento
+(api.warmup) antes de criar os workers: profiles, templates compilados e devices
+quentes ficam em páginas compartilhadas copy-on-write. Sem preload, cada worker
+aquece o próprio cache ao iniciar. /api/ready/ responde 503 até o aquecimento terminar.
+
+Antes do aquecimento é construída a arena de templates (api.template_arena): um
+arquivo em /dev/shm mapeado por todos os workers, com os corpos dos templates.
+"""
+import os
+import time
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 3))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+
+# início do master (herdado pelos workers no fork)
+_started_at = time.time()
+
+# readiness (api.views.ready) só fica verde depois do warm-up
+os.environ.setdefault("PROVISION_WARMUP", "1")
+
+
+def _build_arena(server, since=None):
+    # arena de templates compartilhada pelos workers (api.template_arena)
+    from api import template_arena
+
+    if not template_arena.enabled():
+        return
+    try:
+        server.log.info("Template arena: %s", template_arena.build(since=since))
+    except Exception as exc:
+        server.log.exception("Template arena build failed: %s", exc)
+
+
+def _warm(server):
+    from api.warmup import warm_provisioning_cache
+
+    try:
+        report = warm_provisioning_cache()
+        server.log.info("Provisioning cache warm-up: %s", report)
+    except Exception as exc:
+        server.log.exception("Provisioning cache warm-up failed: %s", exc)
+
+
+def when_ready(server):
+    # roda no master, depois do preload e antes do fork dos workers
+    if not server.cfg.preload_app:
+        return
+    _build_arena(server)
+    _warm(server)
+    # conexões abertas no master não podem ser herdadas pelos workers
+    from django.db import connections
+    from api.utils.mongo import reset_mongo_client
+
+    connections.close_all()
+    reset_mongo_client(close=True)
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from api.utils.mongo import reset_mongo_client
+
+        reset_mongo_client()
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        # o primeiro worker constrói a arena; os outros encontram uma mais nova que o master
+        _build_arena(worker, since=_started_at)
+        _warm(worker)
+    # cada worker remove do seu cache local o que outros processos alteraram
+    from api.invalidation import ensure_subscriber
+
+    ensure_subscriber()
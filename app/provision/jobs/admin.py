@@ -0,0 +1,29 @@
+from django.contrib import admin
+
+from . import queue
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "task", "status", "priority", "attempts", "max_attempts", "progress_current", "progress_total", "created_at", "finished_at")
+    list_filter = ("status",)
+    search_fields = ("task",)
+    readonly_fields = (
+        "task", "kwargs", "status", "attempts", "locked_by", "locked_until", "progress_current", "progress_total",
+        "progress_message", "result", "error", "created_by", "created_at", "started_at", "finished_at", "updated_at",
+    )
+    actions = ["retry_jobs", "cancel_jobs"]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Retry selected failed/cancelled jobs")
+    def retry_jobs(self, request, queryset):
+        count = sum(queue.retry(job) for job in queryset)
+        self.message_user(request, f"{count} job(s) queued again.")
+
+    @admin.action(description="Cancel selected queued jobs")
+    def cancel_jobs(self, request, queryset):
+        count = sum(queue.cancel(job) for job in queryset)
+        self.message_user(request, f"{count} job(s) cancelled.")
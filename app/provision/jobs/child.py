@@ -0,0 +1,35 @@
+"""
+Entry points of the job worker's pool processes (jobs.worker).
+
+Kept free of model imports at module level: with the 'spawn' start method a child
+imports this module before the initializer has called django.setup().
+"""
+import traceback
+
+
+def init():
+    import django
+    from django.db import connections
+
+    django.setup()
+    # with the 'fork' start method the child inherits the parent's connections
+    connections.close_all()
+
+
+def execute(job_id):
+    """Run one job attempt. Returns (ok, result or traceback text); never raises."""
+    from django.db import close_old_connections
+
+    from jobs import queue
+    from jobs.models import Job
+
+    close_old_connections()
+    try:
+        job = Job.objects.get(pk=job_id)
+        func = queue.resolve_task(job.task)
+        result = func(queue.JobContext(job_id), **(job.kwargs or {}))
+        return True, result
+    except Exception:
+        return False, traceback.format_exc()
+    finally:
+        close_old_connections()
@@ -0,0 +1,30 @@
+"""
+Management command that runs background jobs (jobs.models.Job) in a process pool.
+
+Run it as a separate process/container next to gunicorn (same image and settings):
+
+  python app/provision/manage.py runjobs [--processes 4] [--poll 2]
+  python app/provision/manage.py runjobs --burst     # until the queue is empty (cron / Cloud Run jobs)
+
+Several workers (on one or more machines) can share the queue: jobs are leased
+with SELECT ... FOR UPDATE SKIP LOCKED.
+"""
+from django.core.management.base import BaseCommand
+
+from jobs.worker import Worker
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs (DB-backed queue, process pool)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=None, help="Pool size (default: JOBS_PROCESSES; 0 = run inline)")
+        parser.add_argument("--poll", type=float, default=None, help="Seconds between queue polls (default: JOBS_POLL_SECONDS)")
+        parser.add_argument("--burst", action="store_true", help="Exit when no job is due")
+        parser.add_argument("--max-jobs", type=int, default=None, help="Exit after this many job attempts")
+
+    def handle(self, *args, **options):
+        worker = Worker(processes=options["processes"], poll_interval=options["poll"])
+        worker.install_signal_handlers()
+        processed = worker.run(burst=options["burst"], max_jobs=options["max_jobs"])
+        self.stdout.write(self.style.SUCCESS(f"Worker finished: {processed} job attempts."))
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """
+    Tarefa em segundo plano executada por `manage.py runjobs` (ver jobs.queue e jobs.worker).
+
+    `task` é o caminho pontuado de uma função marcada com @jobs.queue.task; `kwargs`
+    são os argumentos (JSON). O worker reserva o job (locked_by/locked_until) e o
+    executa num processo do pool; falhas voltam para a fila até max_attempts.
+    """
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+        (STATUS_CANCELLED, "Cancelled"),
+    ]
+
+    task = models.CharField("task", max_length=255)
+    kwargs = models.JSONField("arguments", default=dict, blank=True)
+    status = models.CharField("status", max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    priority = models.IntegerField("priority", default=0, help_text="Higher runs first")
+
+    attempts = models.IntegerField("attempts", default=0)
+    max_attempts = models.IntegerField("max attempts", default=1)
+    run_after = models.DateTimeField("run after", default=timezone.now)
+
+    # lease: a worker owns the job until locked_until (extended while it runs)
+    locked_by = models.CharField("locked by", max_length=100, blank=True)
+    locked_until = models.DateTimeField("locked until", null=True, blank=True)
+
+    progress_current = models.IntegerField("progress", default=0)
+    progress_total = models.IntegerField("progress total", default=0)
+    progress_message = models.CharField("progress message", max_length=255, blank=True)
+
+    result = models.JSONField("result", null=True, blank=True)
+    error = models.TextField("error", blank=True)
+
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="+", on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField("created at", auto_now_add=True)
+    started_at = models.DateTimeField("started at", null=True, blank=True)
+    finished_at = models.DateTimeField("finished at", null=True, blank=True)
+    updated_at = models.DateTimeField("updated at", auto_now=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+        verbose_name = "Job"
+        verbose_name_plural = "Jobs"
+        indexes = [
+            models.Index(fields=["status", "run_after"]),
+        ]
+
+    def __str__(self):
+        return f"#{self.pk} {self.task} ({self.status})"
+
+    @property
+    def progress_percent(self):
+        if not self.progress_total:
+            return None
+        return min(100, int(self.progress_current * 100 / self.progress_total))
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED, self.STATUS_CANCELLED)
@@ -0,0 +1,190 @@
+"""
+Job queue stored in the Django database (jobs.models.Job).
+
+Enqueue work from anywhere (views, signals, commands):
+
+    from jobs.queue import enqueue
+    job = enqueue("api.tasks.propagation_task", {"run_id": run.pk}, max_attempts=3)
+
+and run `manage.py runjobs` (jobs.worker) to execute it. Only functions decorated
+with @task can be run, so a row in the table cannot name arbitrary callables. A
+task receives a JobContext first and the job's kwargs as keyword arguments; its
+return value (JSON-serializable) is stored in Job.result.
+
+Leasing: lease() picks queued jobs with SELECT ... FOR UPDATE SKIP LOCKED where the
+database supports it (MySQL 8, PostgreSQL), so concurrent workers never wait on each
+other's rows, and claims them with a conditional UPDATE (status still 'queued'),
+which is also what keeps SQLite correct. A claimed job belongs to its worker until
+locked_until; the worker extends the lease while the job runs, and requeue_expired()
+hands jobs of crashed workers to someone else. Each lease() call writes a fresh token
+in locked_by: extend_lease() and complete() take the leased rows and only touch
+jobs still holding that token, so a worker whose lease expired cannot extend or
+overwrite a job that was leased again.
+"""
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from jobs.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def task(func):
+    """Mark func as runnable by the job worker (called as func(ctx, **kwargs))."""
+    func.job_task = True
+    return func
+
+
+def task_path(func_or_path) -> str:
+    if isinstance(func_or_path, str):
+        return func_or_path
+    return f"{func_or_path.__module__}.{func_or_path.__qualname__}"
+
+
+def resolve_task(path):
+    """Import the task function; ValueError if it does not exist or is not a @task."""
+    try:
+        func = import_string(path)
+    except ImportError as exc:
+        raise ValueError(f"Unknown task {path!r}: {exc}") from exc
+    if not getattr(func, "job_task", False):
+        raise ValueError(f"{path!r} is not a job task (missing @jobs.queue.task)")
+    return func
+
+
+def enqueue(func_or_path, kwargs=None, *, priority=0, max_attempts=None, run_after=None, user=None) -> Job:
+    """Queue a task. The job becomes visible to workers when the current transaction commits."""
+    path = task_path(func_or_path)
+    resolve_task(path)
+    return Job.objects.create(
+        task=path,
+        kwargs=kwargs or {},
+        priority=priority,
+        max_attempts=max_attempts or _setting("JOBS_MAX_ATTEMPTS", 3),
+        run_after=run_after or timezone.now(),
+        created_by=user if getattr(user, "is_authenticated", False) else None,
+    )
+
+
+def lease(worker_id, limit, lease_seconds=None) -> list:
+    """Claim up to `limit` due jobs for worker_id. Returns the claimed Job rows."""
+    if limit <= 0:
+        return []
+    now = timezone.now()
+    lease_seconds = lease_seconds or _setting("JOBS_LEASE_SECONDS", 300)
+    token = f"{worker_id}/{uuid.uuid4().hex[:8]}"
+    with transaction.atomic():
+        due = Job.objects.filter(status=Job.STATUS_QUEUED, run_after__lte=now).order_by("-priority", "id")
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        ids = list(due.values_list("pk", flat=True)[:limit])
+        if not ids:
+            return []
+        Job.objects.filter(pk__in=ids, status=Job.STATUS_QUEUED).update(
+            status=Job.STATUS_RUNNING,
+            locked_by=token,
+            locked_until=now + timedelta(seconds=lease_seconds),
+            attempts=F("attempts") + 1,
+            started_at=now,
+            error="",
+        )
+    return list(Job.objects.filter(pk__in=ids, locked_by=token).order_by("-priority", "id"))
+
+
+def extend_lease(jobs, lease_seconds=None) -> int:
+    """Extend the leases of jobs (rows returned by lease()) that still hold their lease token."""
+    lease_seconds = lease_seconds or _setting("JOBS_LEASE_SECONDS", 300)
+    by_token = {}
+    for job in jobs:
+        by_token.setdefault(job.locked_by, []).append(job.pk)
+    locked_until = timezone.now() + timedelta(seconds=lease_seconds)
+    return sum(
+        Job.objects.filter(pk__in=ids, status=Job.STATUS_RUNNING, locked_by=token).update(locked_until=locked_until)
+        for token, ids in by_token.items()
+    )
+
+
+def requeue_expired() -> int:
+    """Jobs whose lease ran out (worker killed or stuck) go back to the queue, or fail when out of attempts."""
+    now = timezone.now()
+    expired = Job.objects.filter(status=Job.STATUS_RUNNING, locked_until__lt=now)
+    failed = expired.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.STATUS_FAILED, error="Lease expired (worker lost)", finished_at=now, locked_by="", locked_until=None
+    )
+    requeued = expired.update(
+        status=Job.STATUS_QUEUED, error="Lease expired (worker lost)", locked_by="", locked_until=None
+    )
+    if failed or requeued:
+        logger.warning("Expired job leases: %s requeued, %s failed", requeued, failed)
+    return requeued + failed
+
+
+def complete(leased, ok, payload) -> Job:
+    """
+    Record the outcome of an attempt of leased (a row returned by lease()): payload is
+    the result (ok) or the error text. Failed attempts are retried with exponential
+    backoff until max_attempts.
+    """
+    token = leased.locked_by
+    job = Job.objects.get(pk=leased.pk)
+    if job.status != Job.STATUS_RUNNING or job.locked_by != token:
+        # cancelled, or requeued (expired lease) and maybe leased again meanwhile: the newer state wins
+        return job
+    now = timezone.now()
+    values = {"locked_by": "", "locked_until": None, "updated_at": now}
+    if ok:
+        values.update(status=Job.STATUS_SUCCEEDED, result=payload, finished_at=now)
+    elif job.attempts < job.max_attempts:
+        backoff = _setting("JOBS_RETRY_BACKOFF_SECONDS", 30) * 2 ** (job.attempts - 1)
+        values.update(status=Job.STATUS_QUEUED, run_after=now + timedelta(seconds=backoff), error=payload)
+    else:
+        values.update(status=Job.STATUS_FAILED, error=payload, finished_at=now)
+    # conditional on the lease we hold, so a concurrent requeue_expired() is not overwritten
+    Job.objects.filter(pk=job.pk, status=Job.STATUS_RUNNING, locked_by=token).update(**values)
+    job.refresh_from_db()
+    return job
+
+
+def cancel(job) -> bool:
+    """Cancel a queued job (running jobs are not interrupted)."""
+    return bool(Job.objects.filter(pk=job.pk, status=Job.STATUS_QUEUED).update(
+        status=Job.STATUS_CANCELLED, finished_at=timezone.now()
+    ))
+
+
+def retry(job) -> bool:
+    """Queue a failed or cancelled job again, with a fresh set of attempts."""
+    return bool(Job.objects.filter(pk=job.pk, status__in=[Job.STATUS_FAILED, Job.STATUS_CANCELLED]).update(
+        status=Job.STATUS_QUEUED, attempts=0, run_after=timezone.now(), finished_at=None, error=""
+    ))
+
+
+class JobContext:
+    """Passed to tasks: job id and progress reporting (written to the Job row, throttled)."""
+
+    def __init__(self, job_id, min_interval=None):
+        self.job_id = job_id
+        self.min_interval = _setting("JOBS_PROGRESS_INTERVAL_SECONDS", 1.0) if min_interval is None else min_interval
+        self._last = 0.0
+
+    def progress(self, current, total=None, message="", force=False):
+        now = time.monotonic()
+        if not force and now - self._last < self.min_interval:
+            return
+        self._last = now
+        values = {"progress_current": current, "progress_message": (message or "")[:255]}
+        if total is not None:
+            values["progress_total"] = total
+        Job.objects.filter(pk=self.job_id).update(**values)
@@ -0,0 +1,110 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from jobs import queue
+from jobs.models import Job
+from jobs.worker import Worker
+
+
+@queue.task
+def add(ctx, a, b):
+    ctx.progress(1, 1, "done", force=True)
+    return {"sum": a + b}
+
+
+@queue.task
+def explode(ctx):
+    raise RuntimeError("boom")
+
+
+def not_a_task(ctx):
+    return None
+
+
+@pytest.mark.django_db
+def test_enqueue_only_accepts_tasks():
+    with pytest.raises(ValueError):
+        queue.enqueue(not_a_task)
+    with pytest.raises(ValueError):
+        queue.enqueue("jobs.test_jobs.missing")
+    job = queue.enqueue(add, {"a": 1, "b": 2})
+    assert job.task == "jobs.test_jobs.add" and job.status == Job.STATUS_QUEUED
+
+
+@pytest.mark.django_db
+def test_lease_claims_each_job_once_in_priority_order():
+    low = queue.enqueue(add, {"a": 1, "b": 1})
+    high = queue.enqueue(add, {"a": 2, "b": 2}, priority=10)
+    later = queue.enqueue(add, {"a": 3, "b": 3}, run_after=timezone.now() + timedelta(hours=1))
+
+    first = queue.lease("w1", 1)
+    second = queue.lease("w2", 5)
+    assert [j.pk for j in first] == [high.pk]
+    assert [j.pk for j in second] == [low.pk]
+    assert queue.lease("w3", 5) == []
+    assert first[0].status == Job.STATUS_RUNNING and first[0].attempts == 1
+    assert first[0].locked_by.startswith("w1/")
+    assert Job.objects.get(pk=later.pk).status == Job.STATUS_QUEUED
+
+
+@pytest.mark.django_db
+def test_inline_worker_runs_job_and_records_result():
+    job = queue.enqueue(add, {"a": 2, "b": 3})
+    assert Worker(processes=0).run(burst=True) == 1
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_SUCCEEDED
+    assert job.result == {"sum": 5}
+    assert (job.progress_current, job.progress_total, job.progress_message) == (1, 1, "done")
+    assert job.finished_at and not job.locked_by
+
+
+@pytest.mark.django_db
+def test_failed_job_is_retried_with_backoff_then_fails(settings):
+    settings.JOBS_RETRY_BACKOFF_SECONDS = 0
+    job = queue.enqueue(explode, max_attempts=2)
+    Worker(processes=0).run(burst=True)
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_FAILED
+    assert job.attempts == 2
+    assert "RuntimeError: boom" in job.error
+
+    assert queue.retry(job)
+    job.refresh_from_db()
+    assert (job.status, job.attempts) == (Job.STATUS_QUEUED, 0)
+
+
+@pytest.mark.django_db
+def test_expired_lease_is_requeued():
+    job = queue.enqueue(add, {"a": 1, "b": 1}, max_attempts=2)
+    (lost,) = queue.lease("dead-worker", 1)
+    Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+    assert queue.requeue_expired() == 1
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_QUEUED and job.locked_by == ""
+    # a late completion from the lost worker does not override the new state
+    assert queue.complete(lost, True, {"sum": 2}).status == Job.STATUS_QUEUED
+
+    # nor the lease of the worker that got the job next
+    (current,) = queue.lease("w2", 1)
+    assert queue.extend_lease([lost]) == 0 and queue.extend_lease([current]) == 1
+    assert queue.complete(lost, False, "late failure").status == Job.STATUS_RUNNING
+    assert queue.complete(current, True, {"sum": 2}).status == Job.STATUS_SUCCEEDED
+
+
+@pytest.mark.django_db
+def test_staff_job_pages(client, django_user_model):
+    job = queue.enqueue(add, {"a": 1, "b": 1})
+    user = django_user_model.objects.create_user("op", password="x")
+    client.force_login(user)
+    assert client.get("/jobs/").status_code == 302
+
+    user.is_staff = True
+    user.save()
+    resp = client.get("/jobs/?status=queued")
+    assert resp.status_code == 200 and b"jobs.test_jobs.add" in resp.content
+    assert client.get(f"/jobs/{job.pk}/").status_code == 200
+    client.post(f"/jobs/{job.pk}/cancel/")
+    job.refresh_from_db()
+    assert job.status == Job.STATUS_CANCELLED
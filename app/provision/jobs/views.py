@@ -0,0 +1,55 @@
+from django.contrib import messages
+from django.contrib.auth.decorators import user_passes_test
+from django.core.paginator import Paginator
+from django.db.models import Count
+from django.shortcuts import get_object_or_404, redirect, render
+from django.views.decorators.http import require_http_methods
+
+from . import queue
+from .models import Job
+
+staff_required = user_passes_test(lambda u: u.is_active and u.is_staff)
+
+
+@staff_required
+def job_list(request):
+    """Lista de jobs (mais recentes primeiro) com filtro por status e totais por status."""
+    status = (request.GET.get("status") or "").strip()
+    qs = Job.objects.all()
+    if status:
+        qs = qs.filter(status=status)
+    page_obj = Paginator(qs.defer("kwargs", "result", "error"), 50).get_page(request.GET.get("page"))
+    counts = dict(Job.objects.values_list("status").annotate(n=Count("id")).order_by())
+    return render(request, "jobs/job_list.html", {
+        "page_obj": page_obj,
+        "status": status,
+        "statuses": [(value, label, counts.get(value, 0)) for value, label in Job.STATUS_CHOICES],
+    })
+
+
+@staff_required
+def job_detail(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    return render(request, "jobs/job_detail.html", {"job": job})
+
+
+@require_http_methods(["POST"])
+@staff_required
+def job_cancel(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    if queue.cancel(job):
+        messages.success(request, f"Job #{job.pk} cancelado.")
+    else:
+        messages.warning(request, "Só jobs na fila podem ser cancelados.")
+    return redirect("jobs:job_detail", pk=job.pk)
+
+
+@require_http_methods(["POST"])
+@staff_required
+def job_retry(request, pk):
+    job = get_object_or_404(Job, pk=pk)
+    if queue.retry(job):
+        messages.success(request, f"Job #{job.pk} voltou para a fila.")
+    else:
+        messages.warning(request, "Só jobs com falha ou cancelados podem ser repetidos.")
+    return redirect("jobs:job_detail", pk=job.pk)
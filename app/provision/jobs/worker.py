@@ -0,0 +1,139 @@
+"""
+Job worker used by `manage.py runjobs`.
+
+The parent process leases jobs (jobs.queue.lease) for free pool slots, runs each
+one in a process of a ProcessPoolExecutor (settings.JOBS_PROCESSES processes,
+'spawn' start method by default so children never inherit open DB/Mongo sockets),
+records the outcome (jobs.queue.complete) and extends the leases of the jobs still
+running. Children report progress directly on the Job row (JobContext).
+
+processes=0 runs jobs inline in the worker process (debugging, tests).
+
+SIGTERM/SIGINT stop leasing; jobs already running are allowed to finish.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import connections
+
+from jobs import queue
+from jobs.child import execute, init
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    def __init__(self, processes=None, poll_interval=None, worker_id=None, start_method=None):
+        self.processes = getattr(settings, "JOBS_PROCESSES", 2) if processes is None else processes
+        self.poll_interval = poll_interval or getattr(settings, "JOBS_POLL_SECONDS", 2.0)
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.start_method = start_method or getattr(settings, "JOBS_START_METHOD", "spawn")
+        self.stopping = False
+        self.processed = 0
+
+    def stop(self, *args):
+        if not self.stopping:
+            logger.info("Worker %s stopping: waiting for running jobs", self.worker_id)
+        self.stopping = True
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def _finish(self, leased, ok, payload):
+        job = queue.complete(leased, ok, payload)
+        self.processed += 1
+        if ok:
+            logger.info("Job %s succeeded", job)
+        else:
+            logger.warning("Job %s attempt %s/%s failed:\n%s", job, job.attempts, job.max_attempts, payload)
+
+    def _done(self, max_jobs):
+        return self.stopping or (max_jobs is not None and self.processed >= max_jobs)
+
+    def run(self, burst=False, max_jobs=None):
+        """
+        Process jobs until stopped. burst=True returns once no job is due (cron /
+        Cloud Run jobs); max_jobs stops after that many attempts.
+        """
+        logger.info("Worker %s started (%s processes)", self.worker_id, self.processes or "inline")
+        if self.processes <= 0:
+            self._run_inline(burst, max_jobs)
+        else:
+            self._run_pool(burst, max_jobs)
+        logger.info("Worker %s finished: %s attempts", self.worker_id, self.processed)
+        return self.processed
+
+    def _run_inline(self, burst, max_jobs):
+        while not self._done(max_jobs):
+            queue.requeue_expired()
+            jobs = queue.lease(self.worker_id, 1)
+            if not jobs:
+                if burst:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+            self._finish(jobs[0], *execute(jobs[0].pk))
+
+    def _new_pool(self):
+        # children get their own DB connections; do not hand them the parent's sockets
+        connections.close_all()
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context(self.start_method),
+            initializer=init,
+        )
+
+    def _run_pool(self, burst, max_jobs):
+        pool = self._new_pool()
+        running = {}  # future -> leased job (its lease token is in locked_by)
+        last_extend = time.monotonic()
+        lease_seconds = getattr(settings, "JOBS_LEASE_SECONDS", 300)
+        try:
+            while True:
+                if not self._done(max_jobs):
+                    queue.requeue_expired()
+                    free = self.processes - len(running)
+                    if max_jobs is not None:
+                        free = min(free, max_jobs - self.processed - len(running))
+                    for job in queue.lease(self.worker_id, free, lease_seconds):
+                        running[pool.submit(execute, job.pk)] = job
+                if not running:
+                    if self._done(max_jobs) or burst:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+
+                done, _ = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        ok, payload = future.result()
+                    except BrokenProcessPool as exc:
+                        # a child died (OOM killer, segfault): the whole pool is unusable
+                        broken = True
+                        ok, payload = False, f"Worker process died: {exc!r}"
+                    except Exception:
+                        ok, payload = False, traceback.format_exc()
+                    self._finish(job, ok, payload)
+                if broken:
+                    for job in running.values():
+                        self._finish(job, False, "Worker process pool broken")
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = self._new_pool()
+
+                if running and time.monotonic() - last_extend > lease_seconds / 3:
+                    queue.extend_lease(running.values(), lease_seconds)
+                    last_extend = time.monotonic()
+        finally:
+            pool.shutdown(wait=True)
@@ -51,6 +51,7 @@ INSTALLED_APPS = [
     # Local apps
     "core",
     "api",
+    "jobs",
 ]
 
 SITE_ID = 1
@@ -92,6 +93,15 @@ WSGI_APPLICATION = "provision.wsgi.application"
 # =====================================================================
 
 # --- MySQL (Cloud SQL) ---
+# Timeouts (s) do PyMySQL (instalado como MySQLdb em provision/__init__.py; connect_timeout,
+# read_timeout e write_timeout são argumentos do pymysql.connect): um banco travado não segura
+# o worker indefinidamente
+MYSQL_TIMEOUTS = {
+    "connect_timeout": int(os.getenv("MYSQL_CONNECT_TIMEOUT", 5)),
+    "read_timeout": int(os.getenv("MYSQL_READ_TIMEOUT", 10)),
+    "write_timeout": int(os.getenv("MYSQL_WRITE_TIMEOUT", 10)),
+}
+
 if IS_CLOUD_RUN_PRODUCTION:
     # Perfil de Produção: Conexão via Unix Socket (Recomendado para Cloud Run)
     CLOUD_SQL_CONNECTION_NAME = os.getenv("CLOUD_SQL_INSTANCE_CONNECTION_NAME")
@@ -107,6 +117,7 @@ if IS_CLOUD_RUN_PRODUCTION:
                 "init_command": "SET sql_mode='STRICT_TRANS_TABLES'",
                 # O Cloud Run monta o socket neste caminho
                 "unix_socket": f"/cloudsql/{CLOUD_SQL_CONNECTION_NAME}",
+                **MYSQL_TIMEOUTS,
             }
         }
     }
@@ -125,6 +136,7 @@ else:
             "PORT": os.getenv("MYSQL_PORT", "3306"),
             "OPTIONS": {
                 "init_command": "SET sql_mode='STRICT_TRANS_TABLES'",
+                **(MYSQL_TIMEOUTS if os.getenv("DJANGO_DB_ENGINE", "django.db.backends.mysql").endswith("mysql") else {}),
             },
         }
     }
@@ -156,6 +168,166 @@ else:
         "PASSWORD": os.getenv("MONGODB_PASSWORD", ""),
     }
 
+# Timeouts do driver (ms): sem eles o pymongo espera 30s por um servidor e não limita leituras
+MONGODB.update({
+    "SERVER_SELECTION_TIMEOUT_MS": int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+    "CONNECT_TIMEOUT_MS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", 3000)),
+    "SOCKET_TIMEOUT_MS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", 10000)),
+})
+
+# --- Armazenamento de templates (collection device_templates) ---
+# Corpos a partir deste tamanho (bytes) são gravados comprimidos com zlib; -1 desativa a compressão
+TEMPLATE_COMPRESS_MIN_BYTES = int(os.getenv("TEMPLATE_COMPRESS_MIN_BYTES", 1024))
+# Corpos a partir deste tamanho vão para o GridFS (bucket device_templates_fs) em vez do documento
+TEMPLATE_GRIDFS_MIN_BYTES = int(os.getenv("TEMPLATE_GRIDFS_MIN_BYTES", 1024 * 1024))
+# Tamanho dos blocos lidos do upload (validação XML incremental + sha256)
+TEMPLATE_UPLOAD_CHUNK_BYTES = int(os.getenv("TEMPLATE_UPLOAD_CHUNK_BYTES", 64 * 1024))
+# Limite da prévia exibida na página de detalhe para templates no GridFS
+TEMPLATE_PREVIEW_MAX_BYTES = int(os.getenv("TEMPLATE_PREVIEW_MAX_BYTES", 256 * 1024))
+# Versões (imutáveis, chave = sha256) mantidas no histórico de cada template para rollback
+TEMPLATE_HISTORY_LIMIT = int(os.getenv("TEMPLATE_HISTORY_LIMIT", 20))
+
+# --- Cache (api.cache: L1 em memória por processo + L2 compartilhado) ---
+# L2 = cache Django 'default': Redis (CACHE_REDIS_URL, requer o pacote redis) ou Memcached
+# (CACHE_MEMCACHED_LOCATION, requer pymemcache) para compartilhar entre workers/instâncias.
+# Sem eles: cache em arquivo (CACHE_FILE_DIR) ou em memória local (desenvolvimento/testes).
+if os.getenv("CACHE_REDIS_URL"):
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": os.getenv("CACHE_REDIS_URL")}}
+elif os.getenv("CACHE_MEMCACHED_LOCATION"):
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache", "LOCATION": os.getenv("CACHE_MEMCACHED_LOCATION")}}
+elif os.getenv("CACHE_FILE_DIR"):
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": os.getenv("CACHE_FILE_DIR")}}
+else:
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "provision"}}
+
+# TTLs (segundos) por namespace; l1_ttl limita por quanto tempo um worker serve um valor
+# já trocado em outro processo. ttl None = sem expiração (versões de template são imutáveis).
+PROVISION_CACHE = {
+    "L2_ALIAS": "default",
+    "KEY_PREFIX": "prov",
+    "L1_MAX_BYTES": int(os.getenv("PROVISION_CACHE_L1_MAX_BYTES", 32 * 1024 * 1024)),
+    "L1_MAX_ENTRIES": int(os.getenv("PROVISION_CACHE_L1_MAX_ENTRIES", 10000)),
+    # lease no L2 para misses simultâneos em processos diferentes: só um carrega, os
+    # outros esperam o resultado no L2 por até LEASE_SECONDS (0 = desligado; útil só com
+    # memcached/redis). Dentro do processo os misses já são sempre agrupados.
+    "LEASE_SECONDS": float(os.getenv("PROVISION_CACHE_LEASE_SECONDS", 0)),
+    "NAMESPACES": {
+        "device": {"ttl": int(os.getenv("PROVISION_CACHE_DEVICE_TTL", 300)), "l1_ttl": 30},
+        "profile": {"ttl": int(os.getenv("PROVISION_CACHE_PROFILE_TTL", 600)), "l1_ttl": 30},
+        "template": {"ttl": int(os.getenv("PROVISION_CACHE_TEMPLATE_TTL", 300)), "l1_ttl": 30},
+        "template_version": {"ttl": None},
+        # templates Django já compilados: não serializáveis, ficam só no L1
+        "compiled": {"ttl": None, "l2": False},
+        "rendered": {"ttl": int(os.getenv("PROVISION_CACHE_RENDERED_TTL", 600)), "l1_ttl": 60},
+        # tokens OAuth2 validados (api.oauth_validators); fora do L1 para a revogação valer em todos os workers
+        "oauth_token": {"ttl": int(os.getenv("PROVISION_CACHE_OAUTH_TOKEN_TTL", 300)), "l1": False},
+        # consultas do painel de operação (api.analytics)
+        "analytics": {"ttl": int(os.getenv("PROVISION_CACHE_ANALYTICS_TTL", 60)), "l1_ttl": 30},
+        # última configuração boa por device (api.last_good), servida com MySQL/Mongo fora do ar
+        "last_good": {"ttl": int(os.getenv("PROVISION_CACHE_LAST_GOOD_TTL", 7 * 24 * 3600)), "l1_ttl": 60},
+    },
+}
+
+# Barramento de invalidação (api.invalidation): cada worker remove do seu cache local
+# (L1) devices, profiles e templates alterados em outro processo em até POLL_SECONDS.
+# Transporte: "db" (tabela core.CacheInvalidation), "mongo" (capped collection com
+# cursor tailable), "local" (só o próprio processo) ou "" (desligado).
+PROVISION_INVALIDATION_TRANSPORT = os.getenv("PROVISION_INVALIDATION_TRANSPORT", "db")
+PROVISION_INVALIDATION_POLL_SECONDS = float(os.getenv("PROVISION_INVALIDATION_POLL_SECONDS", 1))
+PROVISION_INVALIDATION_RETENTION_SECONDS = int(os.getenv("PROVISION_INVALIDATION_RETENTION_SECONDS", 3600))
+PROVISION_INVALIDATION_MONGO_BYTES = int(os.getenv("PROVISION_INVALIDATION_MONGO_BYTES", 1024 * 1024))
+
+# Arena de templates (api.template_arena): catálogo de templates num arquivo mapeado
+# (mmap) por todos os workers do container, em vez de uma cópia por worker. DIR vazio =
+# /dev/shm/provision-templates; CHECK_SECONDS = intervalo para notar uma nova geração.
+PROVISION_TEMPLATE_ARENA = os.getenv("PROVISION_TEMPLATE_ARENA", "1") == "1"
+PROVISION_TEMPLATE_ARENA_DIR = os.getenv("PROVISION_TEMPLATE_ARENA_DIR", "")
+PROVISION_TEMPLATE_ARENA_CHECK_SECONDS = float(os.getenv("PROVISION_TEMPLATE_ARENA_CHECK_SECONDS", 1))
+
+# Última configuração boa (api.last_good): com falha de MySQL/Mongo o device recebe a
+# última resposta boa (cabeçalho X-Provision-Stale) em vez de 403. Com os backends
+# degradados (erro ou resposta acima de SLOW_SECONDS nos últimos DEGRADED_SECONDS), espera
+# no máximo WAIT_SECONDS pela resposta nova; ela termina em segundo plano (REFRESH_THREADS).
+PROVISION_LAST_GOOD = os.getenv("PROVISION_LAST_GOOD", "1") == "1"
+PROVISION_LAST_GOOD_WAIT_SECONDS = float(os.getenv("PROVISION_LAST_GOOD_WAIT_SECONDS", 1))
+PROVISION_LAST_GOOD_SLOW_SECONDS = float(os.getenv("PROVISION_LAST_GOOD_SLOW_SECONDS", 2))
+PROVISION_LAST_GOOD_DEGRADED_SECONDS = float(os.getenv("PROVISION_LAST_GOOD_DEGRADED_SECONDS", 30))
+PROVISION_LAST_GOOD_REFRESH_THREADS = int(os.getenv("PROVISION_LAST_GOOD_REFRESH_THREADS", 4))
+
+# Circuit breakers e orçamento de latência (api.breaker). Cada dependência ("mysql",
+# "mongo") abre o circuito com pelo menos min_calls chamadas em window_seconds e taxa de
+# erro >= error_rate ou de chamadas lentas (> slow_ms) >= slow_rate; aberto, falha na
+# hora por open_seconds e depois testa uma chamada por vez. timeout (s) limita cada
+# operação do Mongo. REQUEST_BUDGET_SECONDS = tempo total de backend por download (0 = sem limite).
+PROVISION_REQUEST_BUDGET_SECONDS = float(os.getenv("PROVISION_REQUEST_BUDGET_SECONDS", 3))
+PROVISION_BREAKERS = {
+    "mysql": {
+        "min_calls": int(os.getenv("PROVISION_BREAKER_MIN_CALLS", 20)),
+        "slow_ms": int(os.getenv("PROVISION_BREAKER_MYSQL_SLOW_MS", 500)),
+        "open_seconds": float(os.getenv("PROVISION_BREAKER_OPEN_SECONDS", 5)),
+    },
+    "mongo": {
+        "min_calls": int(os.getenv("PROVISION_BREAKER_MIN_CALLS", 20)),
+        "slow_ms": int(os.getenv("PROVISION_BREAKER_MONGO_SLOW_MS", 1000)),
+        "open_seconds": float(os.getenv("PROVISION_BREAKER_OPEN_SECONDS", 5)),
+        "timeout": float(os.getenv("PROVISION_BREAKER_MONGO_TIMEOUT", 2)),
+    },
+}
+
+# Orçamento de renderização (api.sandbox): passos (consultas ao contexto e iterações de
+# laço), segundos de CPU e caracteres de saída por renderização; POOL > 0 renderiza em
+# processos separados (MEMORY_MB limita a memória de cada um). No import, templates acima
+# de MAX_BYTES, MAX_NODES nós ou com {% for %} aninhado além de MAX_LOOP_DEPTH são recusados.
+PROVISION_RENDER_MAX_STEPS = int(os.getenv("PROVISION_RENDER_MAX_STEPS", 100000))
+PROVISION_RENDER_CPU_SECONDS = float(os.getenv("PROVISION_RENDER_CPU_SECONDS", 0.5))
+PROVISION_RENDER_MAX_OUTPUT_CHARS = int(os.getenv("PROVISION_RENDER_MAX_OUTPUT_CHARS", 4 * 1024 * 1024))
+PROVISION_RENDER_POOL = int(os.getenv("PROVISION_RENDER_POOL", 0))
+PROVISION_RENDER_POOL_MEMORY_MB = int(os.getenv("PROVISION_RENDER_POOL_MEMORY_MB", 0))
+PROVISION_TEMPLATE_MAX_BYTES = int(os.getenv("PROVISION_TEMPLATE_MAX_BYTES", 8 * 1024 * 1024))
+PROVISION_TEMPLATE_MAX_NODES = int(os.getenv("PROVISION_TEMPLATE_MAX_NODES", 20000))
+PROVISION_TEMPLATE_MAX_LOOP_DEPTH = int(os.getenv("PROVISION_TEMPLATE_MAX_LOOP_DEPTH", 3))
+
+# Aquecimento do cache (api.warmup / gunicorn.conf.py). Com PROVISION_WARMUP=1 o
+# /api/ready/ responde 503 até o aquecimento terminar; WARMUP_DEVICES = devices mais
+# recentes carregados no aquecimento (0 = nenhum).
+PROVISION_WARMUP = os.getenv("PROVISION_WARMUP", "0") == "1"
+PROVISION_WARMUP_DEVICES = int(os.getenv("PROVISION_WARMUP_DEVICES", 0))
+
+# Re-renderização em segundo plano após alterar profile/template (api.propagation):
+# threads de renderização, devices por bloco e máximo de erros guardados por execução.
+PROVISION_PROPAGATION = os.getenv("PROVISION_PROPAGATION", "1") == "1"
+PROVISION_PROPAGATION_WORKERS = int(os.getenv("PROVISION_PROPAGATION_WORKERS", 4))
+PROVISION_PROPAGATION_CHUNK_SIZE = int(os.getenv("PROVISION_PROPAGATION_CHUNK_SIZE", 500))
+PROVISION_PROPAGATION_MAX_ERRORS = int(os.getenv("PROVISION_PROPAGATION_MAX_ERRORS", 500))
+# Renderização em lote (api.batch_render / `manage.py render_configs`): processos e devices por bloco
+PROVISION_BATCH_PROCESSES = int(os.getenv("PROVISION_BATCH_PROCESSES", os.cpu_count() or 1))
+PROVISION_BATCH_CHUNK_SIZE = int(os.getenv("PROVISION_BATCH_CHUNK_SIZE", 1000))
+# "thread": roda no processo que salvou (gunicorn); "jobs": enfileira para o `manage.py runjobs`
+PROVISION_PROPAGATION_RUNNER = os.getenv("PROVISION_PROPAGATION_RUNNER", "thread")
+
+# Template fixado no profile (api.template_pointer): template_ref resolvido ao salvar o
+# profile e ao importar/remover templates, lido pelo download sem consultar device_templates.
+PROVISION_TEMPLATE_PINNING = os.getenv("PROVISION_TEMPLATE_PINNING", "1") == "1"
+
+# Painel de operação (api.analytics): downloads contados em memória e gravados a cada
+# FLUSH_SECONDS nas tabelas agregadas; janela padrão do painel, dias sem contato para
+# considerar um device parado e retenção das contagens por minuto.
+PROVISION_ANALYTICS = os.getenv("PROVISION_ANALYTICS", "1") == "1"
+PROVISION_ANALYTICS_FLUSH_SECONDS = float(os.getenv("PROVISION_ANALYTICS_FLUSH_SECONDS", 10))
+PROVISION_ANALYTICS_WINDOW_HOURS = int(os.getenv("PROVISION_ANALYTICS_WINDOW_HOURS", 24))
+PROVISION_ANALYTICS_STALE_DAYS = int(os.getenv("PROVISION_ANALYTICS_STALE_DAYS", 7))
+PROVISION_ANALYTICS_RETENTION_DAYS = int(os.getenv("PROVISION_ANALYTICS_RETENTION_DAYS", 30))
+
+# Jobs em segundo plano (app jobs, `manage.py runjobs`): processos do pool, intervalo de
+# polling da fila, duração da reserva (renovada enquanto o job roda), tentativas e
+# espera base entre tentativas (dobra a cada falha).
+JOBS_PROCESSES = int(os.getenv("JOBS_PROCESSES", os.cpu_count() or 2))
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", 2))
+JOBS_LEASE_SECONDS = int(os.getenv("JOBS_LEASE_SECONDS", 300))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", 3))
+JOBS_RETRY_BACKOFF_SECONDS = int(os.getenv("JOBS_RETRY_BACKOFF_SECONDS", 30))
+JOBS_START_METHOD = os.getenv("JOBS_START_METHOD", "spawn")
+
 
 # --- Arquivos Estáticos e de Mídia (GCS) ---
 if IS_CLOUD_RUN_PRODUCTION and os.getenv("GS_BUCKET_NAME"):
@@ -263,6 +435,8 @@ SPECTACULAR_SETTINGS = {
 }
 
 OAUTH2_PROVIDER = {
+    # cacheia a validação de access tokens (api.oauth_validators)
+    "OAUTH2_VALIDATOR_CLASS": "api.oauth_validators.CachedOAuth2Validator",
     "ACCESS_TOKEN_EXPIRE_SECONDS": int(os.getenv("OAUTH_ACCESS_TOKEN_EXPIRE", 3600)),
     "REFRESH_TOKEN_EXPIRE_SECONDS": int(os.getenv("OAUTH_REFRESH_TOKEN_EXPIRE", 60 * 60 * 24 * 30)),
     "ROTATE_REFRESH_TOKEN": True,
@@ -276,6 +450,10 @@ OAUTH2_PROVIDER = {
 
 PROVISION_API_KEY = os.getenv("PROVISION_API_KEY", "")
 
+# API REST de devices/profiles (api.viewsets): itens por página (cursor) e limite do /bulk/
+PROVISION_API_PAGE_SIZE = int(os.getenv("PROVISION_API_PAGE_SIZE", 100))
+PROVISION_API_BULK_MAX = int(os.getenv("PROVISION_API_BULK_MAX", 1000))
+
 
 # --- Configurações de Segurança e Outros ---
 if not DEBUG and IS_CLOUD_RUN_PRODUCTION:
@@ -302,18 +480,38 @@ else:
 
 # --- Logging e Email ---
 LOG_LEVEL = os.getenv("DJANGO_LOG_LEVEL", "INFO")
+# Com LOG_ASYNC os handlers só enfileiram (api.request_log.QueueStreamHandler) e uma
+# thread escreve no stream: a requisição nunca espera pelo stdout/stderr (fila cheia =
+# registro descartado).
+LOG_ASYNC = os.getenv("DJANGO_LOG_ASYNC", "1") == "1"
+_LOG_HANDLER = "api.request_log.QueueStreamHandler" if LOG_ASYNC else "logging.StreamHandler"
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
     "formatters": {
         "standard": {"format": "%(asctime)s [%(levelname)s] %(name)s: %(message)s"},
+        # linhas JSON do log por requisição (logging estruturado do Cloud Run)
+        "json": {"format": "%(message)s"},
     },
     "handlers": {
-        "console": {"class": "logging.StreamHandler", "formatter": "standard"},
+        "console": {"class": _LOG_HANDLER, "formatter": "standard"},
+        "requests": {"class": _LOG_HANDLER, "formatter": "json", "stream": "ext://sys.stdout"},
+    },
+    "loggers": {
+        "provision.requests": {"handlers": ["requests"], "level": "INFO", "propagate": False},
     },
     "root": {"handlers": ["console"], "level": LOG_LEVEL},
 }
 
+# Log por requisição de download (api.request_log): fração amostrada (0..1); falhas,
+# respostas desatualizadas e requisições acima de SLOW_MS são sempre registradas.
+PROVISION_REQUEST_LOG_SAMPLE = float(os.getenv("PROVISION_REQUEST_LOG_SAMPLE", 0.01))
+PROVISION_REQUEST_LOG_SLOW_MS = float(os.getenv("PROVISION_REQUEST_LOG_SLOW_MS", 500))
+
+# Arquivos comuns do modelo/profile (templates com 'common_file', api.views._serve_common):
+# max-age do Cache-Control público; mudanças chegam pela revalidação com ETag.
+PROVISION_COMMON_MAX_AGE = int(os.getenv("PROVISION_COMMON_MAX_AGE", 86400))
+
 EMAIL_BACKEND = os.getenv("DJANGO_EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend")
 EMAIL_HOST = os.getenv("EMAIL_HOST", "")
 EMAIL_PORT = int(os.getenv("EMAIL_PORT") or 25)
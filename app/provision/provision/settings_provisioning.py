@@ -0,0 +1,41 @@
+"""
+Papel de provisionamento: settings enxutos para os workers que atendem os telefones
+(/api/download-xml/). Herda tudo de provision.settings (bancos, Mongo, cache, OAuth2)
+e remove o que só a interface de gestão usa: admin, allauth, sessions, messages,
+staticfiles, storages, DRF/drf_spectacular e os middlewares de sessão/CSRF/auth/mensagens.
+
+Uso (serviço/deploy separado só para a API de provisionamento):
+  DJANGO_SETTINGS_MODULE=provision.settings_provisioning \
+    gunicorn -c gunicorn.conf.py provision.wsgi_provisioning:application
+
+Migrations, collectstatic e a interface de gestão continuam no papel completo
+(provision.settings). Para comparar o tempo de importação dos dois papéis:
+  python manage.py measure_startup
+"""
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "django.contrib.contenttypes",
+    "django.contrib.auth",  # usuários dos tokens OAuth2
+    "oauth2_provider",  # Bearer tokens (whoami, cache/stats)
+    "core",
+    "api",
+]
+
+MIDDLEWARE = [
+    "django.middleware.security.SecurityMiddleware",
+    "django.middleware.common.CommonMiddleware",
+]
+
+ROOT_URLCONF = "provision.urls_provisioning"
+WSGI_APPLICATION = "provision.wsgi_provisioning.application"
+
+# só os templates de configuração (strings vindas do Mongo) são renderizados aqui
+TEMPLATES = [
+    {
+        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "DIRS": [],
+        "APP_DIRS": False,
+        "OPTIONS": {"context_processors": []},
+    },
+]
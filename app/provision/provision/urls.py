@@ -24,6 +24,9 @@ urlpatterns = [
     path('accounts/login/', auth_views.LoginView.as_view(template_name='core/login.html'), name='login'),
     path('accounts/logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
 
+    # Background jobs (staff): list, progress, cancel/retry
+    path('jobs/', include('jobs.urls', namespace='jobs')),
+
     # Management interface for devices (core app) — namespace required for reverse lookups
     path('', include('core.urls', namespace='core')),
 ]
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""URLconf do papel de provisionamento (provision.settings_provisioning): somente api.urls."""
+from django.urls import include, path
+
+urlpatterns = [
+    path('api/', include('api.urls')),
+]
@@ -0,0 +1,29 @@
+"""
+WSGI config for the provisioning-only role (provision.settings_provisioning).
+
+Logs how long loading Django and the URLconf took, so cold starts of the lean
+workers can be compared with the full role (see also `manage.py measure_startup`).
+"""
+
+import logging
+import os
+import time
+
+_started = time.perf_counter()
+
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'provision.settings_provisioning')
+
+application = get_wsgi_application()
+
+# resolve the URLconf now (it would otherwise be imported by the first request)
+from django.urls import get_resolver  # noqa: E402
+
+get_resolver().url_patterns
+
+logging.getLogger(__name__).info(
+    "Provisioning WSGI application loaded in %.0f ms (settings=%s)",
+    (time.perf_counter() - _started) * 1000,
+    os.environ['DJANGO_SETTINGS_MODULE'],
+)
@@ -51,16 +51,22 @@ if [ -z "$DJANGO_SETTINGS_MODULE" ]; then
   export DJANGO_SETTINGS_MODULE=provision.settings_docker
 fi
 
-# Run migrations, collectstatic and create superuser if env provided
-echo "[entrypoint] rodando collectstatic"
-python manage.py collectstatic --noinput
+# Papel de provisionamento (settings enxutos, sem staticfiles/admin): migrations,
+# collectstatic e superuser ficam a cargo do serviço completo
+if [ "$DJANGO_SETTINGS_MODULE" = "provision.settings_provisioning" ]; then
+  echo "[entrypoint] papel de provisionamento: pulando collectstatic/migrate"
+else
+  # Run migrations, collectstatic and create superuser if env provided
+  echo "[entrypoint] rodando collectstatic"
+  python manage.py collectstatic --noinput
 
-echo "[entrypoint] aplicando migrations"
-python manage.py migrate --noinput
+  echo "[entrypoint] aplicando migrations"
+  python manage.py migrate --noinput
 
-# Create superuser if requested (script checks env vars)
-echo "Creating superuser (if DJANGO_SUPERUSER_USERNAME/DJANGO_SUPERUSER_PASSWORD provided)..."
-python /app/scripts/create_superuser.py || true
+  # Create superuser if requested (script checks env vars)
+  echo "Creating superuser (if DJANGO_SUPERUSER_USERNAME/DJANGO_SUPERUSER_PASSWORD provided)..."
+  python /app/scripts/create_superuser.py || true
+fi
 
 # Finally exec the given CMD (gunicorn)
 echo "Starting server..."